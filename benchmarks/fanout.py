@@ -0,0 +1,101 @@
+"""
+Microbenchmark: per-recipient CPU cost of a chat broadcast.
+
+Compares the old receivers, which re-encoded the event with json.dumps on
+every socket, against the current encode-once receivers that write the
+sender's pre-encoded text. Runs real ClassroomConsumer receiver methods with
+a no-op transport, so only server-side work is measured.
+
+    python benchmarks/fanout.py [--recipients 500] [--repeat 20]
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'liveclass_project.settings')
+
+import django  # noqa: E402
+
+django.setup()
+
+from classroom import encoding  # noqa: E402
+from classroom.consumers import ClassroomConsumer  # noqa: E402
+
+MESSAGE = "Could you go over the last slide again? " * 4
+
+
+async def discard(message):
+    pass
+
+
+def make_consumers(count):
+    consumers = []
+    for i in range(count):
+        consumer = ClassroomConsumer()
+        consumer.base_send = discard
+        consumer.username = f"student{i}"
+        consumers.append(consumer)
+    return consumers
+
+
+async def legacy_chat_message_broadcast(consumer, event):
+    # The receiver as it was before encode-once fan-out
+    await consumer.send(text_data=json.dumps({
+        'type': 'chat_message',
+        'message': event['message'],
+        'username': event['username']
+    }))
+
+
+async def run_legacy(consumers):
+    event = {'type': 'chat_message_broadcast', 'message': MESSAGE, 'username': 'teacher'}
+    for consumer in consumers:
+        await legacy_chat_message_broadcast(consumer, event)
+
+
+async def run_encode_once(consumers):
+    # Sender-side encode is included, amortized over all recipients
+    event = {
+        'type': 'chat_message_broadcast',
+        'text': encoding.dumps({'type': 'chat_message', 'message': MESSAGE, 'username': 'teacher'}),
+    }
+    for consumer in consumers:
+        await consumer.chat_message_broadcast(event)
+
+
+def measure(runner, consumers, repeat):
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(runner(consumers))  # warm up
+        started = time.process_time()
+        for _ in range(repeat):
+            loop.run_until_complete(runner(consumers))
+        elapsed = time.process_time() - started
+    finally:
+        loop.close()
+    return elapsed / (repeat * len(consumers)) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument('--recipients', type=int, default=500)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    consumers = make_consumers(args.recipients)
+    encoder = 'orjson' if encoding.orjson else 'json'
+    legacy = measure(run_legacy, consumers, args.repeat)
+    current = measure(run_encode_once, consumers, args.repeat)
+
+    print(f"chat broadcast to {args.recipients} recipients, {args.repeat} rounds ({encoder} encoder)")
+    print(f"  per-recipient encode (before): {legacy:8.2f} us/recipient")
+    print(f"  encode once (after):           {current:8.2f} us/recipient")
+    print(f"  speedup:                       {legacy / current:8.2f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,524 @@
+"""
+Load generator for the classroom WebSocket protocol.
+
+Simulates one teacher and N students speaking the real protocol against
+ClassroomConsumer: join, teacher_ready, request_stream, offer/answer
+envelopes, batched ICE candidates and chat_message. Reports join latency
+percentiles, stream setup latency, chat fan-out throughput, messages per
+second and, in-process, memory per room and per connection.
+
+In-process (in-memory channel layer and room store, no server needed):
+
+    python benchmarks/loadgen.py --students 200
+
+Against a running daphne + Redis:
+
+    python benchmarks/loadgen.py --url ws://127.0.0.1:8000 --students 200
+
+In-process runs use a freshly migrated temporary database, not db.sqlite3.
+
+Results are compared with the saved baseline for the same mode and size in
+benchmarks/baselines/ and the run exits non-zero on a regression. Baselines
+are only comparable on the machine that recorded them, so they are not
+checked in: record one with --save-baseline before changing the code.
+"""
+import argparse
+import asyncio
+import gc
+import json
+import os
+import statistics
+import sys
+import time
+import tracemalloc
+from urllib.parse import urlparse
+
+BASELINE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines')
+
+# Metric name -> True if higher is better
+METRICS = {
+    'join_p50_ms': False,
+    'join_p95_ms': False,
+    'join_p99_ms': False,
+    'stream_setup_p95_ms': False,
+    'chat_deliveries_per_sec': True,
+    'msgs_per_sec': True,
+    'bytes_per_room': False,
+    'bytes_per_connection': False,
+}
+
+IN_PROCESS_SETTINGS = {
+    'CHANNEL_LAYERS': {"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}},
+    'CLASSROOM_ROOM_STORE': {"BACKEND": "classroom.rooms.InMemoryRoomStore"},
+    'CLASSROOM_CHANNEL_LAYER_SHARDS': None,
+    'CLASSROOM_BROADCAST_BUS': None,
+    # The teacher sends its chats back to back to measure fan-out
+    'CLASSROOM_RATE_LIMITS': {'chat_message': {}},
+}
+
+# Roughly the size of a real browser SDP; the server never decodes it
+SDP = "v=0\r\no=- 4611731400430051336 2 IN IP4 127.0.0.1\r\n" + "a=x-padding:0\r\n" * 200
+CANDIDATES = [
+    {"candidate": f"candidate:{i} 1 udp 2122260223 192.168.1.{i} 5{i}000 typ host",
+     "sdpMid": "0", "sdpMLineIndex": 0}
+    for i in range(1, 4)
+]
+CHAT = "Could you go over the last slide again?"
+
+
+def use_temporary_database():
+    """Migrate a throwaway test database for in-process runs. Returns a function that drops it."""
+    from django.db import connection
+
+    old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+    return lambda: connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+class InProcessConnection:
+    """A socket to ClassroomConsumer through the ASGI test communicator."""
+
+    def __init__(self, application, room):
+        from channels.testing import WebsocketCommunicator
+
+        self.communicator = WebsocketCommunicator(application, f"/ws/classroom/{room}/")
+
+    async def open(self):
+        connected, _ = await self.communicator.connect()
+        if not connected:
+            raise ConnectionError("Consumer rejected the connection")
+
+    async def send(self, text):
+        await self.communicator.send_to(text_data=text)
+
+    async def recv(self):
+        return await self.communicator.receive_from(timeout=3600)
+
+    async def close(self):
+        await self.communicator.disconnect()
+
+
+class RemoteConnection:
+    """A real WebSocket to a running server, using autobahn (installed with daphne)."""
+
+    def __init__(self, base_url, room):
+        self.url = f"{base_url.rstrip('/')}/ws/classroom/{room}/"
+        self.protocol = None
+        self.incoming = asyncio.Queue()
+
+    async def open(self):
+        from autobahn.asyncio.websocket import WebSocketClientFactory, WebSocketClientProtocol
+
+        connection = self
+        opened = asyncio.get_running_loop().create_future()
+
+        class Protocol(WebSocketClientProtocol):
+            def onOpen(self):
+                opened.set_result(self)
+
+            def onMessage(self, payload, is_binary):
+                connection.incoming.put_nowait(payload if is_binary else payload.decode('utf8'))
+
+            def onClose(self, was_clean, code, reason):
+                if not opened.done():
+                    opened.set_exception(ConnectionError(reason or f"closed with {code}"))
+                connection.incoming.put_nowait(None)
+
+        parsed = urlparse(self.url)
+        factory = WebSocketClientFactory(self.url)
+        factory.protocol = Protocol
+        port = parsed.port or (443 if parsed.scheme == 'wss' else 80)
+        await asyncio.get_running_loop().create_connection(
+            factory, parsed.hostname, port, ssl=parsed.scheme == 'wss' or None
+        )
+        self.protocol = await opened
+
+    async def send(self, text):
+        self.protocol.sendMessage(text.encode('utf8'))
+
+    async def recv(self):
+        text = await self.incoming.get()
+        if text is None:
+            raise ConnectionError("Socket closed")
+        return text
+
+    async def close(self):
+        self.protocol.sendClose()
+
+
+class Counters:
+    def __init__(self):
+        self.frames_in = 0
+        self.frames_out = 0
+
+
+class Participant:
+    """Base simulated client: reads frames in the background and dispatches them by type."""
+
+    is_teacher = False
+
+    def __init__(self, connection, username, counters):
+        self.connection = connection
+        self.username = username
+        self.counters = counters
+        self.snapshot = asyncio.get_running_loop().create_future()
+        self._reader = None
+
+    async def start(self):
+        await self.connection.open()
+        self._reader = asyncio.get_running_loop().create_task(self._read())
+
+    async def send(self, frame):
+        self.counters.frames_out += 1
+        await self.connection.send(json.dumps(frame))
+
+    async def send_envelope(self, header, payload):
+        self.counters.frames_out += 1
+        await self.connection.send(json.dumps(header) + "\n" + json.dumps(payload))
+
+    async def join(self):
+        await self.send({
+            "type": "join",
+            "username": self.username,
+            "is_teacher": self.is_teacher,
+            "features": ["ice_candidates"],
+        })
+
+    async def _read(self):
+        while True:
+            try:
+                text = await self.connection.recv()
+            except (asyncio.CancelledError, ConnectionError):
+                return
+            await self._handle(text)
+
+    async def _handle(self, text):
+        self.counters.frames_in += 1
+        frame = json.loads(text)
+        if frame['type'] == 'roster_snapshot' and not self.snapshot.done():
+            self.snapshot.set_result(time.perf_counter())
+        await self.on_frame(frame)
+
+    async def on_frame(self, frame):
+        pass
+
+    async def close(self):
+        if self._reader:
+            self._reader.cancel()
+        await self.connection.close()
+
+
+class Teacher(Participant):
+    is_teacher = True
+
+    async def on_frame(self, frame):
+        if frame['type'] == 'student_requesting_stream':
+            student = frame['from_user']
+            trace_id = frame.get('trace_id')
+            await self.send_envelope(
+                {"type": "offer", "target_user": student, "trace_id": trace_id, "teacher_ms": 0},
+                {"type": "offer", "sdp": SDP}
+            )
+            await self.send({
+                "type": "ice_candidates",
+                "target_user": student,
+                "is_teacher_stream": True,
+                "candidates": CANDIDATES,
+                "end_of_candidates": True,
+                "trace_id": trace_id,
+            })
+
+
+class Student(Participant):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        loop = asyncio.get_running_loop()
+        self.stream_ready = loop.create_future()
+        self.chats_done = loop.create_future()
+        self.expected_chats = None
+        self.chats = 0
+        self.requested_at = None
+        self.trace_id = os.urandom(8).hex()
+        self.marks = {}
+
+    def mark(self, name):
+        self.marks.setdefault(name, round((time.perf_counter() - self.requested_at) * 1000, 3))
+
+    async def on_frame(self, frame):
+        message_type = frame['type']
+        if message_type == 'teacher_is_live' and self.requested_at is None:
+            self.requested_at = time.perf_counter()
+            await self.send({"type": "request_stream", "trace_id": self.trace_id})
+        elif message_type == 'offer':
+            self.mark('offer_received')
+            await self.send_envelope(
+                {"type": "answer", "target_user": frame['from_user'], "trace_id": self.trace_id},
+                {"type": "answer", "sdp": SDP}
+            )
+            self.mark('answer_sent')
+            await self.send({
+                "type": "ice_candidates",
+                "target_user": "teacher",
+                "is_teacher_stream": True,
+                "candidates": CANDIDATES,
+                "end_of_candidates": True,
+                "trace_id": self.trace_id,
+            })
+        elif message_type == 'ice_candidates' and frame.get('end_of_candidates'):
+            if not self.stream_ready.done():
+                # No media here: the teacher's last candidate stands in for connect and first frame
+                self.mark('connected')
+                self.mark('first_frame')
+                await self.send({"type": "stream_trace", "trace_id": self.trace_id, "teacher_ms": 0, "marks": self.marks})
+                self.stream_ready.set_result(time.perf_counter() - self.requested_at)
+        elif message_type == 'chat_message':
+            self.chats += 1
+            if self.chats == self.expected_chats and not self.chats_done.done():
+                self.chats_done.set_result(time.perf_counter())
+
+
+async def _wait(phase, awaitables, timeout):
+    try:
+        return await asyncio.wait_for(asyncio.gather(*awaitables), timeout)
+    except asyncio.TimeoutError:
+        raise RuntimeError(f"Timed out after {timeout}s waiting for {phase}") from None
+
+
+async def run_scenario(connect, students, chats=20, room="loadtest", join_concurrency=50, timeout=60):
+    """
+    Run one classroom session. ``connect(room)`` returns an unopened
+    connection. Returns a dict of results.
+    """
+    counters = Counters()
+    started = time.perf_counter()
+
+    teacher = Teacher(connect(room), "teacher", counters)
+    await teacher.start()
+    await teacher.join()
+    await _wait("teacher snapshot", [teacher.snapshot], timeout)
+    await teacher.send({"type": "teacher_ready"})
+
+    # Students join while the teacher is live, so every join also sets up a stream
+    members = []
+    join_latencies = []
+    gate = asyncio.Semaphore(join_concurrency)
+
+    async def join_one(i):
+        async with gate:
+            student = Student(connect(room), f"student{i}", counters)
+            sent = time.perf_counter()
+            await student.start()
+            await student.join()
+            members.append(student)
+            joined = await student.snapshot
+            join_latencies.append(joined - sent)
+
+    await _wait("joins", [join_one(i) for i in range(students)], timeout)
+    setup_latencies = await _wait("stream setup", [s.stream_ready for s in members], timeout)
+
+    for student in members:
+        student.expected_chats = chats
+    chat_started = time.perf_counter()
+    for i in range(chats):
+        await teacher.send({"type": "chat_message", "message": f"{CHAT} ({i})"})
+    if chats:
+        await _wait("chat fan-out", [s.chats_done for s in members], timeout)
+    chat_elapsed = time.perf_counter() - chat_started
+
+    elapsed = time.perf_counter() - started
+    for participant in [teacher, *members]:
+        await participant.close()
+
+    return {
+        'students': students,
+        'chats': chats,
+        'join_p50_ms': percentile(join_latencies, 50) * 1000,
+        'join_p95_ms': percentile(join_latencies, 95) * 1000,
+        'join_p99_ms': percentile(join_latencies, 99) * 1000,
+        'stream_setup_p95_ms': percentile(setup_latencies, 95) * 1000,
+        'chat_deliveries': sum(s.chats for s in members),
+        'chat_deliveries_per_sec': students * chats / chat_elapsed if chats else None,
+        'frames_in': counters.frames_in,
+        'frames_out': counters.frames_out,
+        'msgs_per_sec': (counters.frames_in + counters.frames_out) / elapsed,
+        'elapsed_s': elapsed,
+    }
+
+
+async def measure_memory(connect, students, room="loadtest-memory", timeout=60):
+    """
+    Server-side bytes held by one room with a teacher and ``students``
+    joined, and per student connection. Allocations made by this module
+    (the simulated clients) are left out; the in-memory channel layer and
+    the ASGI test transport are counted.
+    """
+    counters = Counters()
+    exclude = [tracemalloc.Filter(False, __file__), tracemalloc.Filter(False, tracemalloc.__file__)]
+
+    def allocated():
+        gc.collect()
+        return sum(stat.size for stat in tracemalloc.take_snapshot().filter_traces(exclude).statistics('filename'))
+
+    tracemalloc.start()
+    try:
+        before = allocated()
+        teacher = Teacher(connect(room), "teacher", counters)
+        await teacher.start()
+        await teacher.join()
+        await _wait("teacher snapshot", [teacher.snapshot], timeout)
+        with_teacher = allocated()
+
+        members = []
+        for i in range(students):
+            student = Student(connect(room), f"student{i}", counters)
+            await student.start()
+            await student.join()
+            members.append(student)
+        await _wait("joins", [s.snapshot for s in members], timeout)
+        # Let roster batches settle so their buffers are not counted
+        await asyncio.sleep(0.5)
+        full = allocated()
+    finally:
+        tracemalloc.stop()
+
+    for participant in [teacher, *members]:
+        await participant.close()
+    return {
+        'bytes_per_room': full - before,
+        'bytes_per_connection': (full - with_teacher) / students if students else None,
+    }
+
+
+def median_results(runs):
+    """Median of every numeric result across runs; single runs are too noisy to compare."""
+    merged = dict(runs[0])
+    for key, value in merged.items():
+        if isinstance(value, (int, float)):
+            merged[key] = statistics.median(run[key] for run in runs)
+    merged['runs'] = len(runs)
+    return merged
+
+
+def baseline_path(mode, students):
+    return os.path.join(BASELINE_DIR, f"{mode}-{students}.json")
+
+
+def compare(results, baseline, tolerance):
+    """Return (rows, regressions) comparing results with a saved baseline."""
+    rows, regressions = [], []
+    for name, higher_is_better in METRICS.items():
+        current, previous = results.get(name), baseline.get(name)
+        if current is None or not previous:
+            rows.append((name, current, previous, None, ""))
+            continue
+        change = (current - previous) / previous
+        worse = -change if higher_is_better else change
+        flag = "REGRESSION" if worse > tolerance else ""
+        if flag:
+            regressions.append(name)
+        rows.append((name, current, previous, change, flag))
+    return rows, regressions
+
+
+def print_results(results, rows):
+    print(f"{results['mode']}: teacher + {results['students']} students, {results['chats']} chat messages, "
+          f"median of {results['runs']} runs")
+    print(f"  {results['chat_deliveries']} chat deliveries, {results['frames_in']} frames in, "
+          f"{results['frames_out']} frames out in {results['elapsed_s']:.2f}s")
+    for name, current, previous, change, flag in rows:
+        line = f"  {name:26} {'-':>14}" if current is None else f"  {name:26} {current:14.2f}"
+        if previous is not None:
+            line += f"   baseline {previous:14.2f}"
+        if change is not None:
+            line += f"   {change:+7.1%} {flag}"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument('--students', type=int, default=100)
+    parser.add_argument('--chats', type=int, default=20)
+    parser.add_argument('--runs', type=int, default=5, help="report the median of this many runs")
+    parser.add_argument('--url', help="ws:// base URL of a running server; in-process if omitted")
+    parser.add_argument('--join-concurrency', type=int, default=50)
+    parser.add_argument('--timeout', type=float, default=60)
+    parser.add_argument('--tolerance', type=float, default=0.3,
+                        help="relative change counted as a regression (default 0.3)")
+    parser.add_argument('--save-baseline', action='store_true')
+    args = parser.parse_args()
+
+    if args.url:
+        mode = 'remote'
+
+        def connect(room):
+            return RemoteConnection(args.url, room)
+    else:
+        mode = 'inprocess'
+        sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'liveclass_project.settings')
+
+        import django
+        from django.test.utils import override_settings
+
+        django.setup()
+        override_settings(**IN_PROCESS_SETTINGS).enable()
+        drop_database = use_temporary_database()
+
+        from channels.routing import URLRouter
+        from classroom.routing import websocket_urlpatterns
+
+        application = URLRouter(websocket_urlpatterns)
+
+        def connect(room):
+            return InProcessConnection(application, room)
+
+    async def run():
+        runs = []
+        for i in range(args.runs):
+            runs.append(await run_scenario(
+                connect, args.students, args.chats,
+                room=f"loadtest-{int(time.time())}-{i}",
+                join_concurrency=args.join_concurrency, timeout=args.timeout
+            ))
+        results = median_results(runs)
+        # Memory is measured in a separate pass so tracing does not skew the timings
+        if mode == 'inprocess':
+            results.update(await measure_memory(connect, args.students, timeout=args.timeout))
+        return results
+
+    try:
+        results = {'mode': mode, **asyncio.run(run())}
+    finally:
+        if mode == 'inprocess':
+            drop_database()
+
+    path = baseline_path(mode, args.students)
+    baseline = None
+    if os.path.exists(path):
+        with open(path) as f:
+            baseline = json.load(f)
+    rows, regressions = compare(results, baseline or {}, args.tolerance)
+    print_results(results, rows)
+    if baseline is None and not args.save_baseline:
+        print(f"No baseline at {os.path.relpath(path)}; record one on this machine with --save-baseline")
+
+    if args.save_baseline:
+        os.makedirs(BASELINE_DIR, exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"Saved baseline to {os.path.relpath(path)}")
+    elif regressions:
+        print(f"Regressed beyond {args.tolerance:.0%}: {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
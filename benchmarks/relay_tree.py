@@ -0,0 +1,149 @@
+"""
+Simulator: relay tree shape and repair under student churn.
+
+Builds a RelayTree the way the teacher's consumer does, then has random
+students leave and new ones join. Reports tree depth and added hops (relays
+between the teacher and a student), and per departure or join how many
+students renegotiate, how many lose the stream until they do, and the
+server-side time spent updating the tree. Wall-clock recovery also needs
+the renegotiations; --negotiation-ms estimates it, counting a student that
+moves under another moved student as one more round and pacing moves onto
+the teacher by the admission limit.
+
+    python benchmarks/relay_tree.py [--students 500] [--fanout 4] [--churn 1000]
+"""
+import argparse
+import math
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'liveclass_project.settings')
+
+import django  # noqa: E402
+
+django.setup()
+
+from classroom.relay import RelayTree  # noqa: E402
+
+TEACHER = 'teacher'
+
+# Reported upload in kbps and the share of students reporting it; None means no estimate
+UPLOADS = ((None, 0.3), (1000, 0.2), (2500, 0.2), (5000, 0.2), (10000, 0.1))
+
+
+def random_upload(rng):
+    return rng.choices([upload for upload, _ in UPLOADS], [share for _, share in UPLOADS])[0]
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def disruption(tree, moved, args):
+    """Students cut off by ``moved`` and the estimated seconds until all have the stream again."""
+    moved_users = {username for username, _ in moved}
+    cut_off, rounds = set(), 0
+    for username in moved_users:
+        pending = [tree.nodes[username]]
+        while pending:
+            node = pending.pop()
+            cut_off.add(node.username)
+            pending.extend(node.children)
+        # A relay that moved itself has to reconnect before its moved children can
+        chain, node = 0, tree.nodes[username]
+        while node:
+            chain += node.username in moved_users
+            node = node.parent
+        rounds = max(rounds, chain)
+    onto_teacher = sum(1 for _, parent in moved if parent == TEACHER)
+    rounds += max(0, math.ceil(onto_teacher / args.admission_limit) - 1)
+    return len(cut_off), rounds * args.negotiation_ms / 1000
+
+
+def shape(tree):
+    depths = [tree.depth(username) for username in tree.nodes if username != TEACHER]
+    return {
+        'max_depth': max(depths),
+        'p95_depth': percentile(depths, 0.95),
+        'added_hops': statistics.mean(depths) - 1,
+        'teacher_children': len(tree.root.children),
+    }
+
+
+def simulate(args):
+    rng = random.Random(args.seed)
+    tree = RelayTree(TEACHER, args.fanout, args.stream_kbps)
+    next_id = 0
+    started = time.perf_counter()
+    for _ in range(args.students):
+        tree.place(f"student{next_id}", random_upload(rng))
+        next_id += 1
+    build_us = (time.perf_counter() - started) / args.students * 1e6
+    initial = shape(tree)
+
+    results = {'build_us': build_us, 'initial': initial}
+    for event in ('leave', 'join'):
+        for key in ('moves', 'interrupted', 'update_us', 'recovery_s'):
+            results[f"{event}_{key}"] = []
+
+    def record(event, moved, started):
+        results[f"{event}_update_us"].append((time.perf_counter() - started) * 1e6)
+        results[f"{event}_moves"].append(len(moved))
+        interrupted, recovery = disruption(tree, moved, args)
+        results[f"{event}_interrupted"].append(interrupted)
+        results[f"{event}_recovery_s"].append(recovery)
+
+    for _ in range(args.churn):
+        leaving = rng.choice([username for username in tree.nodes if username != TEACHER])
+        started = time.perf_counter()
+        record('leave', tree.remove(leaving), started)
+
+        started = time.perf_counter()
+        _, moved = tree.place(f"student{next_id}", random_upload(rng))
+        record('join', moved, started)
+        next_id += 1
+
+    results['final'] = shape(tree)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument('--students', type=int, default=500)
+    parser.add_argument('--fanout', type=int, default=4)
+    parser.add_argument('--churn', type=int, default=1000, help="departures, each followed by a new join")
+    parser.add_argument('--stream-kbps', type=int, default=1500)
+    parser.add_argument('--negotiation-ms', type=int, default=1000)
+    parser.add_argument('--admission-limit', type=int, default=4)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    results = simulate(args)
+    print(f"relay tree, {args.students} students, fanout {args.fanout}, {args.churn} departures")
+    print(f"  placement:                       {results['build_us']:8.1f} us/student")
+    for label in ('initial', 'final'):
+        tree = results[label]
+        print(f"  {label + ' depth (max / p95):':32} {tree['max_depth']:4d} / {tree['p95_depth']}"
+              f"   added hops {tree['added_hops']:.2f}, teacher feeds {tree['teacher_children']}")
+    for event, title in (('leave', 'per departure'), ('join', 'per join')):
+        print(f"  {title} (mean / p95 / max):")
+        for label, key, unit in (
+            ('renegotiations', 'moves', ''),
+            ('students interrupted', 'interrupted', ''),
+            ('tree update', 'update_us', ' us'),
+            ('est. recovery', 'recovery_s', ' s'),
+        ):
+            values = results[f"{event}_{key}"]
+            print(f"    {label:30} {statistics.mean(values):8.2f} / {percentile(values, 0.95):8.2f}"
+                  f" / {max(values):8.2f}{unit}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,167 @@
+"""
+Benchmark: SFU forwarding throughput and CPU per subscriber.
+
+A loopback "teacher" publishes pre-encoded VP8 (720p-sized packets at
+30 fps, encoded once up front) to an SfuSession, and N "students" subscribe
+without decoding: their receivers count encoded frames instead. Reports
+frames forwarded per second, the bitrate students receive and the
+process CPU used.
+
+Everything runs in one process, so the CPU figure also covers the loopback
+clients' RTP, SRTP and jitter buffer work and overstates the server's share;
+"subscribers per core" is a lower bound. Needs aiortc.
+
+    python benchmarks/sfu.py [--subscribers 20] [--duration 10]
+"""
+import argparse
+import asyncio
+import fractions
+import os
+import queue
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'liveclass_project.settings')
+
+import django  # noqa: E402
+
+django.setup()
+
+import av  # noqa: E402
+from aiortc import MediaStreamTrack, RTCPeerConnection, RTCSessionDescription  # noqa: E402
+
+from classroom import sfu  # noqa: E402
+
+FPS = 30
+CLOCK_RATE = 90000
+GOP = 60
+
+
+def encode_clip(width, height, bitrate, frames=GOP):
+    """One GOP of VP8 packets, looped by the publisher."""
+    codec = av.CodecContext.create('libvpx', 'w')
+    codec.width, codec.height, codec.pix_fmt = width, height, 'yuv420p'
+    codec.time_base = fractions.Fraction(1, FPS)
+    codec.bit_rate = bitrate
+    codec.gop_size = frames
+    packets = []
+    for i in range(frames):
+        frame = av.VideoFrame(width, height, 'yuv420p')
+        for plane in frame.planes:
+            plane.update(os.urandom(plane.buffer_size))
+        frame.pts = i
+        packets.extend(bytes(packet) for packet in codec.encode(frame))
+    packets.extend(bytes(packet) for packet in codec.encode(None))
+    return packets
+
+
+class PreEncodedTrack(MediaStreamTrack):
+    kind = 'video'
+
+    def __init__(self, clip):
+        super().__init__()
+        self.clip = clip
+        self.count = 0
+        self.started = None
+
+    async def recv(self):
+        if self.started is None:
+            self.started = time.monotonic()
+        wait = self.started + self.count / FPS - time.monotonic()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        packet = av.Packet(self.clip[self.count % len(self.clip)])
+        packet.pts = self.count * CLOCK_RATE // FPS
+        packet.time_base = fractions.Fraction(1, CLOCK_RATE)
+        self.count += 1
+        return packet
+
+
+class CountingQueue(queue.Queue):
+    """Stands in for a subscriber's decoder queue, like sfu._ForwardingQueue."""
+
+    def __init__(self):
+        super().__init__()
+        self.frames = 0
+        self.bytes = 0
+
+    def put(self, item, block=True, timeout=None):
+        if item is None:
+            super().put(item, block, timeout)
+        else:
+            self.frames += 1
+            self.bytes += len(item[1].data)
+
+
+async def subscribe(session, username):
+    pc = RTCPeerConnection()
+    counter = CountingQueue()
+
+    @pc.on('track')
+    def on_track(track):
+        for transceiver in pc.getTransceivers():
+            transceiver.receiver._RTCRtpReceiver__decoder_queue = counter
+
+    await pc.setRemoteDescription(RTCSessionDescription(**await session.subscribe(username)))
+    await pc.setLocalDescription(await pc.createAnswer())
+    await session.accept_answer(username, {'type': 'answer', 'sdp': pc.localDescription.sdp})
+    return pc, counter
+
+
+async def run(args):
+    clip = encode_clip(1280, 720, args.bitrate)
+    session = sfu.SfuSession()
+    teacher = RTCPeerConnection()
+    teacher.addTrack(PreEncodedTrack(clip))
+    await teacher.setLocalDescription(await teacher.createOffer())
+    answer = await session.publish({'type': 'offer', 'sdp': teacher.localDescription.sdp})
+    await teacher.setRemoteDescription(RTCSessionDescription(**answer))
+
+    students = [await subscribe(session, f"student{i}") for i in range(args.subscribers)]
+    await asyncio.sleep(args.warmup)
+
+    frames_in = sfu.frames_forwarded.values.get(('in', 'video'), 0)
+    frames_out = sfu.frames_forwarded.values.get(('out', 'video'), 0)
+    received = sum(counter.frames for _, counter in students)
+    received_bytes = sum(counter.bytes for _, counter in students)
+    started, cpu_started = time.monotonic(), time.process_time()
+    await asyncio.sleep(args.duration)
+    elapsed, cpu = time.monotonic() - started, time.process_time() - cpu_started
+
+    results = {
+        'frames_in': (sfu.frames_forwarded.values.get(('in', 'video'), 0) - frames_in) / elapsed,
+        'frames_out': (sfu.frames_forwarded.values.get(('out', 'video'), 0) - frames_out) / elapsed,
+        'received': (sum(counter.frames for _, counter in students) - received) / elapsed,
+        'mbit': (sum(counter.bytes for _, counter in students) - received_bytes) * 8 / elapsed / 1e6,
+        'dropped': sfu.frames_dropped.values.get(('video',), 0),
+        'cores': cpu / elapsed,
+    }
+    for pc, _ in students:
+        await pc.close()
+    await teacher.close()
+    await session.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument('--subscribers', type=int, default=20)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--warmup', type=float, default=3)
+    parser.add_argument('--bitrate', type=int, default=1_500_000)
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    print(f"SFU forwarding to {args.subscribers} subscribers for {args.duration:.0f}s (VP8, {FPS} fps)")
+    print(f"  frames from teacher:        {results['frames_in']:8.1f} /s")
+    print(f"  frames handed to senders:   {results['frames_out']:8.1f} /s")
+    print(f"  frames received (students): {results['received']:8.1f} /s ({results['mbit']:.1f} Mbit/s)")
+    print(f"  frames dropped (stalled):   {results['dropped']:8d}")
+    print(f"  CPU incl. loopback clients: {results['cores']:8.2f} cores")
+    if results['cores']:
+        print(f"  subscribers per core:       {args.subscribers / results['cores']:8.1f} (lower bound)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,210 @@
+"""
+Microbenchmark: JSON text frames against the MessagePack subprotocol.
+
+Records a classroom session in-process with the load generator's scripted
+teacher and students (join, stream setup with SDP and batched ICE, chat),
+keeping every frame each socket sent and received. The recording is then
+replayed through both encodings, one codec per socket as on the server, and
+the report gives bytes on the wire per direction and the CPU spent per
+frame on each side:
+
+- server in: parsing what the pages send (``parse_frame`` or the binary
+  decoder);
+- server out: work for what the server sends. Broadcasts (a text more than
+  one socket received) are packed once, as a worker does for its binary
+  sockets, and counted once; frames for one socket are converted by a
+  binary socket;
+- page in / page out: decoding and encoding on the client side, in Python
+  as a stand-in for the browser.
+
+    python benchmarks/wire_format.py [--students 50] [--chats 20] [--repeat 5]
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'liveclass_project.settings')
+
+import django  # noqa: E402
+from django.test.utils import override_settings  # noqa: E402
+
+django.setup()
+
+from benchmarks.loadgen import (  # noqa: E402
+    IN_PROCESS_SETTINGS, InProcessConnection, run_scenario, use_temporary_database,
+)
+from channels.routing import URLRouter  # noqa: E402
+from classroom import binary  # noqa: E402
+from classroom.encoding import dumps, loads  # noqa: E402
+from classroom.framing import PASSTHROUGH_FIELDS, parse_frame  # noqa: E402
+from classroom.routing import websocket_urlpatterns  # noqa: E402
+
+
+class RecordingConnection(InProcessConnection):
+    """Keeps every frame in order as ('in' or 'out', text), seen from the page."""
+
+    recorded = []
+
+    def __init__(self, application, room):
+        super().__init__(application, room)
+        self.frames = []
+        self.recorded.append(self.frames)
+
+    async def send(self, text):
+        self.frames.append(('out', text))
+        await super().send(text)
+
+    async def recv(self):
+        text = await super().recv()
+        self.frames.append(('in', text))
+        return text
+
+
+def record(students, chats):
+    override_settings(**IN_PROCESS_SETTINGS).enable()
+    application = URLRouter(websocket_urlpatterns)
+    drop_database = use_temporary_database()
+    try:
+        asyncio.run(run_scenario(lambda room: RecordingConnection(application, room), students, chats,
+                                 room=f"wire-format-{int(time.time())}"))
+    finally:
+        drop_database()
+    return RecordingConnection.recorded
+
+
+def as_frame(text):
+    # A page speaking binary sends the SDP inside the frame instead of an envelope
+    data, payload = parse_frame(text)
+    if payload is not None:
+        data[PASSTHROUGH_FIELDS[data['type']]] = loads(payload)
+    return data
+
+
+def replay_json(sockets, frames_out):
+    timings = dict.fromkeys(('server_in', 'server_out', 'page_in', 'page_out'), 0.0)
+    clock = time.perf_counter
+    for frames, outbound in zip(sockets, frames_out):
+        outbound = iter(outbound)
+        for direction, text in frames:
+            if direction == 'out':
+                frame = next(outbound)
+                started = clock()
+                dumps(frame).encode()
+                timings['page_out'] += clock() - started
+                encoded = text.encode()
+                started = clock()
+                parse_frame(encoded.decode())
+                timings['server_in'] += clock() - started
+            else:
+                started = clock()
+                encoded = text.encode()
+                timings['server_out'] += clock() - started
+                started = clock()
+                loads(encoded)
+                timings['page_in'] += clock() - started
+    return timings
+
+
+def broadcast_texts(sockets):
+    seen, broadcasts = set(), set()
+    for frames in sockets:
+        for text in {text for direction, text in frames if direction == 'in'}:
+            (broadcasts if text in seen else seen).add(text)
+    return broadcasts
+
+
+def replay_binary(sockets, frames_out):
+    timings = dict.fromkeys(('server_in', 'server_out', 'page_in', 'page_out'), 0.0)
+    clock = time.perf_counter
+    broadcasts, packed = broadcast_texts(sockets), {}
+    for frames, outbound in zip(sockets, frames_out):
+        server, page = binary.BinaryCodec(), binary.BinaryCodec()
+        outbound = iter(outbound)
+        for direction, text in frames:
+            if direction == 'out':
+                frame = next(outbound)
+                started = clock()
+                encoded = page.encode(frame)
+                timings['page_out'] += clock() - started
+                started = clock()
+                server.decode_frame(encoded)
+                timings['server_in'] += clock() - started
+            else:
+                started = clock()
+                if text not in broadcasts:
+                    encoded = server.encode_text(text)
+                elif text in packed:
+                    encoded = packed[text]
+                else:
+                    encoded = packed[text] = binary.pack_broadcast(text)
+                timings['server_out'] += clock() - started
+                started = clock()
+                page._unpack(binary.msgpack.unpackb(encoded, strict_map_key=False))
+                timings['page_in'] += clock() - started
+    return timings
+
+
+def wire_bytes(sockets, frames_out):
+    sizes = {'json_in': 0, 'json_out': 0, 'binary_in': 0, 'binary_out': 0}
+    broadcasts = broadcast_texts(sockets)
+    for frames, outbound in zip(sockets, frames_out):
+        server, page = binary.BinaryCodec(), binary.BinaryCodec()
+        outbound = iter(outbound)
+        for direction, text in frames:
+            sizes[f'json_{direction}'] += len(text.encode())
+            if direction == 'out':
+                sizes['binary_out'] += len(page.encode(next(outbound)))
+            elif text in broadcasts:
+                sizes['binary_in'] += len(binary.pack_broadcast(text))
+            else:
+                sizes['binary_in'] += len(server.encode_text(text))
+    return sizes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument('--students', type=int, default=50)
+    parser.add_argument('--chats', type=int, default=20)
+    parser.add_argument('--repeat', type=int, default=5, help="replays per encoding; the fastest is reported")
+    args = parser.parse_args()
+
+    if binary.msgpack is None:
+        sys.exit("msgpack is not installed")
+
+    sockets = record(args.students, args.chats)
+    frames_out = [[as_frame(text) for direction, text in frames if direction == 'out'] for frames in sockets]
+    counts = {
+        'in': sum(direction == 'in' for frames in sockets for direction, _ in frames),
+        'out': sum(direction == 'out' for frames in sockets for direction, _ in frames),
+    }
+    sizes = wire_bytes(sockets, frames_out)
+
+    def fastest(replay, *replay_args):
+        runs = [replay(*replay_args) for _ in range(args.repeat)]
+        return {key: min(run[key] for run in runs) for key in runs[0]}
+
+    json_times = fastest(replay_json, sockets, frames_out)
+    binary_times = fastest(replay_binary, sockets, frames_out)
+
+    print(f"recorded session: {len(sockets)} sockets, {counts['out']} frames from pages, "
+          f"{counts['in']} frames to pages")
+    print(f"  {'':28} {'JSON':>12} {'MessagePack':>12} {'change':>8}")
+    for label, direction in (('bytes, pages to server', 'out'), ('bytes, server to pages', 'in')):
+        before, after = sizes[f'json_{direction}'], sizes[f'binary_{direction}']
+        print(f"  {label:28} {before:12d} {after:12d} {after / before - 1:+8.1%}")
+    for label, key, direction in (
+        ('server in, us/frame', 'server_in', 'out'),
+        ('server out, us/frame', 'server_out', 'in'),
+        ('page in, us/frame', 'page_in', 'in'),
+        ('page out, us/frame', 'page_out', 'out'),
+    ):
+        before = json_times[key] / counts[direction] * 1e6
+        after = binary_times[key] / counts[direction] * 1e6
+        print(f"  {label:28} {before:12.2f} {after:12.2f} {after / before - 1:+8.1%}")
+
+
+if __name__ == '__main__':
+    main()
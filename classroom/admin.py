@@ -1,5 +1,7 @@
 from django.contrib import admin
-from .models import Course, LiveClass
+from .models import ChatMessage, Course, LiveClass, ParticipantPermission
 
 admin.site.register(Course)
-admin.site.register(LiveClass)
\ No newline at end of file
+admin.site.register(LiveClass)
+admin.site.register(ChatMessage)
+admin.site.register(ParticipantPermission)
@@ -0,0 +1,148 @@
+"""
+Admission control for stream requests.
+
+When a room goes live every student sends ``request_stream`` at once, and a
+browser cannot negotiate hundreds of peer connections in parallel. All
+requests for a room already end up at the teacher's consumer, so that
+consumer keeps the queue: at most ``CLASSROOM_STREAM_ADMISSION_LIMIT``
+students are passed to the teacher's browser at a time. Each admitted
+negotiation holds its slot until:
+
+- the student's answer reaches the teacher (``answered``)
+- the teacher's browser reports ``negotiation_failed`` (``failed``)
+- ``CLASSROOM_STREAM_NEGOTIATION_TIMEOUT`` seconds pass (``timeout``)
+
+Waiting students get ``stream_queue`` frames with their position, sent at
+most every ``CLASSROOM_STREAM_QUEUE_UPDATE_INTERVAL`` seconds. A limit of 0
+turns admission control off.
+"""
+import asyncio
+import logging
+import time
+
+from django.conf import settings
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_LIMIT = 4
+DEFAULT_TIMEOUT = 15
+DEFAULT_UPDATE_INTERVAL = 1.0
+
+admissions = metrics.Counter(
+    'classroom_stream_admissions_total',
+    'Stream negotiations by outcome: answered, failed, timeout or gone (student left before admission).',
+    ['outcome'])
+queue_wait_seconds = metrics.Histogram(
+    'classroom_stream_queue_wait_seconds', 'Time students waited for a negotiation slot.',
+    buckets=(0.01, 0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0))
+
+
+class StreamAdmissionQueue:
+    """Per-teacher-consumer queue of students waiting for a negotiation slot."""
+
+    def __init__(self, consumer):
+        self.consumer = consumer
+        self.limit = getattr(settings, 'CLASSROOM_STREAM_ADMISSION_LIMIT', DEFAULT_LIMIT)
+        self.timeout = getattr(settings, 'CLASSROOM_STREAM_NEGOTIATION_TIMEOUT', DEFAULT_TIMEOUT)
+        self.update_interval = getattr(settings, 'CLASSROOM_STREAM_QUEUE_UPDATE_INTERVAL', DEFAULT_UPDATE_INTERVAL)
+        self.waiting = {}    # username -> request, in arrival order
+        self.in_flight = {}  # username -> (student channel, timeout task)
+        self._updates = None
+
+    async def request(self, username, channel, trace_id=None):
+        if self.limit <= 0:
+            await self.consumer.send_stream_request(username, channel, trace_id)
+            return
+        if username in self.in_flight:
+            # The student asked again, e.g. after a reload; negotiate afresh
+            self.in_flight.pop(username)[1].cancel()
+        self.waiting[username] = {
+            'channel': channel,
+            'trace_id': trace_id,
+            'queued_at': self.waiting.get(username, {}).get('queued_at', time.monotonic()),
+        }
+        await self._admit()
+        if username in self.waiting:
+            position = list(self.waiting).index(username) + 1
+            self.waiting[username]['position'] = position
+            await self._notify(channel, status='waiting', position=position)
+            self._schedule_updates()
+
+    async def finish(self, username, outcome):
+        """Free the slot held by ``username``; outcome is answered or failed."""
+        entry = self.in_flight.pop(username, None)
+        if entry is None:
+            return
+        entry[1].cancel()
+        await self._release(username, entry[0], outcome)
+
+    async def _release(self, username, channel, outcome):
+        admissions.inc(outcome)
+        if outcome != 'answered':
+            logger.info(f"Stream negotiation for {username} ended: {outcome}")
+            # The student's client asks again after a pause
+            await self._notify(channel, status='failed')
+        await self._admit()
+
+    async def _admit(self):
+        while self.waiting and len(self.in_flight) < self.limit:
+            username = next(iter(self.waiting))
+            request = self.waiting.pop(username)
+            # The slot is held before the store lookup, so admissions running
+            # meanwhile (another request, a finished negotiation) see it taken
+            entry = self.in_flight[username] = (
+                request['channel'], asyncio.get_running_loop().create_task(self._expire(username))
+            )
+            # Skip students who left or reconnected on another socket while queued
+            if await self.consumer.rooms.get_channel(self.consumer.room_code, username) != request['channel']:
+                if self.in_flight.get(username) is entry:
+                    del self.in_flight[username]
+                entry[1].cancel()
+                admissions.inc('gone')
+                continue
+            if self.in_flight.get(username) is not entry:
+                # Asked again or closed while we looked; that took care of the slot
+                continue
+
+            queue_wait_seconds.observe(time.monotonic() - request['queued_at'])
+            await self._notify(request['channel'], status='admitted')
+            await self.consumer.send_stream_request(username, request['channel'], request['trace_id'])
+            if self.waiting:
+                self._schedule_updates()
+
+    async def _expire(self, username):
+        await asyncio.sleep(self.timeout)
+        channel, _ = self.in_flight.pop(username)
+        try:
+            await self._release(username, channel, 'timeout')
+        except Exception as e:
+            logger.error(f"Error expiring stream negotiation for {username}: {e}", exc_info=True)
+
+    def _schedule_updates(self):
+        if self._updates is None or self._updates.done():
+            self._updates = asyncio.get_running_loop().create_task(self._send_positions())
+
+    async def _send_positions(self):
+        # Positions shift on every admission; tell waiting students at most once per interval
+        await asyncio.sleep(self.update_interval)
+        try:
+            for position, (username, request) in enumerate(list(self.waiting.items()), 1):
+                if request.get('position') != position:
+                    request['position'] = position
+                    await self._notify(request['channel'], status='waiting', position=position)
+        except Exception as e:
+            logger.error(f"Error sending stream queue positions: {e}", exc_info=True)
+
+    async def _notify(self, channel, **status):
+        await self.consumer.channel_send(channel, {'type': 'stream_queue_update', **status})
+
+    def close(self):
+        # The teacher left; students ask again when the teacher is next live
+        for _, task in self.in_flight.values():
+            task.cancel()
+        if self._updates:
+            self._updates.cancel()
+        self.in_flight.clear()
+        self.waiting.clear()
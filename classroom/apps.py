@@ -4,3 +4,9 @@ from django.apps import AppConfig
 class ClassroomConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'classroom'
+
+    def ready(self):
+        # Connects the LiveClass post_save handler that switches running classes
+        from . import webinar  # noqa: F401
+        # Registers the system checks
+        from . import checks  # noqa: F401
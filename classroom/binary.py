@@ -0,0 +1,173 @@
+"""
+Compact binary frames (MessagePack) for clients that ask for them.
+
+A page that offers the ``classroom.msgpack.v1`` WebSocket subprotocol, on
+a server with ``msgpack`` installed and ``CLASSROOM_BINARY_FRAMES`` on (it
+is off by default), gets binary frames both ways instead of JSON text:
+
+- message types and the common keys (``from_user``,
+  ``is_teacher_stream``, ...) become small integers from ``TYPES`` and
+  ``KEYS``;
+- usernames in frames sent to one socket are interned per connection and
+  direction: the first time a name is sent it travels as ``[id, name]``,
+  afterwards as ``id``.
+
+Values are otherwise the JSON frame's, so the consumer builds and handles
+frames exactly as before. Broadcasts travel through the channel layer as
+JSON text only, so rooms without binary sockets pay nothing for them. A
+worker packs a broadcast the first time one of its binary sockets sends it
+and reuses the bytes for the rest (``pack_broadcast``); their usernames stay
+strings, since one packing can't follow every socket's tables. Text frames
+keep working on a binary socket, and a page without the subprotocol gets
+JSON as before.
+
+The tables are only ever appended to; the page gets them from the template,
+see ``tables()``.
+"""
+from functools import lru_cache
+
+from django.conf import settings
+
+from .encoding import dumps, loads
+from .framing import PASSTHROUGH_FIELDS, FrameError, frame_limits
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+SUBPROTOCOL = 'classroom.msgpack.v1'
+
+TYPES = [
+    'join', 'chat_message', 'permission_update', 'roster_resync', 'teacher_ready', 'request_stream',
+    'offer', 'answer', 'student_offer', 'student_answer', 'ice_candidate', 'ice_candidates',
+    'stream_stopped', 'stream_trace', 'negotiation_failed', 'resume', 'leave', 'heartbeat',
+    'teacher_is_live', 'stream_queue', 'student_requesting_stream', 'relay_request', 'roster_snapshot',
+    'room_batch', 'permission_granted', 'error', 'chat_history', 'session', 'resumed', 'resume_failed',
+    'class_ended', 'participant_added', 'participant_removed', 'permissions_changed',
+    'permission_bulk_update', 'permissions_bulk_changed', 'breakout_assign', 'breakout_close', 'breakout',
+    'breakouts', 'participant_count', 'participant_query', 'participant_page', 'webinar',
+]
+
+KEYS = [
+    'type', 'username', 'from_user', 'target_user', 'is_teacher', 'is_teacher_stream', 'trace_id',
+    'candidates', 'candidate', 'sdpMid', 'sdpMLineIndex', 'usernameFragment', 'end_of_candidates',
+    'message', 'students', 'permissions', 'permission', 'status', 'version', 'deltas', 'left',
+    'student', 'seq', 'sdp', 'offer', 'answer', 'features', 'student_name', 'teacher_ms', 'marks',
+    'upload_kbps', 'position', 'relay', 'messages', 'id', 'created_at', 'before', 'events', 'resync',
+    'resume_token', 'last_seq', 'code', 'message_type', 'limit', 'count',
+    'pattern', 'usernames', 'assignments', 'name', 'breakout', 'search', 'after', 'next', 'total',
+]
+
+# Keys whose string values are usernames, interned per connection
+USER_FIELDS = {'username', 'from_user', 'target_user', 'student_name'}
+
+TYPE_CODES = {name: code for code, name in enumerate(TYPES)}
+KEY_CODES = {name: code for code, name in enumerate(KEYS)}
+
+def binary_enabled():
+    return msgpack is not None and getattr(settings, 'CLASSROOM_BINARY_FRAMES', False)
+
+
+def tables():
+    """What the page needs to speak the subprotocol, or None when it is off."""
+    if not binary_enabled():
+        return None
+    return {'subprotocol': SUBPROTOCOL, 'types': TYPES, 'keys': KEYS, 'user_fields': sorted(USER_FIELDS)}
+
+
+class BinaryCodec:
+    """One connection's MessagePack encoding and username tables."""
+
+    def __init__(self, intern_users=True):
+        self.intern_users = intern_users
+        self.sent_users = {}      # username -> id, as told to the page
+        self.received_users = []  # id -> username, as told by the page
+
+    def encode_text(self, text):
+        return msgpack.packb(self._pack(loads(text)))
+
+    def encode(self, frame):
+        return msgpack.packb(self._pack(frame))
+
+    def _pack(self, value):
+        if isinstance(value, dict):
+            return {KEY_CODES.get(key, key): self._pack_field(key, item) for key, item in value.items()}
+        if isinstance(value, list):
+            return [self._pack(item) for item in value]
+        return value
+
+    def _pack_field(self, key, value):
+        if key == 'type' and value in TYPE_CODES:
+            return TYPE_CODES[value]
+        if key in USER_FIELDS and isinstance(value, str) and self.intern_users:
+            user_id = self.sent_users.get(value)
+            if user_id is None:
+                user_id = self.sent_users[value] = len(self.sent_users)
+                return [user_id, value]
+            return user_id
+        return self._pack(value)
+
+    def decode_frame(self, data):
+        """
+        Parse an inbound binary frame like ``framing.parse_frame``. Returns
+        ``(frame, payload)`` with the raw JSON text of an offer or answer,
+        which pages send as a string field.
+        """
+        limits = frame_limits()
+        if len(data) > max(limits.values()):
+            raise FrameError('frame_too_large', None, max(limits.values()))
+        try:
+            frame = self._unpack(msgpack.unpackb(data, strict_map_key=False))
+        except (ValueError, IndexError, TypeError, msgpack.UnpackException):
+            raise FrameError('invalid_frame') from None
+        if not isinstance(frame, dict):
+            raise FrameError('invalid_frame')
+        message_type = frame.get('type')
+        limit = limits.get(message_type, limits['default'])
+        if len(data) > limit:
+            raise FrameError('frame_too_large', message_type, limit)
+        payload = None
+        if message_type in PASSTHROUGH_FIELDS:
+            description = frame.get(PASSTHROUGH_FIELDS[message_type])
+            if isinstance(description, dict):
+                # Pages loaded before descriptions were sent as text
+                description = dumps(description)
+            if not (isinstance(description, str) and description.startswith('{') and description.endswith('}')):
+                raise FrameError('invalid_payload', message_type)
+            payload = description
+        return frame, payload
+
+    def _unpack(self, value):
+        if isinstance(value, dict):
+            frame = {}
+            for key, item in value.items():
+                key = KEYS[key] if isinstance(key, int) else key
+                frame[key] = self._unpack_field(key, item)
+            return frame
+        if isinstance(value, list):
+            return [self._unpack(item) for item in value]
+        return value
+
+    def _unpack_field(self, key, value):
+        if key == 'type' and isinstance(value, int):
+            return TYPES[value]
+        if key in USER_FIELDS:
+            if isinstance(value, list) and len(value) == 2 and value[0] == len(self.received_users):
+                self.received_users.append(value[1])
+                return value[1]
+            if isinstance(value, (int, list)):
+                user_id = value if isinstance(value, int) else None
+                if user_id is None or not 0 <= user_id < len(self.received_users):
+                    raise ValueError(f"Unknown or out of order username id {value!r}")
+                return self.received_users[user_id]
+        return self._unpack(value)
+
+
+# Packs broadcasts for every binary socket, so it keeps no username table
+_broadcast_codec = BinaryCodec(intern_users=False)
+
+# A broadcast reaches a worker's sockets back to back, and the in-memory layer
+# hands each of them the same text object, so a few entries pack it once; a
+# big cache would only hold on to old SDP
+pack_broadcast = lru_cache(maxsize=8)(_broadcast_codec.encode_text)
@@ -0,0 +1,60 @@
+"""
+Breakout rooms: parts of a class with their own group, roster and chat.
+
+Everything in a class went to the one ``classroom_<code>`` group, so group
+discussion in a 200-student class sent every chat line to all 200 sockets.
+The teacher can now split the class into named breakouts:
+
+- ``breakout_assign`` from the teacher maps usernames to a breakout name,
+  or to ``null`` for the main room; the page splits the class with one
+  frame for everyone. ``breakout_close`` brings everyone back.
+- Assignments are kept in the room store, so a student who rejoins or
+  resumes goes back to their breakout.
+- A moved student's own consumer leaves one channel group and joins the
+  other on the same socket, then sends the page a ``breakout`` frame, the
+  new room's roster snapshot and its chat history. Chat, roster deltas and
+  leave notices go to the breakout's group only, so their fan-out follows
+  the breakout's size rather than the class's.
+- Each breakout is a room of its own in the room store, ``<code>.<name>``,
+  with its own roster versions and resume buffer. Seats, permissions and
+  stream signaling stay with the class. The teacher stays in the main room
+  with the whole roster and gets a ``breakouts`` frame with the assignments.
+- What the teacher sends to everyone (going live, stopping the stream, bulk
+  permission changes) goes to the main group and once to each breakout's.
+
+Breakout chat is saved with the breakout's name and kept out of the main
+room's history.
+"""
+import re
+
+from . import metrics
+from .framing import FrameError
+
+SEPARATOR = '.'
+
+# Also has to fit channel group names, which allow letters, digits, - _ and .
+NAME_PATTERN = re.compile(r'^[A-Za-z0-9_-]{1,32}$')
+
+moves = metrics.Counter(
+    'classroom_breakout_moves_total',
+    'Students moved into a breakout (breakout) or back to the main room (main).',
+    ['to'])
+
+
+def room_code(class_code, breakout):
+    """Room store code of a breakout, or the class's own for the main room (None)."""
+    return class_code if breakout is None else f"{class_code}{SEPARATOR}{breakout}"
+
+
+def group_name(class_code, breakout):
+    return f"classroom_{room_code(class_code, breakout)}"
+
+
+def parse_assignments(assignments):
+    """Check a ``breakout_assign`` frame's username -> breakout mapping."""
+    if not isinstance(assignments, dict):
+        raise FrameError('invalid_breakout', 'breakout_assign')
+    for breakout in assignments.values():
+        if breakout is not None and not (isinstance(breakout, str) and NAME_PATTERN.match(breakout)):
+            raise FrameError('invalid_breakout', 'breakout_assign')
+    return assignments
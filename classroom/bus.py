@@ -0,0 +1,201 @@
+"""
+Pub/sub broadcast bus for room-wide events in very large rooms.
+
+``group_send`` writes one copy of every broadcast per member channel into
+Redis. With a bus configured, room-wide events (chat, stream state, roster
+batches) are published once per room instead. Each worker subscribes once
+per room it hosts and hands the event to its own consumers through the
+channel layer's in-process path, so Redis work grows with the number of
+workers rather than participants. Targeted signaling still uses the channel
+layer directly.
+
+Configured like the room store:
+
+    CLASSROOM_BROADCAST_BUS = {
+        "BACKEND": "classroom.bus.RedisPubSubBus",
+        "CONFIG": {"hosts": [("127.0.0.1", 6379)]},
+    }
+
+Local delivery relies on ``classroom.layers.HybridRedisChannelLayer`` (or
+the in-memory layer) so that sends to this worker's channels skip Redis.
+"""
+import asyncio
+import contextlib
+import logging
+import time
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.utils.module_loading import import_string
+
+from . import metrics
+from .encoding import dumps, loads
+
+logger = logging.getLogger(__name__)
+
+
+class BaseBroadcastBus:
+    """Tracks this worker's members per room group and fans events out to them."""
+
+    def __init__(self):
+        # group -> (channel layer, set of local channel names)
+        self.members = {}
+        # group -> (lock, callers holding or waiting for it)
+        self._locks = {}
+
+    @contextlib.asynccontextmanager
+    async def _group_lock(self, group):
+        # A group's last unsubscribe and next first subscribe must not
+        # interleave, or the worker could end up unsubscribed from a room
+        # that still has members here
+        lock, users = self._locks.get(group, (None, 0))
+        if lock is None:
+            lock = asyncio.Lock()
+        self._locks[group] = (lock, users + 1)
+        try:
+            async with lock:
+                yield
+        finally:
+            lock, users = self._locks[group]
+            if users == 1:
+                del self._locks[group]
+            else:
+                self._locks[group] = (lock, users - 1)
+
+    async def subscribe(self, channel_layer, group, channel):
+        async with self._group_lock(group):
+            first = group not in self.members
+            self.members.setdefault(group, (channel_layer, set()))[1].add(channel)
+            if first:
+                await self.room_added(group)
+
+    async def unsubscribe(self, group, channel):
+        async with self._group_lock(group):
+            entry = self.members.get(group)
+            if not entry:
+                return
+            entry[1].discard(channel)
+            if not entry[1]:
+                del self.members[group]
+                await self.room_removed(group)
+
+    async def room_added(self, group):
+        pass
+
+    async def room_removed(self, group):
+        pass
+
+    async def publish(self, group, event):
+        raise NotImplementedError
+
+    async def deliver(self, group, event):
+        entry = self.members.get(group)
+        if not entry:
+            return
+        channel_layer, channels = entry
+        for channel in list(channels):
+            try:
+                await channel_layer.send(channel, event)
+            except Exception as e:
+                logger.warning(f"Could not deliver {event.get('type')} to {channel}: {e}")
+
+
+class InMemoryBroadcastBus(BaseBroadcastBus):
+    """Single-process bus: publishing is local fan-out. Useful for tests."""
+
+    async def publish(self, group, event):
+        await self.deliver(group, event)
+
+
+class RedisPubSubBus(BaseBroadcastBus):
+    """One PUBLISH per room event; one SUBSCRIBE per room hosted on this worker."""
+
+    def __init__(self, hosts=None, prefix="classroom:bus:"):
+        super().__init__()
+        if not hosts:
+            hosts = settings.CHANNEL_LAYERS['default']['CONFIG']['hosts']
+        self.host = hosts[0]
+        self.prefix = prefix
+        self._client = None
+        self._pubsub = None
+        self._reader = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            self._connect()
+        return self._client
+
+    def _connect(self):
+        from redis import asyncio as aioredis
+
+        if isinstance(self.host, str):
+            self._client = aioredis.Redis.from_url(self.host)
+        else:
+            host, port = self.host
+            self._client = aioredis.Redis(host=host, port=port)
+        self._pubsub = self._client.pubsub(ignore_subscribe_messages=True)
+
+    async def room_added(self, group):
+        if self._client is None:
+            self._connect()
+        await self._pubsub.subscribe(self.prefix + group)
+        if self._reader is None or self._reader.done():
+            self._reader = asyncio.get_running_loop().create_task(self._read())
+
+    async def room_removed(self, group):
+        await self._pubsub.unsubscribe(self.prefix + group)
+
+    async def publish(self, group, event):
+        await self.client.publish(self.prefix + group, dumps(event))
+
+    async def _read(self):
+        while True:
+            try:
+                message = await self._pubsub.get_message(timeout=1.0)
+                if message is None or message['type'] != 'message':
+                    continue
+                group = message['channel'].decode('utf8')[len(self.prefix):]
+                await self.deliver(group, loads(message['data']))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Error reading broadcast bus: {e}", exc_info=True)
+                await asyncio.sleep(1)
+
+
+_bus = None
+_bus_loaded = False
+
+
+def get_broadcast_bus():
+    """Return the configured broadcast bus, or None to use group_send."""
+    global _bus, _bus_loaded
+    if not _bus_loaded:
+        config = getattr(settings, 'CLASSROOM_BROADCAST_BUS', None)
+        if config:
+            _bus = import_string(config['BACKEND'])(**config.get('CONFIG', {}))
+        _bus_loaded = True
+    return _bus
+
+
+async def room_broadcast(channel_layer, group, event):
+    """Send a room-wide event through the bus if configured, else group_send."""
+    started = time.perf_counter()
+    bus = get_broadcast_bus()
+    if bus is not None:
+        await bus.publish(group, event)
+        metrics.layer_seconds.observe(time.perf_counter() - started, 'publish')
+    else:
+        await channel_layer.group_send(group, event)
+        metrics.layer_seconds.observe(time.perf_counter() - started, 'group_send')
+
+
+def _reset_bus(setting, **kwargs):
+    global _bus, _bus_loaded
+    if setting in ('CLASSROOM_BROADCAST_BUS', 'CHANNEL_LAYERS'):
+        _bus = None
+        _bus_loaded = False
+
+
+setting_changed.connect(_reset_bus)
@@ -0,0 +1,204 @@
+"""
+Chat history: write-behind persistence and replay on join.
+
+``handle_chat_message`` broadcasts first and then hands the message to this
+worker's ``ChatWriter``, which saves pending messages with one
+``bulk_create`` once ``CLASSROOM_CHAT_FLUSH_SIZE`` have collected or
+``CLASSROOM_CHAT_FLUSH_INTERVAL`` seconds after the first, on the database
+thread. The consumer never waits for SQLite per message. Messages still
+pending when a worker is killed are lost, so the interval is kept short.
+
+Joining sockets get the last ``CLASSROOM_CHAT_HISTORY_LENGTH`` messages in a
+``chat_history`` frame, including this worker's unsaved ones; older pages
+come from the ``chat_history`` view with ``?before=<id>``. Each breakout
+room has its own history, see breakouts.py. Rooms without a ``LiveClass``
+row are not recorded.
+
+Chat is the first thing to give way when a socket falls behind. A chat
+broadcast reaching a consumer with ``CLASSROOM_CHAT_SHED_BACKLOG`` or more
+events still waiting on its channel is skipped for that socket, so the
+offers, ICE candidates and roster batches queued behind it are sent sooner.
+The message is still saved and shows up in the history.
+"""
+import asyncio
+import logging
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db import DatabaseError, transaction
+from django.utils import timezone
+
+from . import metrics
+from .layers import channel_backlog
+from .models import ChatMessage, LiveClass
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_FLUSH_SIZE = 100
+DEFAULT_FLUSH_INTERVAL = 0.5
+DEFAULT_HISTORY_LENGTH = 50
+# Half the default channel capacity of both the in-memory layer and channels_redis
+DEFAULT_SHED_BACKLOG = 50
+MAX_PAGE_SIZE = 200
+
+chat_messages_saved = metrics.Counter(
+    'classroom_chat_messages_saved_total',
+    'Chat messages written to the database (saved), or not: no LiveClass for the room (no_class) '
+    'or the batch failed (failed).',
+    ['outcome'])
+chat_flush_seconds = metrics.Histogram(
+    'classroom_chat_flush_seconds', 'Time to save one batch of chat messages.')
+chat_shed = metrics.Counter(
+    'classroom_chat_shed_total',
+    'Chat broadcasts skipped for a socket with CLASSROOM_CHAT_SHED_BACKLOG events waiting, by room hash.',
+    ['room'])
+
+_writer = None
+
+
+def history_length():
+    return getattr(settings, 'CLASSROOM_CHAT_HISTORY_LENGTH', DEFAULT_HISTORY_LENGTH)
+
+
+def should_shed(channel_layer, channel, room_code):
+    """True if a chat broadcast for ``channel`` should be skipped, see above."""
+    limit = getattr(settings, 'CLASSROOM_CHAT_SHED_BACKLOG', DEFAULT_SHED_BACKLOG)
+    if limit and channel_backlog(channel_layer, channel) >= limit:
+        chat_shed.inc(metrics.room_label(room_code))
+        return True
+    return False
+
+
+def serialize(message):
+    """The frame form of a ChatMessage; ``id`` is None while it is unsaved."""
+    return {
+        'id': message.id,
+        'username': message.username,
+        'message': message.message,
+        'created_at': message.created_at.isoformat(),
+    }
+
+
+def history_page(live_class, before=None, limit=DEFAULT_HISTORY_LENGTH, breakout=''):
+    """Up to ``limit`` saved messages older than id ``before``, oldest first, and the next cursor."""
+    messages = ChatMessage.objects.filter(live_class=live_class, breakout=breakout)
+    if before is not None:
+        messages = messages.filter(id__lt=before)
+    page = list(messages.order_by('-id')[:limit + 1])
+    more = len(page) > limit
+    page = page[:limit][::-1]
+    return page, page[0].id if more else None
+
+
+class ChatWriter:
+    """This worker's unsaved chat messages, saved in batches."""
+
+    def __init__(self, flush_size, interval):
+        self.flush_size = flush_size
+        self.interval = interval
+        self.loop = asyncio.get_running_loop()
+        self.pending = []   # (room code, unsaved ChatMessage) not yet handed to the database thread
+        self.saving = []    # Batches handed over and not yet saved
+        self._task = None
+
+    def add(self, room_code, username, message, breakout=''):
+        self.pending.append((room_code, ChatMessage(
+            username=username, message=message, created_at=timezone.now(), breakout=breakout
+        )))
+        if len(self.pending) >= self.flush_size or self.interval <= 0:
+            if self._task:
+                self._task.cancel()
+            self._task = self.loop.create_task(self.flush())
+        elif self._task is None:
+            self._task = self.loop.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.interval)
+        await self.flush()
+
+    async def flush(self):
+        self._task = None
+        if not self.pending:
+            return
+        batch, self.pending = self.pending, []
+        self.saving.append(batch)
+        started = self.loop.time()
+        try:
+            await database_sync_to_async(self._save)(batch)
+        except Exception as e:
+            chat_messages_saved.inc('failed', amount=len(batch))
+            logger.error(f"Error saving {len(batch)} chat messages: {e}", exc_info=True)
+        finally:
+            self.saving.remove(batch)
+        chat_flush_seconds.observe(self.loop.time() - started)
+
+    @staticmethod
+    def _save(batch):
+        live_class_ids = dict(LiveClass.objects.filter(
+            code__in={room_code for room_code, _ in batch}
+        ).values_list('code', 'id'))
+        messages = []
+        for room_code, message in batch:
+            if room_code in live_class_ids:
+                message.live_class_id = live_class_ids[room_code]
+                messages.append(message)
+        if len(messages) < len(batch):
+            chat_messages_saved.inc('no_class', amount=len(batch) - len(messages))
+        try:
+            # Sets each message's id, which tells recent() it is saved
+            with transaction.atomic():
+                ChatMessage.objects.bulk_create(messages)
+            chat_messages_saved.inc('saved', amount=len(messages))
+            return
+        except DatabaseError as e:
+            logger.warning(f"Saving {len(messages)} chat messages one by one after the batch failed: {e}")
+        # One bad row fails the whole INSERT; the others are still saved
+        for message in messages:
+            try:
+                with transaction.atomic():
+                    message.save()
+                chat_messages_saved.inc('saved')
+            except DatabaseError as e:
+                chat_messages_saved.inc('failed')
+                logger.error(f"Error saving a chat message from {message.username!r} in room {message.live_class_id}: {e}")
+
+    async def recent(self, room_code, until, limit, breakout=''):
+        """
+        The last ``limit`` messages of a room (or one of its breakouts) sent
+        before ``until`` and the cursor for older ones, or None if the room
+        has no LiveClass.
+        """
+        unsaved = [
+            message for batch in [*self.saving, self.pending] for code, message in batch
+            if code == room_code and message.breakout == breakout and message.created_at < until
+        ]
+        return await database_sync_to_async(self._recent)(room_code, until, limit, unsaved, breakout)
+
+    @staticmethod
+    def _recent(room_code, until, limit, unsaved, breakout):
+        # Runs on the database thread after any batch handed over before it,
+        # so a message still without an id is not in the database yet
+        unsaved = [message for message in unsaved if message.id is None][-limit:]
+        live_class_id = LiveClass.objects.filter(code=room_code).values_list('id', flat=True).first()
+        if live_class_id is None:
+            return None
+        rows = list(ChatMessage.objects.filter(
+            live_class_id=live_class_id, breakout=breakout, created_at__lt=until
+        ).order_by('-id')[:limit + 1])[::-1]
+        page = rows[len(rows) - (limit - len(unsaved)):] if len(unsaved) < limit else []
+        older = rows[:len(rows) - len(page)]
+        cursor = None
+        if older:
+            cursor = page[0].id if page else older[-1].id + 1
+        return [serialize(message) for message in [*page, *unsaved]], cursor
+
+
+def get_chat_writer():
+    """Return this worker's ChatWriter, creating it if needed."""
+    global _writer
+    if _writer is None or _writer.loop is not asyncio.get_running_loop():
+        _writer = ChatWriter(
+            flush_size=getattr(settings, 'CLASSROOM_CHAT_FLUSH_SIZE', DEFAULT_FLUSH_SIZE),
+            interval=getattr(settings, 'CLASSROOM_CHAT_FLUSH_INTERVAL', DEFAULT_FLUSH_INTERVAL),
+        )
+    return _writer
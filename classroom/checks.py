@@ -0,0 +1,26 @@
+"""
+System checks for the classroom app.
+
+``hls.min.js`` isn't in the repository: the Dockerfile fetches the pinned
+hls.js release into ``classroom/static/classroom/js/`` before
+``collectstatic``. Without it, browsers lacking native HLS can't play
+recordings, so with HLS on ``collectstatic`` (and ``check``) fail instead of
+shipping a page that can't use it.
+"""
+from django.contrib.staticfiles import finders
+from django.core.checks import Error, Tags, register
+
+from . import hls
+
+HLS_JS = 'classroom/js/hls.min.js'
+
+
+@register(Tags.staticfiles)
+def hls_js_check(app_configs, **kwargs):
+    if not hls.hls_enabled() or finders.find(HLS_JS):
+        return []
+    return [Error(
+        f"CLASSROOM_HLS_ENABLED is on but the static file {HLS_JS} is missing.",
+        hint="Put hls.js 1.5.17's dist/hls.min.js there (the Dockerfile fetches it) before collectstatic.",
+        id='classroom.E001',
+    )]
@@ -0,0 +1,160 @@
+"""
+Per-room coalescing of roster changes and leave notices.
+
+When a class starts (or ends) hundreds of sockets join or leave within a few
+seconds. Instead of one broadcast per change, each worker collects the
+changes for a room and sends them as a single ``room_batch_broadcast``.
+
+The flush window slides while changes keep arriving, but a batch is never
+held longer than ``CLASSROOM_BROADCAST_MAX_DELAY`` after its first change, so
+the added latency is bounded. A window of 0 sends every change immediately.
+In webinar rooms the batches go to the teacher's socket only and students
+are only told when the teacher leaves, see webinar.py.
+"""
+import asyncio
+import logging
+
+from django.conf import settings
+
+from .bus import room_broadcast
+from .encoding import dumps
+from .resume import encode_room_frame
+from .rooms import get_room_store
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_WINDOW = 0.1
+DEFAULT_MAX_DELAY = 0.25
+
+# Counters for this worker, see coalescer_stats()
+stats = {
+    'events': 0,    # roster changes and leave notices submitted
+    'messages': 0,  # group messages actually sent
+}
+
+_coalescers = {}
+
+
+class BroadcastCoalescer:
+    """Collects pending room events for one group and flushes them as one message."""
+
+    def __init__(self, channel_layer, group_name, room_code, window, max_delay, teacher_only=False):
+        self.channel_layer = channel_layer
+        self.group_name = group_name
+        self.room_code = room_code
+        self.teacher_only = teacher_only
+        self.window = window
+        self.max_delay = max(max_delay, window)
+        self.loop = asyncio.get_running_loop()
+        self.deltas = []
+        self.left = []
+        self._first_at = None
+        self._last_at = None
+        self._task = None
+
+    @property
+    def pending(self):
+        return bool(self.deltas or self.left)
+
+    async def add_delta(self, delta):
+        self.deltas.append(delta)
+        await self._touch()
+
+    async def add_left(self, username, is_teacher):
+        self.left.append({'username': username, 'is_teacher': is_teacher})
+        await self._touch()
+
+    async def _touch(self):
+        stats['events'] += 1
+        if self.window <= 0:
+            await self.flush()
+            return
+
+        now = self.loop.time()
+        if self._first_at is None:
+            self._first_at = now
+        self._last_at = now
+        if self._task is None:
+            self._task = self.loop.create_task(self._run())
+
+    async def _run(self):
+        # Sleep until the window closes, extending it while events keep coming
+        # in, but never past first event + max_delay.
+        while True:
+            deadline = min(self._last_at + self.window, self._first_at + self.max_delay)
+            delay = deadline - self.loop.time()
+            if delay <= 0:
+                break
+            await asyncio.sleep(delay)
+        self._task = None
+        await self.flush()
+
+    async def flush(self):
+        if not self.pending:
+            return
+        deltas, left = self.deltas, self.left
+        self.deltas, self.left = [], []
+        self._first_at = self._last_at = None
+
+        # Encode the batch once for the whole group. Deltas marked with an
+        # exclude_channel are listed per channel so that socket can drop them.
+        exclude = {}
+        frame_deltas = []
+        for delta in deltas:
+            channel = delta.pop('exclude_channel', None)
+            if channel:
+                exclude.setdefault(channel, []).append(delta['version'])
+            frame_deltas.append(delta)
+
+        stats['messages'] += 1
+        frame = {'type': 'room_batch', 'deltas': frame_deltas, 'left': left}
+        try:
+            if self.teacher_only:
+                # Teachers are not resumed, so the batch is not numbered
+                teacher = await get_room_store().get_teacher(self.room_code)
+                if teacher:
+                    await self.channel_layer.send(teacher['channel'], {
+                        'type': 'room_batch_broadcast', 'text': dumps(frame), 'exclude': exclude,
+                    })
+                teacher_left = [entry for entry in left if entry['is_teacher']]
+                if teacher_left:
+                    await room_broadcast(self.channel_layer, self.group_name, {
+                        'type': 'room_batch_broadcast',
+                        'text': await encode_room_frame(
+                            self.room_code, {'type': 'room_batch', 'deltas': [], 'left': teacher_left}
+                        ),
+                        'exclude': {},
+                    })
+            else:
+                await room_broadcast(self.channel_layer, self.group_name, {
+                    'type': 'room_batch_broadcast',
+                    'text': await encode_room_frame(self.room_code, frame),
+                    'exclude': exclude,
+                })
+        except Exception as e:
+            logger.error(f"Error flushing broadcasts for {self.group_name}: {e}", exc_info=True)
+        finally:
+            # A newer coalescer may have replaced this one meanwhile; leave it be
+            if not self.pending and self._task is None and _coalescers.get(self.group_name) is self:
+                del _coalescers[self.group_name]
+
+
+def get_coalescer(channel_layer, group_name, room_code, teacher_only=False):
+    """Return this worker's coalescer for a room group, creating it if needed."""
+    coalescer = _coalescers.get(group_name)
+    if coalescer is None or coalescer.loop is not asyncio.get_running_loop() or coalescer.teacher_only != teacher_only:
+        coalescer = BroadcastCoalescer(
+            channel_layer,
+            group_name,
+            room_code,
+            window=getattr(settings, 'CLASSROOM_BROADCAST_WINDOW', DEFAULT_WINDOW),
+            max_delay=getattr(settings, 'CLASSROOM_BROADCAST_MAX_DELAY', DEFAULT_MAX_DELAY),
+            teacher_only=teacher_only,
+        )
+        _coalescers[group_name] = coalescer
+    return coalescer
+
+
+def coalescer_stats():
+    """Events submitted, messages sent and how many were merged away."""
+    return {**stats, 'merged': stats['events'] - stats['messages']}
@@ -1,66 +1,228 @@
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
 from django.contrib.auth.models import AnonymousUser
+from django.utils import timezone
+from .bus import get_broadcast_bus, room_broadcast
+from .chat import get_chat_writer, history_length, should_shed
+from .coalescer import get_coalescer
+from .encoding import dumps, loads
+from .framing import PASSTHROUGH_FIELDS, FrameError, parse_frame, passthrough_frame
+from .admission import StreamAdmissionQueue
+from . import binary
+from . import breakouts
+from . import hls
+from .ice import IceCandidateBatcher, parse_candidates
+from . import metrics
+from . import permissions
+from . import ratelimit
+from .rooms import get_room_store
+from .sharding import channel_layer_alias_for_room
+from . import reaper
+from . import relay
+from . import resume
+from . import sfu
+from . import tracing
+from . import webinar
+import asyncio
 import json
 import logging
+import time
 
 logger = logging.getLogger(__name__)
-classrooms = {}  # In-memory store for classroom state
 
 class ClassroomConsumer(AsyncWebsocketConsumer):
+    codec = None  # MessagePack tables when the page asked for binary frames, see binary.py
+
+    async def __call__(self, scope, receive, send):
+        # Pick the room's channel layer shard before the channel is created, so
+        # the room group and all its members' channels share one Redis.
+        self.channel_layer_alias = channel_layer_alias_for_room(scope['url_route']['kwargs']['room_code'])
+        return await super().__call__(scope, receive, send)
+
     async def connect(self):
         self.room_code = self.scope['url_route']['kwargs']['room_code']
         self.room_group_name = f'classroom_{self.room_code}'
         self.username = None
         self.is_teacher = False
+        self.rooms = get_room_store()  # Shared room state, see rooms.py
+        self.features = set()  # Optional protocol features the client announced in join
+        self.ice_batcher = IceCandidateBatcher(self)
+        self.stream_admission = StreamAdmissionQueue(self)  # Used on the teacher's socket, see admission.py
+        self.bus = get_broadcast_bus()  # Pub/sub path for room-wide events, see bus.py
+        self.stream_traces = {}  # trace_id -> time request_stream arrived, see tracing.py
+        self.sfu_session = None  # Teacher's stream when published to the server, see sfu.py
+        self.relay_tree = None  # Teacher's socket: who relays the stream to whom, see relay.py
+        self.relay_parent = None  # Student relaying the teacher stream to this one
+        self.relay_children = set()  # Students this one relays the teacher stream to
+        self.connected_at = timezone.now()  # Chat sent after this arrives live, not in chat_history
+        self.session = None  # Student's resumable session, see resume.py
+        self.leaving = False  # The page said it is closing, so don't wait for a resume
+        self.last_seen = asyncio.get_running_loop().time()  # Last frame from the page, see reaper.py
+        self.reaper = reaper.get_reaper()
+        self.rate_limiter = ratelimit.RateLimiter(self.room_code, self.rooms, asyncio.get_running_loop())
+        self.breakout = None  # Student's breakout room, None in the main room, see breakouts.py
+        self.webinar = False  # Students follow a count instead of the roster, see webinar.py
 
-        await self.channel_layer.group_add(
-            self.room_group_name,
-            self.channel_name
-        )
-        await self.accept()
-
-        if self.room_code not in classrooms:
-            classrooms[self.room_code] = {
-                'teacher': {},
-                'students': {},
-                'is_live': False, # Track if teacher stream is active
-            }
+        await self.join_group(self.room_group_name)
+        if binary.SUBPROTOCOL in self.scope.get('subprotocols', []) and binary.binary_enabled():
+            self.codec = binary.BinaryCodec()
+            await self.accept(binary.SUBPROTOCOL)
+        else:
+            await self.accept()
+        metrics.socket_opened(self.room_code)
+        if self.reaper:
+            self.reaper.register(self)
 
     async def disconnect(self, close_code):
+        metrics.socket_closed(self.room_code)
+        if self.reaper:
+            self.reaper.unregister(self)
+        self.ice_batcher.close()
+        self.stream_admission.close()
+        await self.close_sfu_session()
         if self.username:
-            room = classrooms.get(self.room_code)
-            if room:
-                if self.is_teacher:
-                    room['teacher'] = {}
-                    room['is_live'] = False
-                elif self.username in room['students']:
-                    del room['students'][self.username]
-                
-                await self.channel_layer.group_send(
-                    self.room_group_name,
-                    {
-                        'type': 'user_left_broadcast',
-                        'username': self.username,
-                        'is_teacher': self.is_teacher
-                    }
+            if self.session and not self.leaving and resume.resume_grace():
+                # Keep the seat for a reconnect, see resume.py
+                asyncio.get_running_loop().create_task(self.expire_session())
+            else:
+                await self.leave_room()
+
+        await self.leave_group(self.current_group_name)
+
+    async def join_group(self, group):
+        if self.bus:
+            await self.bus.subscribe(self.channel_layer, group, self.channel_name)
+        else:
+            await self.channel_layer.group_add(group, self.channel_name)
+
+    async def leave_group(self, group):
+        if self.bus:
+            await self.bus.unsubscribe(group, self.channel_name)
+        else:
+            await self.channel_layer.group_discard(group, self.channel_name)
+
+    @property
+    def current_room_code(self):
+        # Room store code of the room this socket is in: the class or its breakout
+        return breakouts.room_code(self.room_code, self.breakout)
+
+    @property
+    def current_group_name(self):
+        return breakouts.group_name(self.room_code, self.breakout)
+
+    async def leave_room(self):
+        version = None
+        if self.is_teacher:
+            removed = await self.rooms.remove_teacher(self.room_code, self.channel_name)
+        else:
+            version = await self.rooms.remove_student(self.room_code, self.username, self.channel_name)
+            removed = version is not None
+
+        # Only announce the leave if this socket still owned the seat; a
+        # newer connection for the same user may have replaced it.
+        if removed:
+            await self.coalescer().add_left(self.username, self.is_teacher)
+            if version is not None:
+                await self.broadcast_roster_delta('participant_removed', version, username=self.username)
+            await self.leave_breakout()
+            if not self.is_teacher and relay.relay_fanout():
+                await self.leave_relay_tree()
+
+    async def leave_breakout(self):
+        # Off the breakout's roster; its group is left by the caller
+        if self.breakout is None:
+            return
+        version = await self.rooms.remove_student(self.current_room_code, self.username, self.channel_name)
+        if version is not None:
+            await self.coalescer(self.breakout).add_left(self.username, False)
+            await self.broadcast_roster_delta('participant_removed', version, self.breakout, username=self.username)
+
+    async def enter_breakout(self, breakout, permissions):
+        """Move this student's socket to a breakout's group and roster, or the main room's."""
+        await self.leave_group(self.current_group_name)
+        self.breakout = breakout
+        if breakout is not None:
+            # Already on its roster when resuming
+            student = self.session and await self.rooms.resume_student(
+                self.current_room_code, self.username, self.session, self.channel_name
+            )
+            if not student:
+                student, version = await self.rooms.add_student(
+                    self.current_room_code, self.username, self.channel_name,
+                    session=self.session, permissions=permissions
                 )
-                await self.broadcast_student_list()
+                await self.broadcast_roster_delta(
+                    'participant_added', version, breakout,
+                    student=self.public_student(student),
+                    exclude_channel=self.channel_name
+                )
+        # The new room's chat from here on arrives live
+        self.connected_at = timezone.now()
+        await self.join_group(self.current_group_name)
 
-        await self.channel_layer.group_discard(
-            self.room_group_name,
-            self.channel_name
-        )
+    async def expire_session(self):
+        await asyncio.sleep(resume.resume_grace())
+        try:
+            # A no-op if the student resumed on another socket meanwhile
+            await self.leave_room()
+        except Exception as e:
+            logger.error(f"Error removing {self.username} after the resume grace period: {e}", exc_info=True)
+
+    def websocket_message(self, text_data=None, bytes_data=None):
+        # Frames are built as JSON text; binary sockets get them converted here
+        if text_data is not None:
+            if self.codec:
+                try:
+                    return {'type': 'websocket.send', 'bytes': self.codec.encode_text(text_data)}
+                except ValueError as e:
+                    # Binary sockets still read text frames, so this one goes out as it is
+                    logger.warning(f"Sending an unencodable frame to {self.username} as text: {e}")
+            return {'type': 'websocket.send', 'text': text_data}
+        if bytes_data is not None:
+            return {'type': 'websocket.send', 'bytes': bytes_data}
+        raise ValueError("You must pass one of bytes_data or text_data")
 
-    async def receive(self, text_data):
+    async def send(self, text_data=None, bytes_data=None, close=False):
+        await self.base_send(self.websocket_message(text_data, bytes_data))
+        if close:
+            await self.close(close)
+
+    async def send_broadcast(self, event):
+        # The group shares one JSON text; binary sockets share its packing, see binary.py
+        if self.codec:
+            await self.base_send({'type': 'websocket.send', 'bytes': binary.pack_broadcast(event['text'])})
+        else:
+            await self.send(text_data=event['text'])
+
+    async def receive(self, text_data=None, bytes_data=None):
+        started = time.perf_counter()
+        self.last_seen = asyncio.get_running_loop().time()
         try:
-            data = json.loads(text_data)
+            if bytes_data is not None and self.codec:
+                data, payload = self.codec.decode_frame(bytes_data)
+            elif text_data is not None:
+                # Size-checked before parsing; SDP envelopes only have their header decoded
+                data, payload = parse_frame(text_data)
+            else:
+                raise FrameError('unsupported_frame')
             message_type = data.get("type")
 
+            if message_type in PASSTHROUGH_FIELDS:
+                # Raw JSON text of the SDP, forwarded as-is to the recipient
+                data['raw_payload'] = payload if payload is not None else dumps(data[PASSTHROUGH_FIELDS[message_type]])
+
             handlers = {
                 "join": self.handle_join,
+                "resume": self.handle_resume,
+                "leave": self.handle_leave,
+                "heartbeat": self.handle_heartbeat,
                 "chat_message": self.handle_chat_message,
                 "permission_update": self.handle_permission_update,
+                "permission_bulk_update": self.handle_permission_bulk_update,
+                "breakout_assign": self.handle_breakout_assign,
+                "breakout_close": self.handle_breakout_close,
+                "roster_resync": self.handle_roster_resync,
+                "participant_query": self.handle_participant_query,
                 
                 # New Teacher -> Student stream signaling
                 "teacher_ready": self.handle_teacher_ready,
@@ -73,250 +235,814 @@ class ClassroomConsumer(AsyncWebsocketConsumer):
                 "student_answer": self.handle_student_answer, # Now targeted
                 
                 "ice_candidate": self.handle_ice_candidate, # Now targeted
+                "ice_candidates": self.handle_ice_candidates, # Batched form
                 "stream_stopped": self.handle_stream_stopped,
+                "stream_trace": self.handle_stream_trace,
+                "negotiation_failed": self.handle_negotiation_failed,
             }
 
             handler = handlers.get(message_type)
             if handler:
-                await handler(data)
+                metrics.frames_received.inc(message_type)
+                # Timed whatever happens, so throttled and failing frames show up too
+                outcome = 'error'
+                try:
+                    await self.rate_limiter.check(message_type)
+                    await handler(data)
+                    outcome = 'ok'
+                except ratelimit.RateLimited:
+                    outcome = 'throttled'
+                    raise
+                except FrameError:
+                    outcome = 'rejected'
+                    raise
+                finally:
+                    metrics.handler_seconds.observe(time.perf_counter() - started, message_type, outcome)
             else:
+                metrics.frames_rejected.inc('unknown_type')
                 logger.warning(f"Unknown message type received: {message_type}")
+        except ratelimit.RateLimited as e:
+            ratelimit.throttled.inc(e.message_type, e.scope)
+            if e.notify:
+                logger.warning(f"Throttling {e.message_type} from {self.username} in room {self.room_code} ({e.scope} limit)")
+                await self.send_error('rate_limited', message_type=e.message_type, scope=e.scope,
+                                      retry_after=round(e.retry_after, 2))
+        except FrameError as e:
+            metrics.frames_rejected.inc(e.code)
+            logger.warning(f"Rejected {e.message_type} frame: {e.code}")
+            await self.send_error(e.code, message_type=e.message_type, limit=e.limit)
         except json.JSONDecodeError:
+            metrics.frames_rejected.inc('invalid_json')
             logger.error("Received invalid JSON")
         except Exception as e:
+            metrics.frames_rejected.inc('handler_error')
             logger.error(f"Error processing message: {e}", exc_info=True)
 
     async def handle_join(self, data):
         self.username = data['username']
         self.is_teacher = data.get('is_teacher', False)
-        room = classrooms[self.room_code]
+        self.features = set(data.get('features', []))
+        self.webinar = await webinar.is_webinar(self.room_code)
 
         if self.is_teacher:
-            room['teacher'] = {'username': self.username, 'channel': self.channel_name}
+            await self.rooms.set_teacher(self.room_code, self.username, self.channel_name)
         else:
-            room['students'][self.username] = {'username': self.username, 'channel': self.channel_name, 'permissions': {}}
-        
-        await self.broadcast_student_list()
+            if resume.resume_grace():
+                self.session = resume.new_session()
+            student, version = await self.rooms.add_student(
+                self.room_code, self.username, self.channel_name, session=self.session,
+                permissions=await permissions.load(self.room_code, self.username)
+            )
+            # The joiner's own snapshot already includes them, so skip their socket
+            await self.broadcast_roster_delta(
+                'participant_added', version,
+                student=self.public_student(student),
+                exclude_channel=self.channel_name
+            )
+            # Back to the breakout they were in before leaving
+            breakout = await self.rooms.get_breakout(self.room_code, self.username)
+            if breakout is not None:
+                await self.enter_breakout(breakout, student['permissions'])
+                await self.send(text_data=dumps({'type': 'breakout', 'name': breakout}))
+        await self.rooms.touch(self.room_code)
+
+        # Room events after this one reach the socket live
+        seq = await self.rooms.event_seq(self.current_room_code) if self.session else None
+
+        # The joiner gets one full snapshot; everyone else only sees the delta
+        await self.send_roster_snapshot()
+        if self.is_teacher:
+            await self.send_breakouts(skip_empty=True)
+        if history_length():
+            await self.send_chat_history()
+        if self.session:
+            await self.send(text_data=dumps({
+                'type': 'session',
+                'resume_token': resume.issue_token(self.room_code, self.username, self.session),
+                'seq': seq
+            }))
         
+        if not self.is_teacher:
+            # Granted in an earlier visit to this class
+            for permission, status in student['permissions'].items():
+                if status:
+                    await self.permission_granted_broadcast({'permission': permission, 'status': status})
+
         # If student joins and teacher is already live, notify student
-        if not self.is_teacher and room.get('is_live'):
-            await self.send(text_data=json.dumps({'type': 'teacher_is_live'}))
+        if not self.is_teacher and await self.rooms.is_live(self.room_code):
+            await self.send(text_data=dumps({'type': 'teacher_is_live'}))
+
+    async def handle_resume(self, data):
+        # A student's page reconnecting after its socket dropped
+        claim = resume.read_token(data.get('resume_token'), self.room_code)
+        last_seq = data.get('last_seq')
+        student = None
+        if claim and isinstance(last_seq, int) and not isinstance(last_seq, bool):
+            username, session = claim
+            student = await self.rooms.resume_student(self.room_code, username, session, self.channel_name)
+        if not student:
+            resume.resumes.inc('failed')
+            await self.send(text_data=dumps({'type': 'resume_failed'}))
+            return
+
+        self.username = student['username']
+        self.session = student['session']
+        self.features = set(data.get('features', []))
+        self.webinar = await webinar.is_webinar(self.room_code)
+        breakout = await self.rooms.get_breakout(self.room_code, self.username)
+        if breakout is not None:
+            await self.enter_breakout(breakout, student['permissions'])
+        # A page moved while it was away has numbers from the other room
+        moved = data.get('breakout') != breakout
+        events = None if moved else await self.rooms.events_since(self.current_room_code, last_seq)
+        if events is not None:
+            resume.resumes.inc('resumed')
+            # Already encoded, so spliced in rather than decoded and re-encoded
+            await self.send(text_data='{"type":"resumed","resync":false,"events":[' + ','.join(events) + ']}')
+            return
+
+        # Missed more than the buffer holds, or moved: current state instead
+        resume.resumes.inc('resynced')
+        await self.send(text_data=dumps({
+            'type': 'resumed',
+            'resync': True,
+            'events': [],
+            'seq': await self.rooms.event_seq(self.current_room_code)
+        }))
+        if moved:
+            await self.send(text_data=dumps({'type': 'breakout', 'name': breakout}))
+        await self.send_roster_snapshot()
+        if history_length():
+            await self.send_chat_history()
+        if await self.rooms.is_live(self.room_code):
+            await self.send(text_data=dumps({'type': 'teacher_is_live'}))
+
+    async def handle_leave(self, data):
+        self.leaving = True
+
+    async def handle_heartbeat(self, data):
+        # The page echoing the reaper's heartbeat; receive() noted the time
+        pass
 
     async def handle_chat_message(self, data):
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                'type': 'chat_message_broadcast',
-                'message': data['message'],
-                'username': self.username
-            }
-        )
+        if not self.username:
+            raise FrameError('not_joined', 'chat_message')
+        message = data.get('message')
+        if not isinstance(message, str) or not message.strip():
+            raise FrameError('invalid_message', 'chat_message')
+        await self.group_send_frame('chat_message_broadcast', {
+            'type': 'chat_message',
+            'message': message,
+            'username': self.username
+        })
+        # Saved in the background, see chat.py
+        get_chat_writer().add(self.room_code, self.username, message, self.breakout or '')
 
     async def handle_permission_update(self, data):
         if self.is_teacher:
             student_name = data['student_name']
             permission = data['permission']
             status = data['status']
-            student_info = classrooms[self.room_code]['students'].get(student_name)
+            student_info, version = await self.rooms.set_permission(self.room_code, student_name, permission, status)
             if student_info:
-                student_info['permissions'][permission] = status
-                await self.channel_layer.send(student_info['channel'], {
+                await self.channel_send(student_info['channel'], {
                     'type': 'permission_granted_broadcast',
                     'permission': permission,
                     'status': status
                 })
+                await self.broadcast_roster_delta(
+                    'permissions_changed', version,
+                    username=student_name,
+                    permissions=student_info['permissions']
+                )
+                # A student in a breakout is also on the breakout's roster
+                breakout = await self.rooms.get_breakout(self.room_code, student_name)
+                if breakout is not None:
+                    breakout_info, version = await self.rooms.set_permission(
+                        breakouts.room_code(self.room_code, breakout), student_name, permission, status
+                    )
+                    if breakout_info:
+                        await self.broadcast_roster_delta(
+                            'permissions_changed', version, breakout,
+                            username=student_name,
+                            permissions=breakout_info['permissions']
+                        )
+                await permissions.save(self.room_code, [student_info])
+
+    async def handle_permission_bulk_update(self, data):
+        # One permission for all students, a list or a name pattern, see permissions.py
+        if not self.is_teacher:
+            return
+        permission = data['permission']
+        status = data['status']
+        students = await self.rooms.list_students(self.room_code)
+        selected = permissions.select(students, data.get('students'), data.get('pattern'))
+        updated, version = await self.rooms.set_permissions(self.room_code, selected, {permission: status})
+        if not updated:
+            return
+        usernames = [student['username'] for student in updated]
+        logger.info(f"{self.username} set {permission}={status} for {len(usernames)} students in room {self.room_code}")
+        # Class-wide changes name nobody, so no socket gets or searches the whole class's names
+        everyone = len(updated) == len(students)
+        assignments = await self.rooms.get_breakouts(self.room_code)
+        groups = {None: []}
+        for username in usernames:
+            groups.setdefault(assignments.get(username), []).append(username)
+        for breakout, names in groups.items():
+            selection = {'all': True} if everyone else {'usernames': names}
+            if breakout is not None:
+                _, breakout_version = await self.rooms.set_permissions(
+                    breakouts.room_code(self.room_code, breakout), names, {permission: status}
+                )
+                if breakout_version is not None:
+                    await self.broadcast_roster_delta(
+                        'permissions_bulk_changed', breakout_version, breakout,
+                        **selection, permission=permission, status=status
+                    )
+            if names:
+                # Each group only hears about its own students
+                await room_broadcast(self.channel_layer, breakouts.group_name(self.room_code, breakout), {
+                    'type': 'permission_bulk_broadcast',
+                    **selection,
+                    'permission': permission,
+                    'status': status
+                })
+        await self.broadcast_roster_delta(
+            'permissions_bulk_changed', version,
+            **({'all': True} if everyone else {'usernames': usernames}),
+            permission=permission,
+            status=status
+        )
+        await permissions.save(self.room_code, updated)
+
+    async def handle_breakout_assign(self, data):
+        # Teacher moves students into breakouts or back (None), see breakouts.py
+        if not self.is_teacher:
+            return
+        assignments = breakouts.parse_assignments(data.get('assignments'))
+        students = {student['username']: student for student in await self.rooms.list_students(self.room_code)}
+        assignments = {username: breakout for username, breakout in assignments.items() if username in students}
+        if not assignments:
+            return
+        await self.rooms.assign_breakouts(self.room_code, assignments)
+        logger.info(f"{self.username} moved {len(assignments)} students between breakouts in room {self.room_code}")
+        for username, breakout in assignments.items():
+            # Each student's own consumer switches its groups
+            await self.channel_send(students[username]['channel'], {'type': 'breakout_move', 'breakout': breakout})
+        await self.send_breakouts()
+
+    async def handle_breakout_close(self, data):
+        # Everyone back to the main room
+        if not self.is_teacher:
+            return
+        assignments = await self.rooms.close_breakouts(self.room_code)
+        for student in await self.rooms.list_students(self.room_code):
+            if student['username'] in assignments:
+                await self.channel_send(student['channel'], {'type': 'breakout_move', 'breakout': None})
+        logger.info(f"{self.username} closed the breakouts in room {self.room_code}")
+        await self.send_breakouts()
+
+    async def handle_roster_resync(self, data):
+        # Client spotted a gap in roster versions and wants a fresh snapshot
+        await self.send_roster_snapshot()
+
+    async def handle_participant_query(self, data):
+        # One page of the participant panel, see webinar.py
+        try:
+            search, after, limit = webinar.parse_query(data.get('search'), data.get('after'), data.get('limit'))
+        except ValueError:
+            raise FrameError('invalid_query', 'participant_query') from None
+        students, cursor, total = webinar.page(await self.rooms.list_students(self.room_code), search, after, limit)
+        await self.send(text_data=dumps({
+            'type': 'participant_page',
+            'search': search,
+            'after': after,
+            'students': [self.public_student(s) for s in students],
+            'next': cursor,
+            'total': total
+        }))
 
     # --- Teacher -> Many Students Signaling ---
     async def handle_teacher_ready(self, data):
         if self.is_teacher:
-            classrooms[self.room_code]['is_live'] = True
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {'type': 'teacher_is_live_broadcast'}
-            )
+            await self.rooms.set_live(self.room_code, True)
+            await self.class_send_frame('teacher_is_live_broadcast', {'type': 'teacher_is_live'})
 
     async def handle_request_stream(self, data):
         # Student sends this to request the teacher's stream
-        teacher_channel = classrooms[self.room_code].get('teacher', {}).get('channel')
-        if teacher_channel:
-            await self.channel_layer.send(teacher_channel, {
+        trace_id = tracing.new_trace_id(data.get("trace_id"))
+        self.stream_traces[trace_id] = time.perf_counter()
+        while len(self.stream_traces) > tracing.MAX_PENDING:
+            self.stream_traces.pop(next(iter(self.stream_traces)))
+
+        teacher = await self.rooms.get_teacher(self.room_code)
+        if teacher:
+            logger.debug(f"[trace {trace_id}] {self.username} requested the stream")
+            upload_kbps = data.get("upload_kbps")
+            await self.channel_send(teacher['channel'], {
                 "type": "student_requesting_stream",
-                "from_user": self.username
+                "from_user": self.username,
+                "trace_id": trace_id,
+                "reply_channel": self.channel_name,
+                # Relay placement, see relay.py
+                "upload_kbps": upload_kbps if isinstance(upload_kbps, (int, float)) else None
             })
 
     async def handle_offer(self, data):
         # Teacher sends this offer to a specific student
         target_user = data.get("target_user")
-        student_info = classrooms[self.room_code]['students'].get(target_user)
+        if target_user == sfu.SFU_PEER:
+            if self.is_teacher and sfu.sfu_enabled():
+                await self.publish_to_sfu(data)
+            return
+        if not self.is_teacher and target_user not in self.relay_children:
+            # Students only send the stream on to students the relay tree gave them
+            logger.warning(f"{self.username} sent an offer to {target_user}, who it does not relay to")
+            return
+        student_info = await self.rooms.get_student(self.room_code, target_user)
         if student_info:
-            await self.channel_layer.send(student_info['channel'], {
+            trace = tracing.trace_fields(data)
+            logger.debug(f"[trace {trace.get('trace_id')}] offer {self.username} -> {target_user}")
+            await self.channel_send(student_info['channel'], {
                 "type": "offer_broadcast",
-                "offer": data["offer"],
-                "from_user": self.username
+                "payload": data["raw_payload"],
+                "from_user": self.username,
+                "relay": not self.is_teacher,
+                **trace
             })
 
     async def handle_answer(self, data):
-        # Student's answer to the teacher's offer. Sent only to the teacher.
-        teacher_channel = classrooms[self.room_code].get('teacher', {}).get('channel')
-        if teacher_channel:
-            await self.channel_layer.send(teacher_channel, {
+        # Student's answer to the teacher's offer. Sent only to the teacher,
+        # or to the student relaying the stream to this one.
+        target_user = data.get("target_user")
+        if target_user is not None and target_user == self.relay_parent:
+            target_channel = await self.rooms.get_channel(self.room_code, target_user)
+        else:
+            teacher = await self.rooms.get_teacher(self.room_code)
+            target_channel = teacher['channel'] if teacher else None
+        if target_channel:
+            trace = tracing.trace_fields(data)
+            logger.debug(f"[trace {trace.get('trace_id')}] answer {self.username} -> {target_user or 'teacher'}")
+            await self.channel_send(target_channel, {
                 "type": "answer_received",
-                "answer": data["answer"],
-                "from_user": self.username
+                "payload": data["raw_payload"],
+                "from_user": self.username,
+                "to_sfu": data.get("target_user") == sfu.SFU_PEER,
+                **trace
             })
 
     # --- Student -> Teacher Signaling ---
     async def handle_student_offer(self, data):
-        teacher_channel = classrooms[self.room_code].get('teacher', {}).get('channel')
-        if teacher_channel:
-            await self.channel_layer.send(teacher_channel, {
+        teacher = await self.rooms.get_teacher(self.room_code)
+        if teacher:
+            await self.channel_send(teacher['channel'], {
                 'type': 'student_offer_received',
-                'offer': data['offer'],
+                'payload': data['raw_payload'],
                 'from_user': self.username
             })
 
     async def handle_student_answer(self, data):
         # Teacher sends this answer to a specific student's offer
         target_user = data.get("target_user")
-        student_info = classrooms[self.room_code]['students'].get(target_user)
+        student_info = await self.rooms.get_student(self.room_code, target_user)
         if student_info:
-            await self.channel_layer.send(student_info['channel'], {
+            await self.channel_send(student_info['channel'], {
                 "type": "student_answer_broadcast",
-                "answer": data["answer"],
+                "payload": data["raw_payload"],
                 "from_user": self.username
             })
 
     async def handle_ice_candidate(self, data):
+        # Single candidate from older clients; batched on the server all the same
         target_user = data.get("target_user")
-        room = classrooms.get(self.room_code, {})
-        target_channel = None
+        if target_user:
+            await self.ice_batcher.add(
+                target_user,
+                data.get("is_teacher_stream", False), # Helps client distinguish candidates
+                parse_candidates([data.get("candidate")], 'ice_candidate')
+            )
+        else:
+            logger.warning("ICE candidate without target user")
 
+    async def handle_ice_candidates(self, data):
+        target_user = data.get("target_user")
         if target_user:
-            if target_user == room.get('teacher', {}).get('username'):
-                target_channel = room.get('teacher', {}).get('channel')
-            else:
-                target_channel = room.get('students', {}).get(target_user, {}).get('channel')
-        
-        if target_channel:
-            await self.channel_layer.send(target_channel, {
-                "type": "ice_candidate_broadcast",
-                "candidate": data["candidate"],
-                "from_user": self.username,
-                "is_teacher_stream": data.get("is_teacher_stream", False) # Helps client distinguish candidates
-            })
+            await self.ice_batcher.add(
+                target_user,
+                data.get("is_teacher_stream", False),
+                parse_candidates(data.get("candidates", [])),
+                end_of_candidates=data.get("end_of_candidates", False),
+                trace_id=tracing.trace_fields(data).get("trace_id")
+            )
         else:
-            logger.warning(f"Could not find target user '{target_user}' for ICE candidate")
+            logger.warning("ICE candidates without target user")
 
-    async def handle_stream_stopped(self, data):
+    async def resolve_channel(self, target_user):
+        # Students address the teacher's connection as "teacher"; the SFU lives on the teacher's consumer
+        if target_user == sfu.SFU_PEER and self.is_teacher:
+            return self.channel_name
+        if target_user in ('teacher', sfu.SFU_PEER) and not self.is_teacher:
+            teacher = await self.rooms.get_teacher(self.room_code)
+            return teacher['channel'] if teacher else None
+        return await self.rooms.get_channel(self.room_code, target_user)
+
+    async def handle_negotiation_failed(self, data):
+        # Teacher's (or a relay's) browser could not set up the connection to a student
+        target_user = data.get("target_user")
         if self.is_teacher:
-            classrooms[self.room_code]['is_live'] = False
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                'type': 'stream_stopped_broadcast',
-                'username': self.username,
-                'is_teacher': self.is_teacher
-            }
+            await self.stream_admission.finish(target_user, 'failed')
+        elif target_user in self.relay_children:
+            # The student asks again and is placed under another relay
+            self.relay_children.discard(target_user)
+            channel = await self.rooms.get_channel(self.room_code, target_user)
+            if channel:
+                await self.channel_send(channel, {'type': 'stream_queue_update', 'status': 'failed'})
+
+    async def handle_stream_trace(self, data):
+        # Student's timings for a negotiation it started on this socket
+        trace_id = data.get("trace_id")
+        requested_at = self.stream_traces.pop(trace_id, None)
+        if requested_at is None:
+            return
+        try:
+            durations = tracing.record(self.room_code, data)
+        except ValueError as e:
+            logger.warning(f"[trace {trace_id}] Discarded stream trace from {self.username}: {e}")
+            return
+        logger.info(
+            f"[trace {trace_id}] {self.username} saw the first frame after {durations['total'] * 1000:.0f} ms "
+            f"(server saw {(time.perf_counter() - requested_at) * 1000:.0f} ms)"
         )
 
+    async def handle_stream_stopped(self, data):
+        if self.is_teacher:
+            await self.rooms.set_live(self.room_code, False)
+            self.stream_admission.close()
+            await self.close_sfu_session()
+            self.relay_tree = None
+        await self.class_send_frame('stream_stopped_broadcast', {
+            'type': 'stream_stopped',
+            'username': self.username,
+            'is_teacher': self.is_teacher
+        })
+
+    async def send_error(self, code, **details):
+        # Tell the client why a frame was rejected
+        await self.send(text_data=dumps({
+            'type': 'error',
+            'code': code,
+            **{k: v for k, v in details.items() if v is not None}
+        }))
+
+    async def publish_to_sfu(self, data):
+        # The teacher's browser publishes its stream once; the answer comes back from "sfu"
+        if self.sfu_session is None:
+            self.sfu_session = sfu.SfuSession(self.room_code)
+        answer = await self.sfu_session.publish(loads(data["raw_payload"]))
+        logger.info(f"{self.username} published to the SFU in room {self.room_code}")
+        await self.send(text_data=passthrough_frame("answer", dumps(answer), from_user=sfu.SFU_PEER))
+
+    async def close_sfu_session(self):
+        if self.sfu_session:
+            session, self.sfu_session = self.sfu_session, None
+            await session.close()
+
+    async def hls_ended(self, event):
+        # The class was ended: the recorder's thread finishes before its live window goes
+        await self.close_sfu_session()
+        await asyncio.get_running_loop().run_in_executor(None, hls.remove_live, self.room_code)
+
+    async def channel_send(self, channel, message):
+        # Targeted send to one consumer, timed for /metrics
+        started = time.perf_counter()
+        await self.channel_layer.send(channel, message)
+        metrics.layer_seconds.observe(time.perf_counter() - started, 'send')
+
     # --- BROADCASTERS / RECEIVERS ---
-    async def broadcast_student_list(self):
-        room = classrooms[self.room_code]
-        student_list = [
-            {
-                'username': s['username'],
-                'permissions': s.get('permissions', {})
-            } for s in room['students'].values()
-        ]
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                'type': 'student_list_broadcast',
-                'students': student_list
-            }
+    async def group_send_frame(self, event_type, frame):
+        # To the sender's room: the main one or its breakout
+        await self.room_send_frame(self.breakout, event_type, frame)
+
+    async def class_send_frame(self, event_type, frame):
+        # To the whole class: the main room and every breakout, numbered per room
+        for breakout in await self.class_breakouts():
+            await self.room_send_frame(breakout, event_type, frame)
+
+    async def room_send_frame(self, breakout, event_type, frame):
+        # Serialize the outbound frame once here; every receiver in the group
+        # writes the same text to its socket instead of re-encoding it.
+        await room_broadcast(
+            self.channel_layer,
+            breakouts.group_name(self.room_code, breakout),
+            {'type': event_type, 'text': await resume.encode_room_frame(breakouts.room_code(self.room_code, breakout), frame)}
         )
 
-    async def user_left_broadcast(self, event):
-        await self.send(text_data=json.dumps({
-            'type': 'user_left',
-            'username': event['username']
+    async def class_breakouts(self):
+        # None for the main room, then each open breakout
+        assignments = await self.rooms.get_breakouts(self.room_code)
+        return [None, *sorted(set(assignments.values()))]
+
+    @staticmethod
+    def public_student(student):
+        # Channel names stay on the server
+        return {
+            'username': student['username'],
+            'permissions': student.get('permissions', {})
+        }
+
+    @property
+    def counts_only(self):
+        # Webinar students in the main room, see webinar.py
+        return self.webinar and not self.is_teacher and self.breakout is None
+
+    async def send_roster_snapshot(self):
+        if self.counts_only:
+            await self.send(text_data=webinar.count_frame(await self.rooms.count_students(self.room_code)))
+            return
+        version, students = await self.rooms.roster_snapshot(self.current_room_code)
+        await self.send(text_data=dumps({
+            'type': 'roster_snapshot',
+            'version': version,
+            'students': [self.public_student(s) for s in students]
         }))
 
-    async def student_list_broadcast(self, event):
-        await self.send(text_data=json.dumps({
-            'type': 'student_list',
-            'students': event['students']
+    async def send_chat_history(self):
+        history = await get_chat_writer().recent(
+            self.room_code, self.connected_at, history_length(), self.breakout or ''
+        )
+        if history is None:
+            return
+        messages, before = history
+        await self.send(text_data=dumps({
+            'type': 'chat_history',
+            'messages': messages,
+            'before': before  # Cursor for older pages from the chat_history view
         }))
 
+    async def send_breakouts(self, skip_empty=False):
+        # Teacher's view of who is in which breakout
+        assignments = await self.rooms.get_breakouts(self.room_code)
+        if assignments or not skip_empty:
+            await self.send(text_data=dumps({'type': 'breakouts', 'assignments': assignments}))
+
+    def coalescer(self, breakout=None):
+        # Roster changes are coalesced per room, see coalescer.py; each breakout has its own
+        return get_coalescer(
+            self.channel_layer, breakouts.group_name(self.room_code, breakout), breakouts.room_code(self.room_code, breakout),
+            teacher_only=self.webinar and breakout is None
+        )
+
+    async def broadcast_roster_delta(self, change, version, breakout=None, **payload):
+        # change is one of participant_added, participant_removed, permissions_changed.
+        # The class roster unless a breakout is given
+        await self.coalescer(breakout).add_delta({
+            'type': change,
+            'version': version,
+            **payload
+        })
+        if self.webinar and breakout is None and change in ('participant_added', 'participant_removed'):
+            webinar.get_counter(self.channel_layer, self.room_group_name, self.room_code).touch()
+
+    async def room_batch_broadcast(self, event):
+        # Pre-encoded by the coalescer. Only sockets that must not see some of
+        # the deltas (their own join) decode and re-encode.
+        skip = event['exclude'].get(self.channel_name)
+        if not skip:
+            await self.send_broadcast(event)
+            return
+        batch = loads(event['text'])
+        batch['deltas'] = [d for d in batch['deltas'] if d['version'] not in skip]
+        if batch['deltas'] or batch['left']:
+            await self.send(text_data=dumps(batch))
+
+    async def participant_count_broadcast(self, event):
+        if self.counts_only:
+            await self.send_broadcast(event)
+
+    async def webinar_changed_broadcast(self, event):
+        # LiveClass.webinar changed during the class, see webinar.py
+        self.webinar = event['webinar']
+        if not self.is_teacher and self.breakout is None:
+            await self.send(text_data=webinar.mode_frame(self.webinar))
+            await self.send_roster_snapshot()
+
     async def chat_message_broadcast(self, event):
-        await self.send(text_data=json.dumps({
-            'type': 'chat_message',
-            'message': event['message'],
-            'username': event['username']
-        }))
+        # Signaling and roster batches waiting behind a chat go first, see chat.py
+        if not should_shed(self.channel_layer, self.channel_name, self.room_code):
+            await self.send_broadcast(event)
 
     async def permission_granted_broadcast(self, event):
-        await self.send(text_data=json.dumps({
+        await self.send(text_data=dumps({
             'type': 'permission_granted',
             'permission': event['permission'],
             'status': event['status']
         }))
 
+    async def breakout_move(self, event):
+        # The teacher moved this student; same socket, new group, see breakouts.py
+        breakout = event['breakout']
+        if self.is_teacher or not self.username or breakout == self.breakout:
+            return
+        try:
+            student = await self.rooms.get_student(self.room_code, self.username)
+            if not student or student['channel'] != self.channel_name:
+                return
+            await self.leave_breakout()
+            await self.enter_breakout(breakout, student['permissions'])
+            breakouts.moves.inc('main' if breakout is None else 'breakout')
+            frame = {'type': 'breakout', 'name': breakout}
+            if self.session:
+                # The new room numbers its events from here
+                frame['seq'] = await self.rooms.event_seq(self.current_room_code)
+            await self.send(text_data=dumps(frame))
+            await self.send_roster_snapshot()
+            if history_length():
+                await self.send_chat_history()
+        except Exception as e:
+            logger.error(f"Error moving {self.username} to breakout {breakout} in room {self.room_code}: {e}",
+                         exc_info=True)
+
+    async def permission_bulk_broadcast(self, event):
+        # Sent to a whole group; only the listed students, or all of them, act on it
+        if not self.is_teacher and (event.get('all') or self.username in event['usernames']):
+            await self.permission_granted_broadcast(event)
+
     async def teacher_is_live_broadcast(self, event):
         if not self.is_teacher: # Only send to students
-            await self.send(text_data=json.dumps({'type': 'teacher_is_live'}))
+            await self.send_broadcast(event)
 
     async def student_requesting_stream(self, event):
-        # This is received by the teacher's consumer
-        await self.send(text_data=json.dumps({
+        # This is received by the teacher's consumer; the browser gets it once admitted
+        sfu_live = self.sfu_session and self.sfu_session.publisher
+        try:
+            if event.get("reply_channel") and relay.relay_fanout() and not sfu_live:
+                await self.place_in_relay_tree(
+                    event["from_user"], event["reply_channel"], event.get("trace_id"), event.get("upload_kbps")
+                )
+            elif event.get("reply_channel"):
+                await self.stream_admission.request(event["from_user"], event["reply_channel"], event.get("trace_id"))
+            else:
+                await self.send_stream_request(event["from_user"], None, event.get("trace_id"))
+        except Exception as e:
+            logger.error(f"Error handling {event['from_user']}'s stream request: {e}", exc_info=True)
+            await self.stream_admission.finish(event["from_user"], 'failed')
+
+    async def send_stream_request(self, username, channel, trace_id):
+        if self.sfu_session and self.sfu_session.publisher:
+            await self.subscribe_to_sfu(username, channel, trace_id)
+            return
+        await self.send(text_data=dumps({
             "type": "student_requesting_stream",
-            "from_user": event["from_user"]
+            "from_user": username,
+            **tracing.trace_fields({"trace_id": trace_id})
         }))
 
-    async def offer_broadcast(self, event):
-        # Student receives this from teacher
-        await self.send(text_data=json.dumps({
-            "type": "offer",
-            "offer": event["offer"],
-            "from_user": event["from_user"]
+    async def subscribe_to_sfu(self, username, channel, trace_id):
+        # Answered here instead of by the teacher's browser; teacher_ms is the time the SFU took
+        started = time.perf_counter()
+        try:
+            offer = await self.sfu_session.subscribe(username)
+            channel = channel or await self.rooms.get_channel(self.room_code, username)
+        except Exception as e:
+            logger.error(f"SFU could not subscribe {username}: {e}", exc_info=True)
+            await self.stream_admission.finish(username, 'failed')
+            return
+        if channel:
+            await self.channel_send(channel, {
+                "type": "offer_broadcast",
+                "payload": dumps(offer),
+                "from_user": sfu.SFU_PEER,
+                **tracing.trace_fields({
+                    "trace_id": trace_id,
+                    "teacher_ms": round((time.perf_counter() - started) * 1000)
+                })
+            })
+
+    async def place_in_relay_tree(self, username, channel, trace_id, upload_kbps):
+        if self.relay_tree is None:
+            self.relay_tree = relay.RelayTree(self.username, relay.relay_fanout())
+        parent, moved = self.relay_tree.place(username, upload_kbps)
+        await self.request_relay(parent, username, channel, trace_id)
+        await self.request_relays(moved)
+
+    async def request_relay(self, parent, username, channel, trace_id):
+        # Ask the student's place in the tree to send it the stream
+        if parent == self.username:
+            # This browser's connections are still paced by the admission queue
+            await self.stream_admission.request(username, channel, trace_id)
+            return
+        parent_channel = await self.rooms.get_channel(self.room_code, parent)
+        if parent_channel is None:
+            # The relay left just now; its children, this student included, move
+            await self.relay_left({"username": parent})
+            return
+        logger.debug(f"[trace {trace_id}] {parent} relays the stream to {username}")
+        await self.channel_send(parent_channel, {
+            "type": "relay_request",
+            "from_user": username,
+            "trace_id": trace_id
+        })
+
+    async def leave_relay_tree(self):
+        teacher = await self.rooms.get_teacher(self.room_code)
+        if teacher:
+            await self.channel_send(teacher['channel'], {"type": "relay_left", "username": self.username})
+
+    async def relay_left(self, event):
+        # Teacher's consumer: a student left, so its children need a new relay
+        if self.relay_tree is None:
+            return
+        try:
+            await self.request_relays(self.relay_tree.remove(event["username"]))
+        except Exception as e:
+            logger.error(f"Error moving {event['username']}'s relay children: {e}", exc_info=True)
+
+    async def request_relays(self, moved):
+        for child, parent in moved:
+            channel = await self.rooms.get_channel(self.room_code, child)
+            if channel:
+                await self.request_relay(parent, child, channel, tracing.new_trace_id())
+
+    async def relay_request(self, event):
+        # Student's consumer: send the teacher stream on to another student
+        self.relay_children.add(event["from_user"])
+        await self.send(text_data=dumps({
+            "type": "relay_request",
+            "from_user": event["from_user"],
+            **tracing.trace_fields(event)
         }))
 
+    async def stream_queue_update(self, event):
+        # Student's place in the teacher's admission queue
+        await self.send(text_data=dumps({"type": "stream_queue", **{k: v for k, v in event.items() if k != 'type'}}))
+
+    # SDP receivers get the sender's raw payload as a string field, see framing.py
+    async def offer_broadcast(self, event):
+        # Student receives this from teacher, or from the student relaying the teacher stream
+        self.relay_parent = event["from_user"] if event.get("relay") else None
+        await self.send(text_data=passthrough_frame(
+            "offer", event["payload"], from_user=event["from_user"], **tracing.trace_fields(event)
+        ))
+
     async def answer_received(self, event):
         # Teacher receives this from student
-        await self.send(text_data=json.dumps({
-            "type": "answer",
-            "answer": event["answer"],
-            "from_user": event["from_user"]
-        }))
+        if event.get("to_sfu"):
+            if self.sfu_session:
+                try:
+                    await self.sfu_session.accept_answer(event["from_user"], loads(event["payload"]))
+                except Exception as e:
+                    # A bad answer from one student must not take the teacher's session down
+                    logger.error(f"SFU could not accept {event['from_user']}'s answer: {e}", exc_info=True)
+                    await self.stream_admission.finish(event["from_user"], 'failed')
+                    return
+        else:
+            await self.send(text_data=passthrough_frame(
+                "answer", event["payload"], from_user=event["from_user"], **tracing.trace_fields(event)
+            ))
+        await self.stream_admission.finish(event["from_user"], 'answered')
 
     async def student_offer_received(self, event):
         # Teacher receives this from student
-        await self.send(text_data=json.dumps({
-            "type": "student_offer",
-            "offer": event["offer"],
-            "from_user": event["from_user"]
-        }))
+        await self.send(text_data=passthrough_frame("student_offer", event["payload"], from_user=event["from_user"]))
 
     async def student_answer_broadcast(self, event):
         # Student receives this from teacher
-        await self.send(text_data=json.dumps({
-            "type": "student_answer",
-            "answer": event["answer"],
-            "from_user": event["from_user"]
-        }))
+        await self.send(text_data=passthrough_frame("student_answer", event["payload"], from_user=event["from_user"]))
 
     async def ice_candidate_broadcast(self, event):
         if event["from_user"] != self.username:
-            await self.send(text_data=json.dumps({
+            await self.send(text_data=dumps({
                 "type": "ice_candidate",
                 "candidate": event["candidate"],
                 "from_user": event["from_user"],
                 "is_teacher_stream": event.get("is_teacher_stream", False)
             }))
 
+    async def ice_candidates_broadcast(self, event):
+        if event.get("target_user") == sfu.SFU_PEER:
+            # Only the teacher's consumer resolves "sfu" to itself
+            if self.sfu_session:
+                from_user = None if event["from_user"] == self.username else event["from_user"]
+                try:
+                    await self.sfu_session.add_candidates(from_user, event["candidates"], event["end_of_candidates"])
+                except Exception as e:
+                    logger.error(f"SFU could not add {event['from_user']}'s ICE candidates: {e}", exc_info=True)
+            return
+        if event["from_user"] == self.username:
+            return
+        if 'ice_candidates' in self.features:
+            await self.send(text_data=dumps({
+                "type": "ice_candidates",
+                "candidates": event["candidates"],
+                "end_of_candidates": event["end_of_candidates"],
+                "from_user": event["from_user"],
+                "is_teacher_stream": event["is_teacher_stream"],
+                **tracing.trace_fields(event)
+            }))
+        else:
+            # Older clients only understand one candidate per frame
+            for candidate in event["candidates"]:
+                await self.ice_candidate_broadcast({**event, "candidate": candidate})
+
     async def stream_stopped_broadcast(self, event):
-        await self.send(text_data=json.dumps({
-            'type': 'stream_stopped',
-            'username': event['username'],
-            'is_teacher': event['is_teacher']
-        }))
+        await self.send_broadcast(event)
@@ -0,0 +1,27 @@
+"""
+JSON encoding for WebSocket frames.
+
+Uses orjson when it is installed and falls back to the standard library
+otherwise. Broadcasts are encoded once by the sender and the resulting text
+is carried in the channel layer event, so receivers only write it out.
+"""
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+if orjson is not None:
+    def dumps(obj):
+        return orjson.dumps(obj).decode()
+
+    def loads(text):
+        # orjson.JSONDecodeError subclasses json.JSONDecodeError
+        return orjson.loads(text)
+else:
+    def dumps(obj):
+        return json.dumps(obj, separators=(',', ':'))
+
+    loads = json.loads
@@ -0,0 +1,105 @@
+"""
+Inbound frame parsing, size limits and opaque SDP passthrough.
+
+SDP offers and answers are several KB and the server only needs to know who
+they are for. Clients may send them as an envelope: a small JSON routing
+header, a newline, then the payload as JSON text:
+
+    {"type":"offer","target_user":"bob"}\\n{"type":"offer","sdp":"v=0..."}
+
+The payload is never decoded: it travels through the channel layer as text
+and reaches the recipient as a JSON string field, which the page parses.
+Being a string, it cannot add keys to the frame around it, whatever it
+holds. Plain JSON frames keep working for older clients.
+
+Every frame is checked against ``CLASSROOM_MAX_FRAME_SIZES`` for its type
+before it is parsed.
+"""
+import re
+
+from django.conf import settings
+
+from .encoding import dumps, loads
+
+# Message types that may be sent as an envelope, and the field carrying the payload
+PASSTHROUGH_FIELDS = {
+    'offer': 'offer',
+    'answer': 'answer',
+    'student_offer': 'offer',
+    'student_answer': 'answer',
+}
+
+# Longest routing header accepted in an envelope
+HEADER_LIMIT = 1024
+
+DEFAULT_FRAME_SIZES = {
+    'default': 16 * 1024,
+    'offer': 64 * 1024,
+    'answer': 64 * 1024,
+    'student_offer': 64 * 1024,
+    'student_answer': 64 * 1024,
+    'chat_message': 4 * 1024,
+}
+
+# JSON.stringify puts "type" first since every client message is built that way
+TYPE_PREFIX = re.compile(r'\{\s*"type"\s*:\s*"(\w{1,64})"')
+
+
+class FrameError(Exception):
+    """A frame was rejected before it reached a handler."""
+
+    def __init__(self, code, message_type=None, limit=None):
+        super().__init__(code)
+        self.code = code
+        self.message_type = message_type
+        self.limit = limit
+
+
+def frame_limits():
+    return {**DEFAULT_FRAME_SIZES, **getattr(settings, 'CLASSROOM_MAX_FRAME_SIZES', {})}
+
+
+def parse_frame(text):
+    """
+    Parse an inbound text frame. Returns ``(data, payload)`` where
+    ``payload`` is the raw JSON text of an envelope, or None for plain frames.
+    Raises FrameError for oversized or malformed envelopes; invalid JSON
+    raises json.JSONDecodeError as before.
+    """
+    limits = frame_limits()
+    split = text.find('\n', 0, HEADER_LIMIT + 1)
+    if split != -1:
+        data = loads(text[:split])
+        message_type = data.get('type')
+        if message_type not in PASSTHROUGH_FIELDS:
+            raise FrameError('unsupported_envelope', message_type)
+        payload = text[split + 1:].strip()
+        limit = limits.get(message_type, limits['default'])
+        if len(payload) > limit:
+            raise FrameError('frame_too_large', message_type, limit)
+        # Only a cheap look at the ends; the page parses the rest
+        if not (payload.startswith('{') and payload.endswith('}')):
+            raise FrameError('invalid_payload', message_type)
+        return data, payload
+
+    match = TYPE_PREFIX.match(text)
+    message_type = match.group(1) if match else None
+    limit = limits.get(message_type, limits['default']) if match else max(limits.values())
+    if len(text) > limit:
+        raise FrameError('frame_too_large', message_type, limit)
+    data = loads(text)
+    if not match:
+        message_type = data.get('type')
+        limit = limits.get(message_type, limits['default'])
+        if len(text) > limit:
+            raise FrameError('frame_too_large', message_type, limit)
+    return data, None
+
+
+def passthrough_frame(message_type, payload, **fields):
+    """
+    Build an outbound frame around a raw payload, carried as a string so the
+    only keys in the frame are the server's.
+    """
+    field = PASSTHROUGH_FIELDS[message_type]
+    return dumps({field: payload, 'type': message_type, **fields})
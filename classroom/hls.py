@@ -0,0 +1,336 @@
+"""
+HLS output of the teacher stream for view-only students.
+
+Every WebRTC viewer costs a peer connection. With ``CLASSROOM_HLS_ENABLED``
+(on top of the SFU, which is how the stream reaches the server) students
+instead watch short segments and a playlist written under
+``CLASSROOM_HLS_ROOT``, so each viewer costs one HTTP GET per segment that
+nginx serves from disk. Latency is a few segment lengths.
+
+Per room:
+
+    <root>/<room code>/live/index.m3u8          rolling window, old segments deleted
+    <root>/<room code>/recordings/<start>/      every segment, kept for playback
+
+The SFU session hands each encoded frame to an ``HlsRecorder``, which
+decodes, encodes to H.264/AAC once and muxes into both playlists on its own
+thread, so the event loop only queues frames. When the teacher ends the
+classroom, ``end_live`` has the teacher's consumer stop the recorder, wait
+for its thread and only then remove the live window. Recordings are kept
+for ``CLASSROOM_HLS_RECORDING_DAYS`` days after they were last written;
+each new recording first removes the expired ones of every room.
+
+nginx asks the ``hls_access`` view before serving anything under
+``/hls/``: a signed-in user may fetch a room's files if the class exists,
+the same rule as for opening the classroom page.
+
+PyAV comes with aiortc, see sfu.py.
+"""
+import asyncio
+import fractions
+import logging
+import queue
+import re
+import shutil
+import threading
+import time
+from pathlib import Path
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from . import metrics
+from .rooms import get_room_store
+from .sharding import channel_layer_alias_for_room
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SEGMENT_SECONDS = 2
+DEFAULT_LIVE_SEGMENTS = 6
+DEFAULT_VIDEO_KBPS = 1500
+DEFAULT_RECORDING_DAYS = 30
+
+# Encoded frames waiting for the transcoder before new ones are dropped
+QUEUE_SIZE = 256
+
+VIDEO_TIME_BASE = fractions.Fraction(1, 90000)
+AUDIO_RATE = 48000
+
+# Room codes become directory names
+ROOM_CODE = re.compile(r'^[A-Za-z0-9_-]{1,32}$')
+
+hls_frames = metrics.Counter(
+    'classroom_hls_frames_total',
+    'Teacher frames handed to the HLS transcoder (queued) or dropped because it fell behind, by kind.',
+    ['outcome', 'kind'])
+
+
+def hls_enabled():
+    return getattr(settings, 'CLASSROOM_HLS_ENABLED', False)
+
+
+def hls_root():
+    return Path(getattr(settings, 'CLASSROOM_HLS_ROOT', Path(settings.BASE_DIR) / 'hls'))
+
+
+def room_dir(room_code):
+    if not ROOM_CODE.match(room_code):
+        raise ValueError(f"Room code {room_code!r} can't be used as a directory name")
+    return hls_root() / room_code
+
+
+def room_for_uri(uri):
+    """The room code a request for ``CLASSROOM_HLS_URL`` files is for, or None."""
+    prefix = getattr(settings, 'CLASSROOM_HLS_URL', '/hls/')
+    if not uri.startswith(prefix):
+        return None
+    room_code = uri[len(prefix):].split('/', 1)[0]
+    return room_code if ROOM_CODE.match(room_code) else None
+
+
+def playlist_url(room_code):
+    return f"{getattr(settings, 'CLASSROOM_HLS_URL', '/hls/')}{room_code}/live/index.m3u8"
+
+
+def latest_recording_url(room_code):
+    """URL of the room's most recent recording playlist, or None."""
+    try:
+        recordings = sorted((room_dir(room_code) / 'recordings').glob('*/index.m3u8'))
+    except ValueError:
+        return None
+    if not recordings:
+        return None
+    return f"{getattr(settings, 'CLASSROOM_HLS_URL', '/hls/')}{room_code}/recordings/{recordings[-1].parent.name}/index.m3u8"
+
+
+def remove_live(room_code):
+    try:
+        shutil.rmtree(room_dir(room_code) / 'live', ignore_errors=True)
+    except ValueError:
+        pass
+
+
+def prune_recordings():
+    """Remove recordings last written more than ``CLASSROOM_HLS_RECORDING_DAYS`` ago."""
+    days = getattr(settings, 'CLASSROOM_HLS_RECORDING_DAYS', DEFAULT_RECORDING_DAYS)
+    if not days:
+        return 0
+    cutoff = time.time() - days * 24 * 3600
+    removed = 0
+    # A recording's directory changes whenever a segment is added to it
+    for recording in hls_root().glob('*/recordings/*/'):
+        if recording.stat().st_mtime < cutoff:
+            shutil.rmtree(recording, ignore_errors=True)
+            removed += 1
+    if removed:
+        logger.info(f"Removed {removed} HLS recordings older than {days} days")
+    return removed
+
+
+async def end_live(room_code):
+    """Remove the room's live window once nothing writes to it any more."""
+    teacher = await get_room_store().get_teacher(room_code)
+    if teacher is None:
+        # No teacher socket, so no recorder
+        remove_live(room_code)
+        return
+    # The recorder belongs to the teacher's consumer, maybe on another worker
+    channel_layer = get_channel_layer(channel_layer_alias_for_room(room_code))
+    await channel_layer.send(teacher['channel'], {'type': 'hls_ended'})
+
+
+def _copy_packet(packet, stream):
+    # Muxing takes the packet's data, so the second output gets its own copy
+    import av
+
+    copy = av.Packet(bytes(packet))
+    copy.pts, copy.dts, copy.time_base = packet.pts, packet.dts, packet.time_base
+    copy.is_keyframe = packet.is_keyframe
+    copy.stream = stream
+    return copy
+
+
+class HlsRecorder:
+    """Transcodes one published teacher stream into the live window and a recording."""
+
+    def __init__(self, room_code, kinds):
+        self.room_code = room_code
+        self.directory = room_dir(room_code)
+        self.kinds = set(kinds)
+        self.segment_seconds = getattr(settings, 'CLASSROOM_HLS_SEGMENT_SECONDS', DEFAULT_SEGMENT_SECONDS)
+        self.live_segments = getattr(settings, 'CLASSROOM_HLS_LIVE_SEGMENTS', DEFAULT_LIVE_SEGMENTS)
+        self.video_kbps = getattr(settings, 'CLASSROOM_HLS_VIDEO_KBPS', DEFAULT_VIDEO_KBPS)
+        self.frames = queue.Queue()
+        self.thread = None
+        self.started = None
+
+    def push(self, kind, codec, encoded_frame):
+        """Queue an encoded frame from the event loop; False if it was dropped."""
+        if self.thread is None:
+            self.started = time.monotonic()
+            self.thread = threading.Thread(target=self._run, name=f'hls-{self.room_code}', daemon=True)
+            self.thread.start()
+        if self.frames.qsize() >= QUEUE_SIZE:
+            hls_frames.inc('dropped', kind)
+            return False
+        self.frames.put((kind, codec.mimeType, encoded_frame.data, time.monotonic() - self.started))
+        hls_frames.inc('queued', kind)
+        return True
+
+    async def close(self):
+        if self.thread:
+            self.frames.put(None)
+            await asyncio.get_running_loop().run_in_executor(None, self.thread.join)
+            self.thread = None
+
+    def _run(self):
+        try:
+            _Transcoder(self).run()
+        except Exception as e:
+            logger.error(f"HLS output for room {self.room_code} stopped: {e}", exc_info=True)
+            # Keep draining so the event loop never blocks on a full queue
+            while self.frames.get() is not None:
+                pass
+
+
+class _Transcoder:
+    """Runs on the recorder's thread; owns every PyAV object."""
+
+    def __init__(self, recorder):
+        import av
+
+        self.recorder = recorder
+        self.decoders = {
+            'video/vp8': av.CodecContext.create('vp8', 'r'),
+            'audio/opus': av.CodecContext.create('opus', 'r'),
+        }
+        self.outputs = None  # [(container, {kind: stream})], live first
+        self.resampler = av.AudioResampler(format='fltp', layout='stereo', rate=AUDIO_RATE)
+        self.fifo = av.AudioFifo()
+        self.audio_pts = None
+        self.last_video_pts = -1
+
+    def run(self):
+        import av
+
+        recorder = self.recorder
+        while True:
+            item = recorder.frames.get()
+            if item is None:
+                break
+            kind, mime_type, data, arrival = item
+            decoder = self.decoders.get(mime_type.lower())
+            if decoder is None:
+                continue
+            try:
+                frames = decoder.decode(av.Packet(data))
+            except av.error.FFmpegError:
+                continue  # e.g. frames after a drop, until the next keyframe
+            for frame in frames:
+                if kind == 'video':
+                    self.write_video(frame, arrival)
+                else:
+                    self.write_audio(frame, arrival)
+        self.close()
+
+    def open_outputs(self, width, height):
+        import av
+
+        recorder = self.recorder
+        live_dir = recorder.directory / 'live'
+        recording_dir = recorder.directory / 'recordings' / time.strftime('%Y%m%d-%H%M%S')
+        try:
+            prune_recordings()
+        except OSError as e:
+            logger.error(f"Error removing old HLS recordings: {e}", exc_info=True)
+        # The live window restarts with each session; segment names stay unique
+        # so caches never serve a previous session's segment
+        shutil.rmtree(live_dir, ignore_errors=True)
+        live_dir.mkdir(parents=True)
+        recording_dir.mkdir(parents=True)
+        prefix = recording_dir.name
+        segment = str(recorder.segment_seconds)
+        live = av.open(str(live_dir / 'index.m3u8'), 'w', format='hls', options={
+            'hls_time': segment,
+            'hls_list_size': str(recorder.live_segments),
+            'hls_flags': 'delete_segments+independent_segments+temp_file',
+            'hls_segment_filename': str(live_dir / f'{prefix}-%d.ts'),
+        })
+        recording = av.open(str(recording_dir / 'index.m3u8'), 'w', format='hls', options={
+            'hls_time': segment,
+            'hls_list_size': '0',
+            'hls_playlist_type': 'event',
+            'hls_segment_filename': str(recording_dir / '%05d.ts'),
+        })
+
+        streams = {}
+        if 'video' in recorder.kinds:
+            video = live.add_stream('libx264')
+            video.width, video.height, video.pix_fmt = width, height, 'yuv420p'
+            video.bit_rate = recorder.video_kbps * 1000
+            video.codec_context.time_base = VIDEO_TIME_BASE
+            # A keyframe per segment so every segment starts cleanly
+            video.codec_context.gop_size = 30 * recorder.segment_seconds
+            video.codec_context.options = {'preset': 'veryfast', 'tune': 'zerolatency'}
+            streams['video'] = video
+        if 'audio' in recorder.kinds:
+            audio = live.add_stream('aac', rate=AUDIO_RATE)
+            audio.codec_context.layout = 'stereo'
+            streams['audio'] = audio
+
+        recording_streams = {}
+        for kind, stream in streams.items():
+            # Opened first so the copy carries the SPS/PPS and AAC config
+            stream.codec_context.open()
+            recording_streams[kind] = recording.add_stream_from_template(stream)
+            recording_streams[kind].codec_context.extradata = stream.codec_context.extradata
+        self.outputs = [(live, streams), (recording, recording_streams)]
+        logger.info(f"HLS output for room {recorder.room_code} started in {recording_dir}")
+
+    def mux(self, kind, packets):
+        live, streams = self.outputs[0]
+        recording, recording_streams = self.outputs[1]
+        for packet in packets:
+            recording.mux(_copy_packet(packet, recording_streams[kind]))
+            live.mux(packet)
+
+    def write_video(self, frame, arrival):
+        if self.outputs is None:
+            self.open_outputs(frame.width - frame.width % 2, frame.height - frame.height % 2)
+        stream = self.outputs[0][1]['video']
+        # The teacher's resolution may change with bandwidth; the output's can't
+        frame = frame.reformat(stream.width, stream.height, 'yuv420p')
+        pts = round(arrival / VIDEO_TIME_BASE)
+        if pts <= self.last_video_pts:
+            return
+        frame.pts, frame.time_base = pts, VIDEO_TIME_BASE
+        self.last_video_pts = pts
+        frame.pict_type = 0  # Let the encoder choose
+        self.mux('video', stream.encode(frame))
+
+    def write_audio(self, frame, arrival):
+        if self.outputs is None:
+            if 'video' in self.recorder.kinds:
+                return  # Output sizes come from the first video frame
+            self.open_outputs(0, 0)
+        stream = self.outputs[0][1]['audio']
+        if self.audio_pts is None:
+            self.audio_pts = round(arrival * AUDIO_RATE)
+        frame.pts = None
+        for resampled in self.resampler.resample(frame):
+            self.fifo.write(resampled)
+        frame_size = stream.codec_context.frame_size
+        while self.fifo.samples >= frame_size:
+            chunk = self.fifo.read(frame_size)
+            chunk.pts, chunk.time_base = self.audio_pts, fractions.Fraction(1, AUDIO_RATE)
+            self.audio_pts += frame_size
+            self.mux('audio', stream.encode(chunk))
+
+    def close(self):
+        if self.outputs is None:
+            return
+        for kind, stream in self.outputs[0][1].items():
+            self.mux(kind, stream.encode(None))
+        for container, _ in self.outputs:
+            container.close()
+        logger.info(f"HLS output for room {self.recorder.room_code} finished")
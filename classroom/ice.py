@@ -0,0 +1,96 @@
+"""
+Batching of trickle ICE candidates between peers.
+
+A single RTCPeerConnection gathers dozens of candidates within a few
+milliseconds, and the teacher keeps one connection per student. Each consumer
+buffers outgoing candidates per (target, stream) pair for
+``CLASSROOM_ICE_BATCH_WINDOW`` seconds and relays them as one
+``ice_candidates_broadcast`` channel message. An end-of-candidates marker
+flushes the pair immediately.
+"""
+import asyncio
+import logging
+
+from django.conf import settings
+
+from .framing import FrameError
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BATCH_WINDOW = 0.01
+
+# Counters for this worker
+stats = {
+    'candidates': 0,  # candidates received from clients
+    'messages': 0,    # channel layer messages sent for them
+}
+
+
+def parse_candidates(candidates, message_type='ice_candidates'):
+    """Check a frame's list of candidate objects."""
+    if not isinstance(candidates, list) or not all(isinstance(candidate, dict) for candidate in candidates):
+        raise FrameError('invalid_payload', message_type)
+    return candidates
+
+
+class IceCandidateBatcher:
+    """Per-consumer buffer of outgoing ICE candidates, keyed by (target_user, is_teacher_stream)."""
+
+    def __init__(self, consumer):
+        self.consumer = consumer
+        self.window = getattr(settings, 'CLASSROOM_ICE_BATCH_WINDOW', DEFAULT_BATCH_WINDOW)
+        self.pending = {}
+        self.tasks = {}
+
+    async def add(self, target_user, is_teacher_stream, candidates, end_of_candidates=False, trace_id=None):
+        key = (target_user, bool(is_teacher_stream))
+        batch = self.pending.setdefault(key, {'candidates': [], 'end_of_candidates': False, 'trace_id': None})
+        batch['candidates'].extend(candidates)
+        batch['end_of_candidates'] = batch['end_of_candidates'] or end_of_candidates
+        batch['trace_id'] = trace_id or batch['trace_id']
+        stats['candidates'] += len(candidates)
+
+        if end_of_candidates or self.window <= 0:
+            task = self.tasks.pop(key, None)
+            if task:
+                task.cancel()
+            await self.flush(key)
+        elif key not in self.tasks:
+            self.tasks[key] = asyncio.get_running_loop().create_task(self._flush_later(key))
+
+    async def _flush_later(self, key):
+        await asyncio.sleep(self.window)
+        self.tasks.pop(key, None)
+        try:
+            await self.flush(key)
+        except Exception as e:
+            logger.error(f"Error relaying ICE candidates: {e}", exc_info=True)
+
+    async def flush(self, key):
+        batch = self.pending.pop(key, None)
+        if not batch:
+            return
+        target_user, is_teacher_stream = key
+        # One room store lookup per batch instead of per candidate
+        target_channel = await self.consumer.resolve_channel(target_user)
+        if not target_channel:
+            logger.warning(f"Could not find target user '{target_user}' for ICE candidates")
+            return
+
+        stats['messages'] += 1
+        await self.consumer.channel_send(target_channel, {
+            "type": "ice_candidates_broadcast",
+            "candidates": batch['candidates'],
+            "end_of_candidates": batch['end_of_candidates'],
+            "from_user": self.consumer.username,
+            "target_user": target_user,
+            "is_teacher_stream": is_teacher_stream,
+            "trace_id": batch['trace_id'],
+        })
+
+    def close(self):
+        # The sender is gone; its candidates are useless to the peer
+        for task in self.tasks.values():
+            task.cancel()
+        self.tasks.clear()
+        self.pending.clear()
@@ -0,0 +1,124 @@
+"""
+Channel layers for the classroom project.
+
+``HybridRedisChannelLayer`` is a drop-in replacement for channels_redis'
+``RedisChannelLayer``. Targeted sends (offer, answer, ICE candidates,
+permission changes) to a consumer living in the same daphne process are put
+straight into the layer's in-memory receive buffer instead of taking a round
+trip through Redis. Everything else, including group sends, goes through
+Redis unchanged.
+
+One consumer at a time holds channels_redis' receive lock and waits in
+BZPOPMIN for the whole process, so a local delivery to that consumer would
+otherwise sit in its buffer until unrelated Redis traffic arrived. Local
+sends wake it up; the Redis read it was waiting on is kept running and
+picked up again by the next lock holder, so no message is lost to a
+cancelled read.
+"""
+import asyncio
+import time
+
+from channels_redis.core import RedisChannelLayer
+
+
+def channel_backlog(layer, channel):
+    """
+    Messages waiting in this process for ``channel`` to be dispatched to its
+    consumer: the in-memory layer's queue or channels_redis' receive buffer.
+    0 for a layer that keeps neither.
+    """
+    queue = getattr(layer, 'receive_buffer', {}).get(channel)
+    if queue is None:
+        queue = getattr(layer, 'channels', {}).get(channel)
+    return queue.qsize() if queue is not None else 0
+
+
+class HybridRedisChannelLayer(RedisChannelLayer):
+    # How often unread local buffers are checked against ``expiry``
+    sweep_interval = 10
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.local_sends = 0
+        self.remote_sends = 0
+        # Process-local channel -> time of the last message delivered locally
+        self._local_delivered_at = {}
+        self._last_sweep = time.time()
+        # Set by local sends to wake the receive lock holder, see receive_single
+        self._local_wakeup = None
+        # The process channel's Redis read, outliving the lock holder that started it
+        self._remote_receive = None
+        self._receive_loop = None
+
+    def is_local_channel(self, channel):
+        """True if ``channel`` was created by this layer instance, i.e. this process."""
+        return "!" in channel and self.non_local_name(channel).endswith(self.client_prefix + "!")
+
+    async def send(self, channel, message):
+        if not self.is_local_channel(channel):
+            self.remote_sends += 1
+            return await super().send(channel, message)
+
+        assert isinstance(message, dict), "message is not a dict"
+        assert "__asgi_channel__" not in message
+        self.local_sends += 1
+        # Copy, as the Redis path would hand the receiver a fresh dict
+        self.receive_buffer[channel].put_nowait(dict(message))
+
+        now = time.time()
+        self._local_delivered_at[channel] = now
+        if now - self._last_sweep > self.sweep_interval:
+            self._sweep_local_buffers(now)
+        if self._local_wakeup is not None:
+            self._local_wakeup.set()
+
+    async def receive_single(self, channel):
+        if "!" not in channel:
+            return await super().receive_single(channel)
+        loop = asyncio.get_running_loop()
+        if self._receive_loop is not loop:
+            self._receive_loop = loop
+            self._local_wakeup = asyncio.Event()
+            self._remote_receive = None
+        if self._remote_receive is None:
+            self._remote_receive = loop.create_task(super().receive_single(channel))
+        wakeup = loop.create_task(self._local_wakeup.wait())
+        try:
+            await asyncio.wait([self._remote_receive, wakeup], return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            wakeup.cancel()
+        if self._remote_receive.done():
+            remote_receive, self._remote_receive = self._remote_receive, None
+            return remote_receive.result()
+        # A local send arrived first. receive() puts the message under every
+        # channel of a list, so an empty one hands nothing over and it goes
+        # back to checking its own buffer.
+        self._local_wakeup.clear()
+        return [], None
+
+    async def close_pools(self):
+        if self._remote_receive is not None:
+            self._remote_receive.cancel()
+            self._remote_receive = None
+        await super().close_pools()
+
+    def _sweep_local_buffers(self, now):
+        # A live consumer drains its buffer almost immediately. Anything left
+        # unread past ``expiry`` belongs to a closed consumer; drop it like
+        # Redis would expire the message.
+        self._last_sweep = now
+        for channel, delivered_at in list(self._local_delivered_at.items()):
+            if now - delivered_at > self.expiry:
+                del self._local_delivered_at[channel]
+                buffer = self.receive_buffer.get(channel)
+                if buffer is not None and not buffer.empty():
+                    del self.receive_buffer[channel]
+
+    def delivery_stats(self):
+        """Targeted sends delivered in-process vs through Redis since startup."""
+        total = self.local_sends + self.remote_sends
+        return {
+            'local': self.local_sends,
+            'remote': self.remote_sends,
+            'local_ratio': self.local_sends / total if total else 0.0,
+        }
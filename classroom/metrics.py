@@ -0,0 +1,218 @@
+"""
+Prometheus-style metrics for this worker.
+
+Counters, gauges and histograms are plain dicts in process memory, so
+recording a value is a lookup and an add and can stay on in production.
+``render()`` writes them in the Prometheus text format; the ``/metrics``
+view serves that from the same ASGI app as the consumers. Every daphne
+worker reports its own numbers and Prometheus sums them.
+
+Room codes let anyone join a room, so rooms are labelled by a short hash of
+the code (see ``room_label``).
+"""
+import bisect
+import hashlib
+import math
+
+# Seconds; covers in-process sends (~10us) up to slow Redis round trips
+DEFAULT_LATENCY_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+)
+
+_registry = []
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    pairs = ','.join(
+        '{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in zip(names, values)
+    )
+    return '{' + pairs + '}'
+
+
+class Metric:
+    metric_type = 'untyped'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}  # label values tuple -> value
+        _registry.append(self)
+
+    def samples(self):
+        """Yield (name, label names, label values, value)."""
+        for labels, value in sorted(self.values.items()):
+            yield self.name, self.labelnames, labels, value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.metric_type}"]
+        for name, labelnames, labels, value in self.samples():
+            lines.append(f"{name}{_format_labels(labelnames, labels)} {_format_value(value)}")
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    metric_type = 'counter'
+
+    def inc(self, *labels, amount=1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    metric_type = 'gauge'
+
+    def set(self, value, *labels):
+        self.values[labels] = value
+
+    def inc(self, *labels, amount=1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def dec(self, *labels, amount=1):
+        value = self.values.get(labels, 0) - amount
+        if value:
+            self.values[labels] = value
+        else:
+            # Drop the series, e.g. a room that emptied
+            self.values.pop(labels, None)
+
+
+class Histogram(Metric):
+    metric_type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        entry = self.values.get(labels)
+        if entry is None:
+            # Per-bucket (not cumulative) counts, the last one for +Inf, then the sum
+            entry = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+
+    def samples(self):
+        names = self.labelnames + ('le',)
+        for labels, (counts, total) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                yield f"{self.name}_bucket", names, labels + (_format_value(bound),), cumulative
+            yield f"{self.name}_sum", self.labelnames, labels, total
+            yield f"{self.name}_count", self.labelnames, labels, cumulative
+
+
+class Collected(Metric):
+    """Values owned elsewhere and read at scrape time. ``collect()`` returns {labels tuple: value}."""
+
+    def __init__(self, name, documentation, metric_type, collect, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self.metric_type = metric_type
+        self.collect = collect
+
+    def samples(self):
+        for labels, value in sorted(self.collect().items()):
+            yield self.name, self.labelnames, labels, value
+
+
+def render():
+    """All metrics in the Prometheus text exposition format."""
+    return '\n'.join(metric.render() for metric in _registry) + '\n'
+
+
+def room_label(room_code):
+    return hashlib.blake2b(room_code.encode('utf8'), digest_size=4).hexdigest()
+
+
+# --- Consumer metrics ---
+
+frames_received = Counter(
+    'classroom_frames_received_total', 'WebSocket frames received, by message type.', ['type'])
+frames_rejected = Counter(
+    'classroom_frames_rejected_total',
+    'Frames not handled: unknown_type, invalid_json, handler_error or a framing error code.', ['reason'])
+handler_seconds = Histogram(
+    'classroom_handler_seconds',
+    'Time spent handling a frame, by message type and outcome (ok, throttled, rejected or error).',
+    ['type', 'outcome'])
+layer_seconds = Histogram(
+    'classroom_channel_layer_seconds', 'Latency of channel layer operations.', ['operation'])
+room_sockets = Gauge(
+    'classroom_room_sockets', 'Open sockets per room on this worker, by room hash.', ['room'])
+
+
+def socket_opened(room_code):
+    room_sockets.inc(room_label(room_code))
+
+
+def socket_closed(room_code):
+    label = room_label(room_code)
+    room_sockets.dec(label)
+    if label not in room_sockets.values:
+        forget_room(label)
+
+
+def forget_room(label):
+    """Drop every per-room series of a room this worker no longer hosts."""
+    for metric in _registry:
+        if 'room' in metric.labelnames and not isinstance(metric, Collected):
+            index = metric.labelnames.index('room')
+            for labels in [labels for labels in metric.values if labels[index] == label]:
+                del metric.values[labels]
+
+
+Collected(
+    'classroom_active_rooms', 'Rooms with at least one open socket on this worker.', 'gauge',
+    lambda: {(): len(room_sockets.values)})
+Collected(
+    'classroom_sockets', 'Open sockets on this worker.', 'gauge',
+    lambda: {(): sum(room_sockets.values.values())})
+
+
+# --- Existing counters from the batching and layer modules ---
+
+def _coalescer_stats():
+    from .coalescer import coalescer_stats
+
+    return {(name,): value for name, value in coalescer_stats().items()}
+
+
+def _ice_stats():
+    from .ice import stats
+
+    return {(name,): value for name, value in stats.items()}
+
+
+def _layer_stats():
+    from channels.layers import channel_layers
+
+    values = {}
+    for alias, layer in list(channel_layers.backends.items()):
+        if hasattr(layer, 'delivery_stats'):
+            delivery = layer.delivery_stats()
+            values[(alias, 'local')] = delivery['local']
+            values[(alias, 'remote')] = delivery['remote']
+    return values
+
+
+Collected(
+    'classroom_roster_broadcasts_total',
+    'Roster events submitted, messages sent and events merged by the coalescer.', 'counter',
+    _coalescer_stats, ['kind'])
+Collected(
+    'classroom_ice_batching_total', 'ICE candidates received and channel messages sent for them.', 'counter',
+    _ice_stats, ['kind'])
+Collected(
+    'classroom_targeted_sends_total', 'Targeted sends delivered in-process or through Redis.', 'counter',
+    _layer_stats, ['layer', 'path'])
@@ -0,0 +1,27 @@
+# Generated by Django 5.2.4 on 2026-10-18 09:38
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('classroom', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChatMessage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('username', models.CharField(max_length=150)),
+                ('message', models.TextField()),
+                ('created_at', models.DateTimeField()),
+                ('live_class', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='chat_messages', to='classroom.liveclass')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['live_class', '-id'], name='classroom_c_live_cl_dd959e_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 5.2.4 on 2026-10-18 10:13
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('classroom', '0002_chatmessage'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ParticipantPermission',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('username', models.CharField(max_length=150)),
+                ('permissions', models.JSONField(default=dict)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('live_class', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='participant_permissions', to='classroom.liveclass')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('live_class', 'username'), name='unique_participant_permission')],
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.4 on 2026-10-18 10:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('classroom', '0003_participantpermission'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatmessage',
+            name='breakout',
+            field=models.CharField(blank=True, default='', max_length=32),
+        ),
+    ]
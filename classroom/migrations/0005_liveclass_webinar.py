@@ -0,0 +1,18 @@
+# Generated by Django 5.2.4 on 2026-10-18 10:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('classroom', '0004_chatmessage_breakout'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='liveclass',
+            name='webinar',
+            field=models.BooleanField(default=False),
+        ),
+    ]
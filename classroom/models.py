@@ -17,6 +17,8 @@ class LiveClass(models.Model):
     start_time = models.DateTimeField()
     code = models.CharField(max_length=10, unique=True, blank=True)
     is_active = models.BooleanField(default=False)
+    # Students see a participant count instead of the roster, see webinar.py
+    webinar = models.BooleanField(default=False)
 
     def save(self, *args, **kwargs):
         if not self.code:
@@ -25,3 +27,35 @@ class LiveClass(models.Model):
 
     def __str__(self):
         return f"{self.course.title} - {self.title}"
+
+class ChatMessage(models.Model):
+    live_class = models.ForeignKey(LiveClass, on_delete=models.CASCADE, related_name='chat_messages')
+    # The name the sender joined the room with
+    username = models.CharField(max_length=150)
+    message = models.TextField()
+    created_at = models.DateTimeField()
+    # Breakout room it was sent in, blank for the main room
+    breakout = models.CharField(max_length=32, blank=True, default='')
+
+    class Meta:
+        # History is read newest first per class, paged by id
+        indexes = [models.Index(fields=['live_class', '-id'])]
+
+    def __str__(self):
+        return f"{self.username}: {self.message[:50]}"
+
+class ParticipantPermission(models.Model):
+    live_class = models.ForeignKey(LiveClass, on_delete=models.CASCADE, related_name='participant_permissions')
+    # The name the student joined the room with
+    username = models.CharField(max_length=150)
+    # permission name -> granted, as in the room store
+    permissions = models.JSONField(default=dict)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['live_class', 'username'], name='unique_participant_permission'),
+        ]
+
+    def __str__(self):
+        return f"{self.username}: {self.permissions}"
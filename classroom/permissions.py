@@ -0,0 +1,154 @@
+"""
+Saved student permissions and bulk permission changes.
+
+Permissions used to live only in the room store, so a student who left and
+joined again started with none, and "unmute everyone" took one
+``permission_update`` frame and one channel send per student.
+
+- Every change is saved to ``ParticipantPermission`` for the room's
+  ``LiveClass``, in batches at most ``CLASSROOM_PERMISSION_FLUSH_INTERVAL``
+  seconds later, and straight away to the room store's copy. A joining
+  student gets their saved permissions back in the roster and as
+  ``permission_granted`` frames.
+- The class's saved permissions are read from the database once, by the
+  first join after the room is created in the store; later joins read the
+  store's copy, so joining costs no database query.
+- ``permission_bulk_update`` from the teacher sets one permission for every
+  student, for those listed in ``students``, or for those whose name
+  matches the shell-style ``pattern``. The room store applies it in one
+  step with one roster version; one ``permissions_bulk_changed`` roster
+  delta and one broadcast per group follow, and each student's consumer
+  picks itself out of its group's broadcast. An update for every student
+  says ``all`` instead of listing the class.
+- Students in a breakout are also on its roster, which gets the same
+  changes and deltas, see breakouts.py.
+
+Rooms without a ``LiveClass`` row are not saved.
+"""
+import asyncio
+import fnmatch
+import logging
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+
+from .framing import FrameError
+from .models import LiveClass, ParticipantPermission
+from .rooms import get_room_store
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_FLUSH_INTERVAL = 0.5
+
+_loading = {}  # room code -> this worker's task reading the class's saved permissions
+_writer = None
+
+
+def select(students, usernames=None, pattern=None):
+    """Names of the room's students a bulk update applies to."""
+    names = [student['username'] for student in students]
+    if usernames is not None:
+        if not isinstance(usernames, list):
+            raise FrameError('invalid_selection', 'permission_bulk_update')
+        wanted = set(usernames)
+        names = [name for name in names if name in wanted]
+    if pattern is not None:
+        if not isinstance(pattern, str):
+            raise FrameError('invalid_selection', 'permission_bulk_update')
+        names = [name for name in names if fnmatch.fnmatchcase(name, pattern)]
+    return names
+
+
+async def load(room_code, username):
+    """A student's saved permissions in this room's class, or {}."""
+    rooms = get_room_store()
+    saved = await rooms.get_saved_permissions(room_code, username)
+    if saved is not None:
+        return saved
+    # Joins arriving together share one query
+    loop = asyncio.get_running_loop()
+    task = _loading.get(room_code)
+    if task is None or task.get_loop() is not loop:
+        task = _loading[room_code] = loop.create_task(_load_class(rooms, room_code))
+    try:
+        await asyncio.shield(task)
+    except Exception as e:
+        # The student joins without their saved permissions; the next join reads them again
+        logger.error(f"Could not read saved permissions of room {room_code}: {e}", exc_info=True)
+        return {}
+    finally:
+        if task.done() and _loading.get(room_code) is task:
+            del _loading[room_code]
+    return await rooms.get_saved_permissions(room_code, username) or {}
+
+
+async def _load_class(rooms, room_code):
+    saved = await database_sync_to_async(_load)(room_code)
+    await rooms.load_saved_permissions(room_code, saved)
+
+
+def _load(room_code):
+    return dict(ParticipantPermission.objects.filter(
+        live_class__code=room_code
+    ).values_list('username', 'permissions'))
+
+
+async def save(room_code, students):
+    """Save the current permissions of ``students`` (room store records)."""
+    saved = {student['username']: student['permissions'] for student in students}
+    await get_room_store().save_permissions(room_code, saved)
+    get_permission_writer().add(room_code, saved)
+
+
+class PermissionWriter:
+    """This worker's unsaved permission changes, saved in batches."""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.loop = asyncio.get_running_loop()
+        self.pending = {}  # room code -> username -> permissions
+        self._task = None
+
+    def add(self, room_code, saved):
+        self.pending.setdefault(room_code, {}).update(saved)
+        if self._task is None:
+            self._task = self.loop.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.interval)
+        await self.flush()
+
+    async def flush(self):
+        self._task = None
+        if not self.pending:
+            return
+        batch, self.pending = self.pending, {}
+        for room_code, saved in batch.items():
+            try:
+                await database_sync_to_async(_save)(room_code, saved)
+            except Exception as e:
+                logger.error(f"Error saving permissions for {len(saved)} students in room {room_code}: {e}",
+                             exc_info=True)
+
+
+def _save(room_code, saved):
+    live_class_id = LiveClass.objects.filter(code=room_code).values_list('id', flat=True).first()
+    if live_class_id is None:
+        return
+    ParticipantPermission.objects.bulk_create(
+        [ParticipantPermission(live_class_id=live_class_id, username=username, permissions=permissions)
+         for username, permissions in saved.items()],
+        update_conflicts=True,
+        unique_fields=['live_class', 'username'],
+        update_fields=['permissions', 'updated_at'],
+    )
+
+
+def get_permission_writer():
+    """Return this worker's PermissionWriter, creating it if needed."""
+    global _writer
+    if _writer is None or _writer.loop is not asyncio.get_running_loop():
+        _writer = PermissionWriter(
+            interval=getattr(settings, 'CLASSROOM_PERMISSION_FLUSH_INTERVAL', DEFAULT_FLUSH_INTERVAL),
+        )
+    return _writer
@@ -0,0 +1,161 @@
+"""
+Token-bucket rate limits on inbound frames.
+
+Every chat message, stream request or ICE candidate a page sends becomes a
+channel layer send, so one tab in a loop could saturate the layer for every
+room on the worker. ``CLASSROOM_RATE_LIMITS`` gives, per message type, a
+``(frames per second, burst)`` bucket per connection and per room:
+
+    CLASSROOM_RATE_LIMITS = {
+        'chat_message': {'connection': (1, 5), 'room': (10, 30)},
+    }
+
+Types not listed use ``'default'``; a type mapped to ``{}`` is not limited.
+Connection buckets live on the consumer and room buckets in the worker, so
+the check costs a dict lookup and some arithmetic. With
+``CLASSROOM_RATE_LIMIT_SHARED`` the room buckets are kept in the room store
+instead and hold across workers, for one round trip per limited frame.
+
+A frame over a limit is dropped and counted in
+``classroom_frames_throttled_total``. The page gets one ``rate_limited``
+error with ``retry_after`` seconds, and no more for that type until a frame
+of it gets through.
+"""
+from django.conf import settings
+
+from . import metrics
+
+DEFAULT_RATE_LIMITS = {
+    'default': {'connection': (50, 200)},
+    # A dropped SDP or ICE frame fails a stream, so signaling gets room for a
+    # teacher trickling candidates to a large class; only floods are cut off
+    'offer': {'connection': (50, 500)},
+    'answer': {'connection': (50, 500)},
+    'student_offer': {'connection': (50, 500)},
+    'student_answer': {'connection': (50, 500)},
+    'ice_candidate': {'connection': (300, 2000)},
+    'ice_candidates': {'connection': (100, 500)},
+    # The page echoes one per CLASSROOM_HEARTBEAT_INTERVAL
+    'heartbeat': {'connection': (1, 10)},
+    'chat_message': {'connection': (2, 10), 'room': (30, 300)},
+    # Every student asks at once when the teacher goes live; admission.py paces those
+    'request_stream': {'connection': (0.5, 5)},
+    'stream_trace': {'connection': (0.5, 5)},
+    'negotiation_failed': {'connection': (1, 10)},
+    'permission_update': {'connection': (5, 20)},
+    'permission_bulk_update': {'connection': (1, 5)},
+    'breakout_assign': {'connection': (1, 10)},
+    'breakout_close': {'connection': (1, 5)},
+    'roster_resync': {'connection': (0.5, 3)},
+    'participant_query': {'connection': (2, 10)},
+}
+
+# Room buckets this worker has seen before idle ones are pruned
+ROOM_BUCKETS_PRUNE_SIZE = 10000
+
+throttled = metrics.Counter(
+    'classroom_frames_throttled_total',
+    'Frames dropped by rate limits, by message type and the limit hit (connection or room).',
+    ['type', 'scope'])
+
+
+class TokenBucket:
+    __slots__ = ('tokens', 'updated')
+
+    def __init__(self, burst, now):
+        self.tokens = burst
+        self.updated = now
+
+    def take(self, rate, burst, now):
+        """Take a token; returns 0 if there was one, else seconds until there is."""
+        self.tokens = min(burst, self.tokens + (now - self.updated) * rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / rate
+
+    def full(self, rate, burst, now):
+        return self.tokens + (now - self.updated) * rate >= burst
+
+
+class RateLimited(Exception):
+    def __init__(self, message_type, scope, retry_after, notify):
+        super().__init__(f"{message_type} over its {scope} rate limit")
+        self.message_type = message_type
+        self.scope = scope
+        self.retry_after = retry_after
+        self.notify = notify  # First rejection since the type last got through
+
+
+def rate_limits():
+    return {**DEFAULT_RATE_LIMITS, **getattr(settings, 'CLASSROOM_RATE_LIMITS', {})}
+
+
+def limits_for(message_type):
+    limits = rate_limits()
+    return limits.get(message_type, limits['default'])
+
+
+class RoomBuckets:
+    """This worker's room buckets, keyed by (room code, message type)."""
+
+    def __init__(self):
+        self.buckets = {}
+
+    def take(self, room_code, message_type, rate, burst, now):
+        key = (room_code, message_type)
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            if len(self.buckets) >= ROOM_BUCKETS_PRUNE_SIZE:
+                self.prune(now)
+            bucket = self.buckets[key] = TokenBucket(burst, now)
+        return bucket.take(rate, burst, now)
+
+    def prune(self, now):
+        # A full bucket is the same as no bucket
+        for key, bucket in list(self.buckets.items()):
+            rate, burst = limits_for(key[1]).get('room', (1, 0))
+            if bucket.full(rate, burst, now):
+                del self.buckets[key]
+
+
+_room_buckets = RoomBuckets()
+
+
+class RateLimiter:
+    """One connection's buckets, plus the room's through the worker or the room store."""
+
+    def __init__(self, room_code, rooms, loop):
+        self.room_code = room_code
+        self.rooms = rooms
+        self.loop = loop
+        self.buckets = {}
+        self.notified = set()  # Types the page was told are limited
+
+    async def check(self, message_type):
+        """Raise RateLimited if a frame of ``message_type`` is over a limit."""
+        limits = limits_for(message_type)
+        if not limits:
+            return
+        now = self.loop.time()
+        retry_after, scope = 0.0, None
+        if 'connection' in limits:
+            rate, burst = limits['connection']
+            bucket = self.buckets.get(message_type)
+            if bucket is None:
+                bucket = self.buckets[message_type] = TokenBucket(burst, now)
+            retry_after, scope = bucket.take(rate, burst, now), 'connection'
+        if not retry_after and 'room' in limits:
+            rate, burst = limits['room']
+            if getattr(settings, 'CLASSROOM_RATE_LIMIT_SHARED', False):
+                retry_after = await self.rooms.take_token(self.room_code, message_type, rate, burst)
+            else:
+                retry_after = _room_buckets.take(self.room_code, message_type, rate, burst, now)
+            scope = 'room'
+        if not retry_after:
+            self.notified.discard(message_type)
+            return
+        notify = message_type not in self.notified
+        self.notified.add(message_type)
+        raise RateLimited(message_type, scope, retry_after, notify)
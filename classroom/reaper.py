@@ -0,0 +1,171 @@
+"""
+Per-worker reaper for stale sockets and idle rooms.
+
+Room state used to outlive its room: the in-memory store never dropped a
+room once created, Redis kept its keys, and a half-open socket (a phone that
+lost signal, a laptop that went to sleep) kept its seat until the worker
+restarted. Every ``CLASSROOM_HEARTBEAT_INTERVAL`` seconds each worker's
+reaper:
+
+- sends ``heartbeat`` to its sockets, which the page echoes, and closes any
+  socket that sent nothing for ``CLASSROOM_HEARTBEAT_TIMEOUT`` seconds; the
+  close runs the usual disconnect, including the resume grace period;
+- touches the rooms it has sockets in, which keeps their Redis keys from
+  expiring (see rooms.py), and deletes a room from the room store once it
+  has had no sockets here and no participants anywhere for
+  ``CLASSROOM_ROOM_TTL`` seconds;
+- closes the sockets of a room whose ``LiveClass`` was ended (after a
+  ``class_ended`` frame) and deletes it, ``CLASSROOM_ROOM_TTL`` seconds
+  after noticing.
+
+What it reclaims is counted in ``classroom_reaped_total``. The reaper runs
+while the worker has sockets or rooms to watch and stops by itself after.
+An interval of 0 disables it.
+"""
+import asyncio
+import logging
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+
+from . import metrics
+from .encoding import dumps
+from .models import LiveClass
+from .rooms import get_room_store
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_HEARTBEAT_INTERVAL = 25
+DEFAULT_HEARTBEAT_TIMEOUT = 60
+DEFAULT_ROOM_TTL = 300
+
+HEARTBEAT = dumps({'type': 'heartbeat'})
+
+reaped = metrics.Counter(
+    'classroom_reaped_total',
+    'What the reaper reclaimed: sockets that missed heartbeats (stale_socket), rooms with nobody '
+    'left (empty_room) and rooms whose class had ended (ended_room).',
+    ['kind'])
+
+_reaper = None
+
+
+class RoomWatch:
+    __slots__ = ('consumers', 'empty_since', 'ended_since')
+
+    def __init__(self):
+        self.consumers = set()
+        self.empty_since = None
+        self.ended_since = None
+
+
+class Reaper:
+    """This worker's sockets by room, swept every heartbeat interval."""
+
+    def __init__(self, interval, timeout, room_ttl):
+        self.interval = interval
+        self.timeout = timeout
+        self.room_ttl = room_ttl
+        self.loop = asyncio.get_running_loop()
+        self.rooms = {}  # room code -> RoomWatch
+        self._task = None
+
+    def register(self, consumer):
+        self.rooms.setdefault(consumer.room_code, RoomWatch()).consumers.add(consumer)
+        if self._task is None:
+            self._task = self.loop.create_task(self._run())
+
+    def unregister(self, consumer):
+        watch = self.rooms.get(consumer.room_code)
+        if watch:
+            watch.consumers.discard(consumer)
+
+    async def _run(self):
+        while self.rooms:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.sweep()
+            except Exception as e:
+                logger.error(f"Error sweeping rooms: {e}", exc_info=True)
+        self._task = None
+
+    async def sweep(self):
+        now = self.loop.time()
+        stale = 0
+        for watch in self.rooms.values():
+            for consumer in list(watch.consumers):
+                if now - consumer.last_seen > self.timeout:
+                    watch.consumers.discard(consumer)
+                    stale += 1
+                    logger.info(f"Closing {consumer.username or 'unjoined'} socket in room "
+                                f"{consumer.room_code}: no heartbeat for {now - consumer.last_seen:.0f}s")
+                    await consumer.close()
+                else:
+                    await consumer.send(text_data=HEARTBEAT)
+        reaped.inc('stale_socket', amount=stale)
+
+        ended = await database_sync_to_async(_ended_rooms)(list(self.rooms))
+        evicted = {'empty_room': 0, 'ended_room': 0}
+        for room_code, watch in list(self.rooms.items()):
+            if room_code in ended:
+                watch.ended_since = watch.ended_since or now
+            if watch.consumers:
+                watch.empty_since = None
+            else:
+                watch.empty_since = watch.empty_since or now
+
+            if watch.ended_since is not None and now - watch.ended_since >= self.room_ttl:
+                await self.close_ended(watch)
+                await get_room_store().delete_room(room_code)
+                evicted['ended_room'] += 1
+            elif watch.empty_since is not None and now - watch.empty_since >= self.room_ttl:
+                # Other workers may still host part of the room
+                if await _room_is_empty(room_code):
+                    await get_room_store().delete_room(room_code)
+                    evicted['empty_room'] += 1
+            else:
+                if watch.consumers:
+                    await get_room_store().touch(room_code)
+                continue
+            del self.rooms[room_code]
+
+        for kind, count in evicted.items():
+            reaped.inc(kind, amount=count)
+        if stale or any(evicted.values()):
+            logger.info(f"Reaped {stale} stale sockets, {evicted['empty_room']} empty rooms "
+                        f"and {evicted['ended_room']} ended rooms")
+
+    async def close_ended(self, watch):
+        for consumer in list(watch.consumers):
+            consumer.leaving = True  # No point holding a seat in an ended class
+            await consumer.send(text_data=dumps({'type': 'class_ended'}))
+            await consumer.close()
+        watch.consumers.clear()
+
+
+def _ended_rooms(room_codes):
+    return set(LiveClass.objects.filter(code__in=room_codes, is_active=False).values_list('code', flat=True))
+
+
+async def _room_is_empty(room_code):
+    rooms = get_room_store()
+    _, students = await rooms.roster_snapshot(room_code)
+    return not students and not await rooms.get_teacher(room_code)
+
+
+def heartbeat_interval():
+    return getattr(settings, 'CLASSROOM_HEARTBEAT_INTERVAL', DEFAULT_HEARTBEAT_INTERVAL)
+
+
+def get_reaper():
+    """Return this worker's reaper, or None if heartbeats are off."""
+    global _reaper
+    if not heartbeat_interval():
+        return None
+    if _reaper is None or _reaper.loop is not asyncio.get_running_loop():
+        _reaper = Reaper(
+            interval=heartbeat_interval(),
+            timeout=getattr(settings, 'CLASSROOM_HEARTBEAT_TIMEOUT', DEFAULT_HEARTBEAT_TIMEOUT),
+            room_ttl=getattr(settings, 'CLASSROOM_ROOM_TTL', DEFAULT_ROOM_TTL),
+        )
+    return _reaper
@@ -0,0 +1,146 @@
+"""
+Relay tree for the teacher stream, for large rooms without an SFU.
+
+With ``CLASSROOM_RELAY_FANOUT`` set to K, the teacher's browser sends its
+stream to at most K students and each of those re-sends what it receives to
+up to K more, so nobody uploads more than K copies. The tree is kept by the
+teacher's consumer, which already sees every ``request_stream``:
+
+- A student's ``request_stream`` may carry ``upload_kbps``. Its relay slots
+  are ``min(K, upload_kbps // CLASSROOM_RELAY_STREAM_KBPS)``; students that
+  report nothing only ever receive.
+- The student is placed under the shallowest node with a free slot, the one
+  with the most free slots winning a tie. If it can relay more than a
+  student on the level below that, it takes that student's place instead
+  and adopts it, so strong relays end up near the teacher. The teacher
+  takes the overflow when every slot is used; its requests still go through
+  admission.py.
+- When a student leaves, each of its children is re-placed together with
+  its own subtree, so only the children renegotiate; their descendants keep
+  their connections and see the stream again once their relay has it. A
+  student asking again (a failed negotiation or a reload) is treated as
+  leaving and rejoining, and avoids its previous relay.
+
+Parent and child signal each other with the usual ``offer``, ``answer`` and
+ICE frames; a student's consumer only relays these to students the tree put
+next to it.
+"""
+from django.conf import settings
+
+from . import metrics
+
+DEFAULT_STREAM_KBPS = 1500
+
+relay_placements = metrics.Counter(
+    'classroom_relay_placements_total',
+    'Students placed in relay trees: joined (new or asking again), reparented (their relay left) '
+    'or displaced (moved below a stronger relay).',
+    ['reason'])
+relay_depth = metrics.Histogram(
+    'classroom_relay_depth', 'Hops between the teacher and a student when it is placed.',
+    buckets=(1, 2, 3, 4, 5, 6, 8, 10))
+
+
+def relay_fanout():
+    return getattr(settings, 'CLASSROOM_RELAY_FANOUT', 0)
+
+
+class RelayNode:
+    __slots__ = ('username', 'parent', 'children', 'slots')
+
+    def __init__(self, username, slots):
+        self.username = username
+        self.parent = None
+        self.children = []
+        self.slots = slots
+
+    @property
+    def free(self):
+        return self.slots - len(self.children)
+
+
+class RelayTree:
+    """Which student receives the teacher stream from whom."""
+
+    def __init__(self, root, fanout, stream_kbps=None):
+        self.fanout = fanout
+        self.stream_kbps = stream_kbps or getattr(settings, 'CLASSROOM_RELAY_STREAM_KBPS', DEFAULT_STREAM_KBPS)
+        self.root = RelayNode(root, fanout)
+        self.nodes = {root: self.root}
+
+    def slots_for(self, upload_kbps):
+        if isinstance(upload_kbps, bool) or not isinstance(upload_kbps, (int, float)) or upload_kbps <= 0:
+            return 0
+        return min(self.fanout, int(upload_kbps // self.stream_kbps))
+
+    def place(self, username, upload_kbps=None):
+        """
+        Add a student. Returns its parent's name and, like ``remove``, the
+        children that moved if it was already in the tree.
+        """
+        previous = self.nodes.get(self.parent_of(username))
+        moved = self.remove(username)
+        node = self.nodes[username] = RelayNode(username, self.slots_for(upload_kbps))
+        parent = self._attach(node, moved, avoid=previous)
+        relay_placements.inc('joined')
+        return parent.username, moved
+
+    def remove(self, username):
+        """Drop a student; returns [(child, new parent)] for the children that must reconnect."""
+        node = self.nodes.pop(username, None)
+        if node is None or node is self.root:
+            return []
+        self._detach(node)
+        moved = []
+        for child in list(node.children):
+            child.parent = None
+            moved.append((child.username, self._attach(child, moved).username))
+            relay_placements.inc('reparented')
+        node.children = []
+        return moved
+
+    def parent_of(self, username):
+        node = self.nodes.get(username)
+        return node.parent.username if node and node.parent else None
+
+    def depth(self, username):
+        depth, node = 0, self.nodes[username]
+        while node.parent:
+            depth, node = depth + 1, node.parent
+        return depth
+
+    def _detach(self, node):
+        if node.parent:
+            node.parent.children.remove(node)
+            node.parent = None
+
+    def _attach(self, node, moved, avoid=None):
+        # ``moved`` collects a student displaced to make room
+        parent, displaced = self._best_position(node, avoid)
+        if displaced:
+            parent.children.remove(displaced)
+            displaced.parent = node
+            node.children.append(displaced)
+            moved.append((displaced.username, node.username))
+            relay_placements.inc('displaced')
+        parent.children.append(node)
+        node.parent = parent
+        relay_depth.observe(self.depth(node.username))
+        return parent
+
+    def _best_position(self, node, avoid=None):
+        # Breadth-first so the tree stays shallow. The node being placed is
+        # detached, so its own subtree is never searched.
+        level = [self.root]
+        while level:
+            parents = [n for n in level if n is not avoid]
+            candidates = [n for n in parents if n.free > 0]
+            if candidates:
+                return max(candidates, key=lambda n: n.free), None
+            if node.free > 0:
+                weaker = [child for n in parents for child in n.children if child.slots < node.slots]
+                if weaker:
+                    displaced = min(weaker, key=lambda child: child.slots)
+                    return displaced.parent, displaced
+            level = [child for n in level for child in n.children]
+        return self.root, None
@@ -0,0 +1,75 @@
+"""
+Resumable student sessions across WebSocket drops.
+
+On mobile networks a student's socket drops and reconnects constantly.
+Without resumption every blip was a leave and a join: a roster broadcast to
+the whole room, and a page reload that renegotiated every stream. With
+``CLASSROOM_RESUME_GRACE`` seconds set:
+
+- A joining student gets a ``session`` frame with a signed resume token and
+  the number of the room's latest event.
+- Room-wide frames (chat, stream state, roster batches) carry a ``seq`` and
+  the room store keeps the last ``CLASSROOM_RESUME_BUFFER_SIZE`` of them.
+- When a student's socket closes, its seat is kept for the grace period.
+  Its peer connections live in the page, not the socket, and keep running.
+- The page reconnects and sends ``resume`` with the token and the last
+  ``seq`` it saw. The seat moves to the new socket and the reply,
+  ``resumed``, carries the frames it missed. If the buffer has moved past
+  them it says ``resync`` and is followed by a fresh roster snapshot and
+  chat history. A token whose seat is gone gets ``resume_failed``.
+- Only once the grace period passes without a resume is the student
+  removed and its leave broadcast. Closing the page sends ``leave`` first,
+  so that still leaves at once.
+
+Frames sent to one socket (signaling, queue updates) during the gap are
+lost; the page's stream retry covers a request caught in it. Teachers are
+not resumed because their socket also carries the SFU, admission queue and
+relay tree.
+"""
+import secrets
+
+from django.conf import settings
+from django.core import signing
+
+from . import metrics
+from .encoding import dumps
+from .rooms import get_room_store
+
+DEFAULT_GRACE = 10
+TOKEN_SALT = 'classroom.resume'
+
+resumes = metrics.Counter(
+    'classroom_resumes_total',
+    'Student reconnects: resumed with the missed frames replayed, resynced because the buffer '
+    'had moved on, or failed because the seat was gone.',
+    ['outcome'])
+
+
+def resume_grace():
+    return getattr(settings, 'CLASSROOM_RESUME_GRACE', DEFAULT_GRACE)
+
+
+def new_session():
+    return secrets.token_urlsafe(16)
+
+
+def issue_token(room_code, username, session):
+    return signing.dumps({'room': room_code, 'user': username, 'session': session}, salt=TOKEN_SALT)
+
+
+def read_token(token, room_code):
+    """``(username, session)`` from a token issued for this room, or None."""
+    try:
+        data = signing.loads(token, salt=TOKEN_SALT)
+    except (signing.BadSignature, TypeError):
+        return None
+    if data.get('room') != room_code:
+        return None
+    return data['user'], data['session']
+
+
+async def encode_room_frame(room_code, frame):
+    """Encode a room-wide frame, numbered into the replay buffer when resumption is on."""
+    if not resume_grace():
+        return dumps(frame)
+    return await get_room_store().append_event(room_code, frame)
@@ -0,0 +1,833 @@
+"""
+Room state backends for the classroom consumers.
+
+Room state (teacher channel, students, permissions, live flag) used to live in
+a module-level dict, which only works while every socket of a room is handled
+by the same daphne process. The store is now pluggable and configured via
+``settings.CLASSROOM_ROOM_STORE``, mirroring ``CHANNEL_LAYERS``:
+
+    CLASSROOM_ROOM_STORE = {
+        "BACKEND": "classroom.rooms.RedisRoomStore",
+        "CONFIG": {"hosts": [("127.0.0.1", 6379)]},
+    }
+
+Without the setting the in-memory store is used.
+"""
+import json
+import logging
+import time
+from collections import deque
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+from django.utils.module_loading import import_string
+
+from . import breakouts
+from .encoding import dumps
+from .ratelimit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_ROOM_STORE = "classroom.rooms.InMemoryRoomStore"
+DEFAULT_BUFFER_SIZE = 200
+DEFAULT_KEY_TTL = 24 * 3600
+# Joins and heartbeats refresh a room's key TTLs at most this often per worker
+KEY_REFRESH_INTERVAL = 60
+
+
+class BaseRoomStore:
+    """
+    Interface every room store implements. All methods are coroutines so the
+    consumer does not care whether state is local or remote.
+
+    Teachers are returned as ``{'username', 'channel'}`` dicts and students as
+    ``{'username', 'channel', 'permissions', 'session'}`` dicts; ``None``
+    means absent.
+
+    Every change to the student roster bumps a per-room roster version in the
+    same atomic step and returns it, so clients can apply deltas in order and
+    detect gaps.
+    """
+
+    async def set_teacher(self, room_code, username, channel):
+        raise NotImplementedError
+
+    async def remove_teacher(self, room_code, channel):
+        """Remove the teacher if ``channel`` still owns the seat. Returns True if removed."""
+        raise NotImplementedError
+
+    async def get_teacher(self, room_code):
+        raise NotImplementedError
+
+    async def add_student(self, room_code, username, channel, session=None, permissions=None):
+        """
+        Add (or replace) a student. Returns ``(student, roster_version)``.
+        ``session`` identifies this join for ``resume_student``; ``permissions``
+        are the student's saved ones, see permissions.py.
+        """
+        raise NotImplementedError
+
+    async def resume_student(self, room_code, username, session, channel):
+        """
+        Move a student's seat to a new channel if it still belongs to
+        ``session``. Returns the student, or None. The roster is unchanged.
+        """
+        raise NotImplementedError
+
+    async def remove_student(self, room_code, username, channel):
+        """
+        Remove the student if ``channel`` is still theirs. Returns the new
+        roster version, or None if nothing was removed.
+        """
+        raise NotImplementedError
+
+    async def get_student(self, room_code, username):
+        raise NotImplementedError
+
+    async def list_students(self, room_code):
+        raise NotImplementedError
+
+    async def count_students(self, room_code):
+        raise NotImplementedError
+
+    async def roster_snapshot(self, room_code):
+        """Return ``(roster_version, students)`` read atomically."""
+        raise NotImplementedError
+
+    async def set_permission(self, room_code, username, permission, status):
+        """
+        Update one permission. Returns ``(student, roster_version)``, or
+        ``(None, None)`` if the student is not in the room.
+        """
+        raise NotImplementedError
+
+    async def set_permissions(self, room_code, usernames, changes):
+        """
+        Apply ``changes`` (permission -> status) to each listed student in
+        the room, bumping the roster version once. Returns ``(students,
+        roster_version)`` for those updated, or ``([], None)``.
+        """
+        raise NotImplementedError
+
+    async def set_live(self, room_code, is_live):
+        raise NotImplementedError
+
+    async def is_live(self, room_code):
+        raise NotImplementedError
+
+    async def append_event(self, room_code, frame):
+        """
+        Number a room-wide frame and keep it in the room's replay buffer of
+        the last ``CLASSROOM_RESUME_BUFFER_SIZE``. Returns the encoded frame
+        with its ``seq``.
+        """
+        raise NotImplementedError
+
+    async def event_seq(self, room_code):
+        """Number of the room's latest event."""
+        raise NotImplementedError
+
+    async def events_since(self, room_code, seq):
+        """
+        Encoded frames numbered after ``seq``, oldest first, or None if the
+        buffer no longer holds all of them.
+        """
+        raise NotImplementedError
+
+    async def take_token(self, room_code, name, rate, burst):
+        """
+        Take a token from the room's bucket ``name``, refilled at ``rate`` per
+        second up to ``burst``. Returns 0 if there was one, else the seconds
+        until there is. Used for rate limits shared by workers, see ratelimit.py.
+        """
+        raise NotImplementedError
+
+    async def assign_breakouts(self, room_code, assignments):
+        """Record students' breakouts: username -> breakout name, or None for the main room."""
+        raise NotImplementedError
+
+    async def get_breakouts(self, room_code):
+        """Every assignment, username -> breakout name."""
+        raise NotImplementedError
+
+    async def get_breakout(self, room_code, username):
+        """A student's breakout name, or None in the main room."""
+        raise NotImplementedError
+
+    async def close_breakouts(self, room_code):
+        """
+        Drop every assignment and the breakouts' own room state. Returns the
+        assignments there were.
+        """
+        raise NotImplementedError
+
+    async def get_saved_permissions(self, room_code, username):
+        """
+        A student's saved permissions from the store's copy, ``{}`` if none,
+        or None if the class's saved permissions were never loaded.
+        """
+        raise NotImplementedError
+
+    async def load_saved_permissions(self, room_code, saved):
+        """
+        Fill the store's copy from the database (username -> permissions).
+        Names saved since, with ``save_permissions``, keep the newer value.
+        """
+        raise NotImplementedError
+
+    async def save_permissions(self, room_code, saved):
+        """Record students' current permissions (username -> permissions) in the store's copy."""
+        raise NotImplementedError
+
+    async def get_webinar(self, room_code):
+        """The class's ``LiveClass.webinar`` flag, or None if it was never loaded, see webinar.py."""
+        raise NotImplementedError
+
+    async def load_webinar(self, room_code, webinar):
+        """Keep the flag read from the database unless one is set already. Returns the kept flag."""
+        raise NotImplementedError
+
+    async def set_webinar(self, room_code, webinar):
+        raise NotImplementedError
+
+    async def delete_room(self, room_code):
+        """Forget the room, its breakouts included."""
+        raise NotImplementedError
+
+    async def touch(self, room_code):
+        """
+        Note that the room is in use, on joins and heartbeats. Stores whose
+        state can outlive every worker expire rooms that stop being touched.
+        """
+
+    async def get_channel(self, room_code, username):
+        """Resolve a participant (teacher or student) to their channel name."""
+        teacher = await self.get_teacher(room_code)
+        if teacher and teacher['username'] == username:
+            return teacher['channel']
+        student = await self.get_student(room_code, username)
+        return student['channel'] if student else None
+
+
+class InMemoryRoomStore(BaseRoomStore):
+    """Per-process store. Fine for a single worker and for tests."""
+
+    def __init__(self):
+        self.rooms = {}
+
+    def _room(self, room_code):
+        return self.rooms.setdefault(room_code, {
+            'teacher': {},
+            'students': {},
+            'is_live': False,
+            'roster_version': 0,
+            'event_seq': 0,
+            'events': deque(maxlen=_buffer_size()),  # (seq, encoded frame)
+            'buckets': {},  # name -> TokenBucket
+            'breakouts': {},  # username -> breakout name, see breakouts.py
+            'saved_permissions': {},  # username -> permissions, see permissions.py
+            'saved_permissions_loaded': False,
+            'webinar': None,
+        })
+
+    async def set_teacher(self, room_code, username, channel):
+        self._room(room_code)['teacher'] = {'username': username, 'channel': channel}
+
+    async def remove_teacher(self, room_code, channel):
+        room = self.rooms.get(room_code)
+        if not room or room['teacher'].get('channel') != channel:
+            return False
+        room['teacher'] = {}
+        room['is_live'] = False
+        return True
+
+    async def get_teacher(self, room_code):
+        room = self.rooms.get(room_code)
+        if room and room['teacher']:
+            return dict(room['teacher'])
+        return None
+
+    async def add_student(self, room_code, username, channel, session=None, permissions=None):
+        room = self._room(room_code)
+        student = {'username': username, 'channel': channel, 'permissions': dict(permissions or {}), 'session': session}
+        room['students'][username] = student
+        room['roster_version'] += 1
+        return _copy_student(student), room['roster_version']
+
+    async def resume_student(self, room_code, username, session, channel):
+        room = self.rooms.get(room_code)
+        student = room['students'].get(username) if room else None
+        if not student or not session or student['session'] != session:
+            return None
+        student['channel'] = channel
+        return _copy_student(student)
+
+    async def remove_student(self, room_code, username, channel):
+        room = self.rooms.get(room_code)
+        student = room['students'].get(username) if room else None
+        if not student or student['channel'] != channel:
+            return None
+        del room['students'][username]
+        room['roster_version'] += 1
+        return room['roster_version']
+
+    async def get_student(self, room_code, username):
+        room = self.rooms.get(room_code)
+        student = room['students'].get(username) if room else None
+        return _copy_student(student) if student else None
+
+    async def list_students(self, room_code):
+        room = self.rooms.get(room_code)
+        if not room:
+            return []
+        return [_copy_student(s) for s in room['students'].values()]
+
+    async def count_students(self, room_code):
+        room = self.rooms.get(room_code)
+        return len(room['students']) if room else 0
+
+    async def roster_snapshot(self, room_code):
+        room = self.rooms.get(room_code)
+        if not room:
+            return 0, []
+        return room['roster_version'], [_copy_student(s) for s in room['students'].values()]
+
+    async def set_permission(self, room_code, username, permission, status):
+        room = self.rooms.get(room_code)
+        student = room['students'].get(username) if room else None
+        if not student:
+            return None, None
+        student['permissions'][permission] = status
+        room['roster_version'] += 1
+        return _copy_student(student), room['roster_version']
+
+    async def set_permissions(self, room_code, usernames, changes):
+        room = self.rooms.get(room_code)
+        students = [room['students'][name] for name in usernames if name in room['students']] if room else []
+        if not students:
+            return [], None
+        for student in students:
+            student['permissions'].update(changes)
+        room['roster_version'] += 1
+        return [_copy_student(student) for student in students], room['roster_version']
+
+    async def set_live(self, room_code, is_live):
+        self._room(room_code)['is_live'] = is_live
+
+    async def is_live(self, room_code):
+        room = self.rooms.get(room_code)
+        return bool(room and room['is_live'])
+
+    async def append_event(self, room_code, frame):
+        room = self._room(room_code)
+        room['event_seq'] += 1
+        text = dumps({**frame, 'seq': room['event_seq']})
+        room['events'].append((room['event_seq'], text))
+        return text
+
+    async def event_seq(self, room_code):
+        room = self.rooms.get(room_code)
+        return room['event_seq'] if room else 0
+
+    async def events_since(self, room_code, seq):
+        room = self.rooms.get(room_code)
+        current = room['event_seq'] if room else 0
+        if not 0 <= current - seq <= (len(room['events']) if room else 0):
+            return None
+        return [text for event_seq, text in room['events'] if event_seq > seq]
+
+    async def take_token(self, room_code, name, rate, burst):
+        buckets = self._room(room_code)['buckets']
+        now = time.monotonic()
+        if name not in buckets:
+            buckets[name] = TokenBucket(burst, now)
+        return buckets[name].take(rate, burst, now)
+
+    async def assign_breakouts(self, room_code, assignments):
+        assigned = self._room(room_code)['breakouts']
+        for username, breakout in assignments.items():
+            if breakout is None:
+                assigned.pop(username, None)
+            else:
+                assigned[username] = breakout
+
+    async def get_breakouts(self, room_code):
+        room = self.rooms.get(room_code)
+        return dict(room['breakouts']) if room else {}
+
+    async def get_breakout(self, room_code, username):
+        room = self.rooms.get(room_code)
+        return room['breakouts'].get(username) if room else None
+
+    async def close_breakouts(self, room_code):
+        room = self.rooms.get(room_code)
+        if not room:
+            return {}
+        assigned, room['breakouts'] = room['breakouts'], {}
+        for breakout in set(assigned.values()):
+            self.rooms.pop(breakouts.room_code(room_code, breakout), None)
+        return assigned
+
+    async def get_saved_permissions(self, room_code, username):
+        room = self.rooms.get(room_code)
+        if not room or not room['saved_permissions_loaded']:
+            return None
+        return dict(room['saved_permissions'].get(username, {}))
+
+    async def load_saved_permissions(self, room_code, saved):
+        room = self._room(room_code)
+        room['saved_permissions'] = {**saved, **room['saved_permissions']}
+        room['saved_permissions_loaded'] = True
+
+    async def save_permissions(self, room_code, saved):
+        self._room(room_code)['saved_permissions'].update(
+            (username, dict(permissions)) for username, permissions in saved.items()
+        )
+
+    async def get_webinar(self, room_code):
+        room = self.rooms.get(room_code)
+        return room['webinar'] if room else None
+
+    async def load_webinar(self, room_code, webinar):
+        room = self._room(room_code)
+        if room['webinar'] is None:
+            room['webinar'] = webinar
+        return room['webinar']
+
+    async def set_webinar(self, room_code, webinar):
+        self._room(room_code)['webinar'] = webinar
+
+    async def delete_room(self, room_code):
+        room = self.rooms.pop(room_code, None)
+        for breakout in set(room['breakouts'].values()) if room else ():
+            self.rooms.pop(breakouts.room_code(room_code, breakout), None)
+
+
+def _copy_student(student):
+    return {
+        'username': student['username'],
+        'channel': student['channel'],
+        'permissions': dict(student['permissions']),
+        'session': student.get('session'),
+    }
+
+
+def _buffer_size():
+    return getattr(settings, 'CLASSROOM_RESUME_BUFFER_SIZE', DEFAULT_BUFFER_SIZE)
+
+
+def _key_ttl():
+    return getattr(settings, 'CLASSROOM_ROOM_KEY_TTL', DEFAULT_KEY_TTL)
+
+
+# Compare-and-delete so a stale disconnect on one worker cannot evict a
+# participant who has already reconnected through another worker.
+REMOVE_TEACHER_SCRIPT = """
+if redis.call('HGET', KEYS[1], 'channel') == ARGV[1] then
+    redis.call('DEL', KEYS[1], KEYS[2])
+    return 1
+end
+return 0
+"""
+
+REMOVE_STUDENT_SCRIPT = """
+local raw = redis.call('HGET', KEYS[1], ARGV[1])
+if raw and cjson.decode(raw)['channel'] == ARGV[2] then
+    redis.call('HDEL', KEYS[1], ARGV[1])
+    return redis.call('INCR', KEYS[2])
+end
+return false
+"""
+
+RESUME_STUDENT_SCRIPT = """
+local raw = redis.call('HGET', KEYS[1], ARGV[1])
+if not raw then
+    return false
+end
+local student = cjson.decode(raw)
+if student['session'] ~= ARGV[2] then
+    return false
+end
+student['channel'] = ARGV[3]
+raw = cjson.encode(student)
+redis.call('HSET', KEYS[1], ARGV[1], raw)
+return raw
+"""
+
+SET_PERMISSION_SCRIPT = """
+local raw = redis.call('HGET', KEYS[1], ARGV[1])
+if not raw then
+    return false
+end
+local student = cjson.decode(raw)
+student['permissions'][ARGV[2]] = cjson.decode(ARGV[3])
+raw = cjson.encode(student)
+redis.call('HSET', KEYS[1], ARGV[1], raw)
+return {raw, redis.call('INCR', KEYS[2])}
+"""
+SET_PERMISSIONS_SCRIPT = """
+local changes = cjson.decode(ARGV[1])
+local updated = {}
+for i = 2, #ARGV do
+    local raw = redis.call('HGET', KEYS[1], ARGV[i])
+    if raw then
+        local student = cjson.decode(raw)
+        for permission, status in pairs(changes) do
+            student['permissions'][permission] = status
+        end
+        raw = cjson.encode(student)
+        redis.call('HSET', KEYS[1], ARGV[i], raw)
+        updated[#updated + 1] = raw
+    end
+end
+if #updated == 0 then
+    return false
+end
+table.insert(updated, 1, redis.call('INCR', KEYS[2]))
+return updated
+"""
+
+# Numbered and stored in one step, so events_since never sees a number whose
+# event is missing. The frame arrives encoded; its seq is spliced in at the end.
+# Workers may add events out of order; trimming by rank keeps the newest.
+APPEND_EVENT_SCRIPT = """
+local seq = redis.call('INCR', KEYS[1])
+local text = string.sub(ARGV[1], 1, -2) .. ',"seq":' .. seq .. '}'
+redis.call('ZADD', KEYS[2], seq, text)
+redis.call('ZREMRANGEBYRANK', KEYS[2], 0, -tonumber(ARGV[2]) - 1)
+if tonumber(ARGV[3]) > 0 then
+    redis.call('EXPIRE', KEYS[1], ARGV[3])
+    redis.call('EXPIRE', KEYS[2], ARGV[3])
+end
+return text
+"""
+
+# Token bucket on the server's clock, so workers' clocks don't matter. The
+# key expires once the bucket would be full again.
+TAKE_TOKEN_SCRIPT = """
+local rate, burst = tonumber(ARGV[1]), tonumber(ARGV[2])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(state[1]) or burst
+local updated = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil((burst - tokens) / rate * 1000) + 1000)
+return tostring(wait)
+"""
+
+
+class RedisRoomStore(BaseRoomStore):
+    """
+    Store shared by every worker through Redis. Each room is up to ten keys:
+
+    * ``<prefix><code>:teacher`` - hash with ``username`` and ``channel``
+    * ``<prefix><code>:students`` - hash of username -> JSON student record
+    * ``<prefix><code>:live`` - present while the teacher is streaming
+    * ``<prefix><code>:roster_version`` - counter bumped by roster changes
+    * ``<prefix><code>:event_seq`` - number of the latest room-wide event
+    * ``<prefix><code>:events`` - sorted set of recent encoded events by number
+    * ``<prefix><code>:breakouts`` - hash of username -> breakout name
+    * ``<prefix><code>:saved_permissions`` - hash of username -> JSON saved permissions
+    * ``<prefix><code>:saved_permissions_loaded`` - present once they were read from the database
+    * ``<prefix><code>:webinar`` - the class's webinar flag, ``1`` or ``0``, once read
+
+    plus ``<prefix><code>:rate:<type>`` hashes for shared rate limits, which
+    expire on their own. Breakouts are rooms of their own under
+    ``<code>.<name>``, see breakouts.py.
+
+    The reaper deletes rooms nobody is in, but only while a worker that
+    hosted the room is running. As a backstop every key expires
+    ``CLASSROOM_ROOM_KEY_TTL`` seconds (a day by default) after the room was
+    last touched by a join or heartbeat sweep, or after its last event.
+
+    Every membership change is a single command or Lua script, so it is
+    atomic and costs one round trip regardless of room size, which needs all
+    of a room's keys on one Redis: the store takes a single host. Without
+    ``hosts`` it uses the default channel layer's first one.
+    """
+
+    def __init__(self, hosts=None, prefix="classroom:room:"):
+        if not hosts:
+            hosts = settings.CHANNEL_LAYERS['default']['CONFIG']['hosts'][:1]
+        if len(hosts) != 1:
+            raise ImproperlyConfigured(f"RedisRoomStore takes one Redis host, got {len(hosts)}")
+        self.host = hosts[0]
+        self.prefix = prefix
+        self._client = None
+        self._scripts = {}
+        self._touched = {}  # room code -> when this worker last refreshed its TTLs
+
+    @property
+    def client(self):
+        if self._client is None:
+            self._connect()
+        return self._client
+
+    def _connect(self):
+        from redis import asyncio as aioredis
+
+        if isinstance(self.host, str):
+            self._client = aioredis.Redis.from_url(self.host, decode_responses=True)
+        else:
+            host, port = self.host
+            self._client = aioredis.Redis(host=host, port=port, decode_responses=True)
+        self._scripts = {
+            'remove_teacher': self._client.register_script(REMOVE_TEACHER_SCRIPT),
+            'remove_student': self._client.register_script(REMOVE_STUDENT_SCRIPT),
+            'resume_student': self._client.register_script(RESUME_STUDENT_SCRIPT),
+            'set_permission': self._client.register_script(SET_PERMISSION_SCRIPT),
+            'set_permissions': self._client.register_script(SET_PERMISSIONS_SCRIPT),
+            'take_token': self._client.register_script(TAKE_TOKEN_SCRIPT),
+            'append_event': self._client.register_script(APPEND_EVENT_SCRIPT),
+        }
+
+    def _key(self, room_code, name):
+        return f"{self.prefix}{room_code}:{name}"
+
+    def _script(self, name):
+        if self._client is None:
+            self._connect()
+        return self._scripts[name]
+
+    async def set_teacher(self, room_code, username, channel):
+        await self.client.hset(
+            self._key(room_code, 'teacher'),
+            mapping={'username': username, 'channel': channel},
+        )
+
+    async def remove_teacher(self, room_code, channel):
+        removed = await self._script('remove_teacher')(
+            keys=[self._key(room_code, 'teacher'), self._key(room_code, 'live')],
+            args=[channel],
+        )
+        return bool(removed)
+
+    async def get_teacher(self, room_code):
+        teacher = await self.client.hgetall(self._key(room_code, 'teacher'))
+        return teacher or None
+
+    async def add_student(self, room_code, username, channel, session=None, permissions=None):
+        student = {'username': username, 'channel': channel, 'permissions': dict(permissions or {}), 'session': session}
+        async with self.client.pipeline(transaction=True) as pipe:
+            pipe.hset(self._key(room_code, 'students'), username, json.dumps(student))
+            pipe.incr(self._key(room_code, 'roster_version'))
+            _, version = await pipe.execute()
+        return student, version
+
+    async def resume_student(self, room_code, username, session, channel):
+        if not session:
+            return None
+        raw = await self._script('resume_student')(
+            keys=[self._key(room_code, 'students')],
+            args=[username, session, channel],
+        )
+        return _load_student(raw) if raw else None
+
+    async def remove_student(self, room_code, username, channel):
+        version = await self._script('remove_student')(
+            keys=[self._key(room_code, 'students'), self._key(room_code, 'roster_version')],
+            args=[username, channel],
+        )
+        return version
+
+    async def get_student(self, room_code, username):
+        raw = await self.client.hget(self._key(room_code, 'students'), username)
+        return _load_student(raw) if raw else None
+
+    async def list_students(self, room_code):
+        records = await self.client.hvals(self._key(room_code, 'students'))
+        return [_load_student(raw) for raw in records]
+
+    async def count_students(self, room_code):
+        return await self.client.hlen(self._key(room_code, 'students'))
+
+    async def roster_snapshot(self, room_code):
+        async with self.client.pipeline(transaction=True) as pipe:
+            pipe.get(self._key(room_code, 'roster_version'))
+            pipe.hvals(self._key(room_code, 'students'))
+            version, records = await pipe.execute()
+        return int(version or 0), [_load_student(raw) for raw in records]
+
+    async def set_permission(self, room_code, username, permission, status):
+        result = await self._script('set_permission')(
+            keys=[self._key(room_code, 'students'), self._key(room_code, 'roster_version')],
+            args=[username, permission, json.dumps(status)],
+        )
+        if not result:
+            return None, None
+        raw, version = result
+        return _load_student(raw), version
+
+    async def set_permissions(self, room_code, usernames, changes):
+        if not usernames:
+            return [], None
+        result = await self._script('set_permissions')(
+            keys=[self._key(room_code, 'students'), self._key(room_code, 'roster_version')],
+            args=[json.dumps(changes), *usernames],
+        )
+        if not result:
+            return [], None
+        version, *raws = result
+        return [_load_student(raw) for raw in raws], version
+
+    async def set_live(self, room_code, is_live):
+        if is_live:
+            await self.client.set(self._key(room_code, 'live'), 1)
+        else:
+            await self.client.delete(self._key(room_code, 'live'))
+
+    async def is_live(self, room_code):
+        return bool(await self.client.exists(self._key(room_code, 'live')))
+
+    async def append_event(self, room_code, frame):
+        return await self._script('append_event')(
+            keys=[self._key(room_code, 'event_seq'), self._key(room_code, 'events')],
+            args=[dumps(frame), _buffer_size(), _key_ttl()],
+        )
+
+    async def event_seq(self, room_code):
+        return int(await self.client.get(self._key(room_code, 'event_seq')) or 0)
+
+    async def events_since(self, room_code, seq):
+        async with self.client.pipeline(transaction=True) as pipe:
+            pipe.get(self._key(room_code, 'event_seq'))
+            pipe.zrangebyscore(self._key(room_code, 'events'), f'({seq}', '+inf')
+            current, events = await pipe.execute()
+        if not 0 <= int(current or 0) - seq <= _buffer_size():
+            return None
+        return events
+
+    async def take_token(self, room_code, name, rate, burst):
+        wait = await self._script('take_token')(keys=[self._key(room_code, f'rate:{name}')], args=[rate, burst])
+        return float(wait)
+
+    async def assign_breakouts(self, room_code, assignments):
+        key = self._key(room_code, 'breakouts')
+        assigned = {username: breakout for username, breakout in assignments.items() if breakout is not None}
+        returned = [username for username, breakout in assignments.items() if breakout is None]
+        async with self.client.pipeline(transaction=True) as pipe:
+            if assigned:
+                pipe.hset(key, mapping=assigned)
+            if returned:
+                pipe.hdel(key, *returned)
+            await pipe.execute()
+
+    async def get_breakouts(self, room_code):
+        return await self.client.hgetall(self._key(room_code, 'breakouts'))
+
+    async def get_breakout(self, room_code, username):
+        return await self.client.hget(self._key(room_code, 'breakouts'), username)
+
+    async def close_breakouts(self, room_code):
+        async with self.client.pipeline(transaction=True) as pipe:
+            pipe.hgetall(self._key(room_code, 'breakouts'))
+            pipe.delete(self._key(room_code, 'breakouts'))
+            assigned, _ = await pipe.execute()
+        keys = [key for breakout in set(assigned.values())
+                for key in self._room_keys(breakouts.room_code(room_code, breakout))]
+        if keys:
+            await self.client.delete(*keys)
+        return assigned
+
+    def _room_keys(self, room_code):
+        return [self._key(room_code, name) for name in
+                ('teacher', 'students', 'live', 'roster_version', 'event_seq', 'events', 'breakouts',
+                 'saved_permissions', 'saved_permissions_loaded', 'webinar')]
+
+    async def get_saved_permissions(self, room_code, username):
+        async with self.client.pipeline(transaction=True) as pipe:
+            pipe.exists(self._key(room_code, 'saved_permissions_loaded'))
+            pipe.hget(self._key(room_code, 'saved_permissions'), username)
+            loaded, raw = await pipe.execute()
+        if not loaded:
+            return None
+        return json.loads(raw) if raw else {}
+
+    async def load_saved_permissions(self, room_code, saved):
+        key = self._key(room_code, 'saved_permissions')
+        async with self.client.pipeline(transaction=True) as pipe:
+            for username, permissions in saved.items():
+                pipe.hsetnx(key, username, json.dumps(permissions))
+            pipe.set(self._key(room_code, 'saved_permissions_loaded'), 1)
+            await pipe.execute()
+
+    async def save_permissions(self, room_code, saved):
+        if saved:
+            await self.client.hset(self._key(room_code, 'saved_permissions'), mapping={
+                username: json.dumps(permissions) for username, permissions in saved.items()
+            })
+
+    async def get_webinar(self, room_code):
+        webinar = await self.client.get(self._key(room_code, 'webinar'))
+        return None if webinar is None else webinar == '1'
+
+    async def load_webinar(self, room_code, webinar):
+        key = self._key(room_code, 'webinar')
+        async with self.client.pipeline(transaction=True) as pipe:
+            pipe.setnx(key, int(webinar))
+            pipe.get(key)
+            _, kept = await pipe.execute()
+        return kept == '1'
+
+    async def set_webinar(self, room_code, webinar):
+        await self.client.set(self._key(room_code, 'webinar'), int(webinar))
+
+    async def delete_room(self, room_code):
+        self._touched.pop(room_code, None)
+        assigned = await self.client.hvals(self._key(room_code, 'breakouts'))
+        await self.client.delete(*self._room_keys(room_code), *[
+            key for breakout in set(assigned) for key in self._room_keys(breakouts.room_code(room_code, breakout))
+        ])
+
+    async def touch(self, room_code):
+        ttl = _key_ttl()
+        now = time.monotonic()
+        if not ttl or now - self._touched.get(room_code, -KEY_REFRESH_INTERVAL) < KEY_REFRESH_INTERVAL:
+            return
+        self._touched[room_code] = now
+        assigned = await self.client.hvals(self._key(room_code, 'breakouts'))
+        async with self.client.pipeline(transaction=False) as pipe:
+            for key in self._room_keys(room_code) + [
+                key for breakout in set(assigned) for key in self._room_keys(breakouts.room_code(room_code, breakout))
+            ]:
+                pipe.expire(key, ttl)
+            await pipe.execute()
+
+
+def _load_student(raw):
+    student = json.loads(raw)
+    # cjson encodes an empty table as a list
+    if not isinstance(student.get('permissions'), dict):
+        student['permissions'] = {}
+    return student
+
+
+_room_store = None
+
+
+def get_room_store():
+    """Return the process-wide room store configured in settings."""
+    global _room_store
+    if _room_store is None:
+        config = getattr(settings, 'CLASSROOM_ROOM_STORE', {})
+        backend = import_string(config.get('BACKEND', DEFAULT_ROOM_STORE))
+        _room_store = backend(**config.get('CONFIG', {}))
+    return _room_store
+
+
+def _reset_room_store(setting, **kwargs):
+    global _room_store
+    if setting in ('CLASSROOM_ROOM_STORE', 'CHANNEL_LAYERS'):
+        _room_store = None
+
+
+setting_changed.connect(_reset_room_store)
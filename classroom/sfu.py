@@ -0,0 +1,302 @@
+"""
+Selective forwarding unit (SFU) for the teacher stream.
+
+Without it the teacher's browser encodes and uploads one copy of its stream
+per student. With ``CLASSROOM_SFU_ENABLED`` the teacher publishes once to the
+server, which forwards the encoded media to every student:
+
+- The teacher's browser sends its offer and ICE candidates to the reserved
+  peer name ``"sfu"``; the teacher's consumer answers with an aiortc peer
+  connection (``SfuSession.publish``).
+- Admitted ``request_stream``s are answered by the same consumer with an
+  offer from ``"sfu"``. Students' answers and candidates addressed to
+  ``"sfu"`` are routed back to it, so the student code is unchanged and
+  students may be on any worker.
+
+Forwarding is done below the decoder: complete encoded frames from the
+teacher's receivers are wrapped as ``av.Packet`` once and handed to each
+student's sender, which only re-packetizes them (aiortc's sender accepts
+pre-encoded packets). Nothing is decoded or re-encoded per student. The
+hooks into the receiver and sender use aiortc internals, so the SFU stays
+off, and teachers stream peer to peer, unless the installed aiortc is one
+of ``TESTED_AIORTC``.
+With ``CLASSROOM_HLS_ENABLED`` the same frames also feed the room's HLS
+output, see hls.py.
+
+aiortc is optional and only imported when a session starts.
+"""
+import asyncio
+import fractions
+import functools
+import logging
+import queue
+import time
+
+from django.conf import settings
+
+from . import hls, metrics
+
+logger = logging.getLogger(__name__)
+
+# Peer name clients use to address the SFU in offer, answer and ICE frames
+SFU_PEER = 'sfu'
+
+# Publisher and subscribers must agree on codecs since media is not transcoded
+CODECS = {
+    'audio': ['audio/opus'],
+    'video': ['video/VP8', 'video/rtx'],
+}
+
+# Encoded frames buffered per subscriber track before it is considered stalled
+TRACK_QUEUE_SIZE = 64
+
+# Most keyframe requests sent to the teacher per second
+KEYFRAME_INTERVAL = 0.5
+
+# aiortc versions whose private receiver and sender attributes the hooks were tested with
+TESTED_AIORTC = ('1.15.',)
+
+frames_forwarded = metrics.Counter(
+    'classroom_sfu_frames_total',
+    'Encoded frames received from teachers (in) and handed to student senders (out), by kind.',
+    ['direction', 'kind'])
+frames_dropped = metrics.Counter(
+    'classroom_sfu_frames_dropped_total', 'Encoded frames dropped for stalled subscribers, by kind.', ['kind'])
+
+
+def sfu_enabled():
+    return getattr(settings, 'CLASSROOM_SFU_ENABLED', False) and aiortc_supported()
+
+
+@functools.cache
+def aiortc_supported():
+    try:
+        import aiortc
+    except ImportError:
+        logger.warning("CLASSROOM_SFU_ENABLED is set but aiortc is not installed; teachers stream peer to peer")
+        return False
+    if not aiortc.__version__.startswith(TESTED_AIORTC):
+        logger.warning(f"CLASSROOM_SFU_ENABLED is set but aiortc {aiortc.__version__} is not one of "
+                       f"{', '.join(v + 'x' for v in TESTED_AIORTC)}; teachers stream peer to peer")
+        return False
+    return True
+
+
+def _ice_configuration():
+    from aiortc import RTCConfiguration, RTCIceServer
+
+    urls = getattr(settings, 'CLASSROOM_SFU_ICE_SERVERS', [])
+    return RTCConfiguration(iceServers=[RTCIceServer(urls=url) for url in urls])
+
+
+def _prefer_codecs(transceiver):
+    from aiortc import RTCRtpSender
+
+    capabilities = RTCRtpSender.getCapabilities(transceiver.kind)
+    transceiver.setCodecPreferences([
+        codec for codec in capabilities.codecs if codec.mimeType in CODECS[transceiver.kind]
+    ])
+
+
+def parse_candidate(candidate):
+    """Browser RTCIceCandidateInit dict -> aiortc RTCIceCandidate, or None for end-of-candidates."""
+    from aiortc.sdp import candidate_from_sdp
+
+    text = candidate.get('candidate') if candidate else None
+    if not text:
+        return None
+    parsed = candidate_from_sdp(text.split(':', 1)[1] if text.startswith('candidate:') else text)
+    parsed.sdpMid = candidate.get('sdpMid')
+    parsed.sdpMLineIndex = candidate.get('sdpMLineIndex')
+    return parsed
+
+
+class _ForwardingQueue(queue.Queue):
+    """
+    Stands in for an RTCRtpReceiver's decoder queue. Complete encoded frames
+    go to the session instead of the decoder thread, which then only waits
+    for the stop marker.
+    """
+
+    def __init__(self, session, kind):
+        super().__init__()
+        self.session = session
+        self.kind = kind
+
+    def put(self, item, block=True, timeout=None):
+        if item is None:
+            super().put(item, block, timeout)
+        else:
+            self.session.forward(self.kind, *item)
+
+
+def _make_forwarded_track(kind):
+    from aiortc import MediaStreamTrack
+    from aiortc.mediastreams import MediaStreamError
+
+    class ForwardedTrack(MediaStreamTrack):
+        """A student's copy of one teacher track; yields pre-encoded packets."""
+
+        def __init__(self):
+            super().__init__()
+            self.kind = kind
+            self.packets = asyncio.Queue(maxsize=TRACK_QUEUE_SIZE)
+
+        def push(self, packet):
+            try:
+                self.packets.put_nowait(packet)
+                return True
+            except asyncio.QueueFull:
+                return False
+
+        def flush(self):
+            while not self.packets.empty():
+                self.packets.get_nowait()
+
+        async def recv(self):
+            if self.readyState != 'live':
+                raise MediaStreamError
+            packet = await self.packets.get()
+            if packet is None:
+                self.stop()
+                raise MediaStreamError
+            return packet
+
+    return ForwardedTrack()
+
+
+class SfuSession:
+    """One teacher's published stream and the students subscribed to it, on the teacher's worker."""
+
+    def __init__(self, room_code=None):
+        self.room_code = room_code
+        self.recorder = None   # HlsRecorder, see hls.py
+        self.publisher = None
+        self.receivers = {}    # kind -> RTCRtpReceiver of the teacher's track
+        self.subscribers = {}  # username -> (RTCPeerConnection, {kind: ForwardedTrack})
+        self._last_keyframe_request = 0
+
+    async def publish(self, offer):
+        """Accept the teacher's offer; returns the answer as {'type', 'sdp'}."""
+        from aiortc import RTCPeerConnection, RTCSessionDescription
+        from aiortc.sdp import SessionDescription
+
+        await self.close()
+        self.publisher = RTCPeerConnection(_ice_configuration())
+        # Created first so the codec preferences apply when the offer is matched to them
+        offered = {media.kind for media in SessionDescription.parse(offer['sdp']).media}
+        for kind in CODECS:
+            if kind in offered:
+                _prefer_codecs(self.publisher.addTransceiver(kind, direction='recvonly'))
+        await self.publisher.setRemoteDescription(RTCSessionDescription(sdp=offer['sdp'], type=offer['type']))
+        for transceiver in self.publisher.getTransceivers():
+            receiver = transceiver.receiver
+            # Take encoded frames before they reach the decoder thread (started once connected)
+            receiver._RTCRtpReceiver__decoder_queue = _ForwardingQueue(self, transceiver.kind)
+            self.receivers[transceiver.kind] = receiver
+        if self.room_code and hls.hls_enabled():
+            self.recorder = hls.HlsRecorder(self.room_code, list(self.receivers))
+
+        await self.publisher.setLocalDescription(await self.publisher.createAnswer())
+        return {'type': 'answer', 'sdp': self.publisher.localDescription.sdp}
+
+    async def subscribe(self, username):
+        """Start forwarding to ``username``; returns the offer for the student."""
+        from aiortc import RTCPeerConnection
+
+        await self.unsubscribe(username)
+        pc = RTCPeerConnection(_ice_configuration())
+        tracks = {}
+        for kind in self.receivers:
+            track = tracks[kind] = _make_forwarded_track(kind)
+            sender = pc.addTrack(track)
+            # Packets are forwarded as-is, so a student's keyframe request goes to the teacher
+            sender._send_keyframe = self.request_keyframe
+        for transceiver in pc.getTransceivers():
+            _prefer_codecs(transceiver)
+        self.subscribers[username] = (pc, tracks)
+
+        @pc.on('connectionstatechange')
+        async def on_connectionstatechange():
+            # A student who left stops being forwarded to once ICE gives up
+            if pc.connectionState == 'failed' and self.subscribers.get(username, (None,))[0] is pc:
+                logger.info(f"SFU connection to {username} failed")
+                await self.unsubscribe(username)
+
+        await pc.setLocalDescription(await pc.createOffer())
+        self.request_keyframe()
+        return {'type': 'offer', 'sdp': pc.localDescription.sdp}
+
+    async def accept_answer(self, username, answer):
+        from aiortc import RTCSessionDescription
+
+        entry = self.subscribers.get(username)
+        if entry:
+            await entry[0].setRemoteDescription(RTCSessionDescription(sdp=answer['sdp'], type=answer['type']))
+
+    async def add_candidates(self, username, candidates, end_of_candidates=False):
+        """Trickled candidates from the teacher (username None) or a student."""
+        if username is None:
+            pc = self.publisher
+        else:
+            pc = self.subscribers.get(username, (None,))[0]
+        if pc is None:
+            return
+        for candidate in candidates:
+            parsed = parse_candidate(candidate)
+            if parsed is not None:
+                await pc.addIceCandidate(parsed)
+        if end_of_candidates:
+            await pc.addIceCandidate(None)
+
+    def forward(self, kind, codec, encoded_frame):
+        # Called on the event loop by the teacher's receiver for every complete frame
+        import av
+
+        packet = av.Packet(encoded_frame.data)
+        packet.pts = encoded_frame.timestamp
+        packet.time_base = fractions.Fraction(1, codec.clockRate)
+        frames_forwarded.inc('in', kind)
+
+        delivered = 0
+        for _, tracks in self.subscribers.values():
+            track = tracks.get(kind)
+            if track is None:
+                continue
+            if track.push(packet):
+                delivered += 1
+            else:
+                # Stalled subscriber: start it over from the next keyframe
+                frames_dropped.inc(kind, amount=track.packets.qsize() + 1)
+                track.flush()
+                if kind == 'video':
+                    self.request_keyframe()
+        frames_forwarded.inc('out', kind, amount=delivered)
+        if self.recorder and not self.recorder.push(kind, codec, encoded_frame) and kind == 'video':
+            # The transcoder fell behind and lost a frame; it decodes again from a keyframe
+            self.request_keyframe()
+
+    def request_keyframe(self):
+        receiver = self.receivers.get('video')
+        now = time.monotonic()
+        if receiver is None or now - self._last_keyframe_request < KEYFRAME_INTERVAL:
+            return
+        self._last_keyframe_request = now
+        for source in receiver.getSynchronizationSources():
+            asyncio.ensure_future(receiver._send_rtcp_pli(source.source))
+
+    async def unsubscribe(self, username):
+        entry = self.subscribers.pop(username, None)
+        if entry:
+            await entry[0].close()
+
+    async def close(self):
+        for username in list(self.subscribers):
+            await self.unsubscribe(username)
+        if self.publisher:
+            await self.publisher.close()
+        if self.recorder:
+            await self.recorder.close()
+        self.publisher = None
+        self.recorder = None
+        self.receivers = {}
@@ -0,0 +1,70 @@
+"""
+Room sharding across several Redis channel layers.
+
+Each entry in ``settings.CLASSROOM_CHANNEL_LAYER_SHARDS`` names a channel
+layer alias in ``CHANNEL_LAYERS`` (normally one Redis instance each). A room
+code is mapped to a shard with a consistent-hash ring, and every consumer in
+that room uses the shard's layer for its channel, the room group and all
+targeted sends. Adding a shard only moves roughly 1/N of the rooms.
+
+Only group fan-out and channel sends are sharded. The room store (rosters,
+resume buffers, shared rate-limit buckets, see rooms.py) and the broadcast
+bus (bus.py) keep using ``REDIS_HOST``, so that one Redis still sees every
+room's state changes; sharding spreads the message traffic, not the state.
+
+Without the setting every room uses the default channel layer.
+"""
+import bisect
+import hashlib
+
+from channels import DEFAULT_CHANNEL_LAYER
+from django.conf import settings
+from django.core.signals import setting_changed
+
+# Virtual nodes per shard; more points give a more even spread
+DEFAULT_REPLICAS = 160
+
+
+def _hash(key):
+    return int.from_bytes(hashlib.blake2b(key.encode('utf8'), digest_size=8).digest(), 'big')
+
+
+class HashRing:
+    """Consistent-hash ring mapping keys to nodes."""
+
+    def __init__(self, nodes, replicas=DEFAULT_REPLICAS):
+        self.nodes = list(nodes)
+        points = sorted(
+            (_hash(f"{node}#{i}"), node)
+            for node in self.nodes
+            for i in range(replicas)
+        )
+        self._hashes = [h for h, _ in points]
+        self._nodes = [node for _, node in points]
+
+    def node_for(self, key):
+        index = bisect.bisect(self._hashes, _hash(key)) % len(self._hashes)
+        return self._nodes[index]
+
+
+_ring = None
+
+
+def channel_layer_alias_for_room(room_code):
+    """Return the channel layer alias that serves ``room_code``."""
+    global _ring
+    shards = getattr(settings, 'CLASSROOM_CHANNEL_LAYER_SHARDS', None)
+    if not shards:
+        return DEFAULT_CHANNEL_LAYER
+    if _ring is None or _ring.nodes != list(shards):
+        _ring = HashRing(shards)
+    return _ring.node_for(room_code)
+
+
+def _reset_ring(setting, **kwargs):
+    global _ring
+    if setting == 'CLASSROOM_CHANNEL_LAYER_SHARDS':
+        _ring = None
+
+
+setting_changed.connect(_reset_ring)
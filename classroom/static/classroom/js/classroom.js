@@ -6,7 +6,8 @@
 // const isTeacher = {{ is_teacher|yesno:'true,false' }};
 
 const wsProtocol = window.location.protocol === 'https:' ? 'wss:' : 'ws:';
-const socket = new WebSocket(`${wsProtocol}//${window.location.host}/ws/classroom/${roomCode}/`);
+const socketUrl = `${wsProtocol}//${window.location.host}/ws/classroom/${roomCode}/`;
+let socket;
 
 const config = { 
     iceServers: [
@@ -26,6 +27,48 @@ let studentPeerConnections = {}; // Keyed by username, for RECEIVING student str
 
 let localStream; // Can be teacher's or student's own stream
 let teacherStream; // To hold the stream from the teacher
+let relayPeerConnections = {}; // Student: keyed by username, for passing the teacher stream ON, see relay.py
+let pendingRelayRequests = []; // Relay requests that arrived before we had the teacher stream
+let streamTrace = null; // Student's timings for the current request_stream, see tracing.py
+let streamRetryTimer = null; // Student asks again after the teacher fails to connect
+const STREAM_RETRY_DELAY_MS = 3000;
+const SFU_PEER = "sfu"; // Peer name of the server when sfuMode is on, see sfu.py
+let olderChatBefore = null; // Cursor for chat older than what is shown, see chat.py
+let hlsPlayer = null; // hls.js instance while watching hlsUrl, see hls.py
+let hlsRetryTimer = null;
+let hlsJsLoading = null; // Resolves once hls.js has loaded or failed to
+const HLS_RETRY_DELAY_MS = 1000; // The playlist appears once the first segment is written
+
+// Resumable session after the socket drops, see resume.py
+let resumeToken = null; // Students only, from the server's "session" frame
+let lastSeq = 0; // Number of the latest room-wide frame handled
+let resumingFrames = null; // Frames that arrived before "resumed", while resuming
+let reconnectAttempts = 0;
+const RECONNECT_DELAYS_MS = [250, 1000, 2000, 4000];
+const FEATURES = ["ice_candidates"];
+
+// MessagePack frames when the server offers them (binaryFrames, from the
+// template), with numeric type and key codes and interned usernames, see binary.py
+let wireCodec = null; // This socket's username tables, null while it speaks JSON
+const binaryTables = binaryFrames && {
+    typeCodes: new Map(binaryFrames.types.map((type, code) => [type, code])),
+    keyCodes: new Map(binaryFrames.keys.map((key, code) => [key, code])),
+    userFields: new Set(binaryFrames.user_fields)
+};
+
+// Participant roster, kept current by a snapshot plus versioned deltas
+let roster = new Map(); // username -> { username, permissions }
+let rosterVersion = null; // null until the first snapshot arrives
+let pendingRosterDeltas = new Map(); // version -> delta that arrived ahead of a gap
+let rosterGapTimer = null;
+const ROSTER_GAP_TIMEOUT_MS = 1000; // How long to wait for a missing delta before resyncing
+
+// Webinar classes: students get a count and page through participants on request, see webinar.py
+let participantsNext = null; // Name to continue the participant list after
+
+// Breakout rooms, see breakouts.py
+let currentBreakout = null; // Student: the breakout we are in, null in the main room
+let breakoutAssignments = {}; // Teacher: username -> breakout
 
 // UI Elements
 const teacherVideo = document.getElementById('teacher-video');
@@ -49,9 +92,17 @@ function runPreflightChecks() {
 
 
 // Error handling
+// Messages often carry usernames, so they are only ever set as text.
+function showNotice(className, message) {
+    const notice = document.createElement('div');
+    notice.className = className;
+    notice.textContent = message;
+    document.getElementById('error-container').replaceChildren(notice);
+}
+
 function showError(message) {
     const errorContainer = document.getElementById('error-container');
-    errorContainer.innerHTML = `<div class="error-message">${message}</div>`;
+    showNotice('error-message', message);
     console.error('Error:', message);
     setTimeout(() => {
         errorContainer.innerHTML = '';
@@ -60,7 +111,7 @@ function showError(message) {
 
 function showSuccess(message) {
     const errorContainer = document.getElementById('error-container');
-    errorContainer.innerHTML = `<div class="success-message">${message}</div>`;
+    showNotice('success-message', message);
     console.log('Success:', message);
     setTimeout(() => {
         errorContainer.innerHTML = '';
@@ -68,91 +119,385 @@ function showSuccess(message) {
 }
 
 // WebSocket connection
-socket.onopen = () => {
+function connectSocket() {
+    socket = binaryFrames ? new WebSocket(socketUrl, binaryFrames.subprotocol) : new WebSocket(socketUrl);
+    socket.binaryType = "arraybuffer";
+    socket.onopen = handleSocketOpen;
+    socket.onclose = handleSocketClose;
+    socket.onerror = (error) => {
+        console.error('WebSocket error:', error);
+        if (!resumeToken) {
+            showError('Connection error occurred.');
+        }
+    };
+    socket.onmessage = handleSocketMessage;
+}
+
+function handleSocketOpen() {
     console.log('WebSocket connected');
+    // Username ids start over with every connection
+    wireCodec = binaryFrames && socket.protocol === binaryFrames.subprotocol
+        ? { sentUsers: new Map(), receivedUsers: [] }
+        : null;
+    if (resumeToken) {
+        // Same seat, same peer connections: only the frames we missed come back
+        resumingFrames = [];
+        sendFrame({
+            type: "resume",
+            resume_token: resumeToken,
+            last_seq: lastSeq,
+            breakout: currentBreakout,
+            features: FEATURES
+        });
+        return;
+    }
     if (runPreflightChecks()) {
-        socket.send(JSON.stringify({ type: "join", username: username, is_teacher: isTeacher }));
+        sendFrame({
+            type: "join",
+            username: username,
+            is_teacher: isTeacher,
+            features: FEATURES
+        });
         showSuccess('Connected to classroom!');
     }
-};
+}
 
-socket.onclose = (event) => {
+function handleSocketClose(event) {
     console.log('WebSocket disconnected, code:', event.code, 'reason:', event.reason);
-    showError('Disconnected from classroom. Please refresh the page.');
-};
+    if (!resumeToken) {
+        showError('Disconnected from classroom. Please refresh the page.');
+        return;
+    }
+    const delay = RECONNECT_DELAYS_MS[Math.min(reconnectAttempts, RECONNECT_DELAYS_MS.length - 1)];
+    reconnectAttempts++;
+    showError('Connection lost, reconnecting...');
+    setTimeout(connectSocket, delay);
+}
 
-socket.onerror = (error) => {
-    console.error('WebSocket error:', error);
-    showError('Connection error occurred.');
-};
+function sendFrame(frame) {
+    socket.send(wireCodec ? MsgPack.encode(packFrame(frame)) : JSON.stringify(frame));
+}
+
+function packFrame(value) {
+    if (Array.isArray(value)) {
+        return value.map(packFrame);
+    }
+    if (value === null || typeof value !== "object") {
+        return value;
+    }
+    const packed = new Map();
+    for (const [key, item] of Object.entries(value)) {
+        if (item === undefined) continue;
+        packed.set(binaryTables.keyCodes.has(key) ? binaryTables.keyCodes.get(key) : key, packField(key, item));
+    }
+    return packed;
+}
+
+function packField(key, value) {
+    if (key === "type" && binaryTables.typeCodes.has(value)) {
+        return binaryTables.typeCodes.get(value);
+    }
+    if (binaryTables.userFields.has(key) && typeof value === "string") {
+        const sent = wireCodec.sentUsers;
+        if (!sent.has(value)) {
+            sent.set(value, sent.size);
+            return [sent.get(value), value];
+        }
+        return sent.get(value);
+    }
+    return packFrame(value);
+}
+
+function unpackFrame(value) {
+    if (Array.isArray(value)) {
+        return value.map(unpackFrame);
+    }
+    if (!(value instanceof Map)) {
+        return value;
+    }
+    const frame = {};
+    value.forEach((item, key) => {
+        const name = typeof key === "number" ? binaryFrames.keys[key] : key;
+        frame[name] = unpackField(name, item);
+    });
+    return frame;
+}
+
+function unpackField(key, value) {
+    if (key === "type" && typeof value === "number") {
+        return binaryFrames.types[value];
+    }
+    if (binaryTables.userFields.has(key)) {
+        const received = wireCodec.receivedUsers;
+        if (Array.isArray(value)) {
+            received[value[0]] = value[1];
+            return value[1];
+        }
+        if (typeof value === "number") {
+            return received[value];
+        }
+    }
+    return unpackFrame(value);
+}
+
+// Tell the server we are gone rather than dropped, so it doesn't hold our seat
+window.addEventListener('pagehide', () => {
+    if (socket.readyState === WebSocket.OPEN) {
+        sendFrame({ type: "leave" });
+    }
+});
+
+async function handleSocketMessage(e) {
+    let data;
+    try {
+        data = typeof e.data === "string" ? JSON.parse(e.data) : unpackFrame(MsgPack.decode(e.data));
+    } catch (error) {
+        console.error('Invalid WebSocket message:', error);
+        return;
+    }
+    if (resumingFrames !== null && data.type !== "resumed" && data.type !== "resume_failed") {
+        // Live frames that may overlap the replay; sorted out once it arrives
+        resumingFrames.push(data);
+        return;
+    }
+    await handleFrame(data);
+}
+
+async function handleResumed(data) {
+    const held = resumingFrames;
+    resumingFrames = null;
+    reconnectAttempts = 0;
+    showSuccess('Reconnected to classroom.');
+    if (data.resync) {
+        // Too much was missed; a snapshot and the chat history follow
+        lastSeq = data.seq;
+        document.querySelectorAll('#chat-box > div').forEach(el => el.remove());
+    }
+    const previousSeq = lastSeq;
+    const replayed = new Set(data.events.map(frame => frame.seq));
+    for (const frame of data.events) {
+        await handleFrame(frame);
+    }
+    for (const frame of held) {
+        if (frame.seq === undefined || (frame.seq > previousSeq && !replayed.has(frame.seq))) {
+            await handleFrame(frame);
+        }
+    }
+}
 
-socket.onmessage = async function (e) {
+async function handleFrame(data) {
     try {
-        const data = JSON.parse(e.data);
         console.log("WS received:", data);
+        if (data.seq > lastSeq) {
+            lastSeq = data.seq;
+        }
 
         switch(data.type) {
+            case "session":
+                resumeToken = data.resume_token;
+                lastSeq = data.seq;
+                break;
+            case "resumed":
+                await handleResumed(data);
+                break;
+            case "heartbeat":
+                // The server closes sockets that stop answering, see reaper.py
+                sendFrame({ type: "heartbeat" });
+                break;
+            case "class_ended":
+                resumeToken = null;
+                showError('This class has ended.');
+                break;
+            case "resume_failed":
+                resumeToken = null;
+                resumingFrames = null;
+                showError('Your connection was gone too long. Please refresh the page.');
+                socket.close();
+                break;
             case "teacher_is_live":
-                if (!isTeacher) {
+                if (!isTeacher && watchingTeacher()) {
+                    // Already watching, e.g. told again after a resync
+                    break;
+                }
+                if (!isTeacher && hlsUrl) {
+                    console.log("Teacher is live, watching the HLS stream.");
+                    watchHls(hlsUrl);
+                } else if (!isTeacher) {
                     console.log("Teacher is live, requesting stream.");
-                    socket.send(JSON.stringify({ type: "request_stream" }));
+                    requestTeacherStream();
+                }
+                break;
+            case "stream_queue":
+                // Our place in the teacher's admission queue, see admission.py
+                if (!isTeacher) {
+                    handleStreamQueue(data);
                 }
                 break;
             case "student_requesting_stream":
                 if (isTeacher) {
-                    await createTeacherPeerConnection(data.from_user);
+                    await createTeacherPeerConnection(data.from_user, data.trace_id, performance.now());
+                }
+                break;
+            case "relay_request":
+                // The server picked us to pass the teacher stream on to another student
+                if (!isTeacher && teacherStream) {
+                    await createTeacherPeerConnection(data.from_user, data.trace_id, performance.now());
+                } else if (!isTeacher) {
+                    pendingRelayRequests.push({ ...data, requestedAt: performance.now() });
                 }
                 break;
             case "offer":
                 if (!isTeacher) {
-                    await handleTeacherOffer(data.offer, data.from_user);
+                    markStreamTrace(data.trace_id, 'offer_received');
+                    if (streamTrace && streamTrace.id === data.trace_id) {
+                        streamTrace.teacherMs = data.teacher_ms;
+                    }
+                    await handleTeacherOffer(JSON.parse(data.offer), data.from_user, data.trace_id);
                 }
                 break;
             case "answer":
+                // An answer from a student to the teacher's (or our relayed) offer
                 if (isTeacher) {
-                    // This is an answer from a student to the teacher's offer
-                    await handlePeerAnswer(teacherPeerConnections[data.from_user], data.answer);
+                    await handlePeerAnswer(teacherPeerConnections[data.from_user], JSON.parse(data.answer));
+                } else {
+                    await handlePeerAnswer(relayPeerConnections[data.from_user], JSON.parse(data.answer));
                 }
                 break;
             // Student sends offer, teacher receives
             case "student_offer":
                 if (isTeacher) {
-                    await handleStudentOffer(data.offer, data.from_user);
+                    await handleStudentOffer(JSON.parse(data.offer), data.from_user);
                 }
                 break;
             // Teacher sends answer to student's offer
             case "student_answer":
                 if (!isTeacher && studentSendConnection) {
                     // This is an answer from the teacher to the student's offer
-                    await handlePeerAnswer(studentSendConnection, data.answer);
+                    await handlePeerAnswer(studentSendConnection, JSON.parse(data.answer));
                 }
                 break;
             case "ice_candidate":
                 handleIceCandidate(data);
                 break;
+            case "ice_candidates":
+                handleIceCandidates(data);
+                break;
             case "chat_message":
                 displayChatMessage(data.username, data.message);
                 break;
-            case "student_list":
-                updateStudentList(data.students);
+            case "chat_history": {
+                // Recent chat from before we joined; newer messages arrive live
+                const chatBox = document.getElementById('chat-box');
+                prependChatMessages(data.messages, data.before);
+                chatBox.scrollTop = chatBox.scrollHeight;
+                break;
+            }
+            case "roster_snapshot":
+                applyRosterSnapshot(data.version, data.students);
+                break;
+            case "participant_count":
+                // Webinar students get this instead of the roster
+                if (!isTeacher) {
+                    document.getElementById('participant-count').innerText = data.count;
+                }
+                break;
+            case "participant_page":
+                showParticipantPage(data);
+                break;
+            case "webinar":
+                // The class was switched in or out of webinar mode; a count or snapshot follows
+                setWebinarMode(data.status);
+                break;
+            case "breakout":
+                // Moved to a breakout or back; its roster and chat history follow
+                handleBreakout(data);
+                break;
+            case "breakouts":
+                if (isTeacher) {
+                    breakoutAssignments = data.assignments;
+                    roster.forEach(renderStudent);
+                }
+                break;
+            case "room_batch":
+                // Coalesced roster deltas and leave notices, see coalescer.py
+                data.deltas.forEach(applyRosterDelta);
+                data.left.forEach(left => handleUserLeft(left.username));
                 break;
             case "permission_granted":
                 if (!isTeacher) {
                     handlePermissionGranted(data.permission, data.status);
                 }
                 break;
-            case "user_left":
-                handleUserLeft(data.username);
-                break;
             case "stream_stopped":
                 handleStreamStopped(data.username, data.is_teacher);
                 break;
+            case "error":
+                // The server rejected one of our frames
+                if (data.code === "rate_limited") {
+                    // Dropped, see ratelimit.py; told once until one gets through
+                    showError(`Too many ${data.message_type} messages, try again in ${Math.ceil(data.retry_after)}s.`);
+                    break;
+                }
+                showError(`Server rejected ${data.message_type || 'a message'}: ${data.code}`);
+                break;
         }
     } catch (error) {
         console.error('Error processing WebSocket message:', error);
         showError('Error processing message from server.');
     }
-};
+}
+
+// Offers and answers go out as a small routing header and the SDP payload
+// separated by a newline. The server reads only the header and forwards the
+// payload untouched (see classroom/framing.py). Binary frames carry the SDP
+// text as a field instead. Either way it arrives as a string to parse.
+function sendSignalingEnvelope(header, description) {
+    if (wireCodec) {
+        const field = header.type.endsWith("offer") ? "offer" : "answer";
+        sendFrame({ ...header, [field]: JSON.stringify(description) });
+        return;
+    }
+    socket.send(JSON.stringify(header) + "\n" + JSON.stringify(description));
+}
+
+// --- Stream setup tracing ---
+// A student times each step of receiving the teacher's stream, in ms since it
+// sent request_stream, and reports them once the first frame is rendered.
+// The trace ID also travels with the offer, answer and ICE candidates.
+function startStreamTrace() {
+    const bytes = crypto.getRandomValues(new Uint8Array(8));
+    const id = Array.from(bytes, b => b.toString(16).padStart(2, '0')).join('');
+    streamTrace = { id, started: performance.now(), marks: {}, teacherMs: null, reported: false };
+    return id;
+}
+
+function markStreamTrace(traceId, name) {
+    if (streamTrace && streamTrace.id === traceId && streamTrace.marks[name] === undefined) {
+        streamTrace.marks[name] = Math.round(performance.now() - streamTrace.started);
+    }
+}
+
+function reportStreamTrace(traceId) {
+    if (!streamTrace || streamTrace.id !== traceId || streamTrace.reported) return;
+    // Some browsers render before reporting "connected"
+    markStreamTrace(traceId, 'connected');
+    markStreamTrace(traceId, 'first_frame');
+    streamTrace.reported = true;
+    sendFrame({
+        type: "stream_trace",
+        trace_id: traceId,
+        teacher_ms: streamTrace.teacherMs,
+        marks: streamTrace.marks
+    });
+}
+
+function whenFirstFrameRendered(video, callback) {
+    if (video.requestVideoFrameCallback) {
+        video.requestVideoFrameCallback(() => callback());
+    } else {
+        video.addEventListener('loadeddata', () => callback(), { once: true });
+    }
+}
 
 // Generic Answer Handler
 async function handlePeerAnswer(peerConnection, answer) {
@@ -167,8 +512,61 @@ async function handlePeerAnswer(peerConnection, answer) {
     }
 }
 
-function handleIceCandidate(data) {
-    const { from_user, candidate, is_teacher_stream } = data;
+// --- ICE candidate batching ---
+// Candidates are gathered in bursts; send them per peer connection in one
+// "ice_candidates" frame instead of one frame each.
+const ICE_BATCH_DELAY_MS = 10;
+let outgoingIceBatches = {}; // "targetUser|isTeacherStream" -> { candidates, timer }
+
+function queueIceCandidate(targetUser, isTeacherStream, candidate, traceId) {
+    const key = `${targetUser}|${isTeacherStream}`;
+    let batch = outgoingIceBatches[key];
+    if (!batch) {
+        batch = outgoingIceBatches[key] = { candidates: [], timer: null, traceId };
+    }
+    if (candidate) {
+        batch.candidates.push(candidate);
+        if (!batch.timer) {
+            batch.timer = setTimeout(() => flushIceCandidates(targetUser, isTeacherStream, false), ICE_BATCH_DELAY_MS);
+        }
+    } else {
+        // A null candidate means gathering is complete
+        flushIceCandidates(targetUser, isTeacherStream, true);
+    }
+}
+
+function flushIceCandidates(targetUser, isTeacherStream, endOfCandidates) {
+    const key = `${targetUser}|${isTeacherStream}`;
+    const batch = outgoingIceBatches[key];
+    if (!batch) return;
+    clearTimeout(batch.timer);
+    delete outgoingIceBatches[key];
+
+    if (batch.candidates.length || endOfCandidates) {
+        sendFrame({
+            type: "ice_candidates",
+            candidates: batch.candidates,
+            end_of_candidates: endOfCandidates,
+            target_user: targetUser,
+            is_teacher_stream: isTeacherStream,
+            trace_id: batch.traceId
+        });
+    }
+}
+
+function handleIceCandidates(data) {
+    const { from_user, candidates, end_of_candidates, is_teacher_stream } = data;
+    candidates.forEach(candidate => handleIceCandidate({ from_user, candidate, is_teacher_stream }));
+
+    const pc = peerConnectionFor(from_user, is_teacher_stream);
+    if (pc && end_of_candidates) {
+        pc.addIceCandidate(null).catch(e => {
+            console.warn("Error signalling end of candidates", e);
+        });
+    }
+}
+
+function peerConnectionFor(from_user, is_teacher_stream) {
     let pc;
 
     if (isTeacher) {
@@ -181,8 +579,11 @@ function handleIceCandidate(data) {
             pc = studentPeerConnections[from_user];
         }
     } else {
-        // Student receives a candidate from the teacher
-        if (is_teacher_stream) {
+        // Student receives a candidate from the teacher or its relay
+        if (is_teacher_stream && relayPeerConnections[from_user]) {
+            // Candidate from a student we relay the teacher stream to
+            pc = relayPeerConnections[from_user];
+        } else if (is_teacher_stream) {
             // Candidate for the stream coming FROM the teacher
             pc = teacherPeerConnection;
         } else {
@@ -190,6 +591,12 @@ function handleIceCandidate(data) {
             pc = studentSendConnection;
         }
     }
+    return pc;
+}
+
+function handleIceCandidate(data) {
+    const { from_user, candidate, is_teacher_stream } = data;
+    const pc = peerConnectionFor(from_user, is_teacher_stream);
 
     if (pc && candidate) {
         pc.addIceCandidate(new RTCIceCandidate(candidate)).catch(e => {
@@ -211,9 +618,14 @@ async function startTeacherStream(type = 'camera') {
     try {
         localStream = await navigator.mediaDevices.getUserMedia(constraints);
         teacherVideo.srcObject = localStream;
+
+        if (sfuMode) {
+            // Publish once to the server, which answers students' requests itself
+            await createTeacherPeerConnection(SFU_PEER, null, performance.now());
+        }
         
         // Notify server that teacher is ready to stream
-        socket.send(JSON.stringify({ type: "teacher_ready" }));
+        sendFrame({ type: "teacher_ready" });
         showSuccess('Stream started. Students can now request to view.');
 
     } catch (error) {
@@ -222,45 +634,49 @@ async function startTeacherStream(type = 'camera') {
     }
 }
 
-// This is called when a student requests the stream
-async function createTeacherPeerConnection(forUser) {
+// This is called when a student requests the stream. A relaying student
+// sends on the stream it receives instead of its own media.
+async function createTeacherPeerConnection(forUser, traceId, requestedAt) {
+    const stream = isTeacher ? localStream : teacherStream;
+    const connections = isTeacher ? teacherPeerConnections : relayPeerConnections;
     try {
+        if (connections[forUser]) {
+            connections[forUser].close();
+        }
         const pc = new RTCPeerConnection(config);
-        teacherPeerConnections[forUser] = pc; // Store connection for SENDING
+        connections[forUser] = pc; // Store connection for SENDING
 
-        // Add teacher's local stream tracks to the new connection
-        if (localStream) {
-            localStream.getTracks().forEach(track => {
-                pc.addTrack(track, localStream);
+        // Add the stream's tracks to the new connection
+        if (stream) {
+            stream.getTracks().forEach(track => {
+                pc.addTrack(track, stream);
             });
         } else {
             showError("Teacher stream is not active. Cannot connect student.");
+            sendFrame({ type: "negotiation_failed", target_user: forUser });
             return;
         }
 
         pc.onicecandidate = event => {
-            if (event.candidate) {
-                socket.send(JSON.stringify({ 
-                    type: "ice_candidate", 
-                    candidate: event.candidate,
-                    target_user: forUser,
-                    is_teacher_stream: true
-                }));
-            }
+            queueIceCandidate(forUser, true, event.candidate, traceId);
         };
 
         const offer = await pc.createOffer();
         await pc.setLocalDescription(offer);
 
-        socket.send(JSON.stringify({ 
-            type: "offer", 
-            offer: offer,
-            target_user: forUser
-        }));
+        // teacher_ms: time this browser took to answer the request, see tracing.py
+        sendSignalingEnvelope({
+            type: "offer",
+            target_user: forUser,
+            trace_id: traceId,
+            teacher_ms: Math.round(performance.now() - requestedAt)
+        }, offer);
 
     } catch (error) {
         console.error(`Error creating peer connection for ${forUser}:`, error);
         showError(`Failed to initiate stream for ${forUser}.`);
+        // Free the slot so the next student can be connected
+        sendFrame({ type: "negotiation_failed", target_user: forUser });
     }
 }
 
@@ -277,42 +693,153 @@ function stopTeacherStream() {
         Object.values(studentPeerConnections).forEach(pc => pc.close());
         studentPeerConnections = {};
 
-        socket.send(JSON.stringify({ type: "stream_stopped", is_teacher: true }));
+        sendFrame({ type: "stream_stopped", is_teacher: true });
         showSuccess('Teacher stream stopped.');
     }
 }
 
 // --- Student Logic ---
 
+function watchingTeacher() {
+    if (hlsPlayer || teacherVideo.getAttribute('src')) return true;
+    return Boolean(teacherPeerConnection) &&
+        ['new', 'connecting', 'connected'].includes(teacherPeerConnection.connectionState);
+}
+
+function requestTeacherStream() {
+    clearTimeout(streamRetryTimer);
+    streamRetryTimer = null;
+    sendFrame({
+        type: "request_stream",
+        trace_id: startStreamTrace(),
+        upload_kbps: estimateUploadKbps()
+    });
+}
+
+// View-only students watch the server's HLS output instead of a peer connection
+async function watchHls(url) {
+    stopHls();
+    try {
+        const response = await fetch(url, { method: 'HEAD', cache: 'no-store' });
+        if (!response.ok) throw new Error(`playlist not ready (${response.status})`);
+    } catch (error) {
+        if (!hlsRecording) {
+            hlsRetryTimer = setTimeout(() => watchHls(url), HLS_RETRY_DELAY_MS);
+        }
+        return;
+    }
+    teacherVideo.srcObject = null;
+    if (teacherVideo.canPlayType('application/vnd.apple.mpegurl')) {
+        teacherVideo.src = url;
+    } else {
+        await loadHlsJs();
+        if (!window.Hls || !Hls.isSupported()) {
+            if (hlsRecording) {
+                showError("This browser can't play the class recording.");
+            } else {
+                // hls.js is missing or unsupported here: watch over WebRTC instead
+                console.warn("Can't play HLS, requesting the stream over WebRTC.");
+                requestTeacherStream();
+            }
+            return;
+        }
+        hlsPlayer = new Hls({ liveDurationInfinity: true });
+        hlsPlayer.loadSource(url);
+        hlsPlayer.attachMedia(teacherVideo);
+    }
+    teacherVideo.play().catch(error => console.warn('Autoplay blocked:', error));
+}
+
+function loadHlsJs() {
+    // Tried once per page; a missing file is not fetched again on every retry
+    if (!hlsJsLoading) {
+        hlsJsLoading = new Promise(resolve => {
+            const script = document.createElement('script');
+            script.src = hlsJsUrl;
+            script.onload = resolve;
+            script.onerror = resolve;
+            document.head.appendChild(script);
+        });
+    }
+    return hlsJsLoading;
+}
+
+function stopHls() {
+    clearTimeout(hlsRetryTimer);
+    hlsRetryTimer = null;
+    if (hlsPlayer) {
+        hlsPlayer.destroy();
+        hlsPlayer = null;
+    }
+    if (teacherVideo.src) {
+        teacherVideo.removeAttribute('src');
+        teacherVideo.load();
+    }
+}
+
+// Browsers only expose a download estimate (capped at 10 Mbps); assume a
+// quarter of it is available for upload. No estimate means we never relay.
+function estimateUploadKbps() {
+    const connection = navigator.connection;
+    if (!connection || !connection.downlink) return null;
+    return Math.round(connection.downlink * 1000 / 4);
+}
+
+function handleStreamQueue(data) {
+    const status = document.getElementById('stream-queue-status');
+    if (data.status === 'waiting') {
+        status.textContent = `Waiting to join the teacher's stream (position ${data.position})`;
+    } else if (data.status === 'failed') {
+        status.textContent = "Couldn't connect to the teacher's stream, retrying...";
+        clearTimeout(streamRetryTimer);
+        streamRetryTimer = setTimeout(requestTeacherStream, STREAM_RETRY_DELAY_MS);
+    } else {
+        status.textContent = '';
+    }
+}
+
 // Handle the offer from the teacher to receive their stream
-async function handleTeacherOffer(offer, fromUser) {
+async function handleTeacherOffer(offer, fromUser, traceId) {
     try {
-        teacherPeerConnection = new RTCPeerConnection(config);
+        if (teacherPeerConnection) {
+            // Our relay changed, see relay.py
+            teacherPeerConnection.close();
+        }
+        const pc = teacherPeerConnection = new RTCPeerConnection(config);
         teacherPeerConnection.ontrack = event => {
             teacherStream = event.streams[0];
             teacherVideo.srcObject = teacherStream;
+            whenFirstFrameRendered(teacherVideo, () => reportStreamTrace(traceId));
+            // Students we relay to keep their connections and get the new track
+            Object.values(relayPeerConnections).forEach(relayPc => {
+                relayPc.getSenders()
+                    .filter(sender => sender.track && sender.track.kind === event.track.kind)
+                    .forEach(sender => sender.replaceTrack(event.track));
+            });
+            // Once every track of the offer has arrived, serve students waiting on us
+            setTimeout(() => {
+                const waiting = pendingRelayRequests;
+                pendingRelayRequests = [];
+                waiting.forEach(request => createTeacherPeerConnection(request.from_user, request.trace_id, request.requestedAt));
+            });
         };
 
-        teacherPeerConnection.onicecandidate = event => {
-            if (event.candidate) {
-                socket.send(JSON.stringify({ 
-                    type: "ice_candidate", 
-                    candidate: event.candidate,
-                    target_user: fromUser, // The teacher
-                    is_teacher_stream: true
-                }));
+        teacherPeerConnection.onconnectionstatechange = () => {
+            if (pc.connectionState === 'connected') {
+                markStreamTrace(traceId, 'connected');
             }
         };
 
+        teacherPeerConnection.onicecandidate = event => {
+            queueIceCandidate(fromUser, true, event.candidate, traceId); // To the teacher
+        };
+
         await teacherPeerConnection.setRemoteDescription(new RTCSessionDescription(offer));
         const answer = await teacherPeerConnection.createAnswer();
         await teacherPeerConnection.setLocalDescription(answer);
 
-        socket.send(JSON.stringify({ 
-            type: "answer", 
-            answer: answer,
-            target_user: fromUser
-        }));
+        sendSignalingEnvelope({ type: "answer", target_user: fromUser, trace_id: traceId }, answer);
+        markStreamTrace(traceId, 'answer_sent');
 
     } catch (error) {
         console.error("Error handling teacher offer:", error);
@@ -351,23 +878,14 @@ async function startStudentMedia(type) {
         });
 
         studentSendConnection.onicecandidate = event => {
-            if (event.candidate) {
-                socket.send(JSON.stringify({
-                    type: "ice_candidate",
-                    candidate: event.candidate,
-                    target_user: "teacher", // Always send to teacher
-                    is_teacher_stream: false // This is a student stream
-                }));
-            }
+            // Always send to teacher; this is a student stream
+            queueIceCandidate("teacher", false, event.candidate);
         };
 
         const offer = await studentSendConnection.createOffer();
         await studentSendConnection.setLocalDescription(offer);
 
-        socket.send(JSON.stringify({
-            type: "student_offer",
-            offer: offer
-        }));
+        sendSignalingEnvelope({ type: "student_offer" }, offer);
 
         showSuccess(`Your ${type} has been started.`);
 
@@ -403,7 +921,7 @@ function stopStudentStream() {
     if (myVideo) {
         myVideo.parentElement.remove();
     }
-    socket.send(JSON.stringify({ type: "stream_stopped", is_teacher: false }));
+    sendFrame({ type: "stream_stopped", is_teacher: false });
     showSuccess('Your stream has been stopped.');
 }
 
@@ -421,36 +939,28 @@ async function handleStudentOffer(offer, fromUser) {
                 videoWrapper = document.createElement('div');
                 videoWrapper.className = 'student-video';
                 videoWrapper.id = `video-wrapper-${fromUser}`;
-                videoWrapper.innerHTML = `
-                    <p>${fromUser}</p>
-                    <video id="video-${fromUser}" autoplay playsinline></video>
-                `;
+                const label = document.createElement('p');
+                label.textContent = fromUser;
+                const video = document.createElement('video');
+                video.id = `video-${fromUser}`;
+                video.autoplay = true;
+                video.playsInline = true;
+                videoWrapper.append(label, video);
                 studentVideoContainer.appendChild(videoWrapper);
             }
-            const videoEl = document.getElementById(`video-${fromUser}`);
+            const videoEl = videoWrapper.querySelector('video');
             videoEl.srcObject = event.streams[0];
         };
 
         pc.onicecandidate = event => {
-            if (event.candidate) {
-                socket.send(JSON.stringify({
-                    type: "ice_candidate",
-                    candidate: event.candidate,
-                    target_user: fromUser,
-                    is_teacher_stream: false
-                }));
-            }
+            queueIceCandidate(fromUser, false, event.candidate);
         };
 
         await pc.setRemoteDescription(new RTCSessionDescription(offer));
         const answer = await pc.createAnswer();
         await pc.setLocalDescription(answer);
 
-        socket.send(JSON.stringify({
-            type: "student_answer",
-            answer: answer,
-            target_user: fromUser
-        }));
+        sendSignalingEnvelope({ type: "student_answer", target_user: fromUser }, answer);
 
     } catch (error) {
         console.error(`Error handling student offer from ${fromUser}:`, error);
@@ -494,12 +1004,19 @@ function handleUserLeft(user) {
 
 function handleStreamStopped(user, isStreamFromTeacher) {
     if (isStreamFromTeacher) {
+        clearTimeout(streamRetryTimer);
+        document.getElementById('stream-queue-status').textContent = '';
+        stopHls();
         teacherVideo.srcObject = null;
+        teacherStream = null;
         showError("Teacher has stopped the stream.");
         if (teacherPeerConnection) {
             teacherPeerConnection.close();
             teacherPeerConnection = null;
         }
+        Object.values(relayPeerConnections).forEach(pc => pc.close());
+        relayPeerConnections = {};
+        pendingRelayRequests = [];
     } else {
         // A student stopped their stream
         const studentVideo = document.getElementById(`video-wrapper-${user}`);
@@ -514,50 +1031,235 @@ function handleStreamStopped(user, isStreamFromTeacher) {
     }
 }
 
-function updateStudentList(students) {
+// --- Participant roster ---
+
+function applyRosterSnapshot(version, students) {
+    roster = new Map(students.map(student => [student.username, student]));
+    rosterVersion = version;
+    clearTimeout(rosterGapTimer);
+    rosterGapTimer = null;
+
     const studentList = document.getElementById('student-list');
-    const participantCount = document.getElementById('participant-count');
     studentList.innerHTML = '';
-    participantCount.innerText = students.length;
+    roster.forEach(renderStudent);
+    updateParticipantCount();
 
-    students.forEach(student => {
-        const studentEl = document.createElement('div');
-        studentEl.className = 'participant-item';
-        studentEl.id = `student-${student.username}`;
-        
-        let controls = '';
-        if (isTeacher) {
-            controls = `
-                <div class="participant-controls">
-                    <button onclick="togglePermission('${student.username}', 'audio', ${!student.permissions.audio})">
-                        ${student.permissions.audio ? 'Mute Mic' : 'Allow Mic'}
-                    </button>
-                    <button onclick="togglePermission('${student.username}', 'video', ${!student.permissions.video})">
-                        ${student.permissions.video ? 'Block Cam' : 'Allow Cam'}
-                    </button>
-                    <button onclick="togglePermission('${student.username}', 'screen', ${!student.permissions.screen})">
-                        ${student.permissions.screen ? 'Block Screen' : 'Allow Screen'}
-                    </button>
-                </div>
-            `;
+    // Replay anything newer than the snapshot that arrived while waiting for it
+    const pending = [...pendingRosterDeltas.values()];
+    pendingRosterDeltas = new Map();
+    pending.forEach(applyRosterDelta);
+}
+
+function applyRosterDelta(delta) {
+    if (rosterVersion === null || delta.version <= rosterVersion) {
+        // No snapshot yet, or the snapshot already includes this change
+        return;
+    }
+    // Batches flushed by different server workers can arrive out of order,
+    // so hold deltas past a gap briefly before asking for a fresh snapshot.
+    pendingRosterDeltas.set(delta.version, delta);
+    while (pendingRosterDeltas.has(rosterVersion + 1)) {
+        const next = pendingRosterDeltas.get(rosterVersion + 1);
+        pendingRosterDeltas.delete(next.version);
+        rosterVersion = next.version;
+        applyRosterChange(next);
+    }
+    updateParticipantCount();
+
+    if (pendingRosterDeltas.size === 0) {
+        clearTimeout(rosterGapTimer);
+        rosterGapTimer = null;
+    } else if (!rosterGapTimer) {
+        rosterGapTimer = setTimeout(() => {
+            pendingRosterDeltas.clear();
+            sendFrame({ type: "roster_resync" });
+        }, ROSTER_GAP_TIMEOUT_MS);
+    }
+}
+
+function applyRosterChange(delta) {
+    switch (delta.type) {
+        case "participant_added":
+            roster.set(delta.student.username, delta.student);
+            renderStudent(delta.student);
+            break;
+        case "participant_removed":
+            roster.delete(delta.username);
+            removeStudentElement(delta.username);
+            break;
+        case "permissions_changed": {
+            const student = roster.get(delta.username);
+            if (student) {
+                student.permissions = delta.permissions;
+                renderStudent(student);
+            }
+            break;
         }
+        case "permissions_bulk_changed":
+            // Class-wide changes come with "all" instead of every name
+            (delta.all ? [...roster.keys()] : delta.usernames).forEach(user => {
+                const student = roster.get(user);
+                if (student) {
+                    student.permissions[delta.permission] = delta.status;
+                    renderStudent(student);
+                }
+            });
+            break;
+    }
+}
 
-        studentEl.innerHTML = `
-            <span>${student.username}</span>
-            ${controls}
-        `;
+function updateParticipantCount() {
+    document.getElementById('participant-count').innerText = roster.size;
+}
+
+function removeStudentElement(user) {
+    const studentEl = document.getElementById(`student-${user}`);
+    if (studentEl) {
+        studentEl.remove();
+    }
+}
+
+// Creates the participant row, or updates it in place if it already exists
+function renderStudent(student) {
+    const studentList = document.getElementById('student-list');
+    let studentEl = document.getElementById(`student-${student.username}`);
+    if (!studentEl) {
+        studentEl = document.createElement('div');
+        studentEl.className = 'participant-item';
+        studentEl.id = `student-${student.username}`;
         studentList.appendChild(studentEl);
-    });
+    }
+
+    // Usernames come from other users, so they are set as text and bound
+    // as closure values rather than spliced into markup or inline handlers.
+    const name = document.createElement('span');
+    name.textContent = student.username;
+    const breakout = isTeacher && breakoutAssignments[student.username];
+    if (breakout) {
+        const room = document.createElement('em');
+        room.textContent = `(${breakout})`;
+        name.append(' ', room);
+    }
+    studentEl.replaceChildren(name);
+
+    if (isTeacher) {
+        const controls = document.createElement('div');
+        controls.className = 'participant-controls';
+        const button = (label, onClick) => {
+            const el = document.createElement('button');
+            el.textContent = label;
+            el.addEventListener('click', onClick);
+            controls.appendChild(el);
+        };
+        const { audio, video, screen } = student.permissions;
+        button(audio ? 'Mute Mic' : 'Allow Mic',
+            () => togglePermission(student.username, 'audio', !audio));
+        button(video ? 'Block Cam' : 'Allow Cam',
+            () => togglePermission(student.username, 'video', !video));
+        button(screen ? 'Block Screen' : 'Allow Screen',
+            () => togglePermission(student.username, 'screen', !screen));
+        button('Move', () => moveToBreakout(student.username));
+        studentEl.appendChild(controls);
+    }
 }
 
 function togglePermission(user, permission, status) {
     if (!isTeacher) return;
-    socket.send(JSON.stringify({
-        type: 'grant_permission',
-        target_user: user,
+    sendFrame({
+        type: 'permission_update',
+        student_name: user,
         permission: permission,
         status: status
-    }));
+    });
+}
+
+// One frame for every student; pass a list of names or a pattern like "group-a-*" to narrow it
+function setPermissionForAll(permission, status, selection = {}) {
+    if (!isTeacher) return;
+    sendFrame({
+        type: 'permission_bulk_update',
+        permission: permission,
+        status: status,
+        ...selection
+    });
+}
+
+// --- Participant pages (webinar classes) ---
+
+function queryParticipants(more = false) {
+    const search = document.getElementById('participant-search').value.trim();
+    sendFrame({
+        type: 'participant_query',
+        search: search,
+        ...(more && participantsNext !== null ? { after: participantsNext } : {})
+    });
+}
+
+function setWebinarMode(enabled) {
+    document.getElementById('participant-search-bar').hidden = !enabled;
+    document.getElementById('more-participants').hidden = true;
+    participantsNext = null;
+    if (enabled) {
+        // The roster stops updating; pages are fetched on demand instead
+        roster = new Map();
+        rosterVersion = null;
+        document.getElementById('student-list').innerHTML = '';
+    }
+}
+
+function showParticipantPage(data) {
+    if (data.after === null) {
+        // A new search starts the list over
+        document.getElementById('student-list').innerHTML = '';
+    }
+    data.students.forEach(renderStudent);
+    participantsNext = data.next;
+    const more = document.getElementById('more-participants');
+    if (more) {
+        more.hidden = data.next === null;
+    }
+}
+
+// --- Breakout rooms ---
+
+function handleBreakout(data) {
+    currentBreakout = data.name;
+    if (data.seq !== undefined) {
+        // The new room numbers its frames from here
+        lastSeq = data.seq;
+    }
+    // The other room's roster and chat no longer apply
+    roster = new Map();
+    rosterVersion = null;
+    pendingRosterDeltas.clear();
+    document.getElementById('student-list').innerHTML = '';
+    document.querySelectorAll('#chat-box > div').forEach(el => el.remove());
+    document.getElementById('load-older-chat').hidden = true;
+    document.getElementById('breakout-name').innerText = data.name ? ` - breakout ${data.name}` : '';
+    displayChatNotice(data.name ? `You are in breakout room ${data.name}` : 'You are back in the main room');
+}
+
+// Splits the students round-robin into rooms named room-1 ... room-<count>
+function openBreakouts() {
+    if (!isTeacher) return;
+    const count = parseInt(prompt('How many breakout rooms?', '2'), 10);
+    if (!(count > 0)) return;
+    const assignments = {};
+    [...roster.keys()].forEach((user, i) => { assignments[user] = `room-${i % count + 1}`; });
+    sendFrame({ type: 'breakout_assign', assignments: assignments });
+}
+
+function moveToBreakout(user) {
+    if (!isTeacher) return;
+    const breakout = prompt(`Move ${user} to which breakout room? Leave empty for the main room.`,
+        breakoutAssignments[user] || '');
+    if (breakout === null) return;
+    sendFrame({ type: 'breakout_assign', assignments: { [user]: breakout.trim() || null } });
+}
+
+function closeBreakouts() {
+    if (!isTeacher) return;
+    sendFrame({ type: 'breakout_close' });
 }
 
 // Chat functionality
@@ -565,7 +1267,7 @@ function sendMessage() {
     const input = document.getElementById('chat-message-input');
     const message = input.value.trim();
     if (message) {
-        socket.send(JSON.stringify({ type: 'chat_message', message: message }));
+        sendFrame({ type: 'chat_message', message: message });
         input.value = '';
     }
 }
@@ -576,15 +1278,61 @@ function handleChatKeyPress(event) {
     }
 }
 
+function chatMessageElement(user, message) {
+    const msgEl = document.createElement('div');
+    const author = document.createElement('strong');
+    author.textContent = `${user}:`;
+    msgEl.append(author, ' ', document.createTextNode(message));
+    return msgEl;
+}
+
 function displayChatMessage(user, message) {
     const chatBox = document.getElementById('chat-box');
-    const msgEl = document.createElement('div');
-    msgEl.innerHTML = `<strong>${user}:</strong> ${message}`;
-    chatBox.appendChild(msgEl);
+    chatBox.appendChild(chatMessageElement(user, message));
     chatBox.scrollTop = chatBox.scrollHeight; // Scroll to bottom
 }
 
+function displayChatNotice(text) {
+    const chatBox = document.getElementById('chat-box');
+    const noticeEl = document.createElement('div');
+    const em = document.createElement('em');
+    em.textContent = text;
+    noticeEl.appendChild(em);
+    chatBox.appendChild(noticeEl);
+    chatBox.scrollTop = chatBox.scrollHeight;
+}
+
+// Older messages go above the ones shown, keeping the scroll position
+function prependChatMessages(messages, before) {
+    const chatBox = document.getElementById('chat-box');
+    const loadOlder = document.getElementById('load-older-chat');
+    const first = loadOlder.nextSibling;
+    const previousHeight = chatBox.scrollHeight;
+    messages.forEach(m => chatBox.insertBefore(chatMessageElement(m.username, m.message), first));
+    chatBox.scrollTop += chatBox.scrollHeight - previousHeight;
+    olderChatBefore = before;
+    loadOlder.hidden = before === null;
+}
+
+async function loadOlderChat() {
+    if (olderChatBefore === null) return;
+    try {
+        const breakout = currentBreakout ? `&breakout=${encodeURIComponent(currentBreakout)}` : '';
+        const response = await fetch(`/classroom/${roomCode}/chat/?before=${olderChatBefore}${breakout}`);
+        if (!response.ok) throw new Error(`HTTP ${response.status}`);
+        const page = await response.json();
+        prependChatMessages(page.messages, page.before);
+    } catch (error) {
+        showError(`Could not load earlier messages: ${error.message}`);
+    }
+}
+
 // Run on page load
+connectSocket();
+
 window.onload = () => {
-    // Any initial setup can go here
+    // After the class, students can watch its recording
+    if (!isTeacher && hlsRecording) {
+        watchHls(hlsUrl);
+    }
 };
@@ -0,0 +1,148 @@
+// Minimal MessagePack encoder/decoder for the binary classroom frames, see
+// classroom/binary.py. Handles what JSON can express: null, booleans,
+// numbers, strings, arrays and maps (keys may be strings or integers).
+
+const MsgPack = (() => {
+    const textEncoder = new TextEncoder();
+    const textDecoder = new TextDecoder();
+
+    function encode(value) {
+        const bytes = [];
+        write(bytes, value);
+        return new Uint8Array(bytes);
+    }
+
+    function writeUint(bytes, value, size) {
+        for (let shift = (size - 1) * 8; shift >= 0; shift -= 8) {
+            bytes.push(Math.floor(value / 2 ** shift) & 0xff);
+        }
+    }
+
+    function writeHeader(bytes, length, fix, fixLimit, codes) {
+        // codes: [8-bit, 16-bit, 32-bit] type bytes, 8-bit may be null
+        if (length < fixLimit) {
+            bytes.push(fix | length);
+        } else if (codes[0] !== null && length < 0x100) {
+            bytes.push(codes[0], length);
+        } else if (length < 0x10000) {
+            bytes.push(codes[1]);
+            writeUint(bytes, length, 2);
+        } else {
+            bytes.push(codes[2]);
+            writeUint(bytes, length, 4);
+        }
+    }
+
+    function write(bytes, value) {
+        if (value === null || value === undefined) {
+            bytes.push(0xc0);
+        } else if (value === false || value === true) {
+            bytes.push(value ? 0xc3 : 0xc2);
+        } else if (typeof value === "number") {
+            writeNumber(bytes, value);
+        } else if (typeof value === "string") {
+            const utf8 = textEncoder.encode(value);
+            writeHeader(bytes, utf8.length, 0xa0, 32, [0xd9, 0xda, 0xdb]);
+            for (const b of utf8) bytes.push(b);
+        } else if (Array.isArray(value)) {
+            writeHeader(bytes, value.length, 0x90, 16, [null, 0xdc, 0xdd]);
+            value.forEach(item => write(bytes, item));
+        } else if (value instanceof Map) {
+            writeHeader(bytes, value.size, 0x80, 16, [null, 0xde, 0xdf]);
+            value.forEach((item, key) => { write(bytes, key); write(bytes, item); });
+        } else if (typeof value === "object") {
+            const entries = Object.entries(value).filter(([, item]) => item !== undefined);
+            writeHeader(bytes, entries.length, 0x80, 16, [null, 0xde, 0xdf]);
+            entries.forEach(([key, item]) => { write(bytes, key); write(bytes, item); });
+        } else {
+            throw new TypeError(`Can't encode ${typeof value}`);
+        }
+    }
+
+    function writeNumber(bytes, value) {
+        if (Number.isInteger(value) && value >= 0 && value < 2 ** 32) {
+            if (value < 0x80) bytes.push(value);
+            else if (value < 0x100) bytes.push(0xcc, value);
+            else if (value < 0x10000) { bytes.push(0xcd); writeUint(bytes, value, 2); }
+            else { bytes.push(0xce); writeUint(bytes, value, 4); }
+        } else if (Number.isInteger(value) && value < 0 && value >= -(2 ** 31)) {
+            if (value >= -32) bytes.push(value & 0xff);
+            else { bytes.push(0xd2); writeUint(bytes, value >>> 0, 4); }
+        } else {
+            const view = new DataView(new ArrayBuffer(8));
+            view.setFloat64(0, value);
+            bytes.push(0xcb);
+            for (let i = 0; i < 8; i++) bytes.push(view.getUint8(i));
+        }
+    }
+
+    function decode(buffer) {
+        const data = buffer instanceof Uint8Array ? buffer : new Uint8Array(buffer);
+        const view = new DataView(data.buffer, data.byteOffset, data.byteLength);
+        let offset = 0;
+
+        function string(length) {
+            const value = textDecoder.decode(data.subarray(offset, offset + length));
+            offset += length;
+            return value;
+        }
+        function array(length) {
+            const value = [];
+            for (let i = 0; i < length; i++) value.push(read());
+            return value;
+        }
+        function map(length) {
+            // Integer keys from the binary.py tables stay numbers
+            const value = new Map();
+            for (let i = 0; i < length; i++) {
+                const key = read();
+                value.set(key, read());
+            }
+            return value;
+        }
+        function uint(size) {
+            let value = 0;
+            for (let i = 0; i < size; i++) value = value * 256 + data[offset + i];
+            offset += size;
+            return value;
+        }
+
+        function read() {
+            if (offset >= data.length) throw new RangeError("Truncated MessagePack data");
+            const code = data[offset++];
+            if (code < 0x80) return code;
+            if (code < 0x90) return map(code & 0x0f);
+            if (code < 0xa0) return array(code & 0x0f);
+            if (code < 0xc0) return string(code & 0x1f);
+            if (code >= 0xe0) return code - 0x100;
+            let value;
+            switch (code) {
+                case 0xc0: return null;
+                case 0xc2: return false;
+                case 0xc3: return true;
+                case 0xca: value = view.getFloat32(offset); offset += 4; return value;
+                case 0xcb: value = view.getFloat64(offset); offset += 8; return value;
+                case 0xcc: return uint(1);
+                case 0xcd: return uint(2);
+                case 0xce: return uint(4);
+                case 0xcf: return uint(8);
+                case 0xd0: value = view.getInt8(offset); offset += 1; return value;
+                case 0xd1: value = view.getInt16(offset); offset += 2; return value;
+                case 0xd2: value = view.getInt32(offset); offset += 4; return value;
+                case 0xd3: value = Number(view.getBigInt64(offset)); offset += 8; return value;
+                case 0xd9: return string(uint(1));
+                case 0xda: return string(uint(2));
+                case 0xdb: return string(uint(4));
+                case 0xdc: return array(uint(2));
+                case 0xdd: return array(uint(4));
+                case 0xde: return map(uint(2));
+                case 0xdf: return map(uint(4));
+            }
+            throw new TypeError(`Unsupported MessagePack type 0x${code.toString(16)}`);
+        }
+
+        return read();
+    }
+
+    return { encode, decode };
+})();
@@ -1,12 +1,62 @@
-from django.test import TestCase
+from django.test import TestCase, override_settings
+from channels.routing import URLRouter
 from channels.testing import WebsocketCommunicator
 from channels.db import database_sync_to_async
+from asgiref.sync import async_to_sync
+from django.conf import settings
 from django.contrib.auth.models import User
+from django.core.exceptions import ImproperlyConfigured
+from django.db import DatabaseError
+from django.utils import timezone
+from classroom.routing import websocket_urlpatterns
+from classroom.bus import InMemoryBroadcastBus, get_broadcast_bus
+from classroom.admission import StreamAdmissionQueue
+from classroom.chat import ChatWriter
+from classroom.coalescer import coalescer_stats, get_coalescer
 from classroom.consumers import ClassroomConsumer
+from classroom.framing import FrameError, parse_frame
+from classroom import binary, breakouts, chat, checks, hls, metrics, permissions, ratelimit, reaper, sfu, tracing, webinar
+from classroom.models import ChatMessage, Course, LiveClass, ParticipantPermission
+from classroom.relay import RelayTree
+from classroom.layers import HybridRedisChannelLayer
+from classroom.sharding import HashRing, channel_layer_alias_for_room
+from channels.layers import channel_layers, get_channel_layer
+from classroom.rooms import InMemoryRoomStore, RedisRoomStore, get_room_store
+from benchmarks import loadgen
+import asyncio
+import importlib.util
+import time
 import json
+import os
+import socket
+import tempfile
+import unittest
+import unittest.mock
+import uuid
+from pathlib import Path
 
+TEST_SETTINGS = {
+    'CHANNEL_LAYERS': {"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}},
+    'CLASSROOM_ROOM_STORE': {"BACKEND": "classroom.rooms.InMemoryRoomStore"},
+    'CLASSROOM_BROADCAST_WINDOW': 0.01,
+    'CLASSROOM_BROADCAST_MAX_DELAY': 0.02,
+    'CLASSROOM_ICE_BATCH_WINDOW': 0.005,
+    'CLASSROOM_RESUME_GRACE': 0,
+    'CLASSROOM_HEARTBEAT_INTERVAL': 0,
+}
+
+application = URLRouter(websocket_urlpatterns)
+
+# RedisRoomStoreTest runs against this server when it is up
+REDIS_HOST = (os.environ.get("REDIS_HOST", "127.0.0.1"), int(os.environ.get("REDIS_PORT", 6379)))
+
+
+@override_settings(**TEST_SETTINGS)
 class ClassroomConsumerTest(TestCase):
     """Test cases for ClassroomConsumer WebSocket functionality"""
+
+    def setUp(self):
+        get_room_store().rooms.clear()
     
     @database_sync_to_async
     def create_user(self, username="testuser"):
@@ -16,7 +66,7 @@ class ClassroomConsumerTest(TestCase):
         """Test basic WebSocket connection and disconnection"""
         user = await self.create_user()
         communicator = WebsocketCommunicator(
-            ClassroomConsumer.as_asgi(),
+            application,
             "/ws/classroom/test123/"
         )
         communicator.scope["user"] = user
@@ -32,7 +82,7 @@ class ClassroomConsumerTest(TestCase):
         """Test that student list is updated when users join"""
         user = await self.create_user()
         communicator = WebsocketCommunicator(
-            ClassroomConsumer.as_asgi(),
+            application,
             "/ws/classroom/test123/"
         )
         communicator.scope["user"] = user
@@ -46,9 +96,9 @@ class ClassroomConsumerTest(TestCase):
             "username": "testuser"
         })
         
-        # Receive student list update
+        # Receive roster snapshot
         response = await communicator.receive_json_from()
-        self.assertEqual(response["type"], "student_list")
+        self.assertEqual(response["type"], "roster_snapshot")
         self.assertTrue(len(response["students"]) > 0)
         
         await communicator.disconnect()
@@ -57,7 +107,7 @@ class ClassroomConsumerTest(TestCase):
         """Test chat message functionality"""
         user = await self.create_user()
         communicator = WebsocketCommunicator(
-            ClassroomConsumer.as_asgi(),
+            application,
             "/ws/classroom/test123/"
         )
         communicator.scope["user"] = user
@@ -65,19 +115,2180 @@ class ClassroomConsumerTest(TestCase):
         connected, subprotocol = await communicator.connect()
         self.assertTrue(connected)
         
-        # Send chat message
+        # Join, then send chat message
+        await communicator.send_json_to({
+            "type": "join",
+            "username": "testuser"
+        })
         await communicator.send_json_to({
-            "type": "message",
+            "type": "chat_message",
             "message": "Hello, class!"
         })
         
-        # Should receive student list first, then chat message
+        # Should receive roster snapshot first, then chat message
         response1 = await communicator.receive_json_from()
         response2 = await communicator.receive_json_from()
         
-        # One should be student_list, other should be chat_message
+        # One should be roster_snapshot, other should be chat_message
         message_types = [response1["type"], response2["type"]]
-        self.assertIn("student_list", message_types)
+        self.assertIn("roster_snapshot", message_types)
         self.assertIn("chat_message", message_types)
         
         await communicator.disconnect()
+
+
+class RoomStoreTests:
+    """Test cases every room store backend passes"""
+
+    def make_store(self):
+        raise NotImplementedError
+
+    async def test_membership(self):
+        store = self.make_store()
+        await store.set_teacher("room1", "alice", "chan-a")
+        await store.add_student("room1", "bob", "chan-b")
+
+        self.assertEqual(await store.get_channel("room1", "alice"), "chan-a")
+        self.assertEqual(await store.get_channel("room1", "bob"), "chan-b")
+        self.assertIsNone(await store.get_channel("room1", "carol"))
+        self.assertEqual([s["username"] for s in await store.list_students("room1")], ["bob"])
+
+    async def test_remove_ignores_stale_channel(self):
+        """A disconnect from an old socket must not evict a reconnected user"""
+        store = self.make_store()
+        await store.add_student("room1", "bob", "chan-old")
+        await store.add_student("room1", "bob", "chan-new")
+
+        self.assertFalse(await store.remove_student("room1", "bob", "chan-old"))
+        self.assertEqual((await store.get_student("room1", "bob"))["channel"], "chan-new")
+        self.assertTrue(await store.remove_student("room1", "bob", "chan-new"))
+        self.assertIsNone(await store.get_student("room1", "bob"))
+
+    async def test_teacher_leaving_ends_stream(self):
+        store = self.make_store()
+        await store.set_teacher("room1", "alice", "chan-a")
+        await store.set_live("room1", True)
+
+        self.assertTrue(await store.remove_teacher("room1", "chan-a"))
+        self.assertFalse(await store.is_live("room1"))
+        self.assertIsNone(await store.get_teacher("room1"))
+
+    async def test_permissions(self):
+        store = self.make_store()
+        await store.add_student("room1", "bob", "chan-b")
+
+        student, _ = await store.set_permission("room1", "bob", "audio", True)
+        self.assertEqual(student["permissions"], {"audio": True})
+        self.assertEqual(await store.set_permission("room1", "carol", "audio", True), (None, None))
+
+        await store.add_student("room1", "carol", "chan-c", permissions={"video": True})
+        students, version = await store.set_permissions("room1", ["bob", "carol", "dave"], {"screen": True})
+        self.assertEqual([s["permissions"] for s in students],
+                         [{"audio": True, "screen": True}, {"video": True, "screen": True}])
+        self.assertEqual(version, 4)
+        self.assertEqual(await store.set_permissions("room1", ["dave"], {"screen": True}), ([], None))
+
+    async def test_breakouts(self):
+        store = self.make_store()
+        await store.add_student("room1", "bob", "chan-b")
+        await store.assign_breakouts("room1", {"bob": "g1", "carol": "g2"})
+        await store.add_student("room1.g1", "bob", "chan-b")
+        await store.assign_breakouts("room1", {"carol": None})
+        self.assertEqual(await store.get_breakouts("room1"), {"bob": "g1"})
+        self.assertEqual(await store.get_breakout("room1", "bob"), "g1")
+
+        self.assertEqual(await store.close_breakouts("room1"), {"bob": "g1"})
+        self.assertEqual(await store.get_breakouts("room1"), {})
+        # The breakouts' own room state goes with them
+        self.assertEqual(await store.list_students("room1.g1"), [])
+
+    async def test_roster_version(self):
+        """Every roster change bumps the version exactly once"""
+        store = self.make_store()
+        _, v1 = await store.add_student("room1", "bob", "chan-b")
+        _, v2 = await store.add_student("room1", "carol", "chan-c")
+        _, v3 = await store.set_permission("room1", "bob", "video", True)
+        v4 = await store.remove_student("room1", "carol", "chan-c")
+        self.assertEqual([v1, v2, v3, v4], [1, 2, 3, 4])
+        self.assertIsNone(await store.remove_student("room1", "carol", "chan-c"))
+
+        version, students = await store.roster_snapshot("room1")
+        self.assertEqual(version, 4)
+        self.assertEqual(students[0]["permissions"], {"video": True})
+
+    async def test_events(self):
+        store = self.make_store()
+        texts = [await store.append_event("room1", {"type": "chat_message", "message": str(i)}) for i in range(4)]
+        self.assertEqual(json.loads(texts[0]), {"type": "chat_message", "message": "0", "seq": 1})
+        self.assertEqual(await store.event_seq("room1"), 4)
+        self.assertEqual(await store.events_since("room1", 2), texts[2:])
+        self.assertEqual(await store.events_since("room1", 4), [])
+        # Older than the buffer holds
+        self.assertIsNone(await store.events_since("room1", 0))
+
+    async def test_resume_student(self):
+        store = self.make_store()
+        await store.add_student("room1", "bob", "chan-old", session="s1")
+        self.assertIsNone(await store.resume_student("room1", "bob", "s2", "chan-new"))
+        student = await store.resume_student("room1", "bob", "s1", "chan-new")
+        # An empty permissions table survives the round trip as a dict
+        self.assertEqual((student["channel"], student["permissions"]), ("chan-new", {}))
+        self.assertEqual(await store.roster_snapshot("room1"), (1, [student]))
+
+    async def test_saved_permissions_and_webinar(self):
+        store = self.make_store()
+        self.assertIsNone(await store.get_saved_permissions("room1", "bob"))
+        await store.save_permissions("room1", {"bob": {"audio": False}})
+        await store.load_saved_permissions("room1", {"bob": {"audio": True}, "carol": {"video": True}})
+        self.assertEqual(await store.get_saved_permissions("room1", "bob"), {"audio": False})
+        self.assertEqual(await store.get_saved_permissions("room1", "carol"), {"video": True})
+        self.assertEqual(await store.get_saved_permissions("room1", "dave"), {})
+
+        self.assertIsNone(await store.get_webinar("room1"))
+        self.assertTrue(await store.load_webinar("room1", True))
+        self.assertTrue(await store.load_webinar("room1", False))
+        await store.set_webinar("room1", False)
+        self.assertFalse(await store.get_webinar("room1"))
+
+        await store.delete_room("room1")
+        self.assertIsNone(await store.get_webinar("room1"))
+        self.assertIsNone(await store.get_saved_permissions("room1", "bob"))
+
+
+@override_settings(CLASSROOM_RESUME_BUFFER_SIZE=3)
+class RoomStoreTest(RoomStoreTests, TestCase):
+    """Test cases for the in-memory room store"""
+
+    def make_store(self):
+        return InMemoryRoomStore()
+
+    def test_default_store_is_in_memory(self):
+        redis_layer = {"default": {"BACKEND": "classroom.layers.HybridRedisChannelLayer",
+                                   "CONFIG": {"hosts": [("redis-a", 6379), ("redis-b", 6379)]}}}
+        with self.settings(CHANNEL_LAYERS=redis_layer):
+            del settings.CLASSROOM_ROOM_STORE
+            self.assertIsInstance(get_room_store(), InMemoryRoomStore)
+            # The Redis store, when chosen, uses the channel layer's first host
+            with self.settings(CLASSROOM_ROOM_STORE={"BACKEND": "classroom.rooms.RedisRoomStore"}):
+                self.assertEqual(get_room_store().host, ("redis-a", 6379))
+
+    def test_redis_store_takes_one_host(self):
+        with self.assertRaises(ImproperlyConfigured):
+            RedisRoomStore(hosts=[("redis-a", 6379), ("redis-b", 6379)])
+
+
+def redis_available():
+    try:
+        socket.create_connection(REDIS_HOST, timeout=0.2).close()
+        return True
+    except OSError:
+        return False
+
+
+@unittest.skipUnless(redis_available(), "Redis is not reachable")
+@override_settings(CLASSROOM_RESUME_BUFFER_SIZE=3)
+class RedisRoomStoreTest(RoomStoreTests, TestCase):
+    """Test cases for the Redis room store, run when a Redis server is reachable"""
+
+    def make_store(self):
+        prefix = f"classroom:test:{uuid.uuid4().hex}:"
+        self.addCleanup(self.delete_keys, prefix)
+        return RedisRoomStore(hosts=[REDIS_HOST], prefix=prefix)
+
+    async def test_keys_expire_unless_touched(self):
+        store = self.make_store()
+        await store.add_student("room1", "bob", "chan-bob")
+        await store.append_event("room1", {"type": "chat_message"})
+        events_ttl = await store.client.ttl(store._key("room1", "events"))
+        self.assertGreater(events_ttl, 0)
+        self.assertEqual(await store.client.ttl(store._key("room1", "students")), -1)
+
+        with self.settings(CLASSROOM_ROOM_KEY_TTL=100):
+            await store.touch("room1")
+        self.assertTrue(0 < await store.client.ttl(store._key("room1", "students")) <= 100)
+        # Touched again within the refresh interval: no round trip
+        await store.client.persist(store._key("room1", "students"))
+        await store.touch("room1")
+        self.assertEqual(await store.client.ttl(store._key("room1", "students")), -1)
+
+    def delete_keys(self, prefix):
+        import redis
+
+        client = redis.Redis(*REDIS_HOST)
+        keys = list(client.scan_iter(f"{prefix}*"))
+        if keys:
+            client.delete(*keys)
+        client.close()
+
+
+class ConsumerTestMixin:
+    """Helpers for tests that drive several consumers in one room"""
+
+    def setUp(self):
+        get_room_store().rooms.clear()
+
+    async def connect(self, username, is_teacher=False, room="room1", features=()):
+        communicator = WebsocketCommunicator(application, f"/ws/classroom/{room}/")
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        await communicator.send_json_to({
+            "type": "join", "username": username, "is_teacher": is_teacher, "features": list(features),
+        })
+        return communicator
+
+    async def drain(self, communicator):
+        messages = []
+        while not await communicator.receive_nothing(timeout=0.05):
+            messages.append(await communicator.receive_json_from())
+        return messages
+
+
+@override_settings(**TEST_SETTINGS)
+class SignalingTest(ConsumerTestMixin, TestCase):
+    """Test cases for targeted signaling between consumers"""
+
+    async def test_request_stream_reaches_teacher(self):
+        teacher = await self.connect("alice", is_teacher=True)
+        student = await self.connect("bob")
+        await self.drain(teacher)
+        await self.drain(student)
+
+        await student.send_json_to({"type": "request_stream", "trace_id": "0123456789abcdef"})
+        response = await teacher.receive_json_from()
+        self.assertEqual(response, {
+            "type": "student_requesting_stream", "from_user": "bob", "trace_id": "0123456789abcdef",
+        })
+
+        await teacher.disconnect()
+        await student.disconnect()
+
+    async def test_broadcast_is_encoded_once(self):
+        """Every receiver writes the sender's pre-encoded frame verbatim"""
+        teacher = await self.connect("alice", is_teacher=True)
+        student = await self.connect("bob")
+        await self.drain(teacher)
+        await self.drain(student)
+
+        async def chat_frame(communicator):
+            while True:
+                text = (await communicator.receive_output())["text"]
+                if json.loads(text)["type"] == "chat_message":
+                    return text
+
+        await teacher.send_json_to({"type": "chat_message", "message": "Hello, class!"})
+        frames = [await chat_frame(teacher), await chat_frame(student)]
+        self.assertEqual(frames[0], frames[1])
+        self.assertEqual(json.loads(frames[0]), {
+            "type": "chat_message", "message": "Hello, class!", "username": "alice",
+        })
+
+        await teacher.disconnect()
+        await student.disconnect()
+
+    async def test_late_joiner_sees_live_teacher(self):
+        teacher = await self.connect("alice", is_teacher=True)
+        await teacher.send_json_to({"type": "teacher_ready"})
+        await self.drain(teacher)
+
+        student = await self.connect("bob")
+        types = [m["type"] for m in await self.drain(student)]
+        self.assertIn("teacher_is_live", types)
+
+        await teacher.disconnect()
+        await student.disconnect()
+
+
+@override_settings(**TEST_SETTINGS)
+class RosterTest(ConsumerTestMixin, TestCase):
+    """Test cases for the versioned roster protocol"""
+
+    async def test_snapshot_then_deltas(self):
+        teacher = await self.connect("alice", is_teacher=True)
+        snapshot = await teacher.receive_json_from()
+        self.assertEqual(snapshot, {"type": "roster_snapshot", "version": 0, "students": []})
+
+        student = await self.connect("bob")
+        batch = await teacher.receive_json_from()
+        self.assertEqual(batch, {
+            "type": "room_batch",
+            "deltas": [{
+                "type": "participant_added",
+                "version": 1,
+                "student": {"username": "bob", "permissions": {}},
+            }],
+            "left": [],
+        })
+        await self.drain(student)
+
+        await teacher.send_json_to({
+            "type": "permission_update", "student_name": "bob", "permission": "audio", "status": True,
+        })
+        batch = await teacher.receive_json_from()
+        self.assertEqual(batch["deltas"], [
+            {"type": "permissions_changed", "version": 2, "username": "bob", "permissions": {"audio": True}},
+        ])
+        student_types = [m["type"] for m in await self.drain(student)]
+        self.assertEqual(sorted(student_types), ["permission_granted", "room_batch"])
+
+        await student.disconnect()
+        batch = await teacher.receive_json_from()
+        self.assertEqual(batch["deltas"], [{"type": "participant_removed", "version": 3, "username": "bob"}])
+        self.assertEqual(batch["left"], [{"username": "bob", "is_teacher": False}])
+        await teacher.disconnect()
+
+    async def test_resync(self):
+        teacher = await self.connect("alice", is_teacher=True)
+        student = await self.connect("bob")
+        await self.drain(teacher)
+
+        await teacher.send_json_to({"type": "roster_resync"})
+        snapshot = await teacher.receive_json_from()
+        self.assertEqual(snapshot["type"], "roster_snapshot")
+        self.assertEqual(snapshot["version"], 1)
+        self.assertEqual([s["username"] for s in snapshot["students"]], ["bob"])
+
+        await teacher.disconnect()
+        await student.disconnect()
+
+
+@override_settings(**TEST_SETTINGS)
+class CoalescingTest(ConsumerTestMixin, TestCase):
+    """Test cases for per-room broadcast coalescing"""
+
+    async def test_join_storm_is_merged(self):
+        teacher = await self.connect("alice", is_teacher=True)
+        await self.drain(teacher)
+        before = coalescer_stats()
+
+        students = [await self.connect(f"student{i}") for i in range(10)]
+        for student in students[:3]:
+            await student.disconnect()
+
+        messages = await self.drain(teacher)
+        deltas = [d for m in messages for d in m["deltas"]]
+        left = [l["username"] for m in messages for l in m["left"]]
+        self.assertEqual([d["version"] for d in deltas], list(range(1, 14)))
+        self.assertEqual(left, ["student0", "student1", "student2"])
+        self.assertLess(len(messages), 13)
+
+        after = coalescer_stats()
+        self.assertEqual(after["events"] - before["events"], 16)
+        self.assertGreater(after["merged"], before["merged"])
+
+        for student in students[3:]:
+            await student.disconnect()
+        await teacher.disconnect()
+
+    async def test_flush_keeps_newer_coalescer(self):
+        channel_layer = get_channel_layer()
+        old = get_coalescer(channel_layer, "classroom_room1", "room1")
+        await old.add_delta({"type": "participant_added", "version": 1})
+        # The room became a webinar while the old one was still pending
+        new = get_coalescer(channel_layer, "classroom_room1", "room1", teacher_only=True)
+        self.assertIsNot(new, old)
+        await asyncio.sleep(0.05)
+        self.assertFalse(old.pending)
+        self.assertIs(get_coalescer(channel_layer, "classroom_room1", "room1", teacher_only=True), new)
+
+    @override_settings(CLASSROOM_BROADCAST_WINDOW=0.05, CLASSROOM_BROADCAST_MAX_DELAY=0.1)
+    async def test_latency_is_bounded(self):
+        """A steady trickle of joins must not hold the batch back past MAX_DELAY"""
+        teacher = await self.connect("alice", is_teacher=True)
+        await self.drain(teacher)
+
+        # Joins arrive faster than the window closes, so only MAX_DELAY can
+        # force a flush before the trickle ends.
+        students = []
+        for i in range(8):
+            students.append(await self.connect(f"student{i}"))
+            await asyncio.sleep(0.03)
+
+        first = await teacher.receive_json_from()
+        self.assertLess(len(first["deltas"]), 8)
+
+        for student in students:
+            await student.disconnect()
+        await teacher.disconnect()
+
+
+def create_live_class(code, teacher="alice", **fields):
+    teacher = User.objects.create_user(username=teacher, password="testpass")
+    course = Course.objects.create(title="Course", description="", teacher=teacher)
+    return LiveClass.objects.create(
+        course=course, teacher=teacher, title="Class", start_time=timezone.now(), code=code, is_active=True, **fields
+    )
+
+
+@override_settings(**TEST_SETTINGS, CLASSROOM_CHAT_FLUSH_SIZE=3, CLASSROOM_CHAT_FLUSH_INTERVAL=0.05,
+                   CLASSROOM_CHAT_HISTORY_LENGTH=2)
+class ChatHistoryTest(ConsumerTestMixin, TestCase):
+    """Test cases for saving chat and replaying it to sockets that join later"""
+
+    async def send_chat(self, communicator, count):
+        for i in range(count):
+            await communicator.send_json_to({"type": "chat_message", "message": f"message {i}"})
+
+    async def test_saved_in_batches_and_replayed_on_join(self):
+        await database_sync_to_async(create_live_class)("CHAT01")
+        teacher = await self.connect("alice", is_teacher=True, room="CHAT01")
+        await self.send_chat(teacher, 4)
+        await self.drain(teacher)
+        # Three as soon as the batch is full, the fourth once the interval passes
+        await asyncio.sleep(0.1)
+        self.assertEqual(await ChatMessage.objects.acount(), 4)
+
+        student = await self.connect("bob", room="CHAT01")
+        await student.receive_json_from()  # roster_snapshot
+        history = await student.receive_json_from()
+        self.assertEqual(history["type"], "chat_history")
+        self.assertEqual([m["message"] for m in history["messages"]], ["message 2", "message 3"])
+        self.assertEqual(history["before"], history["messages"][0]["id"])
+
+        for communicator in [teacher, student]:
+            await communicator.disconnect()
+
+    @override_settings(CLASSROOM_CHAT_FLUSH_INTERVAL=10)
+    async def test_unsaved_messages_are_replayed(self):
+        await database_sync_to_async(create_live_class)("CHAT01")
+        teacher = await self.connect("alice", is_teacher=True, room="CHAT01")
+        await self.send_chat(teacher, 1)
+        await self.drain(teacher)
+
+        student = await self.connect("bob", room="CHAT01")
+        await student.receive_json_from()  # roster_snapshot
+        history = await student.receive_json_from()
+        self.assertEqual(history["messages"], [
+            {"id": None, "username": "alice", "message": "message 0", "created_at": history["messages"][0]["created_at"]},
+        ])
+        self.assertIsNone(history["before"])
+        self.assertEqual(await ChatMessage.objects.acount(), 0)
+
+        for communicator in [teacher, student]:
+            await communicator.disconnect()
+
+    async def test_chat_before_join_is_rejected(self):
+        await database_sync_to_async(create_live_class)("CHAT01")
+        stranger = WebsocketCommunicator(application, "/ws/classroom/CHAT01/")
+        self.assertTrue((await stranger.connect())[0])
+        await stranger.send_json_to({"type": "chat_message", "message": "who am I"})
+        self.assertEqual((await stranger.receive_json_from())["code"], "not_joined")
+
+        student = await self.connect("bob", room="CHAT01")
+        await self.drain(student)
+        for message in ["", "   ", 5]:
+            await student.send_json_to({"type": "chat_message", "message": message})
+            self.assertEqual((await student.receive_json_from())["code"], "invalid_message")
+        await self.send_chat(student, 1)
+        await self.drain(student)
+        await asyncio.sleep(0.1)
+        self.assertEqual([m.username async for m in ChatMessage.objects.all()], ["bob"])
+
+        for communicator in [stranger, student]:
+            await communicator.disconnect()
+
+    @override_settings(CLASSROOM_CHAT_SHED_BACKLOG=5)
+    async def test_chat_is_shed_behind_a_backlog(self):
+        student = await self.connect("bob")
+        await self.drain(student)
+        chat.chat_shed.values.clear()
+
+        # Eight chats land on the socket's channel before its consumer runs
+        channel = await get_room_store().get_channel("room1", "bob")
+        for i in range(8):
+            await get_channel_layer().send(channel, {
+                "type": "chat_message_broadcast",
+                "text": json.dumps({"type": "chat_message", "message": f"message {i}", "username": "alice"}),
+            })
+        messages = await self.drain(student)
+        # Skipped while five or more were still waiting behind them
+        self.assertEqual([m["message"] for m in messages], [f"message {i}" for i in range(3, 8)])
+        self.assertEqual(sum(chat.chat_shed.values.values()), 3)
+
+        await student.disconnect()
+
+    def test_bad_row_does_not_lose_the_batch(self):
+        create_live_class("CHAT01")
+        create_live_class("CHAT02", teacher="carol")
+        now = timezone.now()
+        ChatWriter._save([
+            ("CHAT01", ChatMessage(username="bob", message="kept", created_at=now)),
+            ("CHAT01", ChatMessage(username=None, message="bad", created_at=now)),
+            ("CHAT02", ChatMessage(username="dave", message="kept too", created_at=now)),
+        ])
+        self.assertEqual(sorted(ChatMessage.objects.values_list("message", flat=True)), ["kept", "kept too"])
+
+    def test_history_pages(self):
+        live_class = create_live_class("CHAT01")
+        ChatMessage.objects.bulk_create([
+            ChatMessage(live_class=live_class, username="alice", message=f"message {i}", created_at=timezone.now())
+            for i in range(5)
+        ])
+        self.client.force_login(live_class.teacher)
+        url = "/classroom/CHAT01/chat/"
+
+        page = self.client.get(url, {"limit": 2}).json()
+        self.assertEqual([m["message"] for m in page["messages"]], ["message 3", "message 4"])
+        page = self.client.get(url, {"limit": 2, "before": page["before"]}).json()
+        self.assertEqual([m["message"] for m in page["messages"]], ["message 1", "message 2"])
+        page = self.client.get(url, {"limit": 2, "before": page["before"]}).json()
+        self.assertEqual(([m["message"] for m in page["messages"]], page["before"]), (["message 0"], None))
+
+        self.assertEqual(self.client.get(url, {"before": "x"}).status_code, 400)
+        self.assertEqual(self.client.get("/classroom/NOPE00/chat/").status_code, 404)
+
+
+@override_settings(**TEST_SETTINGS)
+class PermissionTest(ConsumerTestMixin, TestCase):
+    """Test cases for bulk permission updates and saved permissions"""
+
+    def test_select(self):
+        students = [{"username": name, "permissions": {}} for name in ["a-1", "a-2", "b-1"]]
+        self.assertEqual(permissions.select(students), ["a-1", "a-2", "b-1"])
+        self.assertEqual(permissions.select(students, ["a-2", "b-1", "zed"]), ["a-2", "b-1"])
+        self.assertEqual(permissions.select(students, pattern="a-*"), ["a-1", "a-2"])
+        self.assertEqual(permissions.select(students, ["a-2", "b-1"], "a-*"), ["a-2"])
+        with self.assertRaises(FrameError):
+            permissions.select(students, "a-1")
+
+    async def test_bulk_update(self):
+        await database_sync_to_async(create_live_class)("PERM01")
+        teacher = await self.connect("alice", is_teacher=True, room="PERM01")
+        students = {name: await self.connect(name, room="PERM01") for name in ["g1-bob", "g1-carol", "g2-dave"]}
+        await self.drain(teacher)
+        for student in students.values():
+            await self.drain(student)
+
+        await teacher.send_json_to({
+            "type": "permission_bulk_update", "permission": "audio", "status": True, "pattern": "g1-*",
+        })
+        batch = await teacher.receive_json_from()
+        self.assertEqual(batch["deltas"], [{
+            "type": "permissions_bulk_changed", "version": 4, "usernames": ["g1-bob", "g1-carol"],
+            "permission": "audio", "status": True,
+        }])
+        for name, student in students.items():
+            granted = [f for f in await self.drain(student) if f["type"] == "permission_granted"]
+            expected = [{"type": "permission_granted", "permission": "audio", "status": True}]
+            self.assertEqual(granted, expected if name.startswith("g1-") else [])
+
+        await permissions.get_permission_writer().flush()
+        saved = {p.username: p.permissions async for p in ParticipantPermission.objects.all()}
+        self.assertEqual(saved, {"g1-bob": {"audio": True}, "g1-carol": {"audio": True}})
+
+        # Only the teacher can change permissions
+        await students["g2-dave"].send_json_to({
+            "type": "permission_bulk_update", "permission": "audio", "status": True,
+        })
+        self.assertTrue(await teacher.receive_nothing(timeout=0.05))
+
+        for communicator in [teacher, *students.values()]:
+            await communicator.disconnect()
+
+    async def test_saved_permissions_restored_on_join(self):
+        await database_sync_to_async(create_live_class)("PERM01")
+        teacher = await self.connect("alice", is_teacher=True, room="PERM01")
+        student = await self.connect("bob", room="PERM01")
+        await self.drain(student)
+        await teacher.send_json_to({
+            "type": "permission_update", "student_name": "bob", "permission": "video", "status": True,
+        })
+        await self.drain(student)
+        await student.disconnect()
+        await self.drain(teacher)
+
+        student = await self.connect("bob", room="PERM01")
+        snapshot = await student.receive_json_from()
+        self.assertEqual(snapshot["students"], [{"username": "bob", "permissions": {"video": True}}])
+        frames = await self.drain(student)
+        self.assertIn({"type": "permission_granted", "permission": "video", "status": True}, frames)
+
+        await teacher.disconnect()
+        await student.disconnect()
+
+    async def test_saved_permissions_read_once_per_room(self):
+        live_class = await database_sync_to_async(create_live_class)("PERM01")
+        await ParticipantPermission.objects.acreate(live_class=live_class, username="bob", permissions={"audio": True})
+        with unittest.mock.patch("classroom.permissions._load", wraps=permissions._load) as load:
+            students = await asyncio.gather(*[self.connect(name, room="PERM01") for name in ["bob", "carol", "dave"]])
+            snapshots = [await student.receive_json_from() for student in students]
+            self.assertEqual(load.call_count, 1)
+        self.assertIn({"username": "bob", "permissions": {"audio": True}}, snapshots[0]["students"])
+
+        # Saved in a batch after the interval, not per change
+        teacher = await self.connect("alice", is_teacher=True, room="PERM01")
+        for name in ["carol", "dave"]:
+            await teacher.send_json_to({
+                "type": "permission_update", "student_name": name, "permission": "video", "status": True,
+            })
+        await self.drain(teacher)
+        self.assertEqual(await ParticipantPermission.objects.acount(), 1)
+        await permissions.get_permission_writer().flush()
+        self.assertEqual(await ParticipantPermission.objects.acount(), 3)
+
+        for communicator in [teacher, *students]:
+            await communicator.disconnect()
+
+
+@override_settings(**TEST_SETTINGS)
+class BreakoutTest(ConsumerTestMixin, TestCase):
+    """Test cases for breakout rooms"""
+
+    async def split(self):
+        teacher = await self.connect("alice", is_teacher=True)
+        students = {name: await self.connect(name) for name in ["bob", "carol", "dave"]}
+        await self.drain(teacher)
+        for student in students.values():
+            await self.drain(student)
+        await teacher.send_json_to({"type": "breakout_assign", "assignments": {"bob": "g1", "carol": "g1"}})
+        return teacher, students
+
+    async def test_chat_stays_in_breakout(self):
+        moved = breakouts.moves.values.get(("breakout",), 0)
+        teacher, students = await self.split()
+        self.assertEqual(await teacher.receive_json_from(),
+                         {"type": "breakouts", "assignments": {"bob": "g1", "carol": "g1"}})
+        carol = await self.drain(students["carol"])
+        self.assertEqual(carol[0], {"type": "breakout", "name": "g1"})
+        self.assertEqual(carol[1]["type"], "roster_snapshot")
+        self.assertEqual(sorted(s["username"] for s in carol[1]["students"]), ["bob", "carol"])
+        await self.drain(students["bob"])
+
+        await students["bob"].send_json_to({"type": "chat_message", "message": "group work"})
+        self.assertEqual(await students["carol"].receive_json_from(),
+                         {"type": "chat_message", "message": "group work", "username": "bob"})
+        self.assertEqual(await self.drain(students["dave"]), [])
+        self.assertEqual(await self.drain(teacher), [])
+        self.assertEqual(breakouts.moves.values[("breakout",)] - moved, 2)
+
+        for communicator in [teacher, *students.values()]:
+            await communicator.disconnect()
+
+    async def test_teacher_reaches_breakouts(self):
+        teacher, students = await self.split()
+        await self.drain(students["bob"])
+        await teacher.send_json_to({"type": "teacher_ready"})
+        self.assertIn({"type": "teacher_is_live"}, await self.drain(students["bob"]))
+        self.assertIn({"type": "teacher_is_live"}, await self.drain(students["dave"]))
+
+        for communicator in [teacher, *students.values()]:
+            await communicator.disconnect()
+
+    async def test_close_merges_everyone_back(self):
+        teacher, students = await self.split()
+        await self.drain(students["bob"])
+        await self.drain(teacher)
+        await teacher.send_json_to({"type": "breakout_close"})
+        self.assertEqual(await teacher.receive_json_from(), {"type": "breakouts", "assignments": {}})
+        bob = await self.drain(students["bob"])
+        self.assertEqual(bob[0], {"type": "breakout", "name": None})
+        self.assertEqual(len(bob[1]["students"]), 3)
+
+        await students["bob"].send_json_to({"type": "chat_message", "message": "back"})
+        for communicator in [teacher, students["dave"]]:
+            frames = await self.drain(communicator)
+            self.assertIn({"type": "chat_message", "message": "back", "username": "bob"}, frames)
+        self.assertNotIn("room1.g1", get_room_store().rooms)
+
+        for communicator in [teacher, *students.values()]:
+            await communicator.disconnect()
+
+    async def test_rejoin_returns_to_breakout(self):
+        teacher, students = await self.split()
+        await self.drain(students["carol"])
+        await students["bob"].disconnect()
+        carol = await self.drain(students["carol"])
+        self.assertEqual(carol[0]["deltas"], [{"type": "participant_removed", "version": 3, "username": "bob"}])
+        self.assertEqual(carol[0]["left"], [{"username": "bob", "is_teacher": False}])
+
+        bob = await self.connect("bob")
+        frames = await self.drain(bob)
+        self.assertEqual(frames[0], {"type": "breakout", "name": "g1"})
+        self.assertEqual(sorted(s["username"] for s in frames[1]["students"]), ["bob", "carol"])
+
+        for communicator in [teacher, bob, students["carol"], students["dave"]]:
+            await communicator.disconnect()
+
+    async def test_permissions_reach_breakout_rosters(self):
+        teacher, students = await self.split()
+        for student in students.values():
+            await self.drain(student)
+        await self.drain(teacher)
+
+        await teacher.send_json_to({
+            "type": "permission_update", "student_name": "bob", "permission": "video", "status": True,
+        })
+        bob = await self.drain(students["bob"])
+        self.assertIn({"type": "permission_granted", "permission": "video", "status": True}, bob)
+        deltas = [d for f in await self.drain(students["carol"]) if f["type"] == "room_batch" for d in f["deltas"]]
+        self.assertEqual([(d["type"], d["username"], d["permissions"]) for d in deltas],
+                         [("permissions_changed", "bob", {"video": True})])
+        _, roster = await get_room_store().roster_snapshot("room1.g1")
+        self.assertEqual({s["username"]: s["permissions"] for s in roster}, {"bob": {"video": True}, "carol": {}})
+        await self.drain(teacher)
+
+        # Everyone: each group is told "all" rather than every name in the class
+        await teacher.send_json_to({"type": "permission_bulk_update", "permission": "audio", "status": True})
+        batch = await teacher.receive_json_from()
+        self.assertEqual(batch["deltas"][-1], {
+            "type": "permissions_bulk_changed", "version": batch["deltas"][-1]["version"], "all": True,
+            "permission": "audio", "status": True,
+        })
+        for name, student in students.items():
+            self.assertIn({"type": "permission_granted", "permission": "audio", "status": True},
+                          await self.drain(student), name)
+        _, roster = await get_room_store().roster_snapshot("room1.g1")
+        self.assertEqual({s["username"]: s["permissions"]["audio"] for s in roster}, {"bob": True, "carol": True})
+
+        for communicator in [teacher, *students.values()]:
+            await communicator.disconnect()
+
+    async def test_only_teacher_assigns(self):
+        teacher, students = await self.split()
+        await students["dave"].send_json_to({"type": "breakout_assign", "assignments": {"dave": "g1"}})
+        await teacher.send_json_to({"type": "breakout_assign", "assignments": {"dave": "no spaces"}})
+        self.assertIsNone(await get_room_store().get_breakout("room1", "dave"))
+        frames = await self.drain(teacher)
+        self.assertEqual(frames[-1], {"type": "error", "code": "invalid_breakout", "message_type": "breakout_assign"})
+
+        for communicator in [teacher, *students.values()]:
+            await communicator.disconnect()
+
+
+@override_settings(**TEST_SETTINGS, CLASSROOM_PARTICIPANT_COUNT_INTERVAL=0.05)
+class WebinarTest(ConsumerTestMixin, TestCase):
+    """Test cases for counts-only presence and participant pages"""
+
+    def test_page(self):
+        students = [{"username": name, "permissions": {}} for name in ["dave", "bob", "Carol", "carl"]]
+        page, cursor, total = webinar.page(students, limit=2)
+        self.assertEqual(([s["username"] for s in page], cursor, total), (["Carol", "bob"], "bob", 4))
+        page, cursor, total = webinar.page(students, after=cursor, limit=2)
+        self.assertEqual(([s["username"] for s in page], cursor, total), (["carl", "dave"], None, 4))
+        page, cursor, total = webinar.page(students, search="car")
+        self.assertEqual(([s["username"] for s in page], cursor, total), (["Carol", "carl"], None, 2))
+        with self.assertRaises(ValueError):
+            webinar.parse_query(limit=0)
+
+    async def test_students_get_counts(self):
+        await database_sync_to_async(create_live_class)("WEB001", webinar=True)
+        teacher = await self.connect("alice", is_teacher=True, room="WEB001")
+        await self.drain(teacher)
+        bob = await self.connect("bob", room="WEB001")
+        self.assertEqual(await bob.receive_json_from(), {"type": "participant_count", "count": 1})
+        carol = await self.connect("carol", room="WEB001")
+        await asyncio.sleep(0.1)
+
+        batches = [f for f in await self.drain(teacher) if f["type"] == "room_batch"]
+        self.assertEqual([d["student"]["username"] for b in batches for d in b["deltas"]], ["bob", "carol"])
+        frames = [f for f in await self.drain(bob) if f["type"] != "chat_history"]
+        self.assertEqual({f["type"] for f in frames}, {"participant_count"})
+        self.assertEqual(frames[-1]["count"], 2)
+
+        await self.drain(carol)
+        await carol.send_json_to({"type": "participant_query", "search": "B"})
+        self.assertEqual(await carol.receive_json_from(), {
+            "type": "participant_page", "search": "B", "after": None,
+            "students": [{"username": "bob", "permissions": {}}], "next": None, "total": 1,
+        })
+        await carol.send_json_to({"type": "participant_query", "limit": 0})
+        self.assertEqual((await carol.receive_json_from())["code"], "invalid_query")
+
+        for communicator in [teacher, bob, carol]:
+            await communicator.disconnect()
+
+    async def test_students_hear_the_teacher_leave(self):
+        await database_sync_to_async(create_live_class)("WEB001", webinar=True)
+        teacher = await self.connect("alice", is_teacher=True, room="WEB001")
+        bob = await self.connect("bob", room="WEB001")
+        carol = await self.connect("carol", room="WEB001")
+        await asyncio.sleep(0.1)
+        await self.drain(bob)
+
+        # Another student leaving is only for the teacher
+        await carol.disconnect()
+        await asyncio.sleep(0.1)
+        self.assertNotIn("room_batch", [f["type"] for f in await self.drain(bob)])
+        left = [entry for f in await self.drain(teacher) if f["type"] == "room_batch" for entry in f["left"]]
+        self.assertEqual(left, [{"username": "carol", "is_teacher": False}])
+
+        await teacher.disconnect()
+        await asyncio.sleep(0.1)
+        batches = [f for f in await self.drain(bob) if f["type"] == "room_batch"]
+        self.assertEqual(batches, [{"type": "room_batch", "deltas": [], "left": [{"username": "alice", "is_teacher": True}]}])
+
+        await bob.disconnect()
+
+    async def test_join_goes_on_when_the_database_fails(self):
+        await database_sync_to_async(create_live_class)("WEB001", webinar=True)
+        failure = DatabaseError("no such table")
+        with unittest.mock.patch("classroom.webinar._is_webinar", side_effect=failure), \
+                unittest.mock.patch("classroom.permissions._load", side_effect=failure):
+            student = await self.connect("bob", room="WEB001")
+            # A regular class with default permissions
+            self.assertEqual(await student.receive_json_from(), {
+                "type": "roster_snapshot", "version": 1, "students": [{"username": "bob", "permissions": {}}],
+            })
+        # Not kept, so the next join reads the flag again
+        self.assertIsNone(await get_room_store().get_webinar("WEB001"))
+        carol = await self.connect("carol", room="WEB001")
+        self.assertEqual(await carol.receive_json_from(), {"type": "participant_count", "count": 2})
+
+        await student.disconnect()
+        await carol.disconnect()
+
+    async def test_flag_read_once_per_room(self):
+        await database_sync_to_async(create_live_class)("WEB001", webinar=True)
+        with unittest.mock.patch("classroom.webinar._is_webinar", wraps=webinar._is_webinar) as read:
+            students = await asyncio.gather(*[self.connect(name, room="WEB001") for name in ["bob", "carol", "dave"]])
+            frames = [await student.receive_json_from() for student in students]
+            self.assertEqual(read.call_count, 1)
+        self.assertEqual({frame["type"] for frame in frames}, {"participant_count"})
+        for communicator in students:
+            await communicator.disconnect()
+
+    async def test_count_throttled_across_workers(self):
+        channel_layer = get_channel_layer()
+        channel = await channel_layer.new_channel()
+        await channel_layer.group_add("classroom_WEB001", channel)
+        await get_room_store().add_student("WEB001", "bob", channel)
+        # One counter per worker for the same room
+        counters = [webinar.ParticipantCounter(channel_layer, "classroom_WEB001", "WEB001", interval=0.2)
+                    for _ in range(2)]
+        for counter in counters:
+            counter.touch()
+
+        await asyncio.sleep(0.1)
+        self.assertEqual((await channel_layer.receive(channel))["type"], "participant_count_broadcast")
+        with self.assertRaises(asyncio.TimeoutError):
+            await asyncio.wait_for(channel_layer.receive(channel), timeout=0.05)
+        # The other worker's change goes out on the room's next turn
+        self.assertEqual((await asyncio.wait_for(channel_layer.receive(channel), timeout=0.3))["type"],
+                         "participant_count_broadcast")
+
+    async def test_switched_during_class(self):
+        live_class = await database_sync_to_async(create_live_class)("WEB001")
+        teacher = await self.connect("alice", is_teacher=True, room="WEB001")
+        bob = await self.connect("bob", room="WEB001")
+        self.assertEqual((await bob.receive_json_from())["type"], "roster_snapshot")
+        await self.drain(bob)
+        await self.drain(teacher)
+
+        live_class.webinar = True
+        await database_sync_to_async(live_class.save)()
+        self.assertEqual(await bob.receive_json_from(), {"type": "webinar", "status": True})
+        self.assertEqual(await bob.receive_json_from(), {"type": "participant_count", "count": 1})
+        self.assertTrue(await get_room_store().get_webinar("WEB001"))
+
+        carol = await self.connect("carol", room="WEB001")
+        self.assertEqual(await carol.receive_json_from(), {"type": "participant_count", "count": 2})
+        await asyncio.sleep(0.1)
+        self.assertNotIn("room_batch", [f["type"] for f in await self.drain(bob)])
+        self.assertIn("room_batch", [f["type"] for f in await self.drain(teacher)])
+
+        for communicator in [teacher, bob, carol]:
+            await communicator.disconnect()
+
+    def test_only_webinar_changes_reach_the_store(self):
+        live_class = create_live_class("WEB001")
+        with unittest.mock.patch("classroom.webinar.webinar_changed", new_callable=unittest.mock.AsyncMock) as changed:
+            live_class.title = "Renamed"
+            live_class.save()
+            LiveClass.objects.get(code="WEB001").save()
+            live_class.webinar = True
+            live_class.save(update_fields=["title"])
+            changed.assert_not_called()
+            live_class.save()
+            changed.assert_called_once_with("WEB001", True)
+            live_class.save()
+            changed.assert_called_once()
+
+    def test_http_pages(self):
+        live_class = create_live_class("WEB001", webinar=True)
+        for name in ["bob", "carol", "dave"]:
+            async_to_sync(get_room_store().add_student)("WEB001", name, f"chan-{name}")
+        self.client.force_login(live_class.teacher)
+        url = "/classroom/WEB001/participants/"
+
+        page = self.client.get(url, {"limit": 2}).json()
+        self.assertEqual(([s["username"] for s in page["students"]], page["next"], page["total"]),
+                         (["bob", "carol"], "carol", 3))
+        page = self.client.get(url, {"limit": 2, "after": page["next"]}).json()
+        self.assertEqual(([s["username"] for s in page["students"]], page["next"]), (["dave"], None))
+        self.assertEqual(self.client.get(url, {"limit": "x"}).status_code, 400)
+        self.assertEqual(self.client.get("/classroom/NOPE00/participants/").status_code, 404)
+
+
+@override_settings(**{**TEST_SETTINGS, 'CLASSROOM_RESUME_GRACE': 0.2, 'CLASSROOM_RESUME_BUFFER_SIZE': 3})
+class ResumeTest(ConsumerTestMixin, TestCase):
+    """Test cases for students resuming their seat after the socket drops"""
+
+    async def join_student(self):
+        student = await self.connect("bob")
+        session = [m for m in await self.drain(student) if m["type"] == "session"][0]
+        return student, session
+
+    async def resume(self, token, last_seq):
+        communicator = WebsocketCommunicator(application, "/ws/classroom/room1/")
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        await communicator.send_json_to({"type": "resume", "resume_token": token, "last_seq": last_seq})
+        return communicator, await communicator.receive_json_from()
+
+    async def send_chat(self, communicator, count):
+        for i in range(count):
+            await communicator.send_json_to({"type": "chat_message", "message": f"message {i}"})
+
+    async def test_resume_replays_missed_frames_without_a_leave(self):
+        teacher = await self.connect("alice", is_teacher=True)
+        student, session = await self.join_student()
+        await self.drain(teacher)
+
+        await student.disconnect()
+        await self.send_chat(teacher, 2)
+        await self.drain(teacher)
+        student, resumed = await self.resume(session["resume_token"], session["seq"])
+        self.assertEqual(resumed["type"], "resumed")
+        self.assertFalse(resumed["resync"])
+        chats = [e for e in resumed["events"] if e["type"] == "chat_message"]
+        self.assertEqual([e["message"] for e in chats], ["message 0", "message 1"])
+        self.assertEqual([e["seq"] for e in resumed["events"]],
+                         list(range(session["seq"] + 1, session["seq"] + 1 + len(resumed["events"]))))
+
+        # The grace period passes without a leave and the seat is on the new socket
+        await asyncio.sleep(0.3)
+        self.assertEqual(await self.drain(teacher), [])
+        await student.send_json_to({"type": "chat_message", "message": "back"})
+        chat = await teacher.receive_json_from()
+        self.assertEqual((chat["username"], chat["seq"]), ("bob", resumed["events"][-1]["seq"] + 1))
+
+        for communicator in [teacher, student]:
+            await communicator.disconnect()
+
+    async def test_resume_past_the_buffer_resyncs(self):
+        teacher = await self.connect("alice", is_teacher=True)
+        student, session = await self.join_student()
+        await student.disconnect()
+        await self.send_chat(teacher, 4)
+        await self.drain(teacher)
+
+        student, resumed = await self.resume(session["resume_token"], session["seq"])
+        self.assertEqual((resumed["resync"], resumed["events"]), (True, []))
+        self.assertEqual(resumed["seq"], await get_room_store().event_seq("room1"))
+        snapshot = await student.receive_json_from()
+        self.assertEqual(snapshot["type"], "roster_snapshot")
+        self.assertEqual([s["username"] for s in snapshot["students"]], ["bob"])
+
+        for communicator in [teacher, student]:
+            await communicator.disconnect()
+
+    async def test_seat_is_released_after_the_grace_period(self):
+        teacher = await self.connect("alice", is_teacher=True)
+        student, session = await self.join_student()
+        await self.drain(teacher)
+
+        await student.disconnect()
+        self.assertEqual(await self.drain(teacher), [])
+        await asyncio.sleep(0.3)
+        batch = await teacher.receive_json_from()
+        self.assertEqual(batch["left"], [{"username": "bob", "is_teacher": False}])
+
+        student, resumed = await self.resume(session["resume_token"], session["seq"])
+        self.assertEqual(resumed, {"type": "resume_failed"})
+        await student.disconnect()
+        student, resumed = await self.resume("forged", 0)
+        self.assertEqual(resumed, {"type": "resume_failed"})
+
+        for communicator in [teacher, student]:
+            await communicator.disconnect()
+
+    async def test_leave_skips_the_grace_period(self):
+        teacher = await self.connect("alice", is_teacher=True)
+        student, _ = await self.join_student()
+        await self.drain(teacher)
+
+        await student.send_json_to({"type": "leave"})
+        await student.disconnect()
+        batch = await teacher.receive_json_from()
+        self.assertEqual(batch["left"], [{"username": "bob", "is_teacher": False}])
+        await teacher.disconnect()
+
+
+@override_settings(**{**TEST_SETTINGS, 'CLASSROOM_HEARTBEAT_INTERVAL': 0.05,
+                      'CLASSROOM_HEARTBEAT_TIMEOUT': 0.2, 'CLASSROOM_ROOM_TTL': 0.1})
+class ReaperTest(ConsumerTestMixin, TestCase):
+    """Test cases for heartbeats and evicting idle rooms"""
+
+    async def wait_for_reaper(self):
+        # It stops once it has nothing left to watch
+        deadline = time.monotonic() + 2
+        while reaper.get_reaper()._task and time.monotonic() < deadline:
+            await asyncio.sleep(0.02)
+        self.assertIsNone(reaper.get_reaper()._task)
+
+    async def test_silent_socket_is_closed(self):
+        responsive = await self.connect("alice", is_teacher=True)
+        silent = await self.connect("bob")
+        before = reaper.reaped.values.get(("stale_socket",), 0)
+
+        deadline = time.monotonic() + 0.4
+        while time.monotonic() < deadline:
+            message = await responsive.receive_json_from()
+            if message["type"] == "heartbeat":
+                await responsive.send_json_to({"type": "heartbeat"})
+        output = None
+        while output is None or output["type"] == "websocket.send":
+            output = await silent.receive_output()
+        self.assertEqual(output["type"], "websocket.close")
+        # Only the silent one
+        self.assertEqual(reaper.reaped.values[("stale_socket",)], before + 1)
+
+        await silent.disconnect()
+        await responsive.disconnect()
+        await self.wait_for_reaper()
+
+    async def test_rooms_in_use_are_touched(self):
+        store = get_room_store()
+        with unittest.mock.patch.object(store, "touch", wraps=store.touch) as touch:
+            student = await self.connect("bob")
+            await student.receive_json_from()  # roster_snapshot
+            self.assertEqual(touch.call_args_list, [unittest.mock.call("room1")])
+            while touch.call_count < 2:
+                message = await student.receive_json_from()
+                if message["type"] == "heartbeat":
+                    await student.send_json_to({"type": "heartbeat"})
+            await student.disconnect()
+        await self.wait_for_reaper()
+
+    async def test_empty_room_is_evicted(self):
+        student = await self.connect("bob")
+        await student.receive_json_from()  # roster_snapshot
+        self.assertIn("room1", get_room_store().rooms)
+        await student.disconnect()
+
+        await self.wait_for_reaper()
+        self.assertNotIn("room1", get_room_store().rooms)
+
+    @override_settings(CLASSROOM_HEARTBEAT_TIMEOUT=5)
+    async def test_ended_class_is_closed_and_evicted(self):
+        live_class = await database_sync_to_async(create_live_class)("ENDED1")
+        student = await self.connect("bob", room="ENDED1")
+        await student.receive_json_from()  # roster_snapshot
+        live_class.is_active = False
+        await live_class.asave()
+
+        messages = []
+        output = await student.receive_output(1)
+        while output["type"] == "websocket.send":
+            messages.append(json.loads(output["text"])["type"])
+            output = await student.receive_output(1)
+        self.assertEqual(output["type"], "websocket.close")
+        self.assertEqual(messages[-1], "class_ended")
+        await student.disconnect()
+
+        await self.wait_for_reaper()
+        self.assertNotIn("ENDED1", get_room_store().rooms)
+
+
+@override_settings(**TEST_SETTINGS)
+class RateLimitTest(ConsumerTestMixin, TestCase):
+    """Test cases for inbound rate limits"""
+
+    def setUp(self):
+        super().setUp()
+        ratelimit._room_buckets.buckets.clear()
+        ratelimit.throttled.values.clear()
+
+    def test_token_bucket(self):
+        bucket = ratelimit.TokenBucket(2, now=0)
+        self.assertEqual(bucket.take(1, 2, now=0), 0)
+        self.assertEqual(bucket.take(1, 2, now=0), 0)
+        self.assertAlmostEqual(bucket.take(1, 2, now=0.25), 0.75)
+        self.assertEqual(bucket.take(1, 2, now=1), 0)
+
+    @override_settings(CLASSROOM_RATE_LIMITS={"chat_message": {"connection": (0.001, 2)}})
+    async def test_connection_limit(self):
+        student = await self.connect("bob")
+        await self.drain(student)
+        for i in range(4):
+            await student.send_json_to({"type": "chat_message", "message": f"hi {i}"})
+        frames = await self.drain(student)
+        self.assertEqual([f["message"] for f in frames if f["type"] == "chat_message"], ["hi 0", "hi 1"])
+        errors = [f for f in frames if f["type"] == "error"]
+        # Told once, not for every dropped frame
+        self.assertEqual(len(errors), 1)
+        self.assertEqual((errors[0]["code"], errors[0]["message_type"], errors[0]["scope"]),
+                         ("rate_limited", "chat_message", "connection"))
+        self.assertGreater(errors[0]["retry_after"], 0)
+        self.assertEqual(ratelimit.throttled.values[("chat_message", "connection")], 2)
+        await student.disconnect()
+
+    async def test_signaling_floods_are_throttled(self):
+        clock = unittest.mock.Mock(time=lambda: 0.0)  # Frozen, so nothing refills
+        limiter = ratelimit.RateLimiter("room1", get_room_store(), clock)
+        for message_type in ["offer", "answer", "student_offer", "student_answer",
+                             "ice_candidate", "ice_candidates", "heartbeat"]:
+            rate, burst = ratelimit.limits_for(message_type)["connection"]
+            for _ in range(burst):
+                await limiter.check(message_type)
+            with self.assertRaises(ratelimit.RateLimited):
+                await limiter.check(message_type)
+
+    async def test_signaling_burst_gets_through(self):
+        teacher = await self.connect("alice", is_teacher=True)
+        student = await self.connect("bob")
+        await self.drain(teacher)
+        await self.drain(student)
+
+        # Well past the default limit's burst, as a teacher with a large class trickles
+        for i in range(500):
+            await teacher.send_json_to({
+                "type": "ice_candidate", "candidate": {"candidate": f"c{i}"},
+                "target_user": "bob", "is_teacher_stream": True,
+            })
+        frames = []
+        while len(frames) < 500:
+            frames.append(await student.receive_json_from())
+        self.assertEqual([f["candidate"]["candidate"] for f in frames], [f"c{i}" for i in range(500)])
+        self.assertEqual([f for f in await self.drain(teacher) if f["type"] == "error"], [])
+        self.assertNotIn(("ice_candidate", "connection"), ratelimit.throttled.values)
+
+        await teacher.disconnect()
+        await student.disconnect()
+
+    async def test_room_limit(self):
+        for shared in (False, True):
+            limits = {"chat_message": {"connection": (100, 100), "room": (0.001, 3)}}
+            with self.subTest(shared=shared), self.settings(CLASSROOM_RATE_LIMITS=limits,
+                                                            CLASSROOM_RATE_LIMIT_SHARED=shared):
+                room = f"room-shared-{shared}"
+                bob = await self.connect("bob", room=room)
+                carol = await self.connect("carol", room=room)
+                await self.drain(bob)
+                await self.drain(carol)
+                for student in (bob, carol, bob, carol):
+                    await student.send_json_to({"type": "chat_message", "message": "hi"})
+                frames = await self.drain(carol)
+                self.assertEqual(len([f for f in frames if f["type"] == "chat_message"]), 3)
+                self.assertEqual([f["scope"] for f in frames if f["type"] == "error"], ["room"])
+                await bob.disconnect()
+                await carol.disconnect()
+
+
+@override_settings(**TEST_SETTINGS)
+class IceBatchingTest(ConsumerTestMixin, TestCase):
+    """Test cases for batched ICE candidate relay"""
+
+    async def test_candidates_are_batched(self):
+        teacher = await self.connect("alice", is_teacher=True, features=["ice_candidates"])
+        student = await self.connect("bob", features=["ice_candidates"])
+        await self.drain(teacher)
+        await self.drain(student)
+
+        # Legacy single-candidate frames and a batch are merged into one relay
+        for i in range(3):
+            await teacher.send_json_to({
+                "type": "ice_candidate", "candidate": {"candidate": f"c{i}"},
+                "target_user": "bob", "is_teacher_stream": True,
+            })
+        await teacher.send_json_to({
+            "type": "ice_candidates", "candidates": [{"candidate": "c3"}], "end_of_candidates": True,
+            "target_user": "bob", "is_teacher_stream": True,
+        })
+
+        response = await student.receive_json_from()
+        self.assertEqual(response, {
+            "type": "ice_candidates",
+            "candidates": [{"candidate": f"c{i}"} for i in range(4)],
+            "end_of_candidates": True,
+            "from_user": "alice",
+            "is_teacher_stream": True,
+        })
+        self.assertTrue(await student.receive_nothing(timeout=0.05))
+
+        await teacher.disconnect()
+        await student.disconnect()
+
+    async def test_legacy_client_gets_single_candidates(self):
+        teacher = await self.connect("alice", is_teacher=True)
+        student = await self.connect("bob", features=["ice_candidates"])
+        await self.drain(teacher)
+        await self.drain(student)
+
+        # Students address the teacher as "teacher"
+        await student.send_json_to({
+            "type": "ice_candidates", "candidates": [{"candidate": "c0"}, {"candidate": "c1"}],
+            "target_user": "teacher", "is_teacher_stream": False,
+        })
+        messages = await self.drain(teacher)
+        self.assertEqual(messages, [
+            {"type": "ice_candidate", "candidate": {"candidate": f"c{i}"}, "from_user": "bob", "is_teacher_stream": False}
+            for i in range(2)
+        ])
+
+        await teacher.disconnect()
+        await student.disconnect()
+
+    async def test_candidates_must_be_a_list_of_objects(self):
+        teacher = await self.connect("alice", is_teacher=True)
+        student = await self.connect("bob")
+        await self.drain(teacher)
+        await self.drain(student)
+
+        for candidates in ["candidate:1", {"candidate": "c0"}, [{"candidate": "c0"}, "c1"]]:
+            await teacher.send_json_to({
+                "type": "ice_candidates", "candidates": candidates, "end_of_candidates": True,
+                "target_user": "bob", "is_teacher_stream": True,
+            })
+            self.assertEqual((await teacher.receive_json_from())["code"], "invalid_payload")
+        # The single-candidate form needs a candidate object too
+        for frame in [{}, {"candidate": "candidate:1"}, {"candidate": None}]:
+            await teacher.send_json_to({
+                "type": "ice_candidate", "target_user": "bob", "is_teacher_stream": True, **frame,
+            })
+            self.assertEqual(await teacher.receive_json_from(), {
+                "type": "error", "code": "invalid_payload", "message_type": "ice_candidate",
+            })
+        self.assertTrue(await student.receive_nothing(timeout=0.05))
+
+        await teacher.disconnect()
+        await student.disconnect()
+
+
+@override_settings(**TEST_SETTINGS)
+class PassthroughTest(ConsumerTestMixin, TestCase):
+    """Test cases for opaque SDP forwarding and frame size limits"""
+
+    SDP = {"type": "offer", "sdp": "v=0\r\no=- 4611731400430051336 2 IN IP4 127.0.0.1\r\n"}
+
+    def test_parse_envelope(self):
+        payload = json.dumps(self.SDP)
+        data, raw = parse_frame(json.dumps({"type": "offer", "target_user": "bob"}) + "\n" + payload)
+        self.assertEqual(data, {"type": "offer", "target_user": "bob"})
+        self.assertEqual(raw, payload)
+
+        with self.assertRaises(FrameError) as cm:
+            parse_frame('{"type":"chat_message"}\n{}')
+        self.assertEqual(cm.exception.code, "unsupported_envelope")
+        with self.assertRaises(FrameError) as cm:
+            parse_frame('{"type":"offer"}\n"not an object"')
+        self.assertEqual(cm.exception.code, "invalid_payload")
+
+    async def test_payload_cannot_add_keys(self):
+        teacher = await self.connect("alice", is_teacher=True)
+        student = await self.connect("bob")
+        await self.drain(teacher)
+        await self.drain(student)
+
+        # Not decoded, so this is forwarded, but only as the text of one field
+        payload = '{"sdp":"x"},"relay":true,"trace_id":"deadbeefdeadbeef","z":{}'
+        await student.send_to(text_data='{"type":"student_offer"}\n' + payload)
+        self.assertEqual(await teacher.receive_json_from(), {"type": "student_offer", "offer": payload, "from_user": "bob"})
+
+        await teacher.disconnect()
+        await student.disconnect()
+
+    @override_settings(CLASSROOM_MAX_FRAME_SIZES={"chat_message": 100})
+    def test_size_limit_checked_before_parsing(self):
+        with self.assertRaises(FrameError) as cm:
+            parse_frame('{"type":"chat_message","message":"' + "x" * 200)  # not even valid JSON
+        self.assertEqual((cm.exception.code, cm.exception.limit), ("frame_too_large", 100))
+
+    async def test_envelope_offer_is_forwarded(self):
+        teacher = await self.connect("alice", is_teacher=True)
+        student = await self.connect("bob")
+        await self.drain(teacher)
+        await self.drain(student)
+
+        payload = json.dumps(self.SDP)
+        await teacher.send_to(text_data='{"type":"offer","target_user":"bob"}\n' + payload)
+        self.assertEqual(await student.receive_json_from(), {"type": "offer", "offer": payload, "from_user": "alice"})
+
+        # Plain JSON frames from older clients are still accepted
+        await student.send_json_to({"type": "answer", "answer": self.SDP})
+        frame = await teacher.receive_json_from()
+        self.assertEqual((frame["type"], frame["from_user"]), ("answer", "bob"))
+        self.assertEqual(json.loads(frame["answer"]), self.SDP)
+
+        await teacher.disconnect()
+        await student.disconnect()
+
+    async def test_payload_cannot_spoof_sender(self):
+        teacher = await self.connect("alice", is_teacher=True)
+        student = await self.connect("bob")
+        await self.drain(teacher)
+        await self.drain(student)
+
+        await student.send_to(text_data='{"type":"student_offer"}\n{"sdp":"x"},"from_user":"carol","type":"chat_message"')
+        rejected = await student.receive_json_from()
+        self.assertEqual(rejected["code"], "invalid_payload")
+
+        await student.send_to(text_data='{"type":"student_offer"}\n{"sdp":"x","from_user":"carol"}')
+        response = await teacher.receive_json_from()
+        self.assertEqual((response["type"], response["from_user"]), ("student_offer", "bob"))
+
+        await teacher.disconnect()
+        await student.disconnect()
+
+    @override_settings(CLASSROOM_MAX_FRAME_SIZES={"offer": 100})
+    async def test_oversized_offer_is_rejected(self):
+        teacher = await self.connect("alice", is_teacher=True)
+        student = await self.connect("bob")
+        await self.drain(teacher)
+        await self.drain(student)
+
+        await teacher.send_to(text_data='{"type":"offer","target_user":"bob"}\n{"sdp":"' + "x" * 200 + '"}')
+        self.assertEqual(await teacher.receive_json_from(), {
+            "type": "error", "code": "frame_too_large", "message_type": "offer", "limit": 100,
+        })
+        self.assertTrue(await student.receive_nothing(timeout=0.05))
+
+        await teacher.disconnect()
+        await student.disconnect()
+
+
+@unittest.skipUnless(importlib.util.find_spec("msgpack"), "msgpack is not installed")
+@override_settings(**TEST_SETTINGS, CLASSROOM_BINARY_FRAMES=True)
+class BinaryFramesTest(ConsumerTestMixin, TestCase):
+    """Test cases for the MessagePack subprotocol"""
+
+    SDP = {"type": "offer", "sdp": "v=0\r\n"}
+
+    async def connect_binary(self, username, is_teacher=False):
+        page = binary.BinaryCodec()
+        communicator = WebsocketCommunicator(application, "/ws/classroom/room1/", subprotocols=[binary.SUBPROTOCOL])
+        connected, subprotocol = await communicator.connect()
+        self.assertTrue(connected)
+        self.assertEqual(subprotocol, binary.SUBPROTOCOL)
+        await communicator.send_to(bytes_data=page.encode({"type": "join", "username": username, "is_teacher": is_teacher}))
+        return communicator, page
+
+    async def receive_binary(self, communicator, page):
+        data = await communicator.receive_from()
+        self.assertIsInstance(data, bytes)
+        return page._unpack(binary.msgpack.unpackb(data, strict_map_key=False))
+
+    def test_usernames_are_sent_once(self):
+        server, page = binary.BinaryCodec(), binary.BinaryCodec()
+        frame = {"type": "chat_message", "message": "hi", "username": "alice"}
+        first, second = server.encode(frame), server.encode(frame)
+        self.assertLess(len(second), len(first))
+        self.assertEqual(binary.msgpack.unpackb(second, strict_map_key=False), {
+            binary.KEY_CODES["type"]: binary.TYPE_CODES["chat_message"],
+            binary.KEY_CODES["message"]: "hi",
+            binary.KEY_CODES["username"]: 0,
+        })
+        for encoded in (first, second):
+            self.assertEqual(page._unpack(binary.msgpack.unpackb(encoded, strict_map_key=False)), frame)
+
+    def test_invalid_frames_are_rejected(self):
+        codec = binary.BinaryCodec()
+        for data in (b"\xc1", binary.msgpack.packb([1, 2]), binary.msgpack.packb({1: 5})):
+            with self.assertRaises(FrameError) as cm:
+                codec.decode_frame(data)
+            self.assertEqual(cm.exception.code, "invalid_frame")
+
+    def test_unencodable_frame_goes_out_as_text(self):
+        consumer = ClassroomConsumer()
+        consumer.codec, consumer.username = binary.BinaryCodec(), "alice"
+        text = '{"type":"student_offer","offer":{"sdp":},"from_user":"bob"}'
+        self.assertEqual(consumer.websocket_message(text), {"type": "websocket.send", "text": text})
+
+    async def test_binary_and_json_pages_share_a_room(self):
+        teacher, page = await self.connect_binary("alice", is_teacher=True)
+        snapshot = await self.receive_binary(teacher, page)
+        self.assertEqual(snapshot, {"type": "roster_snapshot", "version": 0, "students": []})
+        student = await self.connect("bob")
+        await self.drain(student)
+        while not await teacher.receive_nothing(timeout=0.05):
+            await self.receive_binary(teacher, page)
+
+        # The SDP text travels inside the binary frame and reaches a JSON page as usual
+        payload = json.dumps(self.SDP)
+        await teacher.send_to(bytes_data=page.encode({"type": "offer", "target_user": "bob", "offer": payload}))
+        self.assertEqual(await student.receive_json_from(), {"type": "offer", "offer": payload, "from_user": "alice"})
+        # Pages sending the description as a map still work
+        await teacher.send_to(bytes_data=page.encode({"type": "offer", "target_user": "bob", "offer": self.SDP}))
+        self.assertEqual(json.loads((await student.receive_json_from())["offer"]), self.SDP)
+
+        await student.send_json_to({"type": "chat_message", "message": "hello"})
+        raw = binary.msgpack.unpackb(await teacher.receive_from(), strict_map_key=False)
+        # Broadcasts are packed once for every socket, so the name is not interned
+        self.assertEqual(raw[binary.KEY_CODES["username"]], "bob")
+        self.assertEqual(page._unpack(raw), {"type": "chat_message", "message": "hello", "username": "bob"})
+
+        await teacher.disconnect()
+        await student.disconnect()
+
+    async def test_broadcasts_are_packed_once(self):
+        teacher, teacher_page = await self.connect_binary("alice", is_teacher=True)
+        student, student_page = await self.connect_binary("bob")
+        for communicator, page in ((teacher, teacher_page), (student, student_page)):
+            while not await communicator.receive_nothing(timeout=0.05):
+                await self.receive_binary(communicator, page)
+
+        binary.pack_broadcast.cache_clear()
+        layer = get_channel_layer()
+        with unittest.mock.patch.object(layer, "group_send", wraps=layer.group_send) as group_send:
+            await student.send_to(bytes_data=student_page.encode({"type": "chat_message", "message": "hi"}))
+            frames = [await teacher.receive_from(), await student.receive_from()]
+        # The channel layer only carries the JSON text; this worker packs it once
+        self.assertEqual(set(group_send.call_args.args[1]), {"type", "text"})
+        self.assertEqual(binary.pack_broadcast.cache_info().misses, 1)
+        self.assertEqual(frames[0], frames[1])
+        self.assertEqual(teacher_page._unpack(binary.msgpack.unpackb(frames[0], strict_map_key=False)),
+                         {"type": "chat_message", "message": "hi", "username": "bob"})
+
+        await teacher.disconnect()
+        await student.disconnect()
+
+    @override_settings(CLASSROOM_BINARY_FRAMES=False)
+    async def test_json_when_disabled(self):
+        communicator = WebsocketCommunicator(application, "/ws/classroom/room1/", subprotocols=[binary.SUBPROTOCOL])
+        connected, subprotocol = await communicator.connect()
+        self.assertTrue(connected)
+        self.assertIsNone(subprotocol)
+        await communicator.send_json_to({"type": "join", "username": "bob", "is_teacher": False})
+        self.assertEqual((await communicator.receive_json_from())["type"], "roster_snapshot")
+        await communicator.disconnect()
+
+
+class HybridChannelLayerTest(TestCase):
+    """Test cases for in-process delivery in the hybrid channel layer"""
+
+    async def test_local_send_skips_redis(self):
+        # Nothing listens on this port; a Redis round trip would fail
+        layer = HybridRedisChannelLayer(hosts=[("127.0.0.1", 1)])
+        channel = await layer.new_channel()
+
+        await layer.send(channel, {"type": "offer_broadcast", "payload": "{}"})
+        self.assertEqual(await layer.receive(channel), {"type": "offer_broadcast", "payload": "{}"})
+        self.assertEqual(layer.delivery_stats(), {"local": 1, "remote": 0, "local_ratio": 1.0})
+
+    async def test_other_process_channels_are_remote(self):
+        layer = HybridRedisChannelLayer(hosts=[("127.0.0.1", 1)])
+        other = HybridRedisChannelLayer(hosts=[("127.0.0.1", 1)])
+        self.assertTrue(layer.is_local_channel(await layer.new_channel()))
+        self.assertFalse(layer.is_local_channel(await other.new_channel()))
+        self.assertFalse(layer.is_local_channel("some_worker_channel"))
+
+    async def test_local_send_wakes_every_receiver(self):
+        layer = HybridRedisChannelLayer(hosts=[("127.0.0.1", 1)])
+        first, second = await layer.new_channel(), await layer.new_channel()
+        reads = []
+
+        async def redis_read(self, channel):
+            # Stands in for BZPOPMIN on a quiet Redis
+            reads.append(channel)
+            await asyncio.Event().wait()
+
+        with unittest.mock.patch("channels_redis.core.RedisChannelLayer.receive_single", redis_read):
+            receivers = [asyncio.ensure_future(layer.receive(channel)) for channel in (first, second)]
+            await asyncio.sleep(0.01)
+            await layer.send(first, {"type": "first"})
+            await layer.send(second, {"type": "second"})
+            results = await asyncio.wait_for(asyncio.gather(*receivers), timeout=1)
+
+        self.assertEqual(results, [{"type": "first"}, {"type": "second"}])
+        # The lock holder's Redis read was kept, not cancelled and started over
+        self.assertEqual(len(reads), 1)
+        layer._remote_receive.cancel()
+
+    async def test_unread_local_buffers_expire(self):
+        layer = HybridRedisChannelLayer(hosts=[("127.0.0.1", 1)], expiry=1)
+        channel = await layer.new_channel()
+        await layer.send(channel, {"type": "chat_message_broadcast"})
+
+        layer._sweep_local_buffers(time.time() + 5)
+        self.assertNotIn(channel, layer.receive_buffer)
+
+
+SHARDED_LAYERS = {
+    "default": {"BACKEND": "channels.layers.InMemoryChannelLayer"},
+    "shard-0": {"BACKEND": "channels.layers.InMemoryChannelLayer"},
+    "shard-1": {"BACKEND": "channels.layers.InMemoryChannelLayer"},
+}
+
+
+@override_settings(**TEST_SETTINGS)
+class ShardingTest(ConsumerTestMixin, TestCase):
+    """Test cases for consistent-hash room sharding"""
+
+    def test_adding_a_shard_moves_a_bounded_fraction(self):
+        rooms = [f"room{i}" for i in range(5000)]
+        before = HashRing(["shard-0", "shard-1", "shard-2"])
+        after = HashRing(["shard-0", "shard-1", "shard-2", "shard-3"])
+
+        moved = sum(before.node_for(r) != after.node_for(r) for r in rooms)
+        # Ideal is 1/4 of the rooms, all of them onto the new shard
+        self.assertLess(moved / len(rooms), 0.35)
+        self.assertTrue(all(after.node_for(r) == "shard-3" for r in rooms if before.node_for(r) != after.node_for(r)))
+
+    def test_unsharded_rooms_use_default_layer(self):
+        self.assertEqual(channel_layer_alias_for_room("abc123"), "default")
+
+    @override_settings(CHANNEL_LAYERS=SHARDED_LAYERS, CLASSROOM_CHANNEL_LAYER_SHARDS=["shard-0", "shard-1"])
+    async def test_room_lives_on_one_shard(self):
+        room = next(f"room{i}" for i in range(100) if channel_layer_alias_for_room(f"room{i}") == "shard-1")
+        teacher = await self.connect("alice", is_teacher=True, room=room)
+        student = await self.connect("bob", room=room)
+        await self.drain(teacher)
+        await self.drain(student)
+
+        self.assertIn(f"classroom_{room}", channel_layers["shard-1"].groups)
+        self.assertNotIn(f"classroom_{room}", channel_layers["shard-0"].groups)
+
+        await student.send_json_to({"type": "request_stream"})
+        response = await teacher.receive_json_from()
+        self.assertEqual(response["type"], "student_requesting_stream")
+        self.assertEqual(response["from_user"], "bob")
+
+        await teacher.disconnect()
+        await student.disconnect()
+
+
+@override_settings(**TEST_SETTINGS, CLASSROOM_BROADCAST_BUS={"BACKEND": "classroom.bus.InMemoryBroadcastBus"})
+class BroadcastBusTest(ConsumerTestMixin, TestCase):
+    """Test cases for room-wide events over the pub/sub bus"""
+
+    async def test_chat_fans_out_without_groups(self):
+        teacher = await self.connect("alice", is_teacher=True)
+        students = [await self.connect(f"student{i}") for i in range(3)]
+        for communicator in [teacher, *students]:
+            await self.drain(communicator)
+
+        bus = get_broadcast_bus()
+        self.assertEqual(len(bus.members["classroom_room1"][1]), 4)
+        self.assertNotIn("classroom_room1", channel_layers["default"].groups)
+
+        await students[0].send_json_to({"type": "chat_message", "message": "hi"})
+        for communicator in [teacher, *students]:
+            self.assertEqual(await communicator.receive_json_from(), {
+                "type": "chat_message", "message": "hi", "username": "student0",
+            })
+
+        # Roster batches take the same path
+        await students[0].disconnect()
+        batch = await teacher.receive_json_from()
+        self.assertEqual(batch["left"], [{"username": "student0", "is_teacher": False}])
+
+        for communicator in [teacher, *students[1:]]:
+            await communicator.disconnect()
+        self.assertNotIn("classroom_room1", bus.members)
+
+
+    async def test_last_leave_and_next_join_do_not_interleave(self):
+        class SlowBus(InMemoryBroadcastBus):
+            subscribed = set()
+
+            async def room_added(self, group):
+                self.subscribed.add(group)
+
+            async def room_removed(self, group):
+                # The UNSUBSCRIBE goes out after a new member's SUBSCRIBE would
+                await asyncio.sleep(0.05)
+                self.subscribed.discard(group)
+
+        bus, channel_layer = SlowBus(), get_channel_layer()
+        await bus.subscribe(channel_layer, "classroom_room1", "chan-a")
+        leaving = asyncio.ensure_future(bus.unsubscribe("classroom_room1", "chan-a"))
+        await asyncio.sleep(0.01)
+        await bus.subscribe(channel_layer, "classroom_room1", "chan-b")
+        await leaving
+
+        self.assertEqual(bus.members["classroom_room1"][1], {"chan-b"})
+        self.assertEqual(bus.subscribed, {"classroom_room1"})
+        self.assertEqual(bus._locks, {})
+
+
+@override_settings(**TEST_SETTINGS)
+class MetricsTest(ConsumerTestMixin, TestCase):
+    """Test cases for consumer instrumentation and the /metrics endpoint"""
+
+    def sample(self, text, line_prefix):
+        for line in text.splitlines():
+            if line.startswith(line_prefix + " "):
+                return float(line.rsplit(" ", 1)[1])
+        return 0.0
+
+    async def scrape(self):
+        response = await self.async_client.get("/metrics")
+        self.assertEqual(response.status_code, 200)
+        return response.content.decode()
+
+    @override_settings(CLASSROOM_RATE_LIMITS={"chat_message": {"connection": (0.001, 1)}})
+    async def test_frames_and_sockets_are_counted(self):
+        before = await self.scrape()
+        teacher = await self.connect("alice", is_teacher=True, room="metrics1")
+        student = await self.connect("bob", room="metrics1")
+        await student.send_json_to({"type": "chat_message", "message": "hi"})
+        await student.send_json_to({"type": "chat_message", "message": "throttled"})
+        # Missing its permission, so the handler raises
+        await teacher.send_json_to({"type": "permission_update", "student_name": "bob"})
+        await teacher.send_json_to({"type": "chat_message", "message": ""})
+        await student.send_json_to({"type": "no_such_type"})
+        await student.send_to(text_data="{not json")
+        for communicator in [teacher, student]:
+            await self.drain(communicator)
+
+        after = await self.scrape()
+        room = metrics.room_label("metrics1")
+        self.assertEqual(self.sample(after, f'classroom_room_sockets{{room="{room}"}}'), 2)
+        for series, delta in [
+            ('classroom_frames_received_total{type="join"}', 2),
+            ('classroom_frames_received_total{type="chat_message"}', 3),
+            ('classroom_handler_seconds_count{type="chat_message",outcome="ok"}', 1),
+            ('classroom_handler_seconds_count{type="chat_message",outcome="throttled"}', 1),
+            ('classroom_handler_seconds_count{type="chat_message",outcome="rejected"}', 1),
+            ('classroom_handler_seconds_count{type="permission_update",outcome="error"}', 1),
+            ('classroom_frames_rejected_total{reason="unknown_type"}', 1),
+            ('classroom_frames_rejected_total{reason="invalid_json"}', 1),
+        ]:
+            self.assertEqual(self.sample(after, series) - self.sample(before, series), delta, series)
+        self.assertGreater(self.sample(after, 'classroom_channel_layer_seconds_count{operation="group_send"}'), 0)
+        self.assertNotIn("metrics1", after)
+
+        await teacher.disconnect()
+        await student.disconnect()
+        self.assertNotIn(f'room="{room}"', await self.scrape())
+
+    @override_settings(CLASSROOM_METRICS_TOKEN="secret")
+    async def test_token_required_when_configured(self):
+        response = await self.async_client.get("/metrics")
+        self.assertEqual(response.status_code, 403)
+        response = await self.async_client.get("/metrics", headers={"Authorization": "Bearer secret"})
+        self.assertEqual(response.status_code, 200)
+
+    def test_histogram_buckets_are_cumulative(self):
+        histogram = metrics.Histogram("test_seconds", "Test.", ["op"], buckets=(0.1, 1.0))
+        metrics._registry.remove(histogram)
+        for value in (0.05, 0.5, 5):
+            histogram.observe(value, "x")
+        self.assertEqual(histogram.render().splitlines()[2:], [
+            'test_seconds_bucket{op="x",le="0.1"} 1',
+            'test_seconds_bucket{op="x",le="1"} 2',
+            'test_seconds_bucket{op="x",le="+Inf"} 3',
+            'test_seconds_sum{op="x"} 5.55',
+            'test_seconds_count{op="x"} 3',
+        ])
+
+
+@override_settings(**TEST_SETTINGS)
+class StreamTracingTest(ConsumerTestMixin, TestCase):
+    """Test cases for stream setup trace IDs and time-to-first-frame reports"""
+
+    REPORT = {"offer_received": 90, "answer_sent": 120, "connected": 600, "first_frame": 750}
+
+    def setUp(self):
+        super().setUp()
+        tracing.stream_setup_seconds.values.clear()
+
+    async def test_trace_id_follows_the_negotiation(self):
+        teacher = await self.connect("alice", is_teacher=True)
+        student = await self.connect("bob", features=["ice_candidates"])
+        await self.drain(teacher)
+        await self.drain(student)
+
+        # Server assigns a trace ID when the client didn't send one
+        await student.send_json_to({"type": "request_stream"})
+        trace_id = (await teacher.receive_json_from())["trace_id"]
+        self.assertRegex(trace_id, tracing.TRACE_ID)
+        self.assertEqual(await student.receive_json_from(), {"type": "stream_queue", "status": "admitted"})
+
+        await teacher.send_to(text_data=json.dumps(
+            {"type": "offer", "target_user": "bob", "trace_id": trace_id, "teacher_ms": 40}
+        ) + "\n" + json.dumps({"type": "offer", "sdp": "v=0"}))
+        offer = await student.receive_json_from()
+        self.assertEqual((offer["trace_id"], offer["teacher_ms"]), (trace_id, 40))
+
+        await student.send_to(text_data=json.dumps(
+            {"type": "answer", "target_user": "alice", "trace_id": trace_id}
+        ) + "\n" + json.dumps({"type": "answer", "sdp": "v=0"}))
+        self.assertEqual((await teacher.receive_json_from())["trace_id"], trace_id)
+
+        await teacher.send_json_to({
+            "type": "ice_candidates", "target_user": "bob", "is_teacher_stream": True,
+            "candidates": [{"candidate": "c1"}], "end_of_candidates": True, "trace_id": trace_id,
+        })
+        self.assertEqual((await student.receive_json_from())["trace_id"], trace_id)
+
+        await student.send_json_to({
+            "type": "stream_trace", "trace_id": trace_id, "teacher_ms": 40, "marks": self.REPORT,
+        })
+        await self.drain(student)
+        room = metrics.room_label("room1")
+        counts = {
+            stage: entry[0] for (label, stage), entry in tracing.stream_setup_seconds.values.items() if label == room
+        }
+        self.assertEqual(set(counts), {"teacher", "signaling", "answer", "ice", "first_frame", "total"})
+
+        # A trace is only accepted once, and only from the socket that started it
+        await student.send_json_to({"type": "stream_trace", "trace_id": trace_id, "marks": self.REPORT})
+        await self.drain(student)
+        self.assertEqual(sum(tracing.stream_setup_seconds.values[(room, "total")][0]), 1)
+
+        await teacher.disconnect()
+        await student.disconnect()
+        self.assertEqual(tracing.stream_setup_seconds.values, {})
+
+    def test_stage_durations(self):
+        durations = tracing.stage_durations({"teacher_ms": 40, "marks": self.REPORT})
+        self.assertEqual(durations, {
+            "teacher": 0.04, "signaling": 0.05, "answer": 0.03, "ice": 0.48, "first_frame": 0.15, "total": 0.75,
+        })
+        with self.assertRaises(ValueError):
+            tracing.stage_durations({"marks": {**self.REPORT, "connected": 50}})
+        with self.assertRaises(ValueError):
+            tracing.stage_durations({"marks": {**self.REPORT, "first_frame": "soon"}})
+
+
+@override_settings(**TEST_SETTINGS, CLASSROOM_STREAM_ADMISSION_LIMIT=2, CLASSROOM_STREAM_QUEUE_UPDATE_INTERVAL=0.01)
+class StreamAdmissionTest(ConsumerTestMixin, TestCase):
+    """Test cases for pacing stream requests to the teacher"""
+
+    async def answer(self, student, teacher_name="alice"):
+        await student.send_to(text_data=json.dumps(
+            {"type": "answer", "target_user": teacher_name}
+        ) + "\n" + json.dumps({"type": "answer", "sdp": "v=0"}))
+
+    async def test_requests_are_admitted_in_order(self):
+        teacher = await self.connect("alice", is_teacher=True)
+        students = [await self.connect(f"student{i}") for i in range(4)]
+        for communicator in [teacher, *students]:
+            await self.drain(communicator)
+
+        for student in students:
+            await student.send_json_to({"type": "request_stream"})
+        requests = [m for m in await self.drain(teacher) if m["type"] == "student_requesting_stream"]
+        self.assertEqual([m["from_user"] for m in requests], ["student0", "student1"])
+
+        statuses = [(await self.drain(s))[0] for s in students]
+        self.assertEqual(statuses[1], {"type": "stream_queue", "status": "admitted"})
+        self.assertEqual(statuses[2], {"type": "stream_queue", "status": "waiting", "position": 1})
+        self.assertEqual(statuses[3], {"type": "stream_queue", "status": "waiting", "position": 2})
+
+        # An answer frees a slot for the next student, whose position then shifts
+        await self.answer(students[0])
+        requests = [m for m in await self.drain(teacher) if m["type"] == "student_requesting_stream"]
+        self.assertEqual([m["from_user"] for m in requests], ["student2"])
+        self.assertEqual(await self.drain(students[3]), [{"type": "stream_queue", "status": "waiting", "position": 1}])
+
+        # So does a failure the teacher reports; the student is told so it can ask again
+        await teacher.send_json_to({"type": "negotiation_failed", "target_user": "student1"})
+        self.assertEqual(await students[1].receive_json_from(), {"type": "stream_queue", "status": "failed"})
+        requests = [m for m in await self.drain(teacher) if m["type"] == "student_requesting_stream"]
+        self.assertEqual([m["from_user"] for m in requests], ["student3"])
+
+        for communicator in [teacher, *students]:
+            await communicator.disconnect()
+
+    @override_settings(CLASSROOM_STREAM_ADMISSION_LIMIT=1)
+    async def test_concurrent_requests_respect_the_limit(self):
+        store = get_room_store()
+        await store.add_student("room1", "bob", "chan-bob")
+        await store.add_student("room1", "carol", "chan-carol")
+        get_channel = store.get_channel
+        sent = []
+
+        class Consumer:
+            rooms, room_code = store, "room1"
+
+            async def channel_send(self, channel, message):
+                pass
+
+            async def send_stream_request(self, username, channel, trace_id):
+                sent.append(username)
+
+        async def slow_get_channel(room_code, username):
+            # Both requests reach the store lookup before either returns
+            await asyncio.sleep(0.01)
+            return await get_channel(room_code, username)
+
+        queue = StreamAdmissionQueue(Consumer())
+        with unittest.mock.patch.object(store, "get_channel", slow_get_channel):
+            await asyncio.gather(queue.request("bob", "chan-bob"), queue.request("carol", "chan-carol"))
+        self.assertEqual(sent, ["bob"])
+        self.assertEqual(list(queue.in_flight), ["bob"])
+        self.assertEqual(list(queue.waiting), ["carol"])
+        queue.close()
+
+    @override_settings(CLASSROOM_STREAM_ADMISSION_LIMIT=1, CLASSROOM_STREAM_NEGOTIATION_TIMEOUT=0.05)
+    async def test_stuck_negotiation_times_out(self):
+        teacher = await self.connect("alice", is_teacher=True)
+        stuck = await self.connect("bob")
+        waiting = await self.connect("carol")
+        for communicator in [teacher, stuck, waiting]:
+            await self.drain(communicator)
+
+        await stuck.send_json_to({"type": "request_stream"})
+        self.assertEqual((await teacher.receive_json_from())["from_user"], "bob")
+        await waiting.send_json_to({"type": "request_stream"})
+        self.assertEqual(await stuck.receive_json_from(), {"type": "stream_queue", "status": "admitted"})
+
+        # Nobody answers bob in time, so his slot goes to carol
+        self.assertEqual(await stuck.receive_json_from(timeout=1), {"type": "stream_queue", "status": "failed"})
+        self.assertEqual((await teacher.receive_json_from(timeout=1))["from_user"], "carol")
+
+        for communicator in [teacher, stuck, waiting]:
+            await communicator.disconnect()
+
+    async def test_students_who_left_are_skipped(self):
+        teacher = await self.connect("alice", is_teacher=True)
+        students = [await self.connect(f"student{i}") for i in range(4)]
+        for communicator in [teacher, *students]:
+            await self.drain(communicator)
+        for student in students:
+            await student.send_json_to({"type": "request_stream"})
+        await self.drain(teacher)
+
+        await students[2].disconnect()
+        await self.answer(students[0])
+        requests = [m for m in await self.drain(teacher) if m["type"] == "student_requesting_stream"]
+        self.assertEqual([m["from_user"] for m in requests], ["student3"])
+
+        for communicator in [teacher, students[0], students[1], students[3]]:
+            await communicator.disconnect()
+
+
+@unittest.skipUnless(importlib.util.find_spec("aiortc"), "aiortc is not installed")
+@override_settings(**TEST_SETTINGS, CLASSROOM_SFU_ENABLED=True)
+class SfuTest(ConsumerTestMixin, TestCase):
+    """Test cases for forwarding the teacher stream through the server, with aiortc peers as browsers"""
+
+    async def send_envelope(self, communicator, header, description):
+        await communicator.send_to(text_data=json.dumps(header) + "\n" + json.dumps(
+            {"type": description.type, "sdp": description.sdp}
+        ))
+
+    async def receive_type(self, communicator, message_type):
+        while True:
+            message = await communicator.receive_json_from(timeout=5)
+            if message["type"] == message_type:
+                return message
+
+    def test_untested_aiortc_keeps_sfu_off(self):
+        import aiortc
+
+        self.addCleanup(sfu.aiortc_supported.cache_clear)
+        sfu.aiortc_supported.cache_clear()
+        with unittest.mock.patch.object(aiortc, "__version__", "2.0.0"):
+            self.assertFalse(sfu.sfu_enabled())
+        sfu.aiortc_supported.cache_clear()
+        self.assertTrue(sfu.sfu_enabled())
+
+    async def test_student_receives_teacher_stream(self):
+        from aiortc import RTCPeerConnection, RTCSessionDescription
+        from aiortc.mediastreams import VideoStreamTrack
+
+        teacher = await self.connect("alice", is_teacher=True)
+        student = await self.connect("bob")
+        for communicator in [teacher, student]:
+            await self.drain(communicator)
+
+        # The teacher publishes once to "sfu" and gets the answer from it
+        publisher = RTCPeerConnection()
+        publisher.addTrack(VideoStreamTrack())
+        await publisher.setLocalDescription(await publisher.createOffer())
+        await self.send_envelope(teacher, {"type": "offer", "target_user": "sfu"}, publisher.localDescription)
+        answer = await self.receive_type(teacher, "answer")
+        self.assertEqual(answer["from_user"], "sfu")
+        await publisher.setRemoteDescription(RTCSessionDescription(**json.loads(answer["answer"])))
+
+        # The student's request is answered by the server, not the teacher's browser
+        await student.send_json_to({"type": "request_stream", "trace_id": "abcdef0123456789"})
+        offer = await self.receive_type(student, "offer")
+        self.assertEqual((offer["from_user"], offer["trace_id"]), ("sfu", "abcdef0123456789"))
+
+        received = asyncio.Event()
+        subscriber = RTCPeerConnection()
+
+        @subscriber.on("track")
+        def on_track(track):
+            async def first_frame():
+                await track.recv()
+                received.set()
+            asyncio.ensure_future(first_frame())
+
+        await subscriber.setRemoteDescription(RTCSessionDescription(**json.loads(offer["offer"])))
+        await subscriber.setLocalDescription(await subscriber.createAnswer())
+        await self.send_envelope(student, {"type": "answer", "target_user": "sfu"}, subscriber.localDescription)
+        await asyncio.wait_for(received.wait(), 10)
+
+        self.assertEqual([m for m in await self.drain(teacher) if m["type"] != "roster_batch"], [])
+        self.assertGreater(sfu.frames_forwarded.values[("out", "video")], 0)
+
+        await subscriber.close()
+        await publisher.close()
+        for communicator in [teacher, student]:
+            await communicator.disconnect()
+
+    async def test_bad_answer_does_not_close_teacher(self):
+        from aiortc import RTCPeerConnection, RTCSessionDescription
+        from aiortc.mediastreams import VideoStreamTrack
+        from classroom.admission import admissions
+
+        teacher = await self.connect("alice", is_teacher=True)
+        student = await self.connect("bob")
+        for communicator in [teacher, student]:
+            await self.drain(communicator)
+        publisher = RTCPeerConnection()
+        publisher.addTrack(VideoStreamTrack())
+        await publisher.setLocalDescription(await publisher.createOffer())
+        await self.send_envelope(teacher, {"type": "offer", "target_user": "sfu"}, publisher.localDescription)
+        answer = await self.receive_type(teacher, "answer")
+        await publisher.setRemoteDescription(RTCSessionDescription(**json.loads(answer["answer"])))
+
+        await student.send_json_to({"type": "request_stream"})
+        await self.receive_type(student, "offer")
+        failed = admissions.values.get(("failed",), 0)
+        await student.send_to(text_data='{"type":"answer","target_user":"sfu"}\n{"type":"answer","sdp":"garbage"}')
+        self.assertEqual((await self.receive_type(student, "stream_queue"))["status"], "failed")
+        self.assertEqual(admissions.values[("failed",)], failed + 1)
+
+        # The teacher's consumer, and its SFU session, are still there
+        await student.send_json_to({"type": "chat_message", "message": "still here?"})
+        self.assertEqual((await self.receive_type(teacher, "chat_message"))["message"], "still here?")
+
+        await publisher.close()
+        for communicator in [teacher, student]:
+            await communicator.disconnect()
+
+    @override_settings(CLASSROOM_SFU_ENABLED=False)
+    async def test_disabled_sfu_is_not_a_peer(self):
+        teacher = await self.connect("alice", is_teacher=True)
+        await self.drain(teacher)
+        await teacher.send_to(text_data=json.dumps({"type": "offer", "target_user": "sfu"}) + "\n{}")
+        self.assertEqual(await self.drain(teacher), [])
+        await teacher.disconnect()
+
+
+@override_settings(**TEST_SETTINGS)
+class HlsTest(ConsumerTestMixin, TestCase):
+    """Test cases for the HLS output of the teacher stream"""
+
+    def setUp(self):
+        super().setUp()
+        self.root = tempfile.TemporaryDirectory()
+        self.addCleanup(self.root.cleanup)
+        settings = override_settings(CLASSROOM_HLS_ENABLED=True, CLASSROOM_HLS_ROOT=Path(self.root.name))
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def test_remove_live_keeps_recordings(self):
+        (Path(self.root.name) / "ABC123" / "live").mkdir(parents=True)
+        for stamp in ["20260101-090000", "20260102-090000"]:
+            recording = Path(self.root.name) / "ABC123" / "recordings" / stamp
+            recording.mkdir(parents=True)
+            (recording / "index.m3u8").write_text("#EXTM3U\n")
+
+        hls.remove_live("ABC123")
+        self.assertFalse((Path(self.root.name) / "ABC123" / "live").exists())
+        self.assertEqual(hls.latest_recording_url("ABC123"),
+                         "/hls/ABC123/recordings/20260102-090000/index.m3u8")
+        self.assertIsNone(hls.latest_recording_url("XYZ789"))
+
+    @override_settings(CLASSROOM_HLS_RECORDING_DAYS=7)
+    def test_old_recordings_are_pruned(self):
+        recordings = Path(self.root.name) / "ABC123" / "recordings"
+        for stamp, age_days in [("20260101-090000", 8), ("20260105-090000", 6)]:
+            (recordings / stamp).mkdir(parents=True)
+            written = time.time() - age_days * 24 * 3600
+            os.utime(recordings / stamp, (written, written))
+
+        self.assertEqual(hls.prune_recordings(), 1)
+        self.assertEqual([p.name for p in recordings.iterdir()], ["20260105-090000"])
+        with self.settings(CLASSROOM_HLS_RECORDING_DAYS=0):
+            self.assertEqual(hls.prune_recordings(), 0)
+
+    def test_access_is_checked_for_nginx(self):
+        live_class = create_live_class("ABC123")
+        playlist = {"HTTP_X_ORIGINAL_URI": "/hls/ABC123/live/index.m3u8"}
+        self.assertEqual(self.client.get("/hls-access/", **playlist).status_code, 401)
+
+        self.client.force_login(User.objects.create_user(username="bob", password="testpass"))
+        self.assertEqual(self.client.get("/hls-access/", **playlist).status_code, 200)
+        for uri in ["/hls/XYZ789/live/index.m3u8", "/hls/../etc/passwd", "/static/x.js", ""]:
+            self.assertEqual(self.client.get("/hls-access/", HTTP_X_ORIGINAL_URI=uri).status_code, 403)
+        # Recordings stay watchable once the class has ended, like the page
+        live_class.is_active = False
+        live_class.save()
+        self.assertEqual(self.client.get(
+            "/hls-access/", HTTP_X_ORIGINAL_URI="/hls/ABC123/recordings/20260101-090000/00001.ts",
+        ).status_code, 200)
+
+    def test_missing_hls_js_fails_the_checks(self):
+        with unittest.mock.patch.object(checks.finders, "find", return_value=None):
+            self.assertEqual([error.id for error in checks.hls_js_check(None)], ["classroom.E001"])
+            with self.settings(CLASSROOM_HLS_ENABLED=False):
+                self.assertEqual(checks.hls_js_check(None), [])
+        with unittest.mock.patch.object(checks.finders, "find", return_value="/app/hls.min.js"):
+            self.assertEqual(checks.hls_js_check(None), [])
+
+    async def test_recorder_stops_before_live_window_is_removed(self):
+        live = Path(self.root.name) / "room1" / "live"
+        live.mkdir(parents=True)
+        teacher = await self.connect("alice", is_teacher=True)
+        await self.drain(teacher)
+
+        stopped = asyncio.Event()
+        close_sfu_session = ClassroomConsumer.close_sfu_session
+
+        async def close_then_check(consumer):
+            await close_sfu_session(consumer)
+            self.assertTrue(live.exists())
+            stopped.set()
+
+        with unittest.mock.patch.object(ClassroomConsumer, "close_sfu_session", close_then_check):
+            await hls.end_live("room1")
+            await asyncio.wait_for(stopped.wait(), 1)
+            deadline = time.monotonic() + 1
+            while live.exists() and time.monotonic() < deadline:
+                await asyncio.sleep(0.01)
+        self.assertFalse(live.exists())
+
+        await teacher.disconnect()
+        # Without a teacher nothing is recording, so it goes at once
+        live.mkdir()
+        await hls.end_live("room1")
+        self.assertFalse(live.exists())
+
+    def test_room_code_must_be_a_plain_name(self):
+        with self.assertRaises(ValueError):
+            hls.room_dir("../ABC123")
+        hls.remove_live("../..")
+        self.assertTrue(Path(self.root.name).exists())
+
+    @unittest.skipUnless(importlib.util.find_spec("aiortc"), "aiortc is not installed")
+    @override_settings(CLASSROOM_HLS_SEGMENT_SECONDS=1)
+    async def test_published_stream_is_segmented_and_recorded(self):
+        import av
+        from aiortc import RTCPeerConnection, RTCSessionDescription
+        from aiortc.mediastreams import AudioStreamTrack, VideoStreamTrack
+
+        session = sfu.SfuSession("ABC123")
+        publisher = RTCPeerConnection()
+        publisher.addTrack(VideoStreamTrack())
+        publisher.addTrack(AudioStreamTrack())
+        await publisher.setLocalDescription(await publisher.createOffer())
+        answer = await session.publish({"type": "offer", "sdp": publisher.localDescription.sdp})
+        await publisher.setRemoteDescription(RTCSessionDescription(**answer))
+
+        live = Path(self.root.name) / "ABC123" / "live"
+        deadline = time.monotonic() + 15
+        while not list(live.glob("*.ts")) and time.monotonic() < deadline:
+            await asyncio.sleep(0.2)
+        self.assertTrue((live / "index.m3u8").exists())
+
+        await publisher.close()
+        await session.close()
+        hls.remove_live("ABC123")
+
+        recording = next((Path(self.root.name) / "ABC123" / "recordings").glob("*/index.m3u8"))
+        self.assertIn("#EXT-X-ENDLIST", recording.read_text())
+        with av.open(str(recording)) as container:
+            codecs = {stream.type: stream.codec_context.name for stream in container.streams}
+            self.assertEqual(codecs, {"video": "h264", "audio": "aac"})
+            self.assertTrue(any(True for _ in container.decode(video=0)))
+
+
+class RelayTreeTest(TestCase):
+    """Test cases for placing students in the relay tree"""
+
+    def test_students_fill_the_shallowest_free_slots(self):
+        tree = RelayTree("alice", fanout=2, stream_kbps=1000)
+        self.assertEqual(tree.place("bob", 5000), ("alice", []))
+        self.assertEqual(tree.place("carol", 1000), ("alice", []))
+        # bob can relay two copies, carol one; nobody reported for dave
+        self.assertEqual(tree.place("dave"), ("bob", []))
+        self.assertEqual(tree.place("erin"), ("bob", []))
+        self.assertEqual(tree.place("frank"), ("carol", []))
+        self.assertEqual(tree.depth("frank"), 2)
+
+    def test_stronger_relay_takes_a_weaker_students_place(self):
+        tree = RelayTree("alice", fanout=2, stream_kbps=1000)
+        tree.place("bob")
+        tree.place("carol")
+        parent, moved = tree.place("dave", 2000)
+        self.assertEqual((parent, moved), ("alice", [("bob", "dave")]))
+        self.assertEqual(tree.parent_of("bob"), "dave")
+
+    def test_departure_moves_only_the_children(self):
+        tree = RelayTree("alice", fanout=1, stream_kbps=1000)
+        for name in ["bob", "carol", "dave"]:
+            tree.place(name, 1000)
+        # alice -> bob -> carol -> dave; carol keeps dave when bob leaves
+        self.assertEqual(tree.remove("bob"), [("carol", "alice")])
+        self.assertEqual(tree.parent_of("dave"), "carol")
+        self.assertEqual(tree.remove("nobody"), [])
+
+    def test_asking_again_avoids_the_previous_relay(self):
+        tree = RelayTree("alice", fanout=2, stream_kbps=1000)
+        tree.place("bob", 2000)
+        tree.place("carol", 2000)
+        tree.place("dave")
+        previous = tree.parent_of("dave")
+        parent, _ = tree.place("dave")
+        self.assertNotEqual(parent, previous)
+
+
+@override_settings(**TEST_SETTINGS, CLASSROOM_RELAY_FANOUT=1, CLASSROOM_RELAY_STREAM_KBPS=1000)
+class RelaySignalingTest(ConsumerTestMixin, TestCase):
+    """Test cases for students relaying the teacher stream to each other"""
+
+    async def test_relay_negotiation_and_repair(self):
+        teacher = await self.connect("alice", is_teacher=True)
+        relay = await self.connect("bob")
+        viewer = await self.connect("carol")
+        for communicator in [teacher, relay, viewer]:
+            await self.drain(communicator)
+
+        await relay.send_json_to({"type": "request_stream", "upload_kbps": 1000})
+        self.assertEqual((await teacher.receive_json_from())["from_user"], "bob")
+        await self.drain(relay)
+
+        # carol reports no upload, so she goes below bob rather than to the teacher
+        await viewer.send_json_to({"type": "request_stream", "trace_id": "abcdef0123456789"})
+        self.assertEqual(await relay.receive_json_from(), {
+            "type": "relay_request", "from_user": "carol", "trace_id": "abcdef0123456789"
+        })
+        self.assertTrue(await teacher.receive_nothing(timeout=0.05))
+
+        sdp = json.dumps({"type": "offer", "sdp": "v=0"})
+        await relay.send_to(text_data='{"type":"offer","target_user":"carol"}\n' + sdp)
+        self.assertEqual(await viewer.receive_json_from(), {"type": "offer", "offer": sdp, "from_user": "bob"})
+        answer = json.dumps({"type": "answer", "sdp": "v=0"})
+        await viewer.send_to(text_data='{"type":"answer","target_user":"bob"}\n' + answer)
+        self.assertEqual(await relay.receive_json_from(), {"type": "answer", "answer": answer, "from_user": "carol"})
+        self.assertTrue(await teacher.receive_nothing(timeout=0.05))
+
+        # Students can't offer to students they were not asked to relay to
+        await viewer.send_to(text_data='{"type":"offer","target_user":"bob"}\n' + sdp)
+        self.assertTrue(await relay.receive_nothing(timeout=0.05))
+
+        # bob leaves: carol is handed to the teacher
+        await relay.disconnect()
+        requests = [m for m in await self.drain(teacher) if m["type"] == "student_requesting_stream"]
+        self.assertEqual([m["from_user"] for m in requests], ["carol"])
+
+        for communicator in [teacher, viewer]:
+            await communicator.disconnect()
+
+
+@override_settings(**TEST_SETTINGS)
+class LoadgenTest(ConsumerTestMixin, TestCase):
+    """Keeps the benchmark harness in step with the protocol"""
+
+    async def test_small_session(self):
+        results = await loadgen.run_scenario(
+            lambda room: loadgen.InProcessConnection(application, room),
+            students=5, chats=3, timeout=10
+        )
+        self.assertEqual(results["chat_deliveries"], 15)
+        self.assertGreater(results["msgs_per_sec"], 0)
+        self.assertIsNotNone(results["stream_setup_p95_ms"])
+
+    def test_compare_flags_regressions(self):
+        baseline = {"join_p95_ms": 10.0, "msgs_per_sec": 1000.0}
+        _, regressions = loadgen.compare({"join_p95_ms": 20.0, "msgs_per_sec": 950.0}, baseline, 0.3)
+        self.assertEqual(regressions, ["join_p95_ms"])
+        _, regressions = loadgen.compare({"join_p95_ms": 9.0, "msgs_per_sec": 500.0}, baseline, 0.3)
+        self.assertEqual(regressions, ["msgs_per_sec"])
@@ -0,0 +1,102 @@
+"""
+Stream setup tracing: how long until a student sees the teacher's video.
+
+Each negotiation gets a trace ID. The student picks one when it sends
+``request_stream`` (the server makes one up for clients that don't), and it
+travels with ``student_requesting_stream``, the teacher's offer, the
+student's answer and the ICE batches, so every relayed step can be matched
+up in logs.
+
+The teacher adds ``teacher_ms`` to its offer header: time spent in its
+browser between the request and sending the offer. Once video renders, the
+student sends one ``stream_trace`` frame with its own timings, in
+milliseconds since it sent ``request_stream``:
+
+    {"type": "stream_trace", "trace_id": "...", "teacher_ms": 40,
+     "marks": {"offer_received": 90, "answer_sent": 120, "connected": 600, "first_frame": 750}}
+
+Both clocks are browser-local, so no clock sync is needed. The report is
+split into stages and recorded in ``classroom_stream_setup_seconds``, per
+room and per worker.
+"""
+import math
+import re
+import uuid
+
+from . import metrics
+
+TRACE_ID = re.compile(r'^[0-9a-f]{8,32}$')
+
+MARKS = ('offer_received', 'answer_sent', 'connected', 'first_frame')
+
+# Traces a socket may have open at once; older ones are dropped unreported
+MAX_PENDING = 8
+
+# Reports claiming longer than this are discarded
+MAX_DURATION_MS = 10 * 60 * 1000
+
+stream_setup_seconds = metrics.Histogram(
+    'classroom_stream_setup_seconds',
+    'Stream setup time by stage: teacher (teacher browser), signaling (relay of request and offer), '
+    'answer (student browser), ice, first_frame (media after connect) and total.',
+    ['room', 'stage'],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 3.0, 5.0, 8.0, 13.0, 20.0, 30.0, 60.0),
+)
+
+
+def new_trace_id(requested=None):
+    """Use the client's trace ID if it is well formed, else make one up."""
+    if isinstance(requested, str) and TRACE_ID.match(requested):
+        return requested
+    return uuid.uuid4().hex[:16]
+
+
+def _duration_ms(value):
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return None
+    if not math.isfinite(value) or not 0 <= value <= MAX_DURATION_MS:
+        return None
+    return value
+
+
+def trace_fields(data):
+    """The trace fields of an inbound header that may be relayed onwards."""
+    fields = {}
+    trace_id = data.get('trace_id')
+    if isinstance(trace_id, str) and TRACE_ID.match(trace_id):
+        fields['trace_id'] = trace_id
+        teacher_ms = _duration_ms(data.get('teacher_ms'))
+        if teacher_ms is not None:
+            fields['teacher_ms'] = teacher_ms
+    return fields
+
+
+def stage_durations(report):
+    """
+    Split a student's ``stream_trace`` report into stage durations in
+    seconds. Raises ValueError if the marks are missing or out of order.
+    """
+    marks = report.get('marks') or {}
+    values = [_duration_ms(marks.get(name)) for name in MARKS]
+    if None in values or values != sorted(values):
+        raise ValueError("marks missing or out of order")
+    offer_received, answer_sent, connected, first_frame = values
+
+    stages = {}
+    teacher_ms = _duration_ms(report.get('teacher_ms'))
+    if teacher_ms is not None and teacher_ms <= offer_received:
+        stages['teacher'] = teacher_ms
+        stages['signaling'] = offer_received - teacher_ms
+    stages['answer'] = answer_sent - offer_received
+    stages['ice'] = connected - answer_sent
+    stages['first_frame'] = first_frame - connected
+    stages['total'] = first_frame
+    return {stage: ms / 1000 for stage, ms in stages.items()}
+
+
+def record(room_code, report):
+    durations = stage_durations(report)
+    room = metrics.room_label(room_code)
+    for stage, seconds in durations.items():
+        stream_setup_seconds.observe(seconds, room, stage)
+    return durations
@@ -2,7 +2,7 @@ from django.urls import path
 from django.contrib.auth import views as auth_views
 from .views import (
     classroom_chat, home, register, create_classroom, 
-    join_classroom, my_classrooms, end_classroom
+    join_classroom, my_classrooms, end_classroom, chat_history, participants, metrics_view, hls_access
 )
 
 urlpatterns = [
@@ -15,4 +15,8 @@ urlpatterns = [
     path('my-classrooms/', my_classrooms, name='my_classrooms'),
     path('classroom/<str:classroom_code>/', classroom_chat, name='classroom_chat'),
     path('classroom/<str:classroom_code>/end/', end_classroom, name='end_classroom'),
+    path('classroom/<str:classroom_code>/chat/', chat_history, name='chat_history'),
+    path('classroom/<str:classroom_code>/participants/', participants, name='participants'),
+    path('metrics', metrics_view, name='metrics'),
+    path('hls-access/', hls_access, name='hls_access'),
 ]
@@ -1,11 +1,16 @@
-from django.shortcuts import render, redirect, get_object_or_404
+from django.shortcuts import render, redirect, get_object_or_404, aget_object_or_404
+from django.conf import settings
 from django.contrib.auth import login, authenticate
 from django.contrib.auth.forms import UserCreationForm
 from django.contrib.auth.decorators import login_required
-from django.http import JsonResponse
+from django.http import HttpResponse, HttpResponseForbidden, JsonResponse
 from django.contrib import messages
 from django.utils import timezone
+from asgiref.sync import async_to_sync
 from .models import LiveClass, Course
+from . import binary, chat, hls, metrics, webinar
+from .rooms import get_room_store
+from .sfu import sfu_enabled
 from django.utils.crypto import get_random_string
 import uuid
 import string
@@ -45,7 +50,8 @@ def create_classroom(request):
             course=course,
             teacher=request.user,
             start_time=timezone.now(),
-            is_active=True
+            is_active=True,
+            webinar=request.POST.get('webinar') == 'on'
         )
         
         messages.success(request, f'Classroom created! Student code: {live_class.code}')
@@ -75,12 +81,24 @@ def classroom_chat(request, classroom_code):
     try:
         live_class = LiveClass.objects.get(code=classroom_code)
         is_teacher = request.user == live_class.teacher
+        hls_url = ''
+        if hls.hls_enabled():
+            # Students watch the live playlist; after the class, its last recording
+            if live_class.is_active:
+                hls_url = hls.playlist_url(live_class.code)
+            else:
+                hls_url = hls.latest_recording_url(live_class.code) or ''
         return render(request, 'classroom.html', {
             'room_name': live_class.title,
             'room_code': live_class.code,
             'user_id': request.user.id,
             'username': request.user.username,
-            'is_teacher': is_teacher
+            'is_teacher': is_teacher,
+            'sfu_enabled': sfu_enabled(),
+            'hls_url': hls_url,
+            'hls_recording': bool(hls_url) and not live_class.is_active,
+            'binary_frames': binary.tables(),
+            'webinar': live_class.webinar,
         })
     except LiveClass.DoesNotExist:
         # Handle case where classroom with the code does not exist
@@ -93,6 +111,7 @@ def end_classroom(request, classroom_code):
     live_class = get_object_or_404(LiveClass, code=classroom_code, teacher=request.user)
     live_class.is_active = False
     live_class.save()
+    async_to_sync(hls.end_live)(live_class.code)
     messages.success(request, f'The classroom "{live_class.title}" has been ended.')
     return redirect('my_classrooms')
 
@@ -102,6 +121,61 @@ def my_classrooms(request):
     classrooms = LiveClass.objects.filter(teacher=request.user).order_by('-start_time')
     return render(request, 'my_classrooms.html', {'classrooms': classrooms})
 
+@login_required
+def chat_history(request, classroom_code):
+    """Older chat messages, newest page first: ?before=<id from the last page>&limit=<n>&breakout=<name>"""
+    live_class = get_object_or_404(LiveClass, code=classroom_code)
+    try:
+        before = int(request.GET['before']) if request.GET.get('before') else None
+        limit = min(int(request.GET.get('limit', chat.DEFAULT_HISTORY_LENGTH)), chat.MAX_PAGE_SIZE)
+    except ValueError:
+        return JsonResponse({'error': 'before and limit must be integers'}, status=400)
+    if limit < 1:
+        return JsonResponse({'error': 'limit must be positive'}, status=400)
+    messages, next_before = chat.history_page(live_class, before, limit, request.GET.get('breakout', ''))
+    return JsonResponse({
+        'messages': [chat.serialize(message) for message in messages],
+        'before': next_before,
+    })
+
+@login_required
+async def participants(request, classroom_code):
+    """One page of the room's participants by name: ?search=<text>&after=<next from the last page>&limit=<n>"""
+    live_class = await aget_object_or_404(LiveClass, code=classroom_code)
+    try:
+        limit = int(request.GET['limit']) if request.GET.get('limit') else None
+        search, after, limit = webinar.parse_query(request.GET.get('search'), request.GET.get('after'), limit)
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    students, next_after, total = webinar.page(
+        await get_room_store().list_students(live_class.code), search, after, limit
+    )
+    return JsonResponse({
+        'students': [{'username': s['username'], 'permissions': s['permissions']} for s in students],
+        'next': next_after,
+        'total': total,
+    })
+
+def hls_access(request):
+    """
+    nginx's auth_request for files under /hls/: signed-in users may watch a
+    class they could open. 2xx lets nginx serve the file, 401/403 refuse it.
+    """
+    if not request.user.is_authenticated:
+        return HttpResponse(status=401)
+    room_code = hls.room_for_uri(request.headers.get('X-Original-URI', ''))
+    if room_code is None or not LiveClass.objects.filter(code=room_code).exists():
+        return HttpResponseForbidden()
+    return HttpResponse()
+
+async def metrics_view(request):
+    """Prometheus scrape endpoint for this worker."""
+    # Async so it reads the counters on the event loop the consumers update them from
+    token = getattr(settings, 'CLASSROOM_METRICS_TOKEN', None)
+    if token and request.headers.get('Authorization') != f'Bearer {token}':
+        return HttpResponseForbidden()
+    return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
 def generate_student_code():
     """Generate a unique 6-character student code"""
     while True:
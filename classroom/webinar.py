@@ -0,0 +1,233 @@
+"""
+Webinar mode: participant counts for students, the roster for the teacher.
+
+Every socket in a room used to follow the full roster, a snapshot on join
+and a batch of deltas for every join, leave and permission change. In a
+large lecture only the teacher needs that. For a ``LiveClass`` with
+``webinar`` set:
+
+- Roster batches (coalescer.py) go to the teacher's socket only. Students
+  are still told when the teacher leaves.
+- Students in the main room get a ``participant_count`` frame instead of
+  the snapshot, and after that at most one every
+  ``CLASSROOM_PARTICIPANT_COUNT_INTERVAL`` seconds (default 1) while
+  students come and go. Workers that saw a change take turns through a
+  token bucket in the room store, so the limit holds across workers; the
+  one whose turn it is publishes the store's count.
+- The participant panel asks for what it shows: ``participant_query``
+  (``search``, ``after``, ``limit``) over the socket is answered with a
+  ``participant_page``; ``GET /classroom/<code>/participants/`` returns the
+  same page as JSON. Pages are sorted by name and ``next`` is the cursor
+  for the following one.
+- The flag is read from the database by the first join after the room is
+  created in the store, then from the store. Saving a ``LiveClass`` whose
+  ``webinar`` changed updates the store and switches the class's sockets
+  over with a ``webinar`` frame; other saves, such as ending the class,
+  don't touch the store.
+
+Breakouts keep their own rosters, see breakouts.py.
+"""
+import asyncio
+import logging
+
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db.models.signals import post_init, post_save
+
+from . import breakouts
+from .bus import room_broadcast
+from .encoding import dumps
+from .models import LiveClass
+from .resume import encode_room_frame
+from .rooms import get_room_store
+from .sharding import channel_layer_alias_for_room
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_COUNT_INTERVAL = 1.0
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+# Store bucket the rooms' workers take turns sending the count through
+COUNT_BUCKET = 'participant_count'
+
+_counters = {}
+_loading = {}  # room code -> this worker's task reading the flag
+
+
+async def is_webinar(room_code):
+    """Whether the room's class is a webinar, from the room store once it was read."""
+    rooms = get_room_store()
+    webinar = await rooms.get_webinar(room_code)
+    if webinar is not None:
+        return webinar
+    # Joins arriving together share one query
+    loop = asyncio.get_running_loop()
+    task = _loading.get(room_code)
+    if task is None or task.get_loop() is not loop:
+        task = _loading[room_code] = loop.create_task(_load(rooms, room_code))
+    try:
+        return await asyncio.shield(task)
+    except Exception as e:
+        # The join goes on as a regular class; the flag is not kept, so the next join reads it again
+        logger.error(f"Could not read the webinar flag of room {room_code}: {e}", exc_info=True)
+        return False
+    finally:
+        if task.done() and _loading.get(room_code) is task:
+            del _loading[room_code]
+
+
+async def _load(rooms, room_code):
+    webinar = await database_sync_to_async(_is_webinar)(room_code)
+    return await rooms.load_webinar(room_code, webinar)
+
+
+def _is_webinar(room_code):
+    return LiveClass.objects.filter(code=room_code, webinar=True).exists()
+
+
+async def webinar_changed(room_code, webinar):
+    """Switch a running class over after ``LiveClass.webinar`` was changed."""
+    rooms = get_room_store()
+    if await rooms.get_webinar(room_code) in (None, webinar):
+        # Not running here, or nothing changed
+        return
+    await rooms.set_webinar(room_code, webinar)
+    channel_layer = get_channel_layer(channel_layer_alias_for_room(room_code))
+    for breakout in [None, *set((await rooms.get_breakouts(room_code)).values())]:
+        await room_broadcast(channel_layer, breakouts.group_name(room_code, breakout), {
+            'type': 'webinar_changed_broadcast',
+            'webinar': webinar,
+        })
+
+
+def _live_class_loaded(sender, instance, **kwargs):
+    # The flag as read from the row; deferred, it is left unknown
+    instance._saved_webinar = instance.__dict__.get('webinar')
+
+
+def _live_class_saved(sender, instance, created, update_fields=None, **kwargs):
+    if update_fields is not None and 'webinar' not in update_fields:
+        return
+    saved, instance._saved_webinar = getattr(instance, '_saved_webinar', None), instance.webinar
+    if created or instance.webinar == saved:
+        return
+    try:
+        async_to_sync(webinar_changed)(instance.code, instance.webinar)
+    except Exception as e:
+        logger.error(f"Error switching room {instance.code} to webinar={instance.webinar}: {e}", exc_info=True)
+
+
+post_init.connect(_live_class_loaded, sender=LiveClass)
+post_save.connect(_live_class_saved, sender=LiveClass)
+
+
+def parse_query(search=None, after=None, limit=None):
+    """Check a participant query's fields. Returns ``(search, after, limit)``; raises ValueError."""
+    if search is None:
+        search = ''
+    if limit is None:
+        limit = DEFAULT_PAGE_SIZE
+    if not isinstance(search, str) or not (after is None or isinstance(after, str)):
+        raise ValueError("search and after must be strings")
+    if isinstance(limit, bool) or not isinstance(limit, int) or not 1 <= limit <= MAX_PAGE_SIZE:
+        raise ValueError(f"limit must be between 1 and {MAX_PAGE_SIZE}")
+    return search, after, limit
+
+
+def page(students, search='', after=None, limit=DEFAULT_PAGE_SIZE):
+    """
+    Up to ``limit`` students whose name contains ``search``, by name, after
+    the name ``after``. Returns ``(students, next cursor or None, total matching)``.
+    """
+    search = search.casefold()
+    matching = sorted(
+        (student for student in students if search in student['username'].casefold()),
+        key=lambda student: student['username'],
+    )
+    total = len(matching)
+    if after is not None:
+        matching = [student for student in matching if student['username'] > after]
+    more = len(matching) > limit
+    matching = matching[:limit]
+    return matching, matching[-1]['username'] if more else None, total
+
+
+class ParticipantCounter:
+    """
+    This worker's changes to one room's participant count, sent to its group
+    when the room's turn comes up, at most once per interval across workers.
+    """
+
+    def __init__(self, channel_layer, group_name, room_code, interval):
+        self.channel_layer = channel_layer
+        self.group_name = group_name
+        self.room_code = room_code
+        self.interval = interval
+        self.loop = asyncio.get_running_loop()
+        self.changed = False
+        self._task = None
+
+    def touch(self):
+        self.changed = True
+        if self._task is None:
+            self._task = self.loop.create_task(self._run())
+
+    async def _run(self):
+        # The first change goes out at once; changes while waiting share the next turn
+        try:
+            while self.changed:
+                wait = await self.take_turn()
+                if wait:
+                    await asyncio.sleep(wait)
+                    continue
+                self.changed = False
+                await self.send()
+        finally:
+            self._task = None
+            if _counters.get(self.group_name) is self:
+                del _counters[self.group_name]
+
+    async def take_turn(self):
+        """0 if this worker may send the count now, else seconds until the room's next turn."""
+        if self.interval <= 0:
+            return 0
+        try:
+            return await get_room_store().take_token(self.room_code, COUNT_BUCKET, 1 / self.interval, 1)
+        except Exception as e:
+            logger.error(f"Error taking a participant count turn for room {self.room_code}: {e}", exc_info=True)
+            return self.interval
+
+    async def send(self):
+        try:
+            count = await get_room_store().count_students(self.room_code)
+            await room_broadcast(self.channel_layer, self.group_name, {
+                'type': 'participant_count_broadcast',
+                'text': await encode_room_frame(self.room_code, {'type': 'participant_count', 'count': count}),
+            })
+        except Exception as e:
+            logger.error(f"Error sending the participant count for room {self.room_code}: {e}", exc_info=True)
+
+
+def count_frame(count):
+    return dumps({'type': 'participant_count', 'count': count})
+
+
+def mode_frame(webinar):
+    return dumps({'type': 'webinar', 'status': webinar})
+
+
+def get_counter(channel_layer, group_name, room_code):
+    """Return this worker's participant counter for a room group, creating it if needed."""
+    counter = _counters.get(group_name)
+    if counter is None or counter.loop is not asyncio.get_running_loop():
+        counter = ParticipantCounter(
+            channel_layer,
+            group_name,
+            room_code,
+            interval=getattr(settings, 'CLASSROOM_PARTICIPANT_COUNT_INTERVAL', DEFAULT_COUNT_INTERVAL),
+        )
+        _counters[group_name] = counter
+    return counter
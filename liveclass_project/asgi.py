@@ -2,12 +2,16 @@ import os
 from channels.routing import ProtocolTypeRouter, URLRouter
 from django.core.asgi import get_asgi_application
 from channels.auth import AuthMiddlewareStack
-import classroom.routing
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'liveclass_project.settings')
 
+# Set up Django before importing consumers, so daphne can load this module directly
+django_asgi_app = get_asgi_application()
+
+import classroom.routing  # noqa: E402
+
 application = ProtocolTypeRouter({
-    "http": get_asgi_application(),
+    "http": django_asgi_app,
     "websocket": AuthMiddlewareStack(
         URLRouter(
             classroom.routing.websocket_urlpatterns
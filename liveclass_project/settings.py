@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.2/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -72,16 +73,171 @@ TEMPLATES = [
 
 ASGI_APPLICATION = 'liveclass_project.asgi.application'
 
-# Redis channel layer
+# Redis channel layer. Targeted sends between consumers in the same process
+# skip Redis (see classroom/layers.py).
+REDIS_HOST = os.environ.get('REDIS_HOST', '127.0.0.1')
+REDIS_PORT = int(os.environ.get('REDIS_PORT', 6379))
+
 CHANNEL_LAYERS = {
     "default": {
-        "BACKEND": "channels_redis.core.RedisChannelLayer",
+        "BACKEND": "classroom.layers.HybridRedisChannelLayer",
         "CONFIG": {
-            "hosts": [("127.0.0.1", 6379)],
+            "hosts": [(REDIS_HOST, REDIS_PORT)],
         },
     },
 }
 
+# Optional room sharding over several Redis instances, e.g.
+# REDIS_SHARDS="redis-shard-0:6379,redis-shard-1:6379". Each room's group and
+# its members' channels live on one shard, chosen by consistent hashing of the
+# room code (see classroom/sharding.py). Only append shards to keep the mapping stable.
+# Only channel layer traffic is sharded: the room store and CLASSROOM_PUBSUB's
+# bus stay on REDIS_HOST.
+REDIS_SHARDS = [
+    (host, int(port))
+    for host, port in (
+        shard.strip().rsplit(':', 1)
+        for shard in os.environ.get('REDIS_SHARDS', '').split(',') if shard.strip()
+    )
+]
+for index, shard in enumerate(REDIS_SHARDS):
+    CHANNEL_LAYERS[f"shard-{index}"] = {
+        "BACKEND": "classroom.layers.HybridRedisChannelLayer",
+        "CONFIG": {
+            "hosts": [shard],
+        },
+    }
+CLASSROOM_CHANNEL_LAYER_SHARDS = [f"shard-{index}" for index in range(len(REDIS_SHARDS))]
+
+# Room state is kept in memory, which needs every socket of a room on one
+# process. With CLASSROOM_REDIS_ROOM_STORE=1 it is shared by all daphne workers
+# through the default channel layer's Redis (see classroom/rooms.py). The Redis
+# store's tests only run against a live Redis:
+# docker compose --profile test run --rm test
+if os.environ.get('CLASSROOM_REDIS_ROOM_STORE') == '1':
+    CLASSROOM_ROOM_STORE = {"BACKEND": "classroom.rooms.RedisRoomStore"}
+
+# A Redis room's keys expire this many seconds after its last join, heartbeat
+# sweep or event, in case every worker hosting it went away.
+CLASSROOM_ROOM_KEY_TTL = 24 * 3600
+
+# Room-wide broadcasts for very large rooms: one Redis PUBLISH per event that
+# each worker fans out to its own sockets, instead of one copy per member
+# (see classroom/bus.py). Enable with CLASSROOM_PUBSUB=1.
+if os.environ.get('CLASSROOM_PUBSUB') == '1':
+    CLASSROOM_BROADCAST_BUS = {
+        "BACKEND": "classroom.bus.RedisPubSubBus",
+        "CONFIG": {
+            "hosts": [(REDIS_HOST, REDIS_PORT)],
+        },
+    }
+
+# Roster changes and leave notices are merged per room for up to WINDOW
+# seconds (sliding), never delaying a change by more than MAX_DELAY seconds.
+CLASSROOM_BROADCAST_WINDOW = 0.1
+CLASSROOM_BROADCAST_MAX_DELAY = 0.25
+
+# Trickle ICE candidates are relayed in batches per peer pair after this
+# many seconds (an end-of-candidates marker flushes immediately).
+CLASSROOM_ICE_BATCH_WINDOW = 0.01
+
+# Chat is saved in batches of up to FLUSH_SIZE messages, at most
+# FLUSH_INTERVAL seconds after the first; joining sockets are sent the last
+# HISTORY_LENGTH messages (see classroom/chat.py). A socket with SHED_BACKLOG
+# channel layer events waiting skips chat broadcasts until it catches up, so
+# signaling isn't stuck behind them; 0 never skips.
+CLASSROOM_CHAT_FLUSH_SIZE = 100
+CLASSROOM_CHAT_FLUSH_INTERVAL = 0.5
+CLASSROOM_CHAT_HISTORY_LENGTH = 50
+CLASSROOM_CHAT_SHED_BACKLOG = 50
+
+# A student whose socket drops keeps their seat for RESUME_GRACE seconds; the
+# page reconnects and replays the room events it missed from the last
+# RESUME_BUFFER_SIZE kept per room (see classroom/resume.py). 0 disables it.
+CLASSROOM_RESUME_GRACE = 10
+CLASSROOM_RESUME_BUFFER_SIZE = 200
+
+# Each worker sends a heartbeat to its sockets every HEARTBEAT_INTERVAL
+# seconds and closes those silent for HEARTBEAT_TIMEOUT. Rooms left empty,
+# or whose class was ended, are dropped from the room store after ROOM_TTL
+# seconds (see classroom/reaper.py). An interval of 0 disables this.
+CLASSROOM_HEARTBEAT_INTERVAL = 25
+CLASSROOM_HEARTBEAT_TIMEOUT = 60
+CLASSROOM_ROOM_TTL = 300
+
+# Stream requests are passed to the teacher's browser this many at a time;
+# a slot is freed by the student's answer, a reported failure or the timeout
+# (seconds). Queued students get their position at most every UPDATE_INTERVAL
+# seconds. See classroom/admission.py; a limit of 0 disables the queue.
+CLASSROOM_STREAM_ADMISSION_LIMIT = 4
+CLASSROOM_STREAM_NEGOTIATION_TIMEOUT = 15
+CLASSROOM_STREAM_QUEUE_UPDATE_INTERVAL = 1.0
+
+# Largest inbound WebSocket frame accepted per message type, in characters.
+# Checked before the frame is parsed; see classroom/framing.py for defaults.
+CLASSROOM_MAX_FRAME_SIZES = {
+    'default': 16 * 1024,
+    'offer': 64 * 1024,
+    'answer': 64 * 1024,
+    'student_offer': 64 * 1024,
+    'student_answer': 64 * 1024,
+    'chat_message': 4 * 1024,
+}
+
+# Pages get MessagePack frames with numeric type codes and interned usernames
+# instead of JSON when msgpack is installed (see classroom/binary.py); frame
+# size limits above apply to the binary frames in bytes. Broadcasts travel as
+# JSON text and each worker packs them once for its binary sockets. Off by
+# default until pages are known to speak it.
+CLASSROOM_BINARY_FRAMES = False
+
+# Token buckets on inbound frames per message type, as (frames per second,
+# burst) per connection and per room; types not listed use 'default' and a
+# type mapped to {} is not limited. See classroom/ratelimit.py for defaults.
+# RATE_LIMIT_SHARED keeps the room buckets in the room store, across workers.
+# CLASSROOM_RATE_LIMITS = {
+#     'chat_message': {'connection': (2, 10), 'room': (30, 300)},
+# }
+CLASSROOM_RATE_LIMIT_SHARED = False
+
+# Student permission changes are saved to the database at most
+# PERMISSION_FLUSH_INTERVAL seconds later, in one batch per room; joins read
+# the room store's copy (see classroom/permissions.py).
+CLASSROOM_PERMISSION_FLUSH_INTERVAL = 0.5
+
+# In webinar classes (LiveClass.webinar) students get the participant count at
+# most every PARTICIPANT_COUNT_INTERVAL seconds instead of the roster, and
+# page through participants on demand. See classroom/webinar.py.
+CLASSROOM_PARTICIPANT_COUNT_INTERVAL = 1.0
+
+# /metrics serves Prometheus metrics for the worker that answers. Set
+# METRICS_TOKEN to require "Authorization: Bearer <token>" on scrapes.
+CLASSROOM_METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+
+# With CLASSROOM_SFU=1 the teacher uploads one stream to the server, which
+# forwards it to every student (see classroom/sfu.py; needs aiortc). Students
+# must be able to reach this host over UDP; SFU_ICE_SERVERS lists STUN/TURN
+# URLs for the server's own side, comma-separated.
+CLASSROOM_SFU_ENABLED = os.environ.get('CLASSROOM_SFU') == '1'
+CLASSROOM_SFU_ICE_SERVERS = [url for url in os.environ.get('SFU_ICE_SERVERS', '').split(',') if url]
+
+# Without an SFU, CLASSROOM_RELAY_FANOUT=K arranges students into a relay
+# tree: the teacher sends to K students, each of which passes the stream on
+# to up to K more, as far as its reported upload allows at STREAM_KBPS per
+# copy (see classroom/relay.py). 0 disables relaying.
+CLASSROOM_RELAY_FANOUT = int(os.environ.get('CLASSROOM_RELAY_FANOUT', 0))
+CLASSROOM_RELAY_STREAM_KBPS = 1500
+
+# With CLASSROOM_HLS=1 (and the SFU) the server also writes the teacher stream
+# as HLS segments under CLASSROOM_HLS_ROOT, served by nginx at /hls/, and
+# students watch that instead of opening a WebRTC connection (see
+# classroom/hls.py). Each session is also kept as a recording, removed
+# RECORDING_DAYS after it was last written (0 keeps them all).
+CLASSROOM_HLS_ENABLED = os.environ.get('CLASSROOM_HLS') == '1' and CLASSROOM_SFU_ENABLED
+CLASSROOM_HLS_ROOT = BASE_DIR / 'hls'
+CLASSROOM_HLS_URL = '/hls/'
+CLASSROOM_HLS_RECORDING_DAYS = 30
+
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
 